@@ -1,14 +1,16 @@
 import streamlit as st
 import os
-from dotenv import load_dotenv
-from src.pipeline_orchestrator import PipelineOrchestrator
+from src import metrics
+from src.bootstrap import bootstrap
+from src.job_queue import JobQueue, get_worker_orchestrator
+from src.pipeline_orchestrator import RegenerationError
+from src.warmup import Warmup, sample_queries
 import json
 from datetime import datetime
-import streamlit_markmap as st_markmap
 import time
 
-# 環境変数の読み込み
-load_dotenv()
+# 環境変数の読み込みとログ設定
+bootstrap()
 
 # ページ設定
 st.set_page_config(
@@ -18,10 +20,43 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+@st.cache_resource
+def get_job_queue():
+    """全セッションで共有するジョブキュー（ワーカー数は環境変数JOB_WORKERSで設定）"""
+    return JobQueue()
+
+def get_orchestrator():
+    """ワーカーと共有するオーケストレーター（レポートキャッシュも共有される）"""
+    return get_worker_orchestrator()
+
+@st.cache_resource
+def start_warmup():
+    """サーバー起動時に1回だけ、サンプルクエリと最近よく使われたクエリのレポートをバックグラウンドで生成しておく"""
+    job_queue = get_job_queue()
+    warmup = Warmup(get_worker_orchestrator,
+                    is_busy=lambda: job_queue.queue_depth() > 0,
+                    recent_queries=job_queue.store.frequent_queries)
+    warmup.start()
+    return warmup
+
+start_warmup()
+
+@st.cache_resource
+def start_metrics_server():
+    """サーバー起動時に1回だけ、Prometheus がスクレイプする /metrics を別ポートで公開する"""
+    return metrics.start_server()
+
+start_metrics_server()
+
 # セッション状態の初期化
 if 'reports' not in st.session_state:
     st.session_state.reports = []
 
+if 'pending_jobs' not in st.session_state:
+    # ブラウザをリロードしても、URLに残したジョブIDから追跡を再開する
+    job_ids = [j for j in st.query_params.get("jobs", "").split(",") if j]
+    st.session_state.pending_jobs = {job_id: {} for job_id in job_ids}
+
 def main():
     """Lawsyの設計を参考にしたStreamlitアプリケーションのメイン関数"""
     
@@ -51,7 +86,8 @@ def main():
         search_mode = st.selectbox(
             "検索モード",
             ["自動", "教育特化", "一般検索", "詳細検索"],
-            help="検索戦略を選択してください"
+            help="自動: クエリの種類に合わせて検索 / 教育特化: 英語教育関連ドメインのみ / "
+                 "一般検索: 一般検索のみで速く概要をまとめる / 詳細検索: トピックごとに詳しく検索"
         )
         
         st.markdown("---")
@@ -115,37 +151,41 @@ def new_report_tab(search_mode="自動"):
         st.markdown("### 🎯 クエリタイプ")
         query_type = st.selectbox(
             "クエリの種類",
-            ["文法解説", "語彙学習", "読解指導", "リスニング", "ライティング", "その他"],
-            help="クエリの種類を選択すると、より適切な検索戦略が適用されます"
+            ["自動判定", "文法解説", "語彙学習", "読解指導", "リスニング", "ライティング", "その他"],
+            help="種類ごとに検索の範囲とステージが変わります。文法解説・語彙学習は軽い構成で速く生成します。"
+                 "「自動判定」ではクエリから判定します"
         )
         
         st.markdown("### 🔍 検索戦略")
         st.info(f"**選択されたモード:** {search_mode}")
+        
+        time_budget = st.number_input(
+            "時間予算（秒）",
+            min_value=0,
+            max_value=600,
+            value=0,
+            step=10,
+            help="0は無制限。指定すると検索数などを予算に合わせて調整し、間に合わない処理は打ち切ります"
+        )
+        
+        use_cache = not st.checkbox(
+            "キャッシュを使わず再生成",
+            value=False,
+            help="類似クエリのレポートがキャッシュにあっても、パイプラインを最初から実行します"
+        )
     
     # サンプルクエリ
     col1, col2 = st.columns([1, 1])
     
     with col1:
-        if st.button("🎲 サンプルクエリ", type="secondary"):
-            sample_queries = [
-                "英語の比較級と最上級の使い方を教えて",
-                "現在完了形と過去形の違いを説明して",
-                "英語の前置詞の使い方をまとめて",
-                "英語の仮定法の使い方を教えて",
-                "英語の受動態の作り方を説明して"
-            ]
-            st.session_state.sample_query = sample_queries[0]
+        general_queries = sample_queries('general')
+        if st.button("🎲 サンプルクエリ", type="secondary") and general_queries:
+            st.session_state.sample_query = general_queries[0]
             st.rerun()
     
     with col2:
-        if st.button("📚 教育特化クエリ", type="secondary"):
-            education_queries = [
-                "学習指導要領に基づく英語教育の指導法",
-                "第二言語習得論における英語学習の理論",
-                "応用言語学の観点からの英語教育",
-                "英語教授法の最新トレンド",
-                "英語教材研究の方法論"
-            ]
+        education_queries = sample_queries('education')
+        if st.button("📚 教育特化クエリ", type="secondary") and education_queries:
             st.session_state.sample_query = education_queries[0]
             st.rerun()
     
@@ -154,109 +194,117 @@ def new_report_tab(search_mode="自動"):
         st.info(f"💡 サンプルクエリ: {st.session_state.sample_query}")
         query = st.session_state.sample_query
     
-    # レポート生成
+    # レポート生成（ジョブキューに登録し、実行はバックグラウンドのワーカーに任せる）
     if st.button("🚀 Lawsy-inspired レポート生成", type="primary") and query:
         if not os.getenv("OPENAI_API_KEY"):
             st.error("❌ OpenAI APIキーが設定されていません")
             return
         
-        # プログレス表示の改善
-        progress_container = st.container()
-        status_container = st.container()
-        metrics_container = st.container()
-        
-        with progress_container:
-            progress_bar = st.progress(0)
-        
-        with status_container:
-            status_text = st.empty()
-        
-        with metrics_container:
-            col1, col2, col3, col4 = st.columns(4)
-            with col1:
-                education_metric = st.metric("教育ドメイン検索", "0")
-            with col2:
-                general_metric = st.metric("一般検索", "0")
-            with col3:
-                detailed_metric = st.metric("詳細検索", "0")
-            with col4:
-                time_metric = st.metric("処理時間", "0s")
-        
         try:
-            # パイプラインの実行
-            orchestrator = PipelineOrchestrator()
-            
-            # Lawsyの設計に基づくステップ実行
-            steps = [
-                ("クエリ洗練", "Web検索用にクエリを最適化中..."),
-                ("教育ドメイン検索", "英語教育関連サイトを検索中..."),
-                ("一般Web検索", "一般的なWeb情報を収集中..."),
-                ("クエリ展開", "詳細なリサーチトピックを生成中..."),
-                ("詳細検索", "各トピックを詳細に検索中..."),
-                ("情報統合", "検索結果を統合中..."),
-                ("アウトライン生成", "包括的なアウトラインを作成中..."),
-                ("レポート執筆", "リード文、本文、関連事項、結論を執筆中..."),
-                ("マインドマップ生成", "構造化されたマインドマップを生成中...")
-            ]
-            
-            start_time = time.time()
-            
-            for i, (step_name, step_desc) in enumerate(steps):
-                progress = (i + 1) / len(steps)
-                status_text.text(f"ステップ {i+1}/{len(steps)}: {step_desc}")
-                progress_bar.progress(progress)
-                time.sleep(0.5)  # 視覚的な進行表示
-            
-            # 実際のパイプライン実行
-            result = orchestrator.run(query)
-            
-            # メトリクスの更新
-            if 'search_stats' in result:
-                stats = result['search_stats']
-                education_metric.metric("教育ドメイン検索", stats.get('education_results', 0))
-                general_metric.metric("一般検索", stats.get('general_results', 0))
-                detailed_metric.metric("詳細検索", stats.get('detailed_results', 0))
-                time_metric.metric("処理時間", f"{result.get('processing_time', 0):.1f}s")
-            
-            status_text.text("✅ Lawsy-inspired レポート生成完了！")
-            
-            # レポートの保存
-            report_data = {
-                'title': query[:50] + "..." if len(query) > 50 else query,
-                'query': query,
-                'report': result['report'],
-                'mindmap': result['mindmap'],
-                'timestamp': datetime.now().isoformat(),
-                'id': len(st.session_state.reports),
-                'search_stats': result.get('search_stats', {}),
-                'processing_time': result.get('processing_time', 0),
-                'query_type': query_type
-            }
-            
-            st.session_state.reports.append(report_data)
-            st.session_state.current_report = report_data
-            
-            # レポートの表示
-            display_report(report_data)
-            
+            options = {'use_cache': use_cache, 'query_type': query_type, 'search_mode': search_mode}
+            if time_budget:
+                options['deadline'] = float(time_budget)
+            job_id = get_job_queue().submit(query, **options)
+            st.session_state.pending_jobs[job_id] = {'query_type': query_type}
+            st.query_params["jobs"] = ",".join(st.session_state.pending_jobs)
+            st.success(f"📨 ジョブを登録しました (ID: {job_id[:8]})")
         except Exception as e:
-            st.error(f"❌ エラーが発生しました: {str(e)}")
+            st.error(f"❌ ジョブの登録に失敗しました: {str(e)}")
             st.exception(e)
+    
+    # 実行中のジョブの状態表示
+    if st.session_state.pending_jobs:
+        job_status_panel()
+    
+    # 直近に完了したレポートの表示
+    if st.session_state.get('current_report'):
+        display_report(st.session_state.current_report)
+
+@st.fragment(run_every="3s")
+def job_status_panel():
+    """登録済みジョブの状態をポーリングして表示し、完了したものを履歴へ移す"""
+    job_queue = get_job_queue()
+    completed = False
+    
+    st.markdown("### ⏳ 実行中のジョブ")
+    st.caption(f"キュー内のジョブ数: {job_queue.queue_depth()} / 同時実行数: {job_queue.max_workers}")
+    
+    for job_id, meta in list(st.session_state.pending_jobs.items()):
+        job = job_queue.get(job_id)
+        if job is None:
+            del st.session_state.pending_jobs[job_id]
+            continue
+        
+        if job['status'] == "done":
+            report_data = build_report_data(job, meta.get('query_type', 'その他'))
+            st.session_state.reports.append(report_data)
+            st.session_state.current_report = report_data
+            del st.session_state.pending_jobs[job_id]
+            completed = True
+        elif job['status'] == "failed":
+            st.error(f"❌ {job['query'][:30]}: {job['error']}")
+            del st.session_state.pending_jobs[job_id]
+        else:
+            elapsed = time.time() - (job['started_at'] or job['created_at'])
+            label = "実行中" if job['status'] == "running" else "待機中"
+            stage = f" - {job['progress']['stage']}" if job['progress'] else ""
+            st.info(f"🔄 {label}{stage}: {job['query'][:30]} ({elapsed:.0f}s)")
+    
+    st.query_params["jobs"] = ",".join(st.session_state.pending_jobs)
+    if completed:
+        st.rerun(scope="app")
+
+def build_report_data(job, query_type):
+    """完了したジョブから履歴用のレポートデータを組み立てる"""
+    result = job['result']
+    query = job['query']
+    return {
+        'title': query[:50] + "..." if len(query) > 50 else query,
+        'query': query,
+        'refined_query': result.get('refined_query', query),
+        'report': result['report'],
+        'mindmap': result['mindmap'],
+        'timestamp': datetime.fromtimestamp(job['finished_at']).isoformat(),
+        'id': len(st.session_state.reports),
+        'job_id': job['id'],
+        'search_stats': result.get('search_stats', {}),
+        'processing_time': result.get('processing_time', 0),
+        # 自動判定の場合は判定された種類
+        'query_type': result.get('routing', {}).get('query_type') or query_type,
+        'routing': result.get('routing', {}),
+        # 一部だけを作り直すときに再利用する中間成果物
+        'artifacts': result.get('artifacts', {}),
+        'cache': result.get('cache', {}),
+        'stage_timings': result.get('stage_timings', {}),
+        'llm_metrics': result.get('llm_metrics', {})
+    }
 
 def history_tab():
     """レポート履歴タブ"""
     st.subheader("📊 レポート履歴")
     
-    if not st.session_state.reports:
+    if st.session_state.reports:
+        # レポート一覧の表示
+        for i, report in enumerate(st.session_state.reports):
+            with st.expander(f"📄 {report['title']} - {report['timestamp'][:19]}"):
+                st.markdown(f"**クエリ:** {report['query']}")
+                st.markdown("---")
+                st.markdown(report['report'])
+    else:
         st.info("📝 まだレポートがありません。新規レポートタブでレポートを生成してください。")
-        return
     
-    # レポート一覧の表示
-    for i, report in enumerate(st.session_state.reports):
-        with st.expander(f"📄 {report['title']} - {report['timestamp'][:19]}"):
-            st.markdown(f"**クエリ:** {report['query']}")
-            st.markdown("---")
-            st.markdown(report['report'])
+    # ジョブストアに保存された完了済みレポート（リロードや別セッションの分も含む）
+    session_job_ids = {r.get('job_id') for r in st.session_state.reports}
+    stored_jobs = [j for j in get_job_queue().list_jobs(statuses=["done"], limit=20) if j['id'] not in session_job_ids]
+    if stored_jobs:
+        st.markdown("### 🗄️ 保存済みレポート")
+        for job in stored_jobs:
+            finished = datetime.fromtimestamp(job['finished_at']).isoformat()[:19]
+            with st.expander(f"📄 {job['query'][:50]} - {finished}"):
+                if st.button("📋 履歴に追加", key=f"restore_{job['id']}"):
+                    st.session_state.reports.append(build_report_data(job, job['options'].get('query_type', 'その他')))
+                    st.rerun()
+                st.markdown(job['result']['report'])
 
 def mindmap_tab():
     """マインドマップタブ"""
@@ -276,7 +324,7 @@ def mindmap_tab():
         mindmap_content = create_markmap_content(latest_report['mindmap'])
         
         # Streamlit Markmapで表示
-        st_markmap.markmap(mindmap_content, height=600)
+        show_markmap(mindmap_content, height=600)
         
         # ダウンロードボタン
         st.download_button(
@@ -288,6 +336,11 @@ def mindmap_tab():
     else:
         st.warning("⚠️ このレポートにはマインドマップが含まれていません")
 
+def show_markmap(mindmap_content, height):
+    """Markmapを表示する（streamlit_markmapはマインドマップを表示するときに初めて読み込む）"""
+    import streamlit_markmap as st_markmap
+    st_markmap.markmap(mindmap_content, height=height)
+
 def create_markmap_content(mindmap_data):
     """マインドマップデータをMarkmap形式に変換"""
     def _convert_node(node):
@@ -362,6 +415,27 @@ def analytics_tab():
         }
         st.bar_chart(search_data)
     
+    # 検索モードごとの検索数と検索時間（キャッシュから返したレポートは除く）
+    search_modes = {}
+    for report in st.session_state.reports:
+        stats = report.get('search_stats', {})
+        if report.get('cache', {}).get('hit') or 'search_mode' not in stats:
+            continue
+        mode = search_modes.setdefault(stats['search_mode'], {'レポート数': 0, '検索数': 0, '検索時間': 0.0})
+        mode['レポート数'] += 1
+        mode['検索数'] += stats.get('search_count', 0)
+        mode['検索時間'] += stats.get('search_time', 0.0)
+    if search_modes:
+        st.subheader("⏱️ 検索モード別の検索数と時間")
+        st.table({
+            name: {
+                'レポート数': mode['レポート数'],
+                '平均検索数': round(mode['検索数'] / mode['レポート数'], 1),
+                '平均検索時間（秒）': round(mode['検索時間'] / mode['レポート数'], 1),
+            }
+            for name, mode in search_modes.items()
+        })
+    
     # 詳細分析
     st.subheader("📋 詳細分析")
     
@@ -375,6 +449,10 @@ def analytics_tab():
             st.markdown("### 🎯 最新レポート情報")
             st.write(f"**クエリ:** {latest_report['query']}")
             st.write(f"**クエリタイプ:** {latest_report.get('query_type', '不明')}")
+            routing = latest_report.get('routing') or {}
+            if routing:
+                source = "指定" if routing['source'] == 'user' else f"自動判定 確信度{routing['confidence']:.0%}"
+                st.write(f"**パイプライン構成:** {routing['profile']}（{source}）")
             st.write(f"**処理時間:** {latest_report.get('processing_time', 0):.1f}秒")
             st.write(f"**生成日時:** {latest_report['timestamp'][:19]}")
         
@@ -385,6 +463,30 @@ def analytics_tab():
             st.write(f"**一般検索:** {stats.get('general_results', 0)}件")
             st.write(f"**詳細検索:** {stats.get('detailed_results', 0)}件")
             st.write(f"**総トピック数:** {stats.get('total_topics', 0)}件")
+            if 'search_mode' in stats:
+                st.write(f"**検索モード:** {stats['search_mode']}（検索{stats.get('search_count', 0)}回・"
+                         f"{stats.get('search_time', 0.0):.1f}秒）")
+            if stats.get('truncated_stages'):
+                st.write(f"**時間予算で打ち切ったステージ:** {', '.join(stats['truncated_stages'])}")
+            if stats.get('skipped_stages'):
+                st.write(f"**検索APIキーがないため省略したステージ:** {', '.join(stats['skipped_stages'])}")
+    
+    # ステージ別のLLMメトリクス（settings.yamlのモデルルーティング調整用）
+    latest_llm_metrics = st.session_state.reports[-1].get('llm_metrics', {})
+    if latest_llm_metrics:
+        st.subheader("🤖 ステージ別LLMメトリクス（最新レポート）")
+        st.dataframe([
+            {
+                "ステージ": stage,
+                "モデル": m['model'],
+                "呼び出し数": m['calls'],
+                "レイテンシ(s)": round(m['latency'], 2),
+                "入力トークン": m['prompt_tokens'],
+                "キャッシュ済み入力": m.get('cached_tokens', 0),
+                "出力トークン": m['completion_tokens'],
+            }
+            for stage, m in latest_llm_metrics.items()
+        ], use_container_width=True)
     
     # パフォーマンス分析
     st.subheader("⚡ パフォーマンス分析")
@@ -401,6 +503,26 @@ def analytics_tab():
         
         with col3:
             st.metric("中央値", f"{sorted(processing_times)[len(processing_times)//2]:.1f}s")
+    
+    # レポートキャッシュの統計
+    st.subheader("⚡ レポートキャッシュ")
+    cache_stats = get_orchestrator().report_cache.stats()
+    col1, col2, col3, col4 = st.columns(4)
+    
+    with col1:
+        st.metric("キャッシュ件数", cache_stats['entries'])
+    
+    with col2:
+        st.metric("ヒット率", f"{cache_stats['hit_rate'] * 100:.1f}%")
+    
+    with col3:
+        st.metric("検索回数", cache_stats['lookups'])
+    
+    with col4:
+        st.metric("平均検索時間", f"{cache_stats['avg_lookup_ms']:.2f}ms")
+    
+    st.markdown("**類似度分布**")
+    st.bar_chart(cache_stats['similarity_histogram'])
 
 def help_tab():
     """Lawsyの設計を参考にした使い方タブ"""
@@ -448,6 +570,46 @@ def help_tab():
     - **詳細検索**: 特定のトピックを深く掘り下げ
     """)
 
+# 作り直せるパート（PipelineOrchestrator.STAGE_DEPENDENTS のステージ）
+REGENERATE_STAGES = {
+    'section': "本文の章",
+    'lead': "リード文",
+    'body': "本文全体",
+    'related_topics': "関連文法事項",
+    'conclusion': "結論",
+    'mindmap': "マインドマップ",
+}
+
+def regenerate_panel(report_data):
+    """レポートの1つのパート（本文は章単位）だけを作り直す。検索やアウトラインは保存済みのものを使う"""
+    with st.expander("🔁 一部を作り直す"):
+        key = report_data['id']
+        stage = st.selectbox("作り直すパート", list(REGENERATE_STAGES), format_func=REGENERATE_STAGES.get,
+                             key=f"regenerate_stage_{key}")
+        section = None
+        if stage == 'section':
+            body = report_data['artifacts']['sections']['body']
+            chapters = [line[3:].strip() for line in body.split('\n') if line.startswith('## ')]
+            section = st.selectbox("章", chapters, key=f"regenerate_section_{key}")
+        instruction = ""
+        if stage not in ('related_topics', 'mindmap'):
+            instruction = st.text_input("追加の指示（任意）", placeholder="例: 授業で使える具体例を増やしてください",
+                                        key=f"regenerate_instruction_{key}")
+        if st.button("🔁 作り直す", key=f"regenerate_{key}"):
+            with st.spinner(f"{REGENERATE_STAGES[stage]}を作り直しています..."):
+                try:
+                    updated = get_orchestrator().regenerate(report_data, stage, section=section,
+                                                            instruction=instruction)
+                except (ValueError, RegenerationError) as e:
+                    st.error(f"❌ 作り直せませんでした: {str(e)}")
+                    return
+            if report_data.get('job_id'):
+                get_job_queue().save_result(report_data['job_id'], updated)
+            st.session_state.reports = [updated if r['id'] == key else r for r in st.session_state.reports]
+            if st.session_state.get('current_report', {}).get('id') == key:
+                st.session_state.current_report = updated
+            st.rerun()
+
 def display_report(report_data):
     """レポートの表示"""
     st.subheader("📄 生成されたレポート")
@@ -461,8 +623,35 @@ def display_report(report_data):
     with col2:
         st.markdown(f"**生成日時:** {report_data['timestamp'][:19]}")
     
+    # 検索統計の表示
+    stats = report_data.get('search_stats', {})
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("教育ドメイン検索", stats.get('education_results', 0))
+    with col2:
+        st.metric("一般検索", stats.get('general_results', 0))
+    with col3:
+        st.metric("詳細検索", stats.get('detailed_results', 0))
+    with col4:
+        st.metric("処理時間", f"{report_data.get('processing_time', 0):.1f}s")
+    
+    if stats.get('truncated_stages'):
+        st.warning(f"⏱️ 時間予算のため一部を省略しました: {', '.join(stats['truncated_stages'])}")
+    
+    cache_info = report_data.get('cache', {})
+    if cache_info.get('hit'):
+        st.info(
+            f"⚡ 類似クエリのキャッシュから表示しました "
+            f"(類似度: {cache_info['similarity']:.2f}, 元クエリ: {cache_info['matched_query']})"
+        )
+    
     st.markdown("---")
     
+    stale = report_data.get('artifacts', {}).get('stale', [])
+    if stale:
+        st.warning(f"🔁 作り直した部分に合わせて更新されていない箇所があります: "
+                   f"{', '.join(REGENERATE_STAGES.get(stage, stage) for stage in stale)}")
+    
     # レポート本文の表示
     st.markdown(report_data['report'])
     
@@ -470,7 +659,10 @@ def display_report(report_data):
     if 'mindmap' in report_data:
         st.markdown("### 🗺️ マインドマップ")
         mindmap_content = create_markmap_content(report_data['mindmap'])
-        st_markmap.markmap(mindmap_content, height=400)
+        show_markmap(mindmap_content, height=400)
+    
+    if report_data.get('artifacts', {}).get('sections'):
+        regenerate_panel(report_data)
     
     # ダウンロードボタン
     report_text = f"""
@@ -1,5 +1,29 @@
 import argparse
-from src.pipeline_orchestrator import PipelineOrchestrator
+import sys
+from src.bootstrap import bootstrap
+
+def run_batch(args):
+    """
+    バッチモードの実行。
+    クエリファイル（1行1クエリ）を読み込み、バッチAPIのラウンドを繰り返してレポートを生成する。
+    """
+    from src.batch_runner import BatchPipeline, LocalBatchEndpoint, OpenAIBatchEndpoint, chat_completion_responder
+
+    pipeline = BatchPipeline(args.batch_dir)
+    if not pipeline.state['queries']:
+        with open(args.batch, encoding='utf-8') as f:
+            queries = [line.strip() for line in f if line.strip()]
+        pipeline.add_queries(queries)
+    else:
+        print(f"Resuming batch in {args.batch_dir}")
+
+    if args.batch_endpoint == "openai":
+        endpoint = OpenAIBatchEndpoint()
+    else:
+        endpoint = LocalBatchEndpoint(chat_completion_responder())
+
+    results = pipeline.run(endpoint, poll_interval=args.poll_interval)
+    print(f"\n--- Batch finished: {len(results)} reports written to {args.batch_dir}/reports ---")
 
 def main():
     """
@@ -7,15 +31,51 @@ def main():
     コマンドラインから初期クエリを受け取る。
     """
     parser = argparse.ArgumentParser(description="English Report Pipeline")
-    parser.add_argument("query", type=str, help="The initial query to generate a report for.")
+    parser.add_argument("query", type=str, nargs="?", help="The initial query to generate a report for.")
+    parser.add_argument("--deadline", type=float, default=None,
+                        help="Time budget in seconds. Stages adapt their fan-out and stop when it runs out.")
+    parser.add_argument("--query-type", type=str, default=None,
+                        help="Query type (e.g. 文法解説). Selects the pipeline profile; classified automatically if omitted.")
+    parser.add_argument("--search-mode", choices=["自動", "教育特化", "一般検索", "詳細検索"], default=None,
+                        help="Search plan: education domains only, general search only, deep per-topic search, "
+                             "or automatic (follows the query profile).")
+    parser.add_argument("--profile-run", action="store_true",
+                        help="Profile the run (cProfile plus per-stage wait/work breakdown) and save the report "
+                             "and the profile under data/output.")
+    parser.add_argument("--batch", type=str, default=None,
+                        help="File with one query per line. Runs all queries through the batch API offline.")
+    parser.add_argument("--batch-dir", type=str, default="data/batch",
+                        help="Working directory for batch request/result files and state (re-run to resume).")
+    parser.add_argument("--batch-endpoint", choices=["local", "openai"], default="local",
+                        help="'openai' submits to the Batch API; 'local' answers request files synchronously.")
+    parser.add_argument("--poll-interval", type=float, default=60.0,
+                        help="Seconds between batch status checks.")
     args = parser.parse_args()
+    bootstrap()
 
+    if args.batch:
+        run_batch(args)
+        return
+    if not args.query:
+        parser.error("query is required unless --batch is given")
+
+    # オーケストレーターはLLMクライアントなどを読み込むので、引数の確認が済んでから読み込む
+    from src.pipeline_orchestrator import PipelineOrchestrator
     orchestrator = PipelineOrchestrator()
-    final_report = orchestrator.run(args.query)
+    final_report = orchestrator.run(args.query, deadline=args.deadline, query_type=args.query_type,
+                                    search_mode=args.search_mode, profiling=args.profile_run)
+
+    # 生成されたレポート本文だけを標準出力に出す（処理時間などはログに出力済み）
+    print(final_report['report'])
 
-    # 生成されたレポートをコンソールに出力
-    print("\n--- Generated Report ---")
-    print(final_report)
+    if args.profile_run:
+        # レポートはプロファイルと同じ名前で隣に保存する
+        written = final_report['profiling']
+        report_path = written['profile_path'][:-len(".prof")] + ".md"
+        with open(report_path, "w", encoding="utf-8") as f:
+            f.write(final_report['report'])
+        print(f"Report: {report_path} / Profile: {written['profile_path']} ({written['summary_path']})",
+              file=sys.stderr)
 
     # TODO: レポートをファイルに保存する処理を追加
     # with open("data/output/final_report.md", "w") as f:
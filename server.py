@@ -0,0 +1,22 @@
+import argparse
+import os
+from aiohttp import web
+from src.http_service import create_app
+
+def main():
+    """
+    非同期HTTPサービスのエントリーポイント。
+    POST /reports でジョブを登録し、GET /reports/{job_id}/events で進捗をSSEで受け取る。
+    """
+    parser = argparse.ArgumentParser(description="English Report Pipeline HTTP service")
+    parser.add_argument("--host", default=os.getenv("SERVICE_HOST", "0.0.0.0"), help="Bind address")
+    parser.add_argument("--port", type=int, default=int(os.getenv("SERVICE_PORT", "8080")), help="Bind port")
+    parser.add_argument("--max-concurrency", type=int, default=None, help="Concurrent pipelines per worker")
+    parser.add_argument("--per-client-limit", type=int, default=None, help="Concurrent reports per client")
+    args = parser.parse_args()
+
+    app = create_app(max_concurrency=args.max_concurrency, per_client_limit=args.per_client_limit)
+    web.run_app(app, host=args.host, port=args.port)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,448 @@
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+# ステージの進行順（searchはLLMを使わないので、expandの結果を取り込んだ時点で実行する）
+STAGES = ('refine', 'expand', 'outline', 'write', 'conclusion', 'mindmap', 'done')
+
+# 各LLM呼び出しの既定パラメータ（settings.yamlのステージ設定があればそちらが優先される）
+_CALL_PARAMS = {
+    'refine': (500, 0.3),
+    'expand': (1000, 0.4),
+    'outline': (3000, 0.5),
+    'lead': (300, 0.7),
+    'body': (3000, 0.5),
+    'related_topics': (500, 0.6),
+    'conclusion': (800, 0.6),
+    'mindmap': (3000, 0.5),
+}
+
+
+def _custom_id(query_id: str, stage: str, part: str) -> str:
+    return f"{query_id}:{stage}:{part}"
+
+
+def _parse_custom_id(custom_id: str) -> tuple:
+    query_id, stage, part = custom_id.split(':', 2)
+    return query_id, stage, part
+
+
+class BatchPipeline:
+    """
+    バッチAPI向けのオフライン一括実行モード。
+    全クエリのLLM呼び出しをcustom_id付きのリクエストJSONLに書き出し、結果ファイルを取り込んで
+    ステージを1つずつ進める（1ラウンドで各クエリが1ステージ進む）。状態は作業ディレクトリに保存されるので、
+    途中で止めても同じディレクトリを指定すれば再開できる。
+    """
+
+    def __init__(self, work_dir: str, orchestrator: Any = None):
+        """
+        Args:
+            work_dir: 状態・リクエスト・結果・レポートを保存するディレクトリ
+            orchestrator: ステージのモジュールと検索を提供するオーケストレーター（省略時は生成）
+        """
+        self.work_dir = work_dir
+        # 検索を同時に実行するクエリ数（検索プロバイダーへの間隔は検索クライアントが全体で守る）
+        self.search_workers = max(1, int(os.getenv('BATCH_SEARCH_WORKERS', '4')))
+        self.state_path = os.path.join(work_dir, 'state.json')
+        os.makedirs(os.path.join(work_dir, 'reports'), exist_ok=True)
+
+        if orchestrator is None:
+            from .pipeline_orchestrator import PipelineOrchestrator
+            orchestrator = PipelineOrchestrator()
+        self.orchestrator = orchestrator
+        self.llm_client = orchestrator.refiner.llm_client
+
+        self.state = self._load_state()
+
+    def _load_state(self) -> Dict[str, Any]:
+        if os.path.exists(self.state_path):
+            with open(self.state_path, encoding='utf-8') as f:
+                return json.load(f)
+        return {'round': 0, 'queries': {}}
+
+    def _save_state(self) -> None:
+        """状態を書き出す（書き込み途中で落ちても壊れないよう一時ファイル経由で置き換える）"""
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    def add_queries(self, queries: List[str]) -> List[str]:
+        """
+        クエリを登録する。
+
+        Args:
+            queries: ユーザーのクエリのリスト
+
+        Returns:
+            登録したクエリのID
+        """
+        query_ids = []
+        for query in queries:
+            query_id = f"q{len(self.state['queries']):05d}"
+            self.state['queries'][query_id] = {
+                'query': query,
+                'stage': 'refine',
+                'artifacts': {},
+                'pending': [],
+            }
+            query_ids.append(query_id)
+        self._save_state()
+        return query_ids
+
+    def is_complete(self) -> bool:
+        """全クエリが完了したか"""
+        return all(q['stage'] == 'done' for q in self.state['queries'].values())
+
+    def prepare_round(self) -> Optional[str]:
+        """
+        次のラウンドのリクエストファイルを書き出す。
+
+        Returns:
+            リクエストJSONLのパス（送るものがなければNone）
+        """
+        requests = []
+        for query_id, entry in self.state['queries'].items():
+            if entry['stage'] == 'done':
+                continue
+            calls = self._build_calls(query_id, entry)
+            entry['pending'] = [custom_id for custom_id, _ in calls]
+            requests.extend(calls)
+
+        if not requests:
+            return None
+
+        self.state['round'] += 1
+        path = os.path.join(self.work_dir, f"round_{self.state['round']:03d}_requests.jsonl")
+        with open(path, 'w', encoding='utf-8') as f:
+            for custom_id, body in requests:
+                f.write(json.dumps({
+                    'custom_id': custom_id,
+                    'method': 'POST',
+                    'url': '/v1/chat/completions',
+                    'body': body,
+                }, ensure_ascii=False) + '\n')
+        self._save_state()
+        logger.info(f"Prepared batch round {self.state['round']} with {len(requests)} requests: {path}")
+        return path
+
+    def _request(self, query_id: str, stage: str, part: str, prompt: str, output_format: str = "text") -> tuple:
+        max_tokens, temperature = _CALL_PARAMS[part]
+        body = self.llm_client.build_request(prompt, stage=part, max_tokens=max_tokens, temperature=temperature,
+                                             output_format=output_format)
+        return _custom_id(query_id, stage, part), body
+
+    def _build_calls(self, query_id: str, entry: Dict[str, Any]) -> List[tuple]:
+        """クエリの現在のステージに必要なLLM呼び出しを組み立てる"""
+        stage = entry['stage']
+        artifacts = entry['artifacts']
+        orchestrator = self.orchestrator
+
+        if stage == 'refine':
+            return [self._request(query_id, stage, 'refine', orchestrator.refiner.build_prompt(entry['query']))]
+        if stage == 'expand':
+            prompt = orchestrator.expander.build_prompt(artifacts['refined_query'], orchestrator.MAX_TOPICS)
+            prompt = self.llm_client.format_structured_prompt(prompt, "json")
+            return [self._request(query_id, stage, 'expand', prompt, output_format="json")]
+        if stage == 'outline':
+            prompt = orchestrator.outline_creator.build_prompt(artifacts['refined_query'], artifacts['search_results'])
+            prompt = self.llm_client.format_structured_prompt(prompt, "markdown")
+            return [self._request(query_id, stage, 'outline', prompt)]
+        if stage == 'write':
+            writer = orchestrator.writer
+            search_results_text = writer.cited_sources_text(artifacts['outline'], artifacts['search_results'])
+            from . import text_analyzer
+            passage_facts = text_analyzer.format_facts(text_analyzer.analyze_query(entry['query']))
+            return [
+                self._request(query_id, stage, 'lead', writer.build_lead_prompt(artifacts['refined_query'])),
+                self._request(query_id, stage, 'body', writer.build_body_prompt(
+                    artifacts['outline'], search_results_text, artifacts['refined_query'], passage_facts)),
+                self._request(query_id, stage, 'related_topics', writer.build_related_topics_prompt(entry['query'])),
+            ]
+        if stage == 'conclusion':
+            writer = orchestrator.writer
+            digest = writer.build_digest(artifacts['title'], artifacts['lead'], artifacts['body'])
+            return [self._request(query_id, stage, 'conclusion', writer.build_conclusion_prompt(digest))]
+        if stage == 'mindmap':
+            prompt = orchestrator.mindmap_generator.build_prompt(artifacts['report'])
+            prompt = self.llm_client.format_structured_prompt(prompt, "json")
+            return [self._request(query_id, stage, 'mindmap', prompt, output_format="json")]
+        raise ValueError(f"Unknown batch stage: {stage}")
+
+    def ingest_results(self, results_path: str) -> int:
+        """
+        バッチの結果ファイルを取り込み、応答が揃ったクエリを次のステージへ進める。
+        エラーになったリクエストは空の応答として扱い、各ステージのフォールバックを使う。
+
+        Args:
+            results_path: バッチ結果のJSONLファイル
+
+        Returns:
+            ステージが進んだクエリ数
+        """
+        responses: Dict[str, Dict[str, str]] = {}
+        with open(results_path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                query_id, stage, part = _parse_custom_id(record['custom_id'])
+                responses.setdefault(query_id, {})[part] = self._extract_content(record)
+
+        advanced = 0
+        searching: List[Dict[str, Any]] = []
+        for query_id, entry in self.state['queries'].items():
+            if not entry['pending'] or query_id not in responses:
+                continue
+            parts = {_parse_custom_id(custom_id)[2] for custom_id in entry['pending']}
+            if not parts.issubset(responses[query_id]):
+                logger.warning(f"Batch results for {query_id} are incomplete; the stage will be retried")
+                continue
+            if entry['stage'] == 'expand':
+                searching.append(entry)
+            self._advance(query_id, entry, responses[query_id])
+            entry['pending'] = []
+            advanced += 1
+
+        self._search_all(searching)
+        self._save_state()
+        logger.info(f"Ingested {results_path}: {advanced} queries advanced")
+        return advanced
+
+    @staticmethod
+    def _extract_content(record: Dict[str, Any]) -> str:
+        """バッチ結果の1行から生成テキストを取り出す（エラーなら空文字）"""
+        response = record.get('response') or {}
+        if record.get('error') or response.get('status_code', 200) != 200:
+            logger.warning(f"Batch request {record.get('custom_id')} failed: {record.get('error')}")
+            return ""
+        try:
+            return response['body']['choices'][0]['message']['content'] or ""
+        except (KeyError, IndexError, TypeError):
+            return ""
+
+    def _advance(self, query_id: str, entry: Dict[str, Any], responses: Dict[str, str]) -> None:
+        """応答を各ステージの後処理に通し、次のステージへ進める"""
+        stage = entry['stage']
+        artifacts = entry['artifacts']
+        orchestrator = self.orchestrator
+
+        if stage == 'refine':
+            artifacts['refined_query'] = orchestrator.refiner.parse_response(entry['query'], responses['refine'])
+        elif stage == 'expand':
+            topics = orchestrator.expander.parse_response(
+                artifacts['refined_query'], responses['expand'], orchestrator.MAX_TOPICS)
+            # 検索はLLMを使わないので、取り込みの最後に全クエリ分をまとめて実行して次のラウンドに備える
+            artifacts['search_topics'] = topics
+        elif stage == 'outline':
+            artifacts['outline'] = orchestrator.outline_creator.parse_response(
+                responses['outline'], artifacts['search_results'])
+            artifacts['title'] = artifacts['outline'].split('\n')[0]
+        elif stage == 'write':
+            writer = orchestrator.writer
+            artifacts['lead'] = writer.parse_section(
+                responses['lead'], writer._get_fallback_lead(artifacts['refined_query']))
+            artifacts['body'] = writer.parse_section(
+                responses['body'], writer._get_fallback_body(artifacts['outline']))
+            artifacts['related_topics'] = writer.parse_section(
+                responses['related_topics'], writer._get_fallback_related_topics())
+        elif stage == 'conclusion':
+            writer = orchestrator.writer
+            artifacts['conclusion'] = writer.parse_section(
+                responses['conclusion'], writer._get_fallback_conclusion())
+            artifacts['report'] = writer.assemble_report(
+                artifacts['title'], artifacts['lead'], artifacts['body'],
+                artifacts['related_topics'], artifacts['conclusion'], sources=artifacts['search_results'])
+        elif stage == 'mindmap':
+            artifacts['mindmap'] = orchestrator.mindmap_generator.parse_response(
+                responses['mindmap'], artifacts['report'])
+            self._write_report(query_id, entry)
+
+        entry['stage'] = STAGES[STAGES.index(stage) + 1]
+
+    def _search_all(self, entries: List[Dict[str, Any]]) -> None:
+        """トピックを展開し終えたクエリの検索を、同時実行数を抑えたスレッドプールでまとめて実行する"""
+        if not entries:
+            return
+        with ThreadPoolExecutor(max_workers=min(self.search_workers, len(entries)),
+                                thread_name_prefix="batch-search") as executor:
+            futures = [
+                (entry, executor.submit(self.orchestrator.search_sources,
+                                        entry['artifacts']['refined_query'], entry['artifacts']['search_topics']))
+                for entry in entries
+            ]
+            for entry, future in futures:
+                entry['artifacts']['search_results'] = future.result()
+        logger.info(f"Searched sources for {len(entries)} queries")
+
+    def _write_report(self, query_id: str, entry: Dict[str, Any]) -> None:
+        """完了したレポートをMarkdownと結果JSONで保存する"""
+        artifacts = entry['artifacts']
+        base = os.path.join(self.work_dir, 'reports', query_id)
+        with open(base + '.md', 'w', encoding='utf-8') as f:
+            f.write(artifacts['report'])
+        with open(base + '.json', 'w', encoding='utf-8') as f:
+            json.dump(self._to_result(entry), f, ensure_ascii=False, indent=2)
+
+    @staticmethod
+    def _to_result(entry: Dict[str, Any]) -> Dict[str, Any]:
+        artifacts = entry['artifacts']
+        return {
+            'report': artifacts['report'],
+            'mindmap': artifacts['mindmap'],
+            'query': entry['query'],
+            'refined_query': artifacts['refined_query'],
+            'search_stats': {
+                'total_topics': len(artifacts.get('search_topics', [])),
+                'total_results': len(artifacts.get('search_results', {})),
+            },
+        }
+
+    def results(self) -> Dict[str, Dict[str, Any]]:
+        """完了したクエリの結果（PipelineOrchestrator.runに近い形式）を返す"""
+        return {
+            query_id: self._to_result(entry)
+            for query_id, entry in self.state['queries'].items()
+            if entry['stage'] == 'done'
+        }
+
+    def run(self, endpoint: 'BatchEndpoint', poll_interval: float = 30.0,
+            max_rounds: Optional[int] = None) -> Dict[str, Dict[str, Any]]:
+        """
+        全クエリが完了するまでラウンドを繰り返す。
+
+        Args:
+            endpoint: バッチの投入先（LocalBatchEndpointまたはOpenAIBatchEndpoint）
+            poll_interval: バッチ完了を確認する間隔（秒）
+            max_rounds: 実行するラウンド数の上限（省略時は完了まで）
+
+        Returns:
+            完了したクエリの結果
+        """
+        rounds = 0
+        while not self.is_complete() and (max_rounds is None or rounds < max_rounds):
+            requests_path = self.prepare_round()
+            if requests_path is None:
+                break
+            batch_id = endpoint.submit(requests_path)
+            results_path = endpoint.wait(batch_id, os.path.join(self.work_dir, f"round_{self.state['round']:03d}_results.jsonl"),
+                                         poll_interval=poll_interval)
+            self.ingest_results(results_path)
+            rounds += 1
+        return self.results()
+
+
+class BatchEndpoint:
+    """バッチの投入先のインターフェース"""
+
+    def submit(self, requests_path: str) -> str:
+        """リクエストファイルを投入してバッチIDを返す"""
+        raise NotImplementedError
+
+    def wait(self, batch_id: str, results_path: str, poll_interval: float = 30.0) -> str:
+        """バッチの完了を待って結果をresults_pathに保存し、そのパスを返す"""
+        raise NotImplementedError
+
+
+class LocalBatchEndpoint(BatchEndpoint):
+    """
+    バッチAPIのファイルベースの代替。
+    リクエストファイルを1行ずつresponderに渡し、バッチAPIと同じ形式の結果ファイルを書き出す。
+    """
+
+    def __init__(self, responder: Callable[[Dict[str, Any]], str]):
+        """
+        Args:
+            responder: リクエストボディを受け取り生成テキストを返す関数
+        """
+        self.responder = responder
+        self._batches: Dict[str, str] = {}
+
+    def submit(self, requests_path: str) -> str:
+        batch_id = f"batch_local_{uuid.uuid4().hex[:12]}"
+        self._batches[batch_id] = requests_path
+        return batch_id
+
+    def wait(self, batch_id: str, results_path: str, poll_interval: float = 30.0) -> str:
+        with open(self._batches[batch_id], encoding='utf-8') as src, \
+                open(results_path, 'w', encoding='utf-8') as dst:
+            for line in src:
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                record = {'id': f"batch_req_{uuid.uuid4().hex[:12]}", 'custom_id': request['custom_id']}
+                try:
+                    content = self.responder(request['body'])
+                    record['response'] = {
+                        'status_code': 200,
+                        'body': {'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}}]},
+                    }
+                    record['error'] = None
+                except Exception as e:
+                    record['response'] = None
+                    record['error'] = {'message': str(e)}
+                dst.write(json.dumps(record, ensure_ascii=False) + '\n')
+        return results_path
+
+
+def chat_completion_responder(client: Any = None) -> Callable[[Dict[str, Any]], str]:
+    """リクエストボディをそのままChat Completions APIに送るresponderを返す（LocalBatchEndpointでの動作確認用）"""
+    if client is None:
+        import openai
+        client = openai.OpenAI()
+
+    def respond(body: Dict[str, Any]) -> str:
+        body = dict(body)
+        cache_key = body.pop('prompt_cache_key', None)
+        if cache_key:
+            body['extra_body'] = {'prompt_cache_key': cache_key}
+        response = client.chat.completions.create(**body)
+        return response.choices[0].message.content or ""
+
+    return respond
+
+
+class OpenAIBatchEndpoint(BatchEndpoint):
+    """OpenAIのBatch APIにリクエストファイルを投入する"""
+
+    def __init__(self, client: Any = None, completion_window: str = "24h"):
+        if client is None:
+            import openai
+            client = openai.OpenAI()
+        self.client = client
+        self.completion_window = completion_window
+
+    def submit(self, requests_path: str) -> str:
+        with open(requests_path, 'rb') as f:
+            uploaded = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint="/v1/chat/completions",
+            completion_window=self.completion_window,
+        )
+        logger.info(f"Submitted batch {batch.id} from {requests_path}")
+        return batch.id
+
+    def wait(self, batch_id: str, results_path: str, poll_interval: float = 30.0) -> str:
+        while True:
+            batch = self.client.batches.retrieve(batch_id)
+            if batch.status == "completed":
+                break
+            if batch.status in ("failed", "expired", "cancelled"):
+                raise RuntimeError(f"Batch {batch_id} ended with status {batch.status}")
+            time.sleep(poll_interval)
+
+        with open(results_path, 'w', encoding='utf-8') as f:
+            if batch.output_file_id:
+                f.write(self.client.files.content(batch.output_file_id).text)
+            if batch.error_file_id:
+                f.write(self.client.files.content(batch.error_file_id).text)
+        return results_path
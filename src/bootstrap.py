@@ -0,0 +1,25 @@
+import threading
+
+from .structured_logging import configure_logging
+
+_bootstrapped = False
+_bootstrap_lock = threading.Lock()
+
+
+def bootstrap() -> None:
+    """
+    環境変数（.env）の読み込みとログ設定を行う（プロセスで1回だけ）。
+    エントリーポイントと、環境変数を読むクラスの初期化から呼ぶ。
+    """
+    global _bootstrapped
+    if _bootstrapped:
+        return
+    with _bootstrap_lock:
+        if _bootstrapped:
+            return
+        # python-dotenvはここでしか使わないので必要になってから読み込む
+        from dotenv import load_dotenv
+        load_dotenv()
+        # ログは別スレッドで出力する（設定は settings.yaml の logging セクション）
+        configure_logging()
+        _bootstrapped = True
@@ -0,0 +1,454 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+import logging
+
+from . import run_context
+from .settings import get_section
+
+logger = logging.getLogger(__name__)
+
+
+def make_key(*parts: Any) -> str:
+    """キーの材料（プロンプトやパラメータ）から固定長のキャッシュキーを作る"""
+    material = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class CacheBackend:
+    """
+    キャッシュの保存先の共通インターフェース。
+    値は名前空間とキーの組でバイト列として保存し、名前空間ごとに件数・バイト数とヒット数を数える。
+    """
+
+    # 複数のプロセス（レプリカ）から同じキャッシュが見えるか
+    shared = False
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def set(self, namespace: str, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        raise NotImplementedError
+
+    def add(self, namespace: str, key: str, value: bytes, ttl: Optional[float] = None) -> bool:
+        """有効なエントリがなければ原子的に保存してTrueを返す（あれば何もせずFalse）"""
+        raise NotImplementedError
+
+    def delete(self, namespace: str, key: str) -> None:
+        raise NotImplementedError
+
+    def clear(self, namespace: str) -> None:
+        """名前空間のエントリとカウンターを消す"""
+        raise NotImplementedError
+
+    def usage(self, namespace: str) -> Dict[str, int]:
+        """名前空間の有効なエントリの件数とバイト数（{'entries', 'bytes'}）"""
+        raise NotImplementedError
+
+    def incr(self, namespace: str, counter: str, amount: int = 1) -> None:
+        raise NotImplementedError
+
+    def counters(self, namespace: str) -> Dict[str, int]:
+        raise NotImplementedError
+
+
+class MemoryBackend(CacheBackend):
+    """プロセス内の辞書に保存するバックエンド（名前空間ごとに古いものから削除する）"""
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._entries: Dict[str, OrderedDict] = {}
+        self._counters: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        with self._lock:
+            entries = self._entries.get(namespace)
+            item = entries.get(key) if entries is not None else None
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at is not None and expires_at <= time.time():
+                del entries[key]
+                return None
+            entries.move_to_end(key)
+            return value
+
+    def set(self, namespace: str, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        with self._lock:
+            entries = self._entries.setdefault(namespace, OrderedDict())
+            entries[key] = (value, time.time() + ttl if ttl else None)
+            entries.move_to_end(key)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+
+    def add(self, namespace: str, key: str, value: bytes, ttl: Optional[float] = None) -> bool:
+        with self._lock:
+            item = self._entries.get(namespace, {}).get(key)
+            if item is not None and (item[1] is None or item[1] > time.time()):
+                return False
+            entries = self._entries.setdefault(namespace, OrderedDict())
+            entries[key] = (value, time.time() + ttl if ttl else None)
+            entries.move_to_end(key)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            return True
+
+    def delete(self, namespace: str, key: str) -> None:
+        with self._lock:
+            self._entries.get(namespace, {}).pop(key, None)
+
+    def clear(self, namespace: str) -> None:
+        with self._lock:
+            self._entries.pop(namespace, None)
+            self._counters.pop(namespace, None)
+
+    def usage(self, namespace: str) -> Dict[str, int]:
+        now = time.time()
+        with self._lock:
+            entries = self._entries.get(namespace, {})
+            live = [value for value, expires_at in entries.values() if expires_at is None or expires_at > now]
+            return {'entries': len(live), 'bytes': sum(len(value) for value in live)}
+
+    def incr(self, namespace: str, counter: str, amount: int = 1) -> None:
+        with self._lock:
+            counters = self._counters.setdefault(namespace, {})
+            counters[counter] = counters.get(counter, 0) + amount
+
+    def counters(self, namespace: str) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counters.get(namespace, {}))
+
+
+class SQLiteBackend(CacheBackend):
+    """
+    SQLiteファイルに保存するバックエンド。
+    同じボリュームをマウントしたレプリカ間で共有できる（WALモードで読み込みと書き込みが互いを待たない）。
+    """
+
+    shared = True
+
+    def __init__(self, path: str, timeout: float = 5.0):
+        self.path = path
+        self.timeout = timeout
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # sqlite3の接続はスレッド間で共有しない
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache_entries ("
+                         "namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, expires_at REAL, "
+                         "PRIMARY KEY (namespace, key))")
+            conn.execute("CREATE TABLE IF NOT EXISTS cache_counters ("
+                         "namespace TEXT NOT NULL, name TEXT NOT NULL, value INTEGER NOT NULL, "
+                         "PRIMARY KEY (namespace, name))")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        row = self._connect().execute(
+            "SELECT value FROM cache_entries WHERE namespace = ? AND key = ? "
+            "AND (expires_at IS NULL OR expires_at > ?)", (namespace, key, time.time())
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def set(self, namespace: str, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO cache_entries VALUES (?, ?, ?, ?)",
+                         (namespace, key, sqlite3.Binary(value), time.time() + ttl if ttl else None))
+
+    def add(self, namespace: str, key: str, value: bytes, ttl: Optional[float] = None) -> bool:
+        now = time.time()
+        with self._connect() as conn:
+            # 期限切れのエントリを消してから挿入する（同じトランザクションなので他のレプリカと競合しない）
+            conn.execute("DELETE FROM cache_entries WHERE namespace = ? AND key = ? AND expires_at <= ?",
+                         (namespace, key, now))
+            cursor = conn.execute("INSERT OR IGNORE INTO cache_entries VALUES (?, ?, ?, ?)",
+                                  (namespace, key, sqlite3.Binary(value), now + ttl if ttl else None))
+        return cursor.rowcount == 1
+
+    def delete(self, namespace: str, key: str) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def clear(self, namespace: str) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM cache_entries WHERE namespace = ?", (namespace,))
+            conn.execute("DELETE FROM cache_counters WHERE namespace = ?", (namespace,))
+
+    def usage(self, namespace: str) -> Dict[str, int]:
+        with self._connect() as conn:
+            # 期限切れのエントリはここでまとめて消す
+            conn.execute("DELETE FROM cache_entries WHERE namespace = ? AND expires_at <= ?",
+                         (namespace, time.time()))
+            entries, size = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM cache_entries WHERE namespace = ?",
+                (namespace,)
+            ).fetchone()
+        return {'entries': entries, 'bytes': size}
+
+    def incr(self, namespace: str, counter: str, amount: int = 1) -> None:
+        with self._connect() as conn:
+            conn.execute("INSERT INTO cache_counters VALUES (?, ?, ?) "
+                         "ON CONFLICT (namespace, name) DO UPDATE SET value = value + excluded.value",
+                         (namespace, counter, amount))
+
+    def counters(self, namespace: str) -> Dict[str, int]:
+        rows = self._connect().execute("SELECT name, value FROM cache_counters WHERE namespace = ?",
+                                       (namespace,)).fetchall()
+        return dict(rows)
+
+
+class RedisBackend(CacheBackend):
+    """
+    Redis（互換サーバーを含む）に保存するバックエンド。全レプリカで1つのキャッシュを共有する。
+    TTLはRedisの有効期限に任せ、カウンターは名前空間ごとのハッシュに持つ。
+    """
+
+    shared = True
+
+    def __init__(self, url: str = "redis://localhost:6379/0", prefix: str = "erp", client: Any = None):
+        """
+        Args:
+            url: RedisのURL（clientを渡した場合は使わない）
+            prefix: キーの接頭辞（同じRedisを他の用途と共有するため）
+            client: redis.Redis互換のクライアント（テスト用）
+        """
+        if client is None:
+            # redisはRedisバックエンドを選んだときだけ必要
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+
+    def _key(self, namespace: str, key: str) -> str:
+        return f"{self.prefix}:{namespace}:{key}"
+
+    def _counters_key(self, namespace: str) -> str:
+        return f"{self.prefix}:__counters__:{namespace}"
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        return self.client.get(self._key(namespace, key))
+
+    def set(self, namespace: str, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        self.client.set(self._key(namespace, key), value, px=int(ttl * 1000) if ttl else None)
+
+    def add(self, namespace: str, key: str, value: bytes, ttl: Optional[float] = None) -> bool:
+        return bool(self.client.set(self._key(namespace, key), value, nx=True, px=int(ttl * 1000) if ttl else None))
+
+    def delete(self, namespace: str, key: str) -> None:
+        self.client.delete(self._key(namespace, key))
+
+    def _scan(self, namespace: str):
+        return self.client.scan_iter(match=f"{self.prefix}:{namespace}:*", count=500)
+
+    def clear(self, namespace: str) -> None:
+        keys = list(self._scan(namespace))
+        if keys:
+            self.client.delete(*keys)
+        self.client.delete(self._counters_key(namespace))
+
+    def usage(self, namespace: str) -> Dict[str, int]:
+        keys = list(self._scan(namespace))
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipe.strlen(key)
+        sizes = pipe.execute() if keys else []
+        # SCANの後に期限切れになったキーは長さ0として返る
+        live = [size for size in sizes if size]
+        return {'entries': len(live), 'bytes': sum(live)}
+
+    def incr(self, namespace: str, counter: str, amount: int = 1) -> None:
+        self.client.hincrby(self._counters_key(namespace), counter, amount)
+
+    def counters(self, namespace: str) -> Dict[str, int]:
+        raw = self.client.hgetall(self._counters_key(namespace))
+        return {(name.decode() if isinstance(name, bytes) else name): int(value) for name, value in raw.items()}
+
+
+class NamespacedCache:
+    """
+    1つの名前空間のキャッシュ（検索・LLM・レポートなど）。値はJSONにして保存する。
+    バックエンドの障害はキャッシュなしとして扱い、呼び出し側には波及させない。
+    ヒット・ミス・書き込みの件数はプロセス内で数え、COUNTER_FLUSH_INTERVAL 秒ごとにまとめてバックエンドに書く
+    （読み込みのたびに共有バックエンドへ往復しないため）。
+    """
+
+    COUNTER_FLUSH_INTERVAL = 5.0
+
+    def __init__(self, backend: CacheBackend, namespace: str, ttl: Optional[float] = None, enabled: bool = True):
+        self.backend = backend
+        self.namespace = namespace
+        self.ttl = ttl
+        self.enabled = enabled
+        self._pending: Dict[str, int] = {}
+        self._pending_lock = threading.Lock()
+        self._flushed_at = time.monotonic()
+
+    @property
+    def shared(self) -> bool:
+        return self.backend.shared
+
+    def get(self, key: str) -> Optional[Any]:
+        """キャッシュされた値を返す（なければ、無効なら、実行中のパイプラインがキャッシュを使わないならNone）"""
+        if not self.enabled or not run_context.cache_reads_enabled():
+            return None
+        try:
+            raw = self.backend.get(self.namespace, key)
+        except Exception as e:
+            logger.warning(f"Cache read failed ({self.namespace}): {e}")
+            return None
+        self._count('hits' if raw is not None else 'misses')
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        """値を保存する（ttl省略時は名前空間のTTL）"""
+        if not self.enabled:
+            return
+        try:
+            raw = json.dumps(value, ensure_ascii=False).encode('utf-8')
+            self.backend.set(self.namespace, key, raw, ttl if ttl is not None else self.ttl)
+        except Exception as e:
+            logger.warning(f"Cache write failed ({self.namespace}): {e}")
+            return
+        self._count('writes')
+
+    def add(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        """
+        キーがなければ原子的に保存してTrueを返す（あればFalse）。レプリカ間の作業の確保に使う。
+        キャッシュが無効、またはバックエンドの障害時は確保できたものとして扱う（キャッシュなしと同じ振る舞い）。
+        """
+        if not self.enabled:
+            return True
+        try:
+            raw = json.dumps(value, ensure_ascii=False).encode('utf-8')
+            return self.backend.add(self.namespace, key, raw, ttl if ttl is not None else self.ttl)
+        except Exception as e:
+            logger.warning(f"Cache add failed ({self.namespace}): {e}")
+            return True
+
+    def _count(self, counter: str) -> None:
+        """件数をプロセス内に足し、前回の書き出しから間隔が空いていればバックエンドに書く"""
+        with self._pending_lock:
+            self._pending[counter] = self._pending.get(counter, 0) + 1
+            due = time.monotonic() - self._flushed_at >= self.COUNTER_FLUSH_INTERVAL
+        if due:
+            self.flush_counters()
+
+    def flush_counters(self) -> None:
+        """プロセス内で数えた件数をバックエンドに書く（失敗したら次の書き出しに回す）"""
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+            self._flushed_at = time.monotonic()
+        for counter, amount in pending.items():
+            try:
+                self.backend.incr(self.namespace, counter, amount)
+            except Exception as e:
+                logger.warning(f"Cache counter flush failed ({self.namespace}): {e}")
+                with self._pending_lock:
+                    self._pending[counter] = self._pending.get(counter, 0) + amount
+
+    def get_or_set(self, key: str, compute: Callable[[], Any],
+                   should_cache: Callable[[Any], bool] = lambda value: True) -> Any:
+        """キャッシュになければ compute() の値を保存して返す（should_cacheがFalseの値は保存しない）"""
+        value = self.get(key)
+        if value is not None:
+            return value
+        value = compute()
+        if value is not None and should_cache(value):
+            self.set(key, value)
+        return value
+
+    def delete(self, key: str) -> None:
+        try:
+            self.backend.delete(self.namespace, key)
+        except Exception as e:
+            logger.warning(f"Cache delete failed ({self.namespace}): {e}")
+
+    def clear(self) -> None:
+        with self._pending_lock:
+            self._pending = {}
+        self.backend.clear(self.namespace)
+
+    def stats(self) -> Dict[str, Any]:
+        """名前空間の件数・バイト数・ヒット率（共有バックエンドなら全レプリカの合計）"""
+        self.flush_counters()
+        counters = self.backend.counters(self.namespace)
+        hits, misses = counters.get('hits', 0), counters.get('misses', 0)
+        return {
+            'namespace': self.namespace,
+            'backend': type(self.backend).__name__,
+            'ttl': self.ttl,
+            **self.backend.usage(self.namespace),
+            'hits': hits,
+            'misses': misses,
+            'writes': counters.get('writes', 0),
+            'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+        }
+
+
+def create_backend(settings: Optional[Dict[str, Any]] = None) -> CacheBackend:
+    """
+    設定からバックエンドを作る（環境変数 CACHE_BACKEND / CACHE_REDIS_URL / CACHE_SQLITE_PATH で上書きできる）。
+    """
+    settings = settings if settings is not None else get_section('cache')
+    kind = os.getenv('CACHE_BACKEND') or settings.get('backend', 'memory')
+    if kind == 'memory':
+        return MemoryBackend(max_entries=int(settings.get('max_entries', 10000)))
+    if kind == 'sqlite':
+        return SQLiteBackend(os.getenv('CACHE_SQLITE_PATH') or settings.get('sqlite_path', 'data/cache/shared.sqlite3'))
+    if kind == 'redis':
+        return RedisBackend(os.getenv('CACHE_REDIS_URL') or settings.get('redis_url', 'redis://localhost:6379/0'),
+                            prefix=settings.get('prefix', 'erp'))
+    raise ValueError(f"Unknown cache backend: {kind}")
+
+
+_backend: Optional[CacheBackend] = None
+_caches: Dict[str, NamespacedCache] = {}
+_cache_lock = threading.Lock()
+
+
+def get_cache(namespace: str) -> NamespacedCache:
+    """
+    名前空間のキャッシュを返す（初回に settings.yaml の cache セクションからバックエンドを生成）。
+    名前空間ごとのTTLと有効・無効は cache.namespaces で設定する。
+    """
+    global _backend
+    with _cache_lock:
+        cache = _caches.get(namespace)
+        if cache is None:
+            settings = get_section('cache')
+            if _backend is None:
+                _backend = create_backend(settings)
+                logger.info(f"Cache backend: {type(_backend).__name__}")
+            options = (settings.get('namespaces') or {}).get(namespace) or {}
+            ttl = options.get('ttl')
+            cache = _caches[namespace] = NamespacedCache(_backend, namespace, float(ttl) if ttl else None,
+                                                         bool(options.get('enabled', True)))
+        return cache
+
+
+def cache_stats() -> Dict[str, Dict[str, Any]]:
+    """使用中の全名前空間の統計情報"""
+    with _cache_lock:
+        caches = list(_caches.values())
+    return {cache.namespace: cache.stats() for cache in caches}
+
+
+def reset_cache(backend: Optional[CacheBackend] = None) -> None:
+    """バックエンドを破棄する（設定の再読み込みやテスト用。backendを渡すとそれに差し替える）"""
+    global _backend
+    with _cache_lock:
+        _backend = backend
+        _caches.clear()
@@ -0,0 +1,126 @@
+import re
+from typing import Any, Dict, List, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 引用番号の並び（[3] / [2][24][29] / [3, 5]）。Markdownのリンク [1](url) は対象外
+_CITATION_RUN = r"(?:\[\d+(?:\s*[,，、]\s*\d+)*\])+(?!\()"
+# 引用番号だけの行（アウトラインの書式）と文中の引用番号を1回の走査で拾う
+CITATION_SCANNER = re.compile(
+    rf"^(?P<indent>[ \t]*)(?P<line>{_CITATION_RUN})[ \t]*(?P<eol>\n|$)|(?P<inline>{_CITATION_RUN})",
+    re.MULTILINE
+)
+_NUMBER = re.compile(r"\d+")
+# 情報源の文字列の中のURL行（参考文献リストに載せる）
+_SOURCE_URL = re.compile(r"^URL: (\S+)", re.MULTILINE)
+
+REFERENCES_HEADING = "## 参考文献"
+
+
+def extract_citations(text: str) -> List[int]:
+    """テキスト中の引用番号を出現順に重複なく返す"""
+    cited: Dict[int, None] = {}
+    for match in CITATION_SCANNER.finditer(text):
+        for number in _NUMBER.findall(match.group('line') or match.group('inline')):
+            cited.setdefault(int(number), None)
+    return list(cited)
+
+
+def section_citations(outline: str) -> Dict[str, List[int]]:
+    """
+    アウトラインの見出し（## / ###）ごとに、その節で引用された番号を出現順に返す。
+    ### の引用は親の ## にも含める（## の節は配下の ### の情報源をすべて使う）。
+    """
+    sections: Dict[str, Dict[int, None]] = {}
+    current: List[str] = []
+    for line in outline.split('\n'):
+        stripped = line.strip()
+        if stripped.startswith('## ') or stripped.startswith('### '):
+            heading = stripped.lstrip('#').strip()
+            if stripped.startswith('## '):
+                current = [heading]
+            else:
+                current = current[:1] + [heading]
+            for name in current:
+                sections.setdefault(name, {})
+            continue
+        for number in extract_citations(line):
+            for name in current:
+                sections[name].setdefault(number, None)
+    return {heading: list(numbers) for heading, numbers in sections.items()}
+
+
+def resolve_citations(text: str, source_count: int, renumber: bool = False) -> Dict[str, Any]:
+    """
+    引用番号を情報源の数と照合して、1回の走査で書き直す。
+    範囲外の番号（存在しない情報源）は削除し、同じ並びの中の重複はまとめる。
+    引用番号だけの行が空になった場合は行ごと削除する。
+
+    Args:
+        text: アウトラインやレポート本文
+        source_count: 情報源の数（有効な番号は1からsource_countまで）
+        renumber: 引用された情報源を初出順に1から振り直すか（参考文献の番号を詰める）
+
+    Returns:
+        {'text': 書き直したテキスト, 'cited': 引用された元の番号（初出順）,
+         'dropped': 削除した番号（初出順）, 'mapping': 元の番号から新しい番号への対応}
+    """
+    mapping: Dict[int, int] = {}
+    dropped: Dict[int, None] = {}
+
+    def rewrite(match: re.Match) -> str:
+        run = match.group('line') or match.group('inline')
+        numbers: List[int] = []
+        for number in map(int, _NUMBER.findall(run)):
+            if not 1 <= number <= source_count:
+                dropped.setdefault(number, None)
+                continue
+            if number not in mapping:
+                mapping[number] = len(mapping) + 1 if renumber else number
+            if mapping[number] not in numbers:
+                numbers.append(mapping[number])
+        rewritten = "".join(f"[{n}]" for n in numbers)
+        if match.group('line') is not None:
+            return f"{match.group('indent')}{rewritten}{match.group('eol')}" if rewritten else ""
+        return rewritten
+
+    resolved = CITATION_SCANNER.sub(rewrite, text)
+    if dropped:
+        logger.info("Dropped out-of-range citations",
+                    extra={'dropped': sorted(dropped), 'source_count': source_count})
+    return {'text': resolved, 'cited': list(mapping), 'dropped': list(dropped), 'mapping': mapping}
+
+
+def format_references(sources: Dict[str, str], mapping: Dict[int, int]) -> str:
+    """
+    実際に引用された情報源だけの参考文献リストを作る。
+
+    Args:
+        sources: 情報源（プロンプトに渡した順序で番号が1から振られている）
+        mapping: resolve_citations が返す元の番号から新しい番号への対応
+    """
+    entries = list(sources.items())
+    lines = []
+    for old, new in sorted(mapping.items(), key=lambda item: item[1]):
+        label, text = entries[old - 1]
+        url = _SOURCE_URL.search(text)
+        lines.append(f"[{new}] {label} {url.group(1)}" if url else f"[{new}] {label}")
+    return REFERENCES_HEADING + "\n" + "\n".join(lines)
+
+
+def add_references(report: str, sources: Optional[Dict[str, str]]) -> Dict[str, Any]:
+    """
+    レポートの引用番号を検証・振り直して、末尾に参考文献リストを付ける。
+
+    Returns:
+        resolve_citations の戻り値（'text' は参考文献リストを付けたレポート）
+    """
+    sources = sources or {}
+    resolved = resolve_citations(report, len(sources), renumber=True)
+    if resolved['mapping']:
+        resolved['text'] = resolved['text'].rstrip() + "\n\n" + format_references(sources, resolved['mapping'])
+    logger.info("Resolved citations", extra={'cited_count': len(resolved['cited']),
+                                             'dropped_count': len(resolved['dropped']),
+                                             'source_count': len(sources)})
+    return resolved
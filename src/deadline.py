@@ -0,0 +1,48 @@
+import time
+from typing import Optional
+
+
+class DeadlineExceeded(TimeoutError):
+    """時間予算を使い切ったときに送出される例外"""
+
+
+class Deadline:
+    """
+    パイプラインの時間予算（締め切り時刻）を表すクラス。
+    time.monotonicを基準にするので、システム時刻の変更の影響を受けない。
+    """
+
+    def __init__(self, seconds: float, expires_at: Optional[float] = None):
+        """
+        Args:
+            seconds: 現在からの予算（秒）
+            expires_at: 締め切り時刻（monotonic）。指定時はsecondsより優先
+        """
+        self.budget = seconds
+        self.expires_at = expires_at if expires_at is not None else time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        """残り時間（秒）。期限切れなら0"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        """期限切れかどうか"""
+        return time.monotonic() >= self.expires_at
+
+    def timeout(self, cap: Optional[float] = None) -> float:
+        """I/Oのタイムアウトに使う秒数（capを上限とする）"""
+        remaining = self.remaining()
+        return remaining if cap is None else min(cap, remaining)
+
+    def slice(self, fraction: float) -> 'Deadline':
+        """残り時間のうちfractionだけを割り当てた子の締め切りを返す（親より後にはならない）"""
+        seconds = self.remaining() * max(0.0, min(1.0, fraction))
+        return Deadline(seconds, expires_at=min(self.expires_at, time.monotonic() + seconds))
+
+    def check(self, what: str = "operation") -> None:
+        """期限切れならDeadlineExceededを送出する"""
+        if self.expired():
+            raise DeadlineExceeded(f"Deadline exceeded before {what}")
+
+    def __repr__(self) -> str:
+        return f"Deadline(remaining={self.remaining():.2f}s, budget={self.budget:.2f}s)"
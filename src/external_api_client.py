@@ -1,18 +1,26 @@
 import os
+import contextvars
+import threading
 import requests
-from typing import Dict, List
-from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional
 import logging
-from bs4 import BeautifulSoup
 import time
 
-# 環境変数を読み込み
-load_dotenv()
+from . import metrics
+from . import run_context
+from .bootstrap import bootstrap
+from .cache_backend import get_cache, make_key
+from .host_scheduler import get_scheduler
+from .deadline import DeadlineExceeded
 
-# ログ設定
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def has_results(result: str) -> bool:
+    """検索結果の文字列が実際の検索結果か（失敗や結果なしを知らせる定型文ならFalse）"""
+    return not result.startswith(("No results found", "Search error", "Basic search completed"))
+
+
 class ExternalApiClient:
     """
     外部API(Web検索)と通信するクライアント。
@@ -21,45 +29,157 @@ class ExternalApiClient:
         """
         APIクライアントの初期化
         """
+        bootstrap()
         self.google_api_key = os.getenv('GOOGLE_CUSTOM_SEARCH_API_KEY')
         self.google_engine_id = os.getenv('GOOGLE_CUSTOM_SEARCH_ENGINE_ID')
         self.serpapi_key = os.getenv('SERPAPI_API_KEY')
         
+        # 並列検索の設定（リクエスト開始の間隔は全スレッド共通で守る）
+        self.max_concurrency = int(os.getenv('SEARCH_CONCURRENCY', '4'))
+        self.request_interval = float(os.getenv('SEARCH_REQUEST_INTERVAL', '1.0'))
+        self.request_timeout = float(os.getenv('SEARCH_REQUEST_TIMEOUT', '10'))
+        self._throttle_lock = threading.Lock()
+        self._next_request_at = 0.0
+        # 検索結果はレプリカ間で共有するキャッシュに保存する（TTLは settings.yaml の cache.namespaces.search）
+        self.search_cache = get_cache('search')
+        
         # セッション設定
         self.session = requests.Session()
         self.session.headers.update({
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
         })
         
-        print("ExternalApiClient initialized.")
+        logger.info("ExternalApiClient initialized.")
 
     def search(self, search_topics: list[str]) -> dict[str, str]:
         """
         与えられた検索トピックのリストに基づいてWeb検索を実行する。
+        実行中のパイプラインに時間予算があれば、期限までに終わらなかった検索は打ち切る。
 
         Args:
             search_topics: 検索トピックのリスト
 
         Returns:
-            各トピックをキーとし、検索結果の要約を値とする辞書
+            各トピックをキーとし、検索結果の要約を値とする辞書（打ち切られたトピックは含まない）
+        """
+        logger.info("Searching the web", extra={'topic_count': len(search_topics)})
+        all_results = self.run_searches({topic: topic for topic in search_topics}, self._search_topic,
+                                        cache_as=self.search_provider())
+        logger.info("Finished web search", extra={'result_count': len(all_results)})
+        return all_results
+
+    def search_provider(self) -> str:
+        """_search_topic が使う検索方法の名前（検索結果のキャッシュキーに使う）"""
+        if self.google_api_key and self.google_engine_id:
+            return 'google_custom'
+        if self.serpapi_key:
+            return 'serpapi'
+        return 'basic_web'
+
+    @staticmethod
+    def _cacheable(result: str) -> bool:
+        """一時的な失敗の結果はキャッシュしない"""
+        return has_results(result)
+
+    def run_searches(self, queries: Dict[str, str], search_fn: Callable[[str], str],
+                     cache_as: Optional[str] = None) -> Dict[str, str]:
+        """
+        複数の検索を並列に実行する。
+
+        Args:
+            queries: 結果のキーと検索クエリの辞書
+            search_fn: 検索クエリを受け取り結果の文字列を返す関数
+            cache_as: 検索方法の名前。指定すると検索結果のキャッシュを使う（キャッシュにあった検索は送らない）
+
+        Returns:
+            キーと検索結果の辞書（queriesの順序を保つ）
         """
-        print(f"Searching the web for topics: {search_topics}")
-        all_results = {}
+        if not queries:
+            return {}
+
+        results = {}
+        if cache_as is not None:
+            for key, query in queries.items():
+                cached = self.search_cache.get(make_key(cache_as, query))
+                if cached is not None:
+                    results[key] = cached
+            if results:
+                logger.info("Search cache hits", extra={'hit_count': len(results), 'query_count': len(queries)})
+                self._count_searches(cache_as, 'cache_hit', len(results))
+            if len(results) == len(queries):
+                return {key: results[key] for key in queries}
+
+        deadline = run_context.current_deadline()
+        if deadline is not None and deadline.expired():
+            run_context.mark_truncated(None, "no time left before searching")
+            return {key: results[key] for key in queries if key in results}
+
+        executor = ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(queries) - len(results)),
+                                      thread_name_prefix="search")
+        futures = {}
+        provider = cache_as or getattr(search_fn, '__name__', 'search').lstrip('_')
+        for key, query in queries.items():
+            if key in results:
+                continue
+            # 実行コンテキスト（締め切りなど）を検索スレッドへ引き継ぐ
+            context = contextvars.copy_context()
+            futures[executor.submit(context.run, self._throttled_search, search_fn, query, provider)] = key
 
-        for topic in search_topics:
+        done, not_done = wait(futures, timeout=deadline.remaining() if deadline is not None else None)
+        executor.shutdown(wait=False, cancel_futures=True)
+
+        for future in done:
+            key = futures[future]
             try:
-                # レート制限を避けるため少し待機
-                time.sleep(1)
-                
-                search_result = self._search_topic(topic)
-                all_results[topic] = search_result
-                
+                results[key] = future.result()
+                if cache_as is not None and self._cacheable(results[key]):
+                    self.search_cache.set(make_key(cache_as, queries[key]), results[key])
+            except DeadlineExceeded:
+                not_done.add(future)
             except Exception as e:
-                print(f"Error searching for topic '{topic}': {e}")
-                all_results[topic] = f"No results found for '{topic}'."
+                self._count_searches(provider, 'error')
+                logger.warning(f"Error searching for topic '{queries[key]}': {e}")
+                results[key] = f"No results found for '{queries[key]}'."
 
-        print(f"Finished web search. Found results for {len(all_results)} topics.")
-        return all_results
+        if not_done:
+            run_context.mark_truncated(None, f"{len(not_done)}/{len(futures)} searches cancelled by deadline")
+
+        return {key: results[key] for key in queries if key in results}
+
+    def _throttled_search(self, search_fn: Callable[[str], str], query: str, provider: str = 'search') -> str:
+        """レート制限を避けるため、リクエストの開始間隔を空けてから検索する"""
+        with self._throttle_lock:
+            now = time.monotonic()
+            start_at = max(now, self._next_request_at)
+            self._next_request_at = start_at + self.request_interval
+
+        delay = start_at - time.monotonic()
+        if delay > 0:
+            deadline = run_context.current_deadline()
+            if deadline is not None and delay >= deadline.remaining():
+                raise DeadlineExceeded(f"No time left to search '{query}'")
+            time.sleep(delay)
+            run_context.record_wait('search_throttle', delay)
+
+        started = time.perf_counter()
+        result = search_fn(query)
+        metrics.histogram('search_request_duration_seconds', "Search latency, excluding throttling",
+                          ('provider',)).observe(time.perf_counter() - started, provider=provider)
+        self._count_searches(provider, 'ok' if self._cacheable(result) else 'error')
+        return result
+
+    @staticmethod
+    def _count_searches(provider: str, result: str, amount: int = 1) -> None:
+        metrics.counter('search_requests_total', "Searches by provider and result (cache_hit, ok, error)",
+                        ('provider', 'result')).inc(amount, provider=provider, result=result)
+
+    def _timeout(self) -> float:
+        """HTTPリクエストのタイムアウト（時間予算があれば残り時間を上限とする）"""
+        deadline = run_context.current_deadline()
+        if deadline is None:
+            return self.request_timeout
+        deadline.check("HTTP request")
+        return max(0.1, deadline.timeout(cap=self.request_timeout))
     
     def _search_topic(self, topic: str) -> str:
         """個別のトピックを検索する"""
@@ -73,8 +193,16 @@ class ExternalApiClient:
             # フォールバック: 基本的なWebスクレイピング
             return self._search_basic_web(topic)
     
+    @staticmethod
+    def _format_hit(title: str, link: str, snippet: str) -> str:
+        """検索結果1件を文字列にする（URLは本文の取得と参考文献リストに使う）"""
+        url_line = f"URL: {link}\n" if link else ""
+        return f"Title: {title}\n{url_line}Snippet: {snippet}"
+
     def _search_google_custom(self, topic: str) -> str:
         """Google Custom Search APIを使用して検索"""
+        # 時間切れ（DeadlineExceeded）は検索エラーの文字列にせず、呼び出し側に伝える
+        timeout = self._timeout()
         try:
             url = "https://www.googleapis.com/customsearch/v1"
             params = {
@@ -84,7 +212,7 @@ class ExternalApiClient:
                 'num': 5  # 最大5件の結果
             }
             
-            response = self.session.get(url, params=params)
+            response = self.session.get(url, params=params, timeout=timeout)
             response.raise_for_status()
             
             data = response.json()
@@ -92,9 +220,7 @@ class ExternalApiClient:
             
             if 'items' in data:
                 for item in data['items']:
-                    title = item.get('title', '')
-                    snippet = item.get('snippet', '')
-                    results.append(f"Title: {title}\nSnippet: {snippet}")
+                    results.append(self._format_hit(item.get('title', ''), item.get('link', ''), item.get('snippet', '')))
             
             return "\n\n".join(results) if results else f"No results found for '{topic}'"
             
@@ -104,6 +230,7 @@ class ExternalApiClient:
     
     def _search_serpapi(self, topic: str) -> str:
         """SerpAPIを使用して検索"""
+        timeout = self._timeout()
         try:
             url = "https://serpapi.com/search"
             params = {
@@ -113,7 +240,7 @@ class ExternalApiClient:
                 'num': 5
             }
             
-            response = self.session.get(url, params=params)
+            response = self.session.get(url, params=params, timeout=timeout)
             response.raise_for_status()
             
             data = response.json()
@@ -121,9 +248,8 @@ class ExternalApiClient:
             
             if 'organic_results' in data:
                 for result in data['organic_results'][:5]:
-                    title = result.get('title', '')
-                    snippet = result.get('snippet', '')
-                    results.append(f"Title: {title}\nSnippet: {snippet}")
+                    results.append(self._format_hit(result.get('title', ''), result.get('link', ''),
+                                                    result.get('snippet', '')))
             
             return "\n\n".join(results) if results else f"No results found for '{topic}'"
             
@@ -144,9 +270,12 @@ class ExternalApiClient:
             results = []
             for url in search_urls[:1]:  # 最初のURLのみ使用
                 try:
-                    response = self.session.get(url, timeout=10)
+                    # 検索エンジンへの直接アクセスはホストごとのペース配分とrobots.txtに従う
+                    response = get_scheduler().get(url, timeout=self._timeout())
                     response.raise_for_status()
                     
+                    # BeautifulSoupは読み込みが重く、フォールバック検索でしか使わないのでここで読み込む
+                    from bs4 import BeautifulSoup
                     soup = BeautifulSoup(response.content, 'html.parser')
                     
                     # 検索結果のタイトルとスニペットを抽出
@@ -156,19 +285,26 @@ class ExternalApiClient:
                         snippet_elem = result.find('div', class_='VwiC3b')
                         
                         if title_elem and snippet_elem:
-                            title = title_elem.get_text().strip()
-                            snippet = snippet_elem.get_text().strip()
-                            results.append(f"Title: {title}\nSnippet: {snippet}")
+                            link_elem = title_elem.find_parent('a') or result.find('a', href=True)
+                            link = link_elem.get('href', '') if link_elem is not None else ''
+                            results.append(self._format_hit(title_elem.get_text().strip(),
+                                                            link if link.startswith('http') else '',
+                                                            snippet_elem.get_text().strip()))
                     
                     if results:
                         break
                         
+                except DeadlineExceeded:
+                    raise
                 except Exception as e:
                     logger.error(f"Basic web search error: {e}")
                     continue
             
             return "\n\n".join(results) if results else f"Basic search completed for '{topic}'"
             
+        except DeadlineExceeded:
+            # 時間切れは検索エラーの文字列にせず、呼び出し側に伝える
+            raise
         except Exception as e:
             logger.error(f"Basic web search error: {e}")
             return f"Search error for '{topic}': {str(e)}"
@@ -0,0 +1,237 @@
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, List, Pattern
+import logging
+
+logger = logging.getLogger(__name__)
+
+# パターンの部品
+_BE = r"(?:am|is|are|was|were|be|been|being|'m|'re)"
+# 進行形の be（been は完了進行形の規則で扱う。裸の be は助動詞・to の後だけ。"between will and be going to" を拾わない）
+_BE_PROGRESSIVE = r"(?:am|is|are|was|were|'m|'re|(?:will|would|can|could|may|might|must|should|to)\s+be)"
+_IRREGULAR_PP = (
+    "been|done|gone|seen|taken|written|given|known|made|said|told|found|thought|brought|bought|caught|taught|"
+    "built|sent|spent|left|lost|met|read|heard|held|kept|felt|paid|put|set|cut|hit|let|shut|run|come|become|"
+    "begun|broken|chosen|driven|eaten|fallen|forgotten|gotten|got|grown|hidden|ridden|risen|shaken|shown|spoken|"
+    "stolen|sung|swum|thrown|understood|woken|worn|won|drawn|drunk|flown|sold|stood|sat|slept|fed|led|meant|"
+    "born|beaten|bitten|blown"
+)
+# 不規則動詞の原形
+_IRREGULAR_VERBS = (
+    "be have do go get make take come see know give find think tell become leave feel bring begin keep hold write "
+    "stand hear let mean set meet run pay sit speak lie lead read grow lose fall send build understand draw break "
+    "spend cut rise drive buy wear choose throw catch win forget teach sell fight eat drink sleep sing swim fly ride "
+    "wake shake steal hide bite blow feed hit put say shut beat forgive"
+).split()
+# 規則動詞の原形（-ed・-ing の形はここから作る。語尾が -ed・-ing でも動詞でない語 "red" "spring" などは拾わない）
+_REGULAR_VERBS = (
+    "accept add agree allow answer appear apply arrive ask believe belong borrow call carry change check clean climb "
+    "close collect compare complete consider contain continue cook copy correct count cover cross cry dance decide "
+    "deliver depend describe design destroy develop die discover discuss dress drop earn end enjoy enter explain "
+    "fail fill finish fix follow found guess happen hate help hope hurry imagine improve include increase introduce "
+    "invent invite join jump kill kiss knock laugh learn like listen live look love marry mention miss move need "
+    "notice offer open order own paint pass pick plan play point practice praise prefer prepare present prevent "
+    "produce promise protect provide publish pull push reach realize receive recommend relax remember repeat reply "
+    "report respect rest return save seem serve share shop shout smile solve start stay stop study succeed suggest "
+    "support surprise talk taste thank touch translate travel try turn use visit wait walk want wash watch work "
+    "worry interest excite bore tire please satisfy disappoint confuse amaze shock scare injure damage elect name "
+    "kick form admit occur refer regret"
+).split()
+# 語末の子音字を重ねて -ed・-ing を付ける動詞
+_DOUBLED = set("stop plan drop prefer shop admit occur refer regret run sit get swim begin put cut hit let set shut "
+               "win forget".split())
+
+
+def _ed_form(verb: str) -> str:
+    if verb in _DOUBLED:
+        return verb + verb[-1] + "ed"
+    if verb.endswith("e"):
+        return verb + "d"
+    if verb.endswith("y") and verb[-2] not in "aeiou":
+        return verb[:-1] + "ied"
+    return verb + "ed"
+
+
+def _ing_form(verb: str) -> str:
+    if verb in _DOUBLED:
+        return verb + verb[-1] + "ing"
+    if verb.endswith("ie"):
+        return verb[:-2] + "ying"
+    if verb.endswith("e") and verb not in ("be", "see", "agree", "free"):
+        return verb[:-1] + "ing"
+    return verb + "ing"
+
+
+def _alternation(words) -> str:
+    # 長い語を先に並べ、短い語に先に一致しないようにする
+    return "(?:" + "|".join(sorted(set(words), key=len, reverse=True)) + ")"
+
+
+_VERB = _alternation(_IRREGULAR_VERBS + _REGULAR_VERBS)
+_REGULAR_ED = _alternation(_ed_form(verb) for verb in _REGULAR_VERBS)
+_PP = rf"(?:{_REGULAR_ED}|{_IRREGULAR_PP})"
+_ING = _alternation(_ing_form(verb) for verb in _IRREGULAR_VERBS + _REGULAR_VERBS)
+_PRONOUN = r"(?:me|you|him|her|us|them|it)"
+
+
+@dataclass(frozen=True)
+class GrammarRule:
+    """
+    文法項目を見つけるパターン。
+    同じfamilyの規則は表の先にあるものほど具体的で、範囲が重なる後の規則の一致は捨てる
+    （現在完了進行形に一致した箇所を、現在完了形や進行形としても挙げないため）。
+    precise が False の規則は形だけでは紛らわしい（"My hobby is reading books." の動名詞を進行形と取るなど）ので、
+    一致した英文の判定はLLMに任せる。
+    """
+    name: str
+    family: str
+    description: str
+    pattern: Pattern
+    precise: bool = True
+
+
+def _rule(name: str, family: str, description: str, pattern: str, precise: bool = True,
+          flags: int = re.IGNORECASE) -> GrammarRule:
+    return GrammarRule(name, family, description, re.compile(pattern, flags), precise)
+
+
+# 文法項目の表（モジュールの読み込み時に1回だけコンパイルする）
+GRAMMAR_RULES = (
+    _rule("仮定法過去完了", "conditional", "過去の事実に反する仮定を表します",
+          rf"\bif\b[^.?!]*?\bhad\s+{_PP}\b[^.?!]*?\b(?:would|could|might)\s+have\s+{_PP}\b"),
+    _rule("仮定法過去", "conditional", "現在の事実に反する仮定や、実現の可能性が低い願望を表します",
+          rf"\bif\b[^.?!]*?\b(?:were|had|{_REGULAR_ED})\b[^.?!]*?\b(?:would|could|might)\s+(?!have\b)[a-z]+\b"
+          r"|\bI\s+wish\s+\w+\s+(?:were|had|could|would)\b", precise=False),
+    _rule("未来完了形", "tense", "未来のある時点までに完了している動作や状態を表します",
+          rf"\bwill\s+have\s+{_PP}\b"),
+    _rule("現在完了進行形", "tense", "過去のある時点から現在まで継続している動作を表します",
+          rf"\b(?:have|has|'ve)\s+been\s+{_ING}\b"),
+    _rule("過去完了進行形", "tense", "過去のある時点までそれ以前から継続していた動作を表します",
+          rf"\bhad\s+been\s+{_ING}\b"),
+    _rule("過去完了形", "tense", "過去のある時点までに完了していた動作や、それまでの経験・継続を表します",
+          rf"\bhad\s+(?:not\s+|never\s+|already\s+|just\s+)?{_PP}\b"),
+    _rule("現在完了形", "tense", "過去の出来事が現在とつながっていること（完了・経験・継続）を表します",
+          rf"\b(?:have|has|'ve)\s+(?:not\s+|never\s+|ever\s+|already\s+|just\s+|yet\s+)?{_PP}\b"),
+    _rule("進行形", "tense", "ある時点で進行中の動作を表します",
+          rf"\b{_BE_PROGRESSIVE}\s+(?:not\s+)?{_ING}\b", precise=False),
+    _rule("未来表現", "future", "未来の予定・意志・予測を表します",
+          rf"\b(?:will|won't|'ll)\s+(?:not\s+)?(?!have\b){_VERB}\b"
+          rf"|\b(?:am|is|are|was|were|'m|'re)\s+going\s+to\s+{_VERB}\b"),
+    _rule("助動詞", "modal", "動詞に可能・義務・推量などの意味を加えます",
+          r"\b(?:can|could|may|might|must|should|would|shall|(?:have|has|had)\s+to)\s+(?:not\s+)?[a-z]+\b"),
+    _rule("受動態", "voice", "「〜される」という、動作を受ける側を主語にした表現です",
+          rf"\b{_BE}\s+(?:not\s+)?(?:[a-z]+ly\s+)?{_PP}\b(?:\s+by\b)?"),
+    _rule("形式主語構文", "infinitive", "itを仮の主語にして、真の主語である不定詞を後ろに置く表現です",
+          rf"\bit\s+(?:is|was|'s)\s+[a-z]+\s+(?:for\s+\w+\s+)?to\s+{_VERB}\b"),
+    _rule("too ~ to構文", "infinitive", "「あまりに〜なので…できない」という意味を表します",
+          rf"\btoo\s+[a-z]+\s+(?:for\s+\w+\s+)?to\s+{_VERB}\b"),
+    _rule("不定詞", "infinitive", "to＋動詞の原形で、名詞・形容詞・副詞の働きをします",
+          # 固有名詞（"went to Tokyo"）を拾わないよう大文字小文字を区別する。"go to work" のような名詞もあるのでLLMに任せる
+          rf"\b[Tt]o\s+{_VERB}\b", precise=False, flags=0),
+    _rule("動名詞", "gerund", "動詞の-ing形で「〜すること」という名詞の働きをします",
+          rf"\b(?:enjoy|enjoys|enjoyed|finish|finished|stop|stopped|mind|avoid|keep|kept|practice|"
+          rf"give\s+up|gave\s+up|like|love|start|started|began|begin)\s+{_ING}\b"
+          rf"|\b(?:of|in|at|for|about|without|before|after|by)\s+{_ING}\b"),
+    _rule("間接疑問文", "clause", "疑問詞で始まる節が文の一部（目的語など）になる表現です",
+          rf"\b(?:know|knows|knew|tell|ask|asked|wonder|understand|explain|remember|forget|sure)\s+"
+          rf"(?:{_PRONOUN}\s+)?(?:what|where|when|why|how|who|which|if|whether)\s+\w+"),
+    _rule("関係副詞", "clause", "場所・時・理由などを表す名詞を後ろから説明する節を導きます",
+          r"\b(?:place|time|day|year|reason|way|house|city|town|room|country|school)\s+(?:where|when|why)\s+\w+"),
+    _rule("関係代名詞", "clause", "名詞を後ろから説明する節を導きます",
+          r"(?<=[a-z])\s+(?:who|whom|whose|which)\s+\w+|\b(?:the|a|an)\s+[a-z]+\s+that\s+[a-z]+"),
+    _rule("接続詞that", "conjunction", "thatで始まる節が動詞の目的語になる表現です",
+          r"\b(?:think|thinks|thought|know|knows|knew|believe|believes|believed|hope|hopes|hoped|say|says|said|"
+          r"feel|feels|felt)\s+that\b"),
+    _rule("使役動詞", "causative", "「（人）に〜させる」という意味を表します",
+          rf"\b(?:make|makes|made|let|lets)\s+{_PRONOUN}\s+{_VERB}\b"),
+    _rule("比較級", "comparison", "2つのものを比べて「より〜」を表します",
+          r"\b(?!(?:other|rather|never|ever|under|over|after)\b)(?:[a-z]+er|more\s+[a-z]+|less\s+[a-z]+|better|worse)"
+          r"\s+than\b"),
+    _rule("最上級", "comparison", "3つ以上の中で「最も〜」を表します",
+          r"\bthe\s+(?:[a-z]+est|most\s+[a-z]+|least\s+[a-z]+|best|worst)\b"),
+    _rule("原級比較", "comparison", "as 〜 as で「同じくらい〜」を表します",
+          r"\bas\s+(?:many\s+|much\s+)?[a-z]+\s+as\b"),
+    _rule("付加疑問文", "question", "文末に短い疑問形を付けて、確認や同意を求めます",
+          r",\s*(?:isn't|aren't|wasn't|weren't|don't|doesn't|didn't|can't|won't|haven't|hasn't|is|are|do|does|did|"
+          r"can|will|have|has)\s+(?:it|he|she|they|you|we|I|there)\s*\?"),
+)
+
+# 日本語の混じったクエリから英文を取り出す（3語以上の英字の並び）
+_ENGLISH_SENTENCE = re.compile(r"[A-Za-z][A-Za-z0-9',;:\- ]*[A-Za-z0-9'][.?!]?")
+_QUOTES = str.maketrans({'’': "'", '‘': "'", '“': '"', '”': '"'})
+
+
+@dataclass(frozen=True)
+class GrammarMatch:
+    """英文中で見つかった文法項目と、その箇所"""
+    rule: GrammarRule
+    sentence: str
+    start: int
+    end: int
+
+    @property
+    def span(self) -> str:
+        return self.sentence[self.start:self.end].strip()
+
+    def example(self) -> str:
+        """該当箇所を太字にした例文"""
+        start = self.start + len(self.sentence[self.start:self.end]) - len(self.sentence[self.start:self.end].lstrip())
+        return f"{self.sentence[:start]}**{self.span}**{self.sentence[self.end:]}"
+
+
+def english_sentences(text: str) -> List[str]:
+    """テキストに含まれる英文を出現順に返す"""
+    text = text.translate(_QUOTES)
+    return [match.group(0).strip() for match in _ENGLISH_SENTENCE.finditer(text)
+            if len(match.group(0).split()) >= 3]
+
+
+def find_grammar_items(sentence: str) -> List[GrammarMatch]:
+    """1つの英文に含まれる文法項目を、文中の出現順に返す"""
+    matches: List[GrammarMatch] = []
+    claimed: Dict[str, List[tuple]] = {}
+    for rule in GRAMMAR_RULES:
+        for found in rule.pattern.finditer(sentence):
+            start, end = found.span()
+            spans = claimed.setdefault(rule.family, [])
+            if any(start < other_end and other_start < end for other_start, other_end in spans):
+                continue
+            spans.append((start, end))
+            matches.append(GrammarMatch(rule, sentence, start, end))
+    return sorted(matches, key=lambda match: match.start)
+
+
+def analyze(text: str) -> Dict[str, Any]:
+    """
+    テキスト中の英文を文法項目のパターン表で解析する。
+
+    Returns:
+        {'sentences': 英文, 'matches': 見つかった文法項目（文の順・文中の出現順）,
+         'unclassified': 文法項目が1つも見つからなかったか、紛らわしい規則（precise=False）に一致した英文。
+                         これらの英文の項目は matches に含めず、LLMに判定させる}
+    """
+    sentences = english_sentences(text)
+    matches: List[GrammarMatch] = []
+    unclassified: List[str] = []
+    for sentence in sentences:
+        found = find_grammar_items(sentence)
+        if found and all(match.rule.precise for match in found):
+            matches.extend(found)
+        else:
+            unclassified.append(sentence)
+    return {'sentences': sentences, 'matches': matches, 'unclassified': unclassified}
+
+
+def format_items(matches: List[GrammarMatch]) -> str:
+    """
+    関連文法事項の箇条書きにする（文法項目ごとに1行、例は最初に見つかった箇所）。
+    形式は related_topics プロンプトの出力フォーマットと同じ。
+    """
+    lines = []
+    seen = set()
+    for match in matches:
+        if match.rule.name in seen:
+            continue
+        seen.add(match.rule.name)
+        lines.append(f"- **{match.rule.name}**: {match.rule.description}。例: \"{match.example()}\"")
+    return "\n".join(lines)
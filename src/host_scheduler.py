@@ -0,0 +1,369 @@
+import contextvars
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Dict, Optional, TypeVar
+from urllib.parse import urlsplit
+from urllib.robotparser import RobotFileParser
+import logging
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .settings import get_section
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+USER_AGENT = "EnglishReportPipeline/1.0 (report source fetcher)"
+# ブロックされたとみなす応答（ホストごとにバックオフする）
+BLOCK_STATUSES = (429, 503)
+
+
+class DisallowedByRobots(PermissionError):
+    """robots.txtで取得が禁止されているURLを取得しようとしたときに送出される例外"""
+
+
+class _Request(Future):
+    """ホストのキューに積んだリクエストのFuture（呼び出し側が待つのをやめたら abandoned にして積み直さない）"""
+
+    def __init__(self, host: str):
+        super().__init__()
+        self.host = host
+        self.abandoned = False
+
+
+class _Host:
+    """1つのホストのキュー・接続プール・ペース配分の状態"""
+
+    def __init__(self, name: str, session: requests.Session, concurrency: int, interval: float):
+        self.name = name
+        self.session = session
+        self.concurrency = concurrency
+        self.interval = interval
+        self.queue: deque = deque()
+        self.in_flight = 0
+        # 次のリクエストを開始してよい時刻（interval・Crawl-delay・バックオフで決まる）
+        self.next_start = 0.0
+        self.strikes = 0
+        self.robots: Optional[RobotFileParser] = None
+        self.robots_checked_at = 0.0
+        self.robots_lock = threading.Lock()
+        # 最後にリクエストを積んだか終えた時刻（しばらく使われないホストは接続プールごと破棄する）
+        self.last_used = time.monotonic()
+
+    def idle(self) -> bool:
+        return not self.queue and self.in_flight == 0
+
+    def ready_at(self) -> float:
+        """キューの先頭を開始できる時刻（同時接続数が埋まっていれば無限大）"""
+        if not self.queue or self.in_flight >= self.concurrency:
+            return float('inf')
+        return self.next_start
+
+
+class HostScheduler:
+    """
+    スクレイピングやページ取得のHTTPリクエストをホストごとに統制するプロセス共通のスケジューラー。
+    ホストごとに接続プール・同時接続数・リクエスト間隔を持ち、robots.txtに従う。
+    リクエストはホストごとのキューに積み、ワーカーは開始できるホストを順番に回って取り出す
+    （1つのホストに大量のリクエストがあっても、他のホストのリクエストが待たされない）。
+    429/503を受けたホストはretry-afterかジッター付きの指数バックオフの間止め、リクエストを積み直す。
+    idle_ttl 秒使われなかったホストは、セッション（接続プール）ごと破棄する。
+    """
+
+    def __init__(self, max_workers: int = 16, per_host_concurrency: int = 2, per_host_interval: float = 1.0,
+                 respect_robots: bool = True, robots_ttl: float = 3600.0, max_retries: int = 2,
+                 base_delay: float = 2.0, max_delay: float = 120.0, idle_ttl: float = 300.0,
+                 user_agent: str = USER_AGENT,
+                 hosts: Optional[Dict[str, Dict[str, Any]]] = None,
+                 session_factory: Optional[Callable[[str], requests.Session]] = None):
+        """
+        Args:
+            max_workers: 全ホスト合計の同時リクエスト数
+            per_host_concurrency: 1ホストあたりの同時接続数
+            per_host_interval: 1ホストへのリクエスト開始の最小間隔（秒）
+            respect_robots: robots.txtに従うか
+            robots_ttl: robots.txtを取得し直すまでの秒数
+            max_retries: ブロックされたリクエストを積み直す最大回数
+            base_delay: バックオフの基準秒数
+            max_delay: バックオフの最大秒数
+            idle_ttl: 使われなくなったホストの状態と接続プールを破棄するまでの秒数
+            user_agent: 送信するUser-Agent（robots.txtの判定にも使う）
+            hosts: ホストごとの設定の上書き（{'www.mext.go.jp': {'concurrency': 4, 'interval': 0.5}}）
+            session_factory: ホスト名を受け取りセッションを返す関数（省略時はホストごとに接続プールを作る）
+        """
+        self.max_workers = max_workers
+        self.per_host_concurrency = per_host_concurrency
+        self.per_host_interval = per_host_interval
+        self.respect_robots = respect_robots
+        self.robots_ttl = robots_ttl
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.idle_ttl = idle_ttl
+        self.user_agent = user_agent
+        self.host_overrides = hosts or {}
+        self.session_factory = session_factory or self._new_session
+
+        self._hosts: Dict[str, _Host] = {}
+        # ホストを回る順番（公平に交互に取り出すため、取り出したホストは末尾に回す）
+        self._rotation: deque = deque()
+        self._condition = threading.Condition()
+        self._workers: list = []
+        self._swept_at = time.monotonic()
+        self.stats_counters = {'requests': 0, 'blocked': 0, 'retries': 0, 'disallowed': 0, 'evicted': 0}
+
+    def _new_session(self, host: str) -> requests.Session:
+        session = requests.Session()
+        pool_size = int((self.host_overrides.get(host) or {}).get('concurrency', self.per_host_concurrency))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers.update({'User-Agent': self.user_agent})
+        return session
+
+    def _host(self, name: str) -> _Host:
+        """ホストの状態を返す（初回に生成。呼び出し側で self._condition を保持すること）"""
+        host = self._hosts.get(name)
+        if host is None:
+            override = self.host_overrides.get(name) or {}
+            host = _Host(name, self.session_factory(name),
+                         int(override.get('concurrency', self.per_host_concurrency)),
+                         float(override.get('interval', self.per_host_interval)))
+            self._hosts[name] = host
+            self._rotation.append(host)
+        host.last_used = time.monotonic()
+        return host
+
+    def _evict_idle(self) -> None:
+        """idle_ttl 秒使われていないホストを破棄する（呼び出し側で self._condition を保持すること）"""
+        now = time.monotonic()
+        if now - self._swept_at < min(60.0, self.idle_ttl):
+            return
+        self._swept_at = now
+        for name, host in list(self._hosts.items()):
+            if host.idle() and now - host.last_used >= self.idle_ttl:
+                del self._hosts[name]
+                self._rotation.remove(host)
+                self.stats_counters['evicted'] += 1
+                try:
+                    host.session.close()
+                except Exception as e:
+                    logger.debug(f"Could not close the session for {name}: {e}")
+
+    def _ensure_workers(self) -> None:
+        if len(self._workers) >= self.max_workers:
+            return
+        for i in range(len(self._workers), self.max_workers):
+            worker = threading.Thread(target=self._work, name=f"host-scheduler-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, url: str, fn: Callable[[requests.Session], T]) -> 'Future[T]':
+        """
+        URLのホストのキューにリクエストを積む。fnはワーカーでホストのセッションを受け取って実行される。
+        戻り値（requests.Responseなど）が status_code を持ち429/503なら、バックオフしてから積み直す。
+
+        Returns:
+            fnの戻り値を受け取るFuture（robots.txtで禁止されていれば DisallowedByRobots）
+        """
+        name = urlsplit(url).netloc.lower()
+        future = _Request(name)
+        # 呼び出し元の実行コンテキスト（締め切り）をワーカーに引き継ぐ
+        task = {'url': url, 'fn': fn, 'future': future, 'context': contextvars.copy_context(), 'attempt': 0}
+        with self._condition:
+            self._evict_idle()
+            host = self._host(name)
+            host.queue.append(task)
+            self._ensure_workers()
+            self._condition.notify()
+        return future
+
+    def run(self, url: str, fn: Callable[[requests.Session], T], timeout: Optional[float] = None) -> T:
+        """
+        submitして結果を待つ。timeout秒（キューでの待ちとバックオフを含む）で終わらなければリクエストを取り消し、
+        TimeoutError を送出する。
+        """
+        future = self.submit(url, fn)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            self.cancel(future)
+            raise TimeoutError(f"Gave up waiting for {url} after {timeout:.1f}s") from None
+
+    def get(self, url: str, timeout: Optional[float] = None, **kwargs: Any) -> requests.Response:
+        """
+        ホストのキューを通してGETし、応答を待つ。timeoutはHTTPリクエストのタイムアウトで、
+        キューでの待ちとバックオフも含めて応答を待つ上限にもする（時間予算を超えて待たない）。
+        """
+        return self.run(url, lambda session: session.get(url, timeout=timeout, **kwargs), timeout=timeout)
+
+    def cancel(self, future: 'Future[Any]') -> None:
+        """待つのをやめたリクエストを取り消す（キューにあれば取り除き、実行中のものは積み直さない）"""
+        if not isinstance(future, _Request):
+            future.cancel()
+            return
+        with self._condition:
+            future.abandoned = True
+            host = self._hosts.get(future.host)
+            if host is not None:
+                for task in [task for task in host.queue if task['future'] is future]:
+                    host.queue.remove(task)
+        future.cancel()
+
+    def _next_task(self) -> tuple:
+        """開始できるホストを順番に回ってリクエストを取り出す（なければ開始できるまで待つ）"""
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                earliest = float('inf')
+                for _ in range(len(self._rotation)):
+                    host = self._rotation[0]
+                    self._rotation.rotate(-1)
+                    ready_at = host.ready_at()
+                    if ready_at <= now:
+                        host.in_flight += 1
+                        host.next_start = now + host.interval
+                        return host, host.queue.popleft()
+                    earliest = min(earliest, ready_at)
+                self._condition.wait(timeout=None if earliest == float('inf') else earliest - now)
+
+    def _work(self) -> None:
+        while True:
+            host, task = self._next_task()
+            requeue = False
+            try:
+                if task['future'].abandoned:
+                    # 呼び出し側が待つのをやめた（積み直した）リクエストは送らない
+                    if task['future'].running():
+                        task['future'].set_exception(TimeoutError(f"Request to {task['url']} was cancelled"))
+                # 積み直したリクエストのFutureは既に実行中になっている
+                elif task['attempt'] > 0 or task['future'].set_running_or_notify_cancel():
+                    requeue = task['context'].run(self._execute, host, task)
+            finally:
+                with self._condition:
+                    host.in_flight -= 1
+                    host.last_used = time.monotonic()
+                    if requeue:
+                        host.queue.appendleft(task)
+                    self._condition.notify_all()
+
+    def _execute(self, host: _Host, task: Dict[str, Any]) -> bool:
+        """リクエストを実行してFutureに結果を設定する（積み直す場合はTrue）"""
+        future = task['future']
+        try:
+            if self.respect_robots and not self._allowed(host, task['url']):
+                with self._condition:
+                    self.stats_counters['disallowed'] += 1
+                raise DisallowedByRobots(f"robots.txt disallows {task['url']}")
+            result = task['fn'](host.session)
+        except BaseException as e:
+            future.set_exception(e)
+            return False
+
+        with self._condition:
+            self.stats_counters['requests'] += 1
+        if getattr(result, 'status_code', None) in BLOCK_STATUSES:
+            self._on_blocked(host, _retry_after(getattr(result, 'headers', None)))
+            if task['attempt'] < self.max_retries and not future.abandoned:
+                task['attempt'] += 1
+                with self._condition:
+                    self.stats_counters['retries'] += 1
+                return True
+        else:
+            self._on_success(host)
+        future.set_result(result)
+        return False
+
+    def _on_blocked(self, host: _Host, retry_after: Optional[float]) -> None:
+        """ブロックの兆候を受けたホストを、retry-afterかバックオフの間止める"""
+        with self._condition:
+            host.strikes += 1
+            self.stats_counters['blocked'] += 1
+            backoff = random.uniform(0.5, 1.0) * min(self.max_delay, self.base_delay * (2 ** host.strikes))
+            delay = max(retry_after or 0.0, backoff)
+            host.next_start = max(host.next_start, time.monotonic() + delay)
+            logger.warning(f"Host {host.name} is throttling us, pausing {delay:.1f}s (strike {host.strikes})")
+
+    def _on_success(self, host: _Host) -> None:
+        with self._condition:
+            host.strikes = 0
+
+    def _allowed(self, host: _Host, url: str) -> bool:
+        """robots.txtで取得が許可されているか（robots.txtはホストごとにキャッシュし、Crawl-delayも反映する）"""
+        with host.robots_lock:
+            if host.robots is None or time.monotonic() - host.robots_checked_at >= self.robots_ttl:
+                host.robots = self._fetch_robots(host, url)
+                host.robots_checked_at = time.monotonic()
+                crawl_delay = host.robots.crawl_delay(self.user_agent)
+                if crawl_delay:
+                    with self._condition:
+                        host.interval = max(host.interval, float(crawl_delay))
+            return host.robots.can_fetch(self.user_agent, url)
+
+    def _fetch_robots(self, host: _Host, url: str) -> RobotFileParser:
+        """robots.txtを取得する（401/403なら全面禁止、その他の失敗は制限なしとみなす）"""
+        parts = urlsplit(url)
+        parser = RobotFileParser(f"{parts.scheme}://{parts.netloc}/robots.txt")
+        try:
+            response = host.session.get(parser.url, timeout=10)
+        except Exception as e:
+            logger.info(f"Could not fetch {parser.url}, assuming no restrictions: {e}")
+            parser.parse([])
+            return parser
+        if response.status_code in (401, 403):
+            parser.disallow_all = True
+        elif response.status_code >= 400:
+            parser.allow_all = True
+        else:
+            parser.parse(response.text.splitlines())
+        return parser
+
+    def stats(self) -> Dict[str, Any]:
+        """スケジューラーの状態と累計のカウンター"""
+        with self._condition:
+            return {
+                'hosts': len(self._hosts),
+                'queued': sum(len(host.queue) for host in self._hosts.values()),
+                'in_flight': sum(host.in_flight for host in self._hosts.values()),
+                **self.stats_counters,
+            }
+
+
+def _retry_after(headers: Optional[Any]) -> Optional[float]:
+    """Retry-Afterヘッダー（秒数またはHTTP日付）から待ち秒数を取り出す"""
+    value = headers.get('Retry-After') if headers else None
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+_scheduler: Optional[HostScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> HostScheduler:
+    """プロセスで共有するスケジューラーを返す（初回に settings.yaml の host_scheduler から生成）"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = HostScheduler(**(get_section('host_scheduler')))
+        return _scheduler
+
+
+def reset_scheduler() -> None:
+    """スケジューラーを破棄する（設定の再読み込みやテスト用）"""
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = None
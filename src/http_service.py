@@ -0,0 +1,375 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional
+import logging
+
+from aiohttp import web
+
+from . import metrics
+from .pipeline_orchestrator import RegenerationError
+from .query_classifier import AUTO_SEARCH_MODE
+from .settings import get_section
+
+logger = logging.getLogger(__name__)
+
+# ジョブの終了を表すイベント種別
+_TERMINAL_EVENTS = ('done', 'error')
+
+
+class ServiceJob:
+    """
+    HTTPサービス上の1件のレポート生成ジョブ。
+    パイプラインのイベントを蓄積し、SSEの購読者へ配信する（途中から接続しても最初から再送する）。
+    """
+
+    def __init__(self, query: str, client_id: str, options: Dict[str, Any]):
+        self.id = uuid.uuid4().hex
+        self.query = query
+        self.client_id = client_id
+        self.options = options
+        self.status = "queued"
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.events: List[Dict[str, Any]] = []
+        self._changed = asyncio.Event()
+        # 同じジョブの作り直しは1件ずつ行う（並行すると後から終わった方の結果で前の作り直しが消える）
+        self.regenerate_lock = asyncio.Lock()
+
+    def publish(self, event: Dict[str, Any]) -> None:
+        """イベントを追加して購読者を起こす（イベントループのスレッドから呼ぶこと）"""
+        if event['type'] == 'pipeline' and event.get('status') == 'start':
+            self.status = "running"
+        self.events.append(event)
+        self._changed.set()
+
+    async def subscribe(self, keepalive: float = 15.0):
+        """
+        イベントを順に返す非同期イテレーター。
+        keepalive秒イベントがなければNoneを返すので、呼び出し側で死活確認のコメントを送る。
+        """
+        index = 0
+        while True:
+            if index >= len(self.events):
+                self._changed.clear()
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout=keepalive)
+                except asyncio.TimeoutError:
+                    yield None
+                continue
+            event = self.events[index]
+            index += 1
+            yield event
+            if event['type'] in _TERMINAL_EVENTS:
+                return
+
+    def to_dict(self, include_result: bool = True) -> Dict[str, Any]:
+        data = {
+            'job_id': self.id,
+            'query': self.query,
+            'status': self.status,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at,
+        }
+        if self.error:
+            data['error'] = self.error
+        if include_result and self.result is not None:
+            data['result'] = self.result
+        return data
+
+
+class ReportService:
+    """
+    パイプラインを包む非同期HTTPサービス。
+    ワーカープロセスごとに温めたオーケストレーター（とその接続プール）を1つ保持し、
+    スレッドプールでパイプラインを実行しながら進捗とレポートのトークンをSSEで配信する。
+    """
+
+    def __init__(self,
+                 orchestrator_factory: Optional[Callable[[], Any]] = None,
+                 max_concurrency: Optional[int] = None,
+                 per_client_limit: Optional[int] = None,
+                 job_ttl: Optional[float] = None,
+                 trusted_proxies: Optional[List[str]] = None):
+        """
+        Args:
+            orchestrator_factory: オーケストレーターを生成する関数（省略時はPipelineOrchestrator）
+            max_concurrency: 同時に実行するパイプライン数（省略時は環境変数SERVICE_MAX_CONCURRENCY、既定4）
+            per_client_limit: クライアントごとの同時ジョブ数の上限（省略時はSERVICE_PER_CLIENT_LIMIT、既定2）
+            job_ttl: 完了したジョブを保持する秒数（省略時はSERVICE_JOB_TTL、既定3600）
+            trusted_proxies: X-Client-Id と X-Forwarded-For を信用する接続元のアドレス
+                （省略時はSERVICE_TRUSTED_PROXIESのカンマ区切り、既定は空で、どちらのヘッダーも無視する）
+        """
+        self.orchestrator_factory = orchestrator_factory or self._default_orchestrator_factory
+        self.max_concurrency = max_concurrency or int(os.getenv('SERVICE_MAX_CONCURRENCY', '4'))
+        self.per_client_limit = per_client_limit or int(os.getenv('SERVICE_PER_CLIENT_LIMIT', '2'))
+        self.job_ttl = job_ttl if job_ttl is not None else float(os.getenv('SERVICE_JOB_TTL', '3600'))
+        if trusted_proxies is None:
+            trusted_proxies = [address.strip() for address in os.getenv('SERVICE_TRUSTED_PROXIES', '').split(',')]
+        self.trusted_proxies = {address for address in trusted_proxies if address}
+
+        self.orchestrator = None
+        self.jobs: Dict[str, ServiceJob] = {}
+        self._active_by_client: Dict[str, int] = defaultdict(int)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._tasks: set = set()
+        self._warmup = None
+        metrics.gauge('service_active_jobs', "Service jobs queued or running").set_function(self._active_jobs)
+
+    @staticmethod
+    def _default_orchestrator_factory():
+        from .pipeline_orchestrator import PipelineOrchestrator
+        return PipelineOrchestrator()
+
+    async def startup(self, app: web.Application) -> None:
+        """起動時にオーケストレーターを生成しておき、最初のリクエストで初期化を待たせない"""
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="report-service")
+        loop = asyncio.get_running_loop()
+        self.orchestrator = await loop.run_in_executor(self._executor, self.orchestrator_factory)
+        # サンプルクエリと最近よく使われたクエリのレポートを、ライブのジョブがない間に生成しておく
+        from .warmup import Warmup
+        self._warmup = Warmup(lambda: self.orchestrator, is_busy=lambda: bool(self._active_by_client),
+                              recent_queries=self._frequent_queries)
+        self._warmup.start()
+        logger.info(f"ReportService ready (max_concurrency={self.max_concurrency}, "
+                    f"per_client_limit={self.per_client_limit})")
+
+    async def cleanup(self, app: web.Application) -> None:
+        if self._warmup is not None:
+            self._warmup.stop()
+        for task in list(self._tasks):
+            task.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _frequent_queries(self, since: float, limit: int) -> List[str]:
+        """since以降に完了したジョブのクエリを多い順に返す（ウォームアップの対象）"""
+        counts = Counter(job.query for job in list(self.jobs.values())
+                         if job.status == "done" and job.created_at >= since)
+        return [query for query, _ in counts.most_common(limit)]
+
+    def _client_id(self, request: web.Request) -> str:
+        """
+        同時実行数の制限に使うクライアントの識別子。
+        ヘッダーはクライアントが自由に付けられるので、信用する接続元（LMSのゲートウェイやリバースプロキシ）から
+        来たときだけ X-Client-Id か X-Forwarded-For（プロキシが末尾に追加した接続元）を使い、それ以外は接続元のアドレスを使う。
+        """
+        remote = request.remote or "anonymous"
+        if remote not in self.trusted_proxies:
+            return remote
+        client_id = request.headers.get('X-Client-Id')
+        if client_id:
+            return client_id
+        forwarded = [address.strip() for address in request.headers.get('X-Forwarded-For', '').split(',')]
+        return forwarded[-1] or remote
+
+    def _expire_jobs(self) -> None:
+        """保持期限を過ぎた完了済みジョブを削除する"""
+        now = time.time()
+        expired = [job_id for job_id, job in self.jobs.items()
+                   if job.finished_at is not None and now - job.finished_at > self.job_ttl]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    async def handle_submit(self, request: web.Request) -> web.Response:
+        """POST /reports: クエリを受け付けてジョブIDを返す"""
+        try:
+            payload = await request.json()
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return web.json_response({'error': 'Request body must be JSON'}, status=400)
+
+        query = payload.get('query') if isinstance(payload, dict) else None
+        if not isinstance(query, str) or not query.strip():
+            return web.json_response({'error': "'query' must be a non-empty string"}, status=400)
+
+        client_id = self._client_id(request)
+        if self._active_by_client[client_id] >= self.per_client_limit:
+            return web.json_response(
+                {'error': f"Too many concurrent reports for client (limit {self.per_client_limit})"},
+                status=429,
+                headers={'Retry-After': '10'}
+            )
+
+        deadline = payload.get('deadline')
+        if deadline is not None and (not isinstance(deadline, (int, float)) or deadline <= 0):
+            return web.json_response({'error': "'deadline' must be a positive number of seconds"}, status=400)
+
+        query_type = payload.get('query_type')
+        if query_type is not None and not isinstance(query_type, str):
+            return web.json_response({'error': "'query_type' must be a string"}, status=400)
+        search_mode = payload.get('search_mode')
+        search_modes = (AUTO_SEARCH_MODE, *get_section('search_modes'))
+        if search_mode is not None and search_mode not in search_modes:
+            return web.json_response({'error': f"'search_mode' must be one of: {', '.join(search_modes)}"},
+                                     status=400)
+
+        self._expire_jobs()
+        options = {'use_cache': bool(payload.get('use_cache', True))}
+        if deadline is not None:
+            options['deadline'] = float(deadline)
+        if query_type:
+            options['query_type'] = query_type
+        if search_mode:
+            options['search_mode'] = search_mode
+        job = ServiceJob(query.strip(), client_id, options)
+        self.jobs[job.id] = job
+        self._active_by_client[client_id] += 1
+
+        task = asyncio.create_task(self._run_job(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+        return web.json_response({
+            'job_id': job.id,
+            'status_url': f"/reports/{job.id}",
+            'events_url': f"/reports/{job.id}/events",
+        }, status=202)
+
+    async def _run_job(self, job: ServiceJob) -> None:
+        """スレッドプールでパイプラインを実行し、イベントをジョブに流し込む"""
+        loop = asyncio.get_running_loop()
+
+        def on_event(event: Dict[str, Any]) -> None:
+            # パイプラインのスレッドから呼ばれるので、イベントループに処理を渡す（順序は保たれる）
+            loop.call_soon_threadsafe(job.publish, event)
+
+        try:
+            run = partial(self.orchestrator.run, job.query, event_callback=on_event, **job.options)
+            job.result = await loop.run_in_executor(self._executor, run)
+            job.status = "done"
+            job.finished_at = time.time()
+            job.publish({'type': 'done', 'job_id': job.id, 'result': job.result})
+        except Exception as e:
+            logger.error(f"Service job {job.id} failed: {e}")
+            job.status = "failed"
+            job.error = str(e)
+            job.finished_at = time.time()
+            job.publish({'type': 'error', 'job_id': job.id, 'error': str(e)})
+        finally:
+            self._release_client(job.client_id)
+
+    def _release_client(self, client_id: str) -> None:
+        """クライアントの実行中の件数を1つ減らす"""
+        self._active_by_client[client_id] -= 1
+        if self._active_by_client[client_id] <= 0:
+            del self._active_by_client[client_id]
+
+    def _get_job(self, request: web.Request) -> ServiceJob:
+        job = self.jobs.get(request.match_info['job_id'])
+        if job is None:
+            raise web.HTTPNotFound(text=json.dumps({'error': 'Job not found'}), content_type='application/json')
+        return job
+
+    async def handle_status(self, request: web.Request) -> web.Response:
+        """GET /reports/{job_id}: ジョブの状態（完了していれば結果）を返す"""
+        return web.json_response(self._get_job(request).to_dict())
+
+    async def handle_regenerate(self, request: web.Request) -> web.Response:
+        """
+        POST /reports/{job_id}/regenerate: 完了したレポートの1つのステージ（または本文の1つの章）だけを作り直す。
+        本文は {"stage": "section", "section": "章の見出し", "instruction": "追加の指示"} のように章を指定できる。
+        作り直しもクライアントごとの同時実行数に数え、同じジョブへの作り直しは順に行う。
+        """
+        job = self._get_job(request)
+        if job.status != "done" or job.result is None:
+            return web.json_response({'error': 'Only finished reports can be regenerated'}, status=409)
+        try:
+            payload = await request.json()
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return web.json_response({'error': 'Request body must be JSON'}, status=400)
+        if not isinstance(payload, dict) or not isinstance(payload.get('stage'), str):
+            return web.json_response({'error': "'stage' must be a string"}, status=400)
+        section = payload.get('section')
+        instruction = payload.get('instruction', "")
+        if section is not None and not isinstance(section, str):
+            return web.json_response({'error': "'section' must be a string"}, status=400)
+        if not isinstance(instruction, str):
+            return web.json_response({'error': "'instruction' must be a string"}, status=400)
+
+        client_id = self._client_id(request)
+        if self._active_by_client[client_id] >= self.per_client_limit:
+            return web.json_response(
+                {'error': f"Too many concurrent reports for client (limit {self.per_client_limit})"},
+                status=429,
+                headers={'Retry-After': '10'}
+            )
+
+        loop = asyncio.get_running_loop()
+        self._active_by_client[client_id] += 1
+        try:
+            async with job.regenerate_lock:
+                # 前の作り直しが終わってからその結果を元にする
+                run = partial(self.orchestrator.regenerate, job.result, payload['stage'],
+                              section=section, instruction=instruction)
+                try:
+                    job.result = await loop.run_in_executor(self._executor, run)
+                except ValueError as e:
+                    return web.json_response({'error': str(e)}, status=400)
+                except RegenerationError as e:
+                    # 生成に失敗した。保存済みのレポートはそのまま
+                    return web.json_response({'error': str(e)}, status=502)
+                job.finished_at = time.time()
+                return web.json_response(job.to_dict())
+        finally:
+            self._release_client(client_id)
+
+    async def handle_events(self, request: web.Request) -> web.StreamResponse:
+        """GET /reports/{job_id}/events: ステージの進捗とレポートのトークンをSSEで配信する"""
+        job = self._get_job(request)
+        response = web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+        })
+        await response.prepare(request)
+
+        async for event in job.subscribe():
+            if event is None:
+                await response.write(b": keep-alive\n\n")
+                continue
+            data = json.dumps(event, ensure_ascii=False)
+            await response.write(f"event: {event['type']}\ndata: {data}\n\n".encode('utf-8'))
+
+        await response.write_eof()
+        return response
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        """GET /healthz: 稼働状況"""
+        return web.json_response({
+            'status': 'ok' if self.orchestrator is not None else 'starting',
+            'active_jobs': self._active_jobs(),
+            'max_concurrency': self.max_concurrency,
+        })
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        """GET /metrics: Prometheus のテキスト形式のメトリクス"""
+        return web.Response(body=metrics.get_registry().render().encode('utf-8'),
+                            headers={'Content-Type': metrics.CONTENT_TYPE})
+
+    def _active_jobs(self) -> int:
+        return sum(1 for job in list(self.jobs.values()) if job.status in ("queued", "running"))
+
+    def create_app(self) -> web.Application:
+        """aiohttpのアプリケーションを組み立てる"""
+        app = web.Application()
+        app.on_startup.append(self.startup)
+        app.on_cleanup.append(self.cleanup)
+        app.router.add_post('/reports', self.handle_submit)
+        app.router.add_get('/reports/{job_id}', self.handle_status)
+        app.router.add_get('/reports/{job_id}/events', self.handle_events)
+        app.router.add_post('/reports/{job_id}/regenerate', self.handle_regenerate)
+        app.router.add_get('/healthz', self.handle_health)
+        app.router.add_get('/metrics', self.handle_metrics)
+        return app
+
+
+def create_app(**kwargs: Any) -> web.Application:
+    """ReportServiceを生成してアプリケーションを返す（gunicornのaiohttpワーカーからも利用可能）"""
+    return ReportService(**kwargs).create_app()
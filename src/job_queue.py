@@ -0,0 +1,377 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+import logging
+
+from . import metrics
+from .run_context import EventCallback
+
+logger = logging.getLogger(__name__)
+
+# (query, options, on_event) を受け取り結果の辞書を返す関数
+Runner = Callable[[str, Dict[str, Any], Optional[EventCallback]], Dict[str, Any]]
+
+# ジョブの状態
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# 実行中のジョブの所有権（リース）の有効期間。所有者はこの間隔の1/3ごとに心拍を書き、
+# 心拍が途絶えたRUNNINGのジョブだけを他のプロセスが引き取る
+DEFAULT_LEASE_SECONDS = 60.0
+
+# プロセスごとに1つだけ保持するオーケストレーター（スレッドワーカー間では共有される）
+_worker_orchestrator = None
+_worker_lock = threading.Lock()
+
+
+def get_worker_orchestrator():
+    """このプロセスのオーケストレーターを返す（初回呼び出し時に生成）"""
+    global _worker_orchestrator
+    with _worker_lock:
+        if _worker_orchestrator is None:
+            from .pipeline_orchestrator import PipelineOrchestrator
+            _worker_orchestrator = PipelineOrchestrator()
+    return _worker_orchestrator
+
+
+def _run_pipeline(query: str, options: Dict[str, Any], on_event: Optional[EventCallback] = None) -> Dict[str, Any]:
+    """ワーカー内でパイプラインを実行する"""
+    return get_worker_orchestrator().run(query, event_callback=on_event, **options)
+
+
+def _execute_job(job_id: str, db_path: str, runner: Runner, owner: str,
+                 lease_seconds: float = DEFAULT_LEASE_SECONDS) -> None:
+    """
+    1件のジョブを実行し、結果をジョブストアに書き込む。
+    プロセスプールからも呼べるようにモジュールレベルの関数にしている。
+    ジョブは待機中のものを原子的に確保してから実行し、他のプロセスが確保済みなら何もしない。
+    """
+    store = JobStore(db_path)
+    if not store.claim(job_id, owner):
+        logger.info(f"Job {job_id} was already claimed or finished; skipping")
+        return
+    job = store.get(job_id)
+    if job is None:
+        logger.warning(f"Job {job_id} disappeared before execution")
+        return
+
+    def record_progress(event: Dict[str, Any]) -> None:
+        # トークン単位のイベントは書き込まず、ステージの進捗だけを記録する
+        if event['type'] == 'stage':
+            store.update(job_id, progress=json.dumps(
+                {'stage': event['stage'], 'status': event['status']}, ensure_ascii=False
+            ))
+
+    stop = threading.Event()
+
+    def beat() -> None:
+        while not stop.wait(lease_seconds / 3):
+            if not store.heartbeat(job_id, owner):
+                logger.warning(f"Lost the lease on job {job_id}")
+                return
+
+    heartbeat = threading.Thread(target=beat, name=f"job-heartbeat-{job_id[:8]}", daemon=True)
+    heartbeat.start()
+    try:
+        result = runner(job['query'], job['options'], record_progress)
+        if result.get('error'):
+            # パイプラインは失敗しても例外ではなくエラー付きのフォールバックの結果を返す
+            logger.error(f"Job {job_id} failed: {result['error']}")
+            finished = store.finish(job_id, owner, status=FAILED, error=str(result['error']),
+                                    result=json.dumps(result, ensure_ascii=False))
+        else:
+            finished = store.finish(job_id, owner, status=DONE, result=json.dumps(result, ensure_ascii=False))
+    except Exception as e:
+        logger.error(f"Job {job_id} failed: {e}")
+        finished = store.finish(job_id, owner, status=FAILED, error=str(e))
+    finally:
+        stop.set()
+    if not finished:
+        logger.warning(f"Job {job_id} was reclaimed by another worker; discarding this result")
+
+
+class JobStore:
+    """
+    ジョブの状態をSQLiteファイルに永続化するストア。
+    プロセス再起動やブラウザのリロードを跨いでジョブを追跡できる。
+    """
+
+    _COLUMNS = ('id', 'query', 'options', 'status', 'progress', 'result', 'error',
+                'created_at', 'started_at', 'finished_at', 'owner', 'heartbeat_at')
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    query TEXT NOT NULL,
+                    options TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    progress TEXT,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    owner TEXT,
+                    heartbeat_at REAL
+                )"""
+            )
+            # リースのカラムがない古いジョブストアにはカラムを足す
+            existing = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, kind in (('owner', 'TEXT'), ('heartbeat_at', 'REAL')):
+                if column not in existing:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def create(self, query: str, options: Dict[str, Any]) -> str:
+        """ジョブを登録してIDを返す"""
+        job_id = uuid.uuid4().hex
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, query, options, status, created_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, query, json.dumps(options, ensure_ascii=False), QUEUED, time.time())
+            )
+        return job_id
+
+    def update(self, job_id: str, **fields: Any) -> None:
+        """指定したカラムを更新する"""
+        unknown = set(fields) - set(self._COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown job fields: {sorted(unknown)}")
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._connect() as conn:
+            conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def claim(self, job_id: str, owner: str) -> bool:
+        """待機中のジョブを実行中にして所有者を記録する（他の所有者が先に確保していればFalse）"""
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, owner = ?, heartbeat_at = ?, started_at = ? WHERE id = ? AND status = ?",
+                (RUNNING, owner, now, now, job_id, QUEUED)
+            )
+        return cursor.rowcount == 1
+
+    def heartbeat(self, job_id: str, owner: str) -> bool:
+        """所有しているジョブのリースを延長する（所有権を失っていればFalse）"""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND owner = ? AND status = ?",
+                (time.time(), job_id, owner, RUNNING)
+            )
+        return cursor.rowcount == 1
+
+    def finish(self, job_id: str, owner: str, **fields: Any) -> bool:
+        """所有しているジョブを完了にする（所有権を失っていれば何もせずFalse）"""
+        unknown = set(fields) - set(self._COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown job fields: {sorted(unknown)}")
+        fields['finished_at'] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._connect() as conn:
+            cursor = conn.execute(
+                f"UPDATE jobs SET {assignments} WHERE id = ? AND owner = ? AND status = ?",
+                (*fields.values(), job_id, owner, RUNNING)
+            )
+        return cursor.rowcount == 1
+
+    def requeue_expired(self, lease_seconds: float) -> List[str]:
+        """リースの切れた実行中のジョブ（所有者のプロセスが落ちたもの）を待機中に戻し、そのIDを返す"""
+        cutoff = time.time() - lease_seconds
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT id FROM jobs WHERE status = ? AND (heartbeat_at IS NULL OR heartbeat_at < ?)",
+                (RUNNING, cutoff)
+            ).fetchall()
+            job_ids = [row[0] for row in rows]
+            conn.executemany(
+                "UPDATE jobs SET status = ?, owner = NULL, heartbeat_at = NULL, started_at = NULL "
+                "WHERE id = ? AND status = ?",
+                [(QUEUED, job_id, RUNNING) for job_id in job_ids]
+            )
+        return job_ids
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """ジョブを1件取得する"""
+        with self._connect() as conn:
+            row = conn.execute(f"SELECT {', '.join(self._COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def list(self, statuses: Optional[List[str]] = None, limit: int = 50) -> List[Dict[str, Any]]:
+        """ジョブを新しい順に取得する"""
+        query = f"SELECT {', '.join(self._COLUMNS)} FROM jobs"
+        params: List[Any] = []
+        if statuses:
+            query += f" WHERE status IN ({', '.join('?' for _ in statuses)})"
+            params.extend(statuses)
+        query += " ORDER BY created_at DESC LIMIT ?"
+        params.append(limit)
+        with self._connect() as conn:
+            rows = conn.execute(query, params).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def frequent_queries(self, since: float, limit: int = 5) -> List[str]:
+        """since以降に完了したジョブのクエリを、多い順に返す"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT query FROM jobs WHERE status = ? AND created_at >= ? "
+                "GROUP BY query ORDER BY COUNT(*) DESC, MAX(created_at) DESC LIMIT ?",
+                (DONE, since, limit)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def count(self, statuses: List[str]) -> int:
+        """指定した状態のジョブ数を返す"""
+        with self._connect() as conn:
+            return conn.execute(
+                f"SELECT COUNT(*) FROM jobs WHERE status IN ({', '.join('?' for _ in statuses)})",
+                statuses
+            ).fetchone()[0]
+
+    def _to_dict(self, row: tuple) -> Dict[str, Any]:
+        job = dict(zip(self._COLUMNS, row))
+        job['options'] = json.loads(job['options']) if job['options'] else {}
+        job['progress'] = json.loads(job['progress']) if job['progress'] else None
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+
+class JobQueue:
+    """
+    レポート生成をバックグラウンドで実行するジョブキュー。
+    submitでジョブを登録し、ワーカープール（スレッドまたはプロセス）が順に実行する。
+    同時に実行されるパイプラインの数はワーカー数で制御する。
+    """
+
+    def __init__(self,
+                 max_workers: Optional[int] = None,
+                 executor_type: Optional[str] = None,
+                 db_path: Optional[str] = None,
+                 runner: Runner = _run_pipeline,
+                 resume: bool = True,
+                 lease_seconds: Optional[float] = None):
+        """
+        Args:
+            max_workers: 同時実行するジョブ数（省略時は環境変数JOB_WORKERS、既定2）
+            executor_type: "thread" または "process"（省略時は環境変数JOB_EXECUTOR）
+            db_path: ジョブストアのSQLiteファイル（省略時は環境変数JOB_DB_PATH）
+            runner: (query, options, on_event) を受け取り結果の辞書を返す関数
+            resume: 前回のプロセスで未完了だったジョブを再投入するか
+            lease_seconds: 実行中のジョブのリースの有効期間（省略時は環境変数JOB_LEASE_SECONDS、既定60秒）
+        """
+        self.max_workers = max_workers or int(os.getenv('JOB_WORKERS', '2'))
+        self.executor_type = executor_type or os.getenv('JOB_EXECUTOR', 'thread')
+        self.db_path = db_path or os.getenv('JOB_DB_PATH', 'data/jobs/jobs.db')
+        self.runner = runner
+        self.lease_seconds = lease_seconds or float(os.getenv('JOB_LEASE_SECONDS', DEFAULT_LEASE_SECONDS))
+        # 同じジョブストアを共有する他のプロセス・レプリカと区別するための所有者ID
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.store = JobStore(self.db_path)
+        self._executor = self._create_executor()
+        depth = metrics.gauge('job_queue_depth', "Jobs waiting or running in the job queue", ('status',))
+        depth.set_function(lambda: self.store.count([QUEUED]), status=QUEUED)
+        depth.set_function(lambda: self.store.count([RUNNING]), status=RUNNING)
+
+        if resume:
+            self._resume_unfinished()
+        # 動き続けている間も、落ちた他のプロセスのジョブをリースの有効期間ごとに引き取る
+        self._stop = threading.Event()
+        self._reaper = threading.Thread(target=self._reap, name="job-reaper", daemon=True)
+        self._reaper.start()
+
+        logger.info(f"JobQueue started with {self.max_workers} {self.executor_type} workers")
+
+    def _create_executor(self) -> Executor:
+        if self.executor_type == "process":
+            return ProcessPoolExecutor(max_workers=self.max_workers)
+        if self.executor_type == "thread":
+            return ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="report-job")
+        raise ValueError(f"Unknown executor type: {self.executor_type}")
+
+    def _resume_unfinished(self) -> None:
+        """
+        未完了のジョブを再投入する。実行中のジョブはリースが切れたもの（所有者が落ちたもの）だけを引き取る。
+        待機中のジョブは他のレプリカも投入済みかもしれないが、実行前の確保が原子的なので二重には実行されない。
+        """
+        for job_id in self.store.requeue_expired(self.lease_seconds):
+            logger.info(f"Reclaimed job {job_id} whose lease expired")
+        for job in reversed(self.store.list(statuses=[QUEUED], limit=1000)):
+            logger.info(f"Resuming unfinished job {job['id']}")
+            self._dispatch(job['id'])
+
+    def _reap(self) -> None:
+        """リースの切れた実行中のジョブを定期的に待機中に戻し、このプロセスで実行する"""
+        while not self._stop.wait(self.lease_seconds):
+            try:
+                for job_id in self.store.requeue_expired(self.lease_seconds):
+                    logger.info(f"Reclaimed job {job_id} whose lease expired")
+                    self._dispatch(job_id)
+            except Exception as e:
+                logger.warning(f"Job reaper failed: {e}")
+
+    def _dispatch(self, job_id: str) -> None:
+        self._executor.submit(_execute_job, job_id, self.db_path, self.runner, self.owner, self.lease_seconds)
+
+    def submit(self, query: str, **options: Any) -> str:
+        """
+        レポート生成ジョブを登録する。
+
+        Args:
+            query: ユーザーのクエリ
+            **options: PipelineOrchestrator.runに渡すキーワード引数
+
+        Returns:
+            ジョブID
+        """
+        job_id = self.store.create(query, options)
+        self._dispatch(job_id)
+        logger.info(f"Submitted job {job_id} for query: {query}")
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """ジョブの状態（完了していれば結果も）を返す"""
+        return self.store.get(job_id)
+
+    def save_result(self, job_id: str, result: Dict[str, Any]) -> None:
+        """完了済みジョブの結果を差し替える（レポートの一部を作り直したとき）"""
+        self.store.update(job_id, result=json.dumps(result, ensure_ascii=False))
+
+    def list_jobs(self, statuses: Optional[List[str]] = None, limit: int = 50) -> List[Dict[str, Any]]:
+        """ジョブの一覧を新しい順に返す"""
+        return self.store.list(statuses=statuses, limit=limit)
+
+    def queue_depth(self) -> int:
+        """待機中と実行中のジョブ数を返す"""
+        return self.store.count([QUEUED, RUNNING])
+
+    def wait(self, job_id: str, timeout: Optional[float] = None, poll_interval: float = 0.2) -> Optional[Dict[str, Any]]:
+        """ジョブの完了（成功・失敗）を待って返す。タイムアウト時は現在の状態を返す"""
+        start = time.time()
+        while True:
+            job = self.get(job_id)
+            if job is None or job['status'] in (DONE, FAILED):
+                return job
+            if timeout is not None and time.time() - start >= timeout:
+                return job
+            time.sleep(poll_interval)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """ワーカープールと、リースの切れたジョブの引き取りを停止する"""
+        self._stop.set()
+        self._executor.shutdown(wait=wait)
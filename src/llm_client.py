@@ -1,81 +1,510 @@
 import os
+import threading
+import time
 import openai
-from typing import Optional
-from dotenv import load_dotenv
+from dataclasses import dataclass, replace
+from typing import Any, Dict, Optional, Union
 import logging
+from . import metrics
+from .bootstrap import bootstrap
+from .cache_backend import get_cache, make_key
+from .run_context import RunContext, current_run
+from .deadline import DeadlineExceeded
+from .settings import get_section
+from .structured_output import IncrementalJSONParser, StructuredOutputError, parse_json, validate
+from .rate_governor import Permit, get_governor
+from .prompt_templates import Messages, PromptTemplate, RenderedPrompt
+from . import token_budget
 
-# 環境変数を読み込み
-load_dotenv()
+# 文字列（単一のユーザーメッセージ）か、テンプレートから組み立てたメッセージのリスト
+Prompt = Union[str, Messages]
 
-# ログ設定
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# response_format={"type": "json_object"} に対応するモデル（前方一致）
+JSON_MODE_MODELS = ('gpt-4o', 'gpt-4.1', 'gpt-4-turbo', 'gpt-4-1106', 'gpt-4-0125', 'gpt-3.5-turbo-1106',
+                    'gpt-3.5-turbo-0125', 'o1', 'o3', 'o4')
+
+# APIキーごとにプロセスで共有するOpenAIクライアント（接続プールも共有される）
+_openai_clients: Dict[str, openai.OpenAI] = {}
+_openai_clients_lock = threading.Lock()
+
+
+def get_openai_client(api_key: str) -> openai.OpenAI:
+    """APIキーに対応する共有のOpenAIクライアントを返す（初回に生成）"""
+    with _openai_clients_lock:
+        client = _openai_clients.get(api_key)
+        if client is None:
+            client = _openai_clients[api_key] = openai.OpenAI(api_key=api_key)
+        return client
+
+
+@dataclass(frozen=True)
+class ModelRoute:
+    """1回のLLM呼び出しに使うモデルと生成パラメータ"""
+    model: str
+    max_tokens: int
+    temperature: float
+
+
 class LLMClient:
     """
     OpenAI APIとの連携を行うクライアントクラス
+    ステージごとのモデル・max_tokens・temperatureは config/settings.yaml の llm セクションで切り替える。
     """
     
     def __init__(self):
         """LLMクライアントの初期化"""
+        bootstrap()
         self.api_key = os.getenv('OPENAI_API_KEY')
-        self.model = os.getenv('OPENAI_MODEL', 'gpt-4-turbo-preview')
+        llm_settings = get_section('llm')
+        self.default_route = dict(llm_settings.get('default') or {})
+        self.stage_routes = dict(llm_settings.get('stages') or {})
+        self.model = os.getenv('OPENAI_MODEL') or self.default_route.get('model', 'gpt-4-turbo-preview')
+        self.json_mode = bool(llm_settings.get('json_mode', True))
+        # json_objectを拒否されたモデル（以後はプロンプトの指示だけでJSONを求める）
+        self._json_mode_rejected: set = set()
+        # 同じプロンプトと生成パラメータの応答はレプリカ間で共有するキャッシュから返す
+        # （temperatureが0の呼び出しと、settings.yamlで指定したステージだけ）
+        self.response_cache = get_cache('llm')
+        self.response_cache_stages = set(llm_settings.get('response_cache_stages') or [])
         
         if not self.api_key:
             raise ValueError("OPENAI_API_KEY environment variable is not set")
         
-        # OpenAIクライアントの初期化
-        self.client = openai.OpenAI(api_key=self.api_key)
+        # OpenAIクライアントは最初の呼び出しで共有のものを取得する
+        self._client: Optional[openai.OpenAI] = None
         logger.info(f"LLMClient initialized with model: {self.model}")
+
+    @property
+    def client(self) -> openai.OpenAI:
+        """OpenAIクライアント（全ステージで共有）"""
+        if self._client is None:
+            self._client = get_openai_client(self.api_key)
+        return self._client
+
+    @client.setter
+    def client(self, client: openai.OpenAI) -> None:
+        self._client = client
+
+    def resolve_route(self, stage: Optional[str], max_tokens: Optional[int] = None,
+                      temperature: Optional[float] = None) -> ModelRoute:
+        """
+        ステージに使うモデルと生成パラメータを決める。
+        優先順位は settings.yaml のステージ設定 > 呼び出し側の指定 > settings.yaml の既定値。
+        """
+        route = (self.stage_routes.get(stage) or {}) if stage else {}
+        return ModelRoute(
+            model=route.get('model') or self.model,
+            max_tokens=int(route.get('max_tokens') or max_tokens or self.default_route.get('max_tokens', 2000)),
+            temperature=float(route.get('temperature', temperature if temperature is not None
+                                        else self.default_route.get('temperature', 0.7)))
+        )
     
-    def generate_text(self, prompt: str, max_tokens: int = 2000, temperature: float = 0.7) -> str:
+    def generate_text(self, prompt: Prompt, max_tokens: Optional[int] = None, temperature: Optional[float] = None,
+                      stage: Optional[str] = None, stream: bool = False) -> str:
         """
         プロンプトを送信してテキストを生成する
         
         Args:
             prompt: 生成用のプロンプト
-            max_tokens: 最大トークン数
-            temperature: 生成の多様性（0.0-1.0）
+            max_tokens: 最大トークン数（settings.yamlにステージの設定があればそちらを優先）
+            temperature: 生成の多様性（0.0-1.0、同上）
+            stage: 呼び出し元のステージ名（モデルのルーティング・メトリクス・イベント用）
+            stream: 実行中のパイプラインにイベントの受け手がいれば、生成トークンを逐次通知する
             
         Returns:
             生成されたテキスト
         """
+        context = current_run()
+        route, prompt_tokens = self._preflight(prompt, self.resolve_route(stage, max_tokens, temperature))
+        cache_key = self._response_cache_key('text', prompt, route, stage)
+        cached = self._cached_response(cache_key)
+        if cached is not None:
+            logger.info(f"LLM response cache hit (stage: {stage}, model: {route.model})")
+            if stream and context is not None:
+                context.emit('token', stage=stage, text=cached)
+            return cached
+
+        timeout = self._timeout(context, stage)
+        if stream and context is not None and context.event_callback is not None:
+            text = self._generate_streaming(prompt, route, stage, context, timeout, prompt_tokens)
+            self._store_response(cache_key, text)
+            return text
+
+        def send(permit: Permit) -> str:
+            started = time.perf_counter()
+            response = self.client.chat.completions.create(
+                model=route.model,
+                messages=self._messages(prompt),
+                **self._cache_options(prompt),
+                max_tokens=route.max_tokens,
+                temperature=route.temperature,
+                timeout=timeout
+            )
+            self._record_usage(context, stage, route, time.perf_counter() - started, response.usage, permit,
+                               prompt_tokens)
+            return response.choices[0].message.content
+
         try:
+            text = get_governor(route.model).call(send, prompt_tokens + route.max_tokens, self._deadline(context),
+                                                  self._background(context))
+        except openai.APITimeoutError as e:
+            self._on_timeout(context, stage, e)
+            raise
+        except Exception as e:
+            logger.error(f"Error generating text: {e}")
+            raise
+        if text:
+            self._store_response(cache_key, text)
+        return text
+
+    def _response_cache_key(self, kind: str, prompt: Prompt, route: ModelRoute,
+                            stage: Optional[str]) -> Optional[str]:
+        """
+        応答キャッシュのキー（モデル・メッセージ・生成パラメータがすべて同じ呼び出しだけが当たる）。
+        サンプリングのある呼び出しは毎回違う応答を期待されるので、キャッシュしない（Noneを返す）。
+        """
+        if route.temperature != 0 and stage not in self.response_cache_stages:
+            return None
+        return make_key(kind, route.model, self._messages(prompt), route.max_tokens, route.temperature)
+
+    def _cached_response(self, cache_key: Optional[str]) -> Optional[str]:
+        """キャッシュ済みの応答を返す（キャッシュしない呼び出しはNone）"""
+        if cache_key is None:
+            return None
+        cached = self.response_cache.get(cache_key)
+        self._count_cache_lookup(cached is not None)
+        return cached
+
+    def _store_response(self, cache_key: Optional[str], text: str) -> None:
+        """応答をキャッシュに保存する（キャッシュしない呼び出しは何もしない）"""
+        if cache_key is not None:
+            self.response_cache.set(cache_key, text)
+
+    @staticmethod
+    def _messages(prompt: Prompt) -> Messages:
+        """プロンプトをChat Completions APIのメッセージのリストにする"""
+        if isinstance(prompt, str):
+            return [{"role": "user", "content": prompt}]
+        return [dict(message) for message in prompt]
+
+    @staticmethod
+    def _cache_options(prompt: Prompt) -> dict:
+        """テンプレートから組み立てたプロンプトは、テンプレートの版ごとにキャッシュのキーをそろえる"""
+        if isinstance(prompt, RenderedPrompt):
+            return {'extra_body': {'prompt_cache_key': prompt.cache_key}}
+        return {}
+
+    def _preflight(self, prompt: Prompt, route: ModelRoute) -> tuple:
+        """
+        送信前にプロンプトのトークン数を数え、コンテキストウィンドウに収まるよう出力枠を調整する。
+        プロンプトのトークン数はレート制限の枠取り（OpenAIと同じく出力枠も数える）にも使う。
+
+        Raises:
+            ContextWindowExceeded: 出力枠を削っても収まらない場合（送信せずに失敗させる）
+        """
+        checked = token_budget.preflight(self._messages(prompt), route.model, route.max_tokens)
+        if checked['max_tokens'] != route.max_tokens:
+            route = replace(route, max_tokens=checked['max_tokens'])
+        return route, checked['prompt_tokens']
+
+    def render(self, template: PromptTemplate, stage: Optional[str] = None, trimmable: tuple = (),
+               max_tokens: Optional[int] = None, max_prompt_tokens: Optional[int] = None,
+               **values: Any) -> RenderedPrompt:
+        """
+        テンプレートを組み立てる。ステージのモデルのコンテキストウィンドウ（と出力枠）に収まらなければ、
+        trimmableに挙げた値（検索結果やドラフトなど）を均等に切り詰めてから組み立てる。
+
+        Args:
+            template: プロンプトテンプレート
+            stage: ステージ名（モデルと出力枠の決定に使用）
+            trimmable: 切り詰めてよい値の名前（先に挙げたものから削る）
+            max_tokens: 呼び出し側の出力枠（generate_*に渡すものと同じ値）
+            max_prompt_tokens: コストのために設けるプロンプトの上限
+            **values: テンプレートに埋め込む値
+        """
+        route = self.resolve_route(stage, max_tokens)
+        fitted = token_budget.fit_values(template.render, values, trimmable, route.model,
+                                         route.max_tokens, max_prompt_tokens)
+        context = current_run()
+        if fitted['trimmed_tokens'] > 0 and context is not None:
+            context.record_prompt_trim(stage or context.stage or "unknown", route.model, fitted['trimmed_tokens'])
+        return template.render(**fitted['values'])
+
+    @staticmethod
+    def _deadline(context: Optional[RunContext]):
+        return context.active_deadline() if context is not None else None
+
+    @staticmethod
+    def _background(context: Optional[RunContext]) -> bool:
+        return context is not None and context.background
+
+    def _record_usage(self, context: Optional[RunContext], stage: Optional[str], route: ModelRoute,
+                      latency: float, usage: Any, permit: Optional[Permit] = None,
+                      counted_prompt_tokens: int = 0) -> None:
+        """呼び出しのレイテンシとトークン数をログと実行コンテキスト（とレート制限の枠）に記録する"""
+        # 使用量が返らなかった場合は送信前に数えたトークン数で代用する
+        prompt_tokens = getattr(usage, 'prompt_tokens', 0) or counted_prompt_tokens
+        completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+        # プロバイダー側のプロンプトキャッシュに当たった入力トークン数
+        cached_tokens = getattr(getattr(usage, 'prompt_tokens_details', None), 'cached_tokens', 0) or 0
+        if permit is not None:
+            permit.settle(prompt_tokens + completion_tokens)
+        logger.info(f"Generated text successfully (stage: {stage}, model: {route.model}, "
+                    f"latency: {latency:.2f}s, tokens: {prompt_tokens}+{completion_tokens}, cached: {cached_tokens})")
+        if context is not None:
+            stage = stage or context.stage
+            context.record_llm_call(stage or "unknown", route.model, latency,
+                                    prompt_tokens, completion_tokens, cached_tokens)
+        labels = {'stage': stage or "unknown", 'model': route.model}
+        metrics.histogram('llm_request_duration_seconds', "LLM call latency",
+                          ('stage', 'model')).observe(latency, **labels)
+        tokens = metrics.counter('llm_tokens_total', "LLM tokens by kind (cached is a subset of prompt)",
+                                 ('stage', 'model', 'kind'))
+        tokens.inc(prompt_tokens, kind='prompt', **labels)
+        tokens.inc(completion_tokens, kind='completion', **labels)
+        tokens.inc(cached_tokens, kind='cached', **labels)
+
+    @staticmethod
+    def _count_cache_lookup(hit: bool) -> None:
+        metrics.counter('llm_response_cache_requests_total', "LLM response cache lookups",
+                        ('result',)).inc(result='hit' if hit else 'miss')
+
+    def _timeout(self, context: Optional[RunContext], stage: Optional[str]) -> Optional[float]:
+        """時間予算から今回の呼び出しのタイムアウトを決める（期限切れなら送信せずに打ち切る）"""
+        deadline = context.active_deadline() if context is not None else None
+        if deadline is None:
+            return None
+        if deadline.expired():
+            context.mark_truncated(stage or context.stage or "llm", "no time left before LLM call")
+            raise DeadlineExceeded(f"Deadline exceeded before LLM call ({stage})")
+        return deadline.remaining()
+
+    def _on_timeout(self, context: Optional[RunContext], stage: Optional[str], error: Exception) -> None:
+        logger.error(f"LLM call timed out ({stage}): {error}")
+        if context is not None:
+            context.mark_truncated(stage or context.stage or "llm", "LLM call timed out")
+
+    def _generate_streaming(self, prompt: Prompt, route: ModelRoute, stage: Optional[str],
+                            context: RunContext, timeout: Optional[float], prompt_tokens: int) -> str:
+        """ストリーミングでテキストを生成し、差分をtokenイベントとして通知する"""
+        def send(permit: Permit) -> str:
+            started = time.perf_counter()
             response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=max_tokens,
-                temperature=temperature
+                model=route.model,
+                messages=self._messages(prompt),
+                **self._cache_options(prompt),
+                max_tokens=route.max_tokens,
+                temperature=route.temperature,
+                stream=True,
+                stream_options={"include_usage": True},
+                timeout=timeout
             )
-            
-            generated_text = response.choices[0].message.content
-            logger.info(f"Generated text successfully (tokens: {response.usage.total_tokens})")
-            return generated_text
-            
+
+            parts = []
+            usage = None
+            try:
+                for chunk in response:
+                    if chunk.usage is not None:
+                        usage = chunk.usage
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        parts.append(delta)
+                        context.emit('token', stage=stage, text=delta)
+            except openai.APITimeoutError:
+                raise
+            except Exception as e:
+                # 送信済みのトークンと重複するので、途中で切れたストリームは再試行しない
+                if parts:
+                    raise RuntimeError(f"Stream interrupted after {len(parts)} chunks: {e}") from e
+                raise
+
+            self._record_usage(context, stage, route, time.perf_counter() - started, usage, permit,
+                               prompt_tokens)
+            return "".join(parts)
+
+        try:
+            return get_governor(route.model).call(send, prompt_tokens + route.max_tokens,
+                                                  context.active_deadline(), context.background)
+        except openai.APITimeoutError as e:
+            self._on_timeout(context, stage, e)
+            raise
         except Exception as e:
             logger.error(f"Error generating text: {e}")
             raise
     
-    def generate_structured_output(self, prompt: str, output_format: str = "text") -> str:
+    def generate_structured_output(self, prompt: Prompt, output_format: str = "text", stage: Optional[str] = None) -> str:
         """
         構造化された出力を生成する
         
         Args:
             prompt: 生成用のプロンプト
             output_format: 出力形式（"text", "json", "markdown"など）
+            stage: 呼び出し元のステージ名
             
         Returns:
             生成された構造化テキスト
         """
-        # 出力形式に応じてプロンプトを調整
+        prompt = self.format_structured_prompt(prompt, output_format)
+        return self.generate_text(prompt, max_tokens=3000, temperature=0.5, stage=stage)
+
+    def supports_json_mode(self, model: str) -> bool:
+        """モデルがJSONモード（response_format=json_object）を使えるか"""
+        return (self.json_mode and model not in self._json_mode_rejected
+                and model.startswith(JSON_MODE_MODELS))
+
+    def generate_json(self, prompt: Prompt, schema: Optional[dict] = None, max_tokens: Optional[int] = None,
+                      temperature: Optional[float] = None, stage: Optional[str] = None) -> Any:
+        """
+        JSONを生成して解釈済みの値を返す。
+        対応モデルではJSONモードを使い、応答はストリーミングで受け取りながら逐次解釈する。
+        コードフェンスや途中で切れた出力（max_tokensや時間予算による打ち切り）は修復して使うので、
+        多少崩れた応答でも呼び出しが無駄にならない。
+
+        Args:
+            prompt: 生成用のプロンプト（JSONで出力する指示は自動で追加する）
+            schema: 検証に使うJSON Schema（structured_output.validateのサブセット）
+            max_tokens: 最大トークン数
+            temperature: 生成の多様性
+            stage: 呼び出し元のステージ名
+
+        Returns:
+            解釈済みのJSONの値
+
+        Raises:
+            StructuredOutputError: 修復してもJSONとして解釈できない、またはスキーマに合わない場合
+        """
+        context = current_run()
+        prompt = self.format_structured_prompt(prompt, "json")
+        route, prompt_tokens = self._preflight(prompt, self.resolve_route(stage, max_tokens, temperature))
+        cache_key = self._response_cache_key('json', prompt, route, stage)
+        cached = self._cached_response(cache_key)
+        if cached is not None:
+            logger.info(f"LLM response cache hit (stage: {stage}, model: {route.model})")
+            return parse_json(cached, schema)
+
+        timeout = self._timeout(context, stage)
+        deadline = context.active_deadline() if context is not None else None
+
+        request = {
+            'model': route.model,
+            'messages': self._messages(prompt),
+            **self._cache_options(prompt),
+            'max_tokens': route.max_tokens,
+            'temperature': route.temperature,
+            'stream': True,
+            'stream_options': {"include_usage": True},
+            'timeout': timeout,
+        }
+        if self.supports_json_mode(route.model):
+            request['response_format'] = {"type": "json_object"}
+
+        def send(permit: Permit) -> IncrementalJSONParser:
+            started = time.perf_counter()
+            try:
+                response = self.client.chat.completions.create(**request)
+            except openai.BadRequestError as e:
+                if 'response_format' not in request or 'response_format' not in str(e):
+                    raise
+                logger.warning(f"Model {route.model} rejected JSON mode; falling back to prompt-only JSON")
+                self._json_mode_rejected.add(route.model)
+                del request['response_format']
+                response = self.client.chat.completions.create(**request)
+
+            parser = IncrementalJSONParser()
+            usage = None
+            try:
+                for chunk in response:
+                    if chunk.usage is not None:
+                        usage = chunk.usage
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        parser.feed(chunk.choices[0].delta.content)
+                    if deadline is not None and deadline.expired():
+                        # 締め切りを過ぎたら受信済みの部分だけで打ち切る
+                        if context is not None:
+                            context.mark_truncated(stage or context.stage or "llm", "JSON output cut at deadline")
+                        break
+            except openai.APITimeoutError as e:
+                self._on_timeout(context, stage, e)
+            finally:
+                close = getattr(response, 'close', None)
+                if close is not None:
+                    close()
+
+            self._record_usage(context, stage, route, time.perf_counter() - started, usage, permit,
+                               prompt_tokens)
+            return parser
+
+        try:
+            parser = get_governor(route.model).call(send, prompt_tokens + route.max_tokens, deadline,
+                                                    self._background(context))
+        except openai.APITimeoutError as e:
+            self._on_timeout(context, stage, e)
+            raise
+
+        if parser.complete:
+            snapshot = parser.snapshot()
+            data = parse_json(snapshot, schema)
+            # 途中で切れて修復した出力はキャッシュしない
+            self._store_response(cache_key, snapshot)
+            return data
+        # 途中で切れた出力は、受信済みの部分を閉じて使う
+        data = parser.partial()
+        if data is None:
+            raise StructuredOutputError("Could not parse JSON output", parser.text)
+        logger.info(f"Recovered truncated JSON output (stage: {stage})")
+        errors = validate(data, schema) if schema is not None else []
+        if errors:
+            raise StructuredOutputError(f"Output does not match schema: {errors[0]}", parser.text, errors)
+        return data
+
+    @staticmethod
+    def format_structured_prompt(prompt: Prompt, output_format: str = "text") -> Prompt:
+        """出力形式に応じてプロンプトを調整する（指示は末尾に足すので、静的な前半部分は変わらない）"""
         if output_format == "json":
-            prompt += "\n\n出力は有効なJSON形式でお願いします。"
+            suffix = "\n\n出力は有効なJSON形式でお願いします。"
         elif output_format == "markdown":
-            prompt += "\n\n出力はMarkdown形式でお願いします。"
-        
-        return self.generate_text(prompt, max_tokens=3000, temperature=0.5)
+            suffix = "\n\n出力はMarkdown形式でお願いします。"
+        else:
+            return prompt
+        if isinstance(prompt, RenderedPrompt):
+            return prompt.with_suffix(suffix)
+        if isinstance(prompt, str):
+            return prompt + suffix
+        messages = [dict(message) for message in prompt]
+        messages[-1]['content'] += suffix
+        return messages
+
+    def build_request(self, prompt: Prompt, stage: Optional[str] = None, max_tokens: Optional[int] = None,
+                      temperature: Optional[float] = None, output_format: str = "text") -> dict:
+        """
+        Chat Completions APIのリクエストボディを組み立てる（バッチAPIのリクエストファイル用）
+
+        Args:
+            prompt: 生成用のプロンプト
+            stage: ステージ名（モデルのルーティングに使用）
+            max_tokens: 最大トークン数
+            temperature: 生成の多様性
+            output_format: "json"ならJSONモードを指定する（対応モデルのみ）
+
+        Returns:
+            リクエストボディの辞書
+        """
+        route = self.resolve_route(stage, max_tokens, temperature)
+        body = {
+            'model': route.model,
+            'messages': self._messages(prompt),
+            'max_tokens': route.max_tokens,
+            'temperature': route.temperature,
+        }
+        if output_format == "json" and self.supports_json_mode(route.model):
+            body['response_format'] = {"type": "json_object"}
+        if isinstance(prompt, RenderedPrompt):
+            body['prompt_cache_key'] = prompt.cache_key
+        return body
     
     def validate_response(self, response: str, expected_format: str = "text") -> bool:
         """
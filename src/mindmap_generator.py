@@ -1,37 +1,70 @@
 from typing import Dict, List, Any
-import json
 from .llm_client import LLMClient
+from .prompt_templates import RenderedPrompt, get_template
+from .structured_output import StructuredOutputError, parse_json
+from . import run_context
+import logging
+
+logger = logging.getLogger(__name__)
+
+# マインドマップのノード（name必須、childrenは省略可）
+MINDMAP_SCHEMA = {
+    "type": "object",
+    "required": ["name", "children"],
+    "properties": {
+        "name": {"type": "string", "minLength": 1},
+        "children": {"type": "array", "items": {"$ref": "#/definitions/node"}},
+    },
+    "definitions": {
+        "node": {
+            "type": "object",
+            "required": ["name"],
+            "properties": {
+                "name": {"type": "string", "minLength": 1},
+                "children": {"type": "array", "items": {"$ref": "#/definitions/node"}},
+            },
+        },
+    },
+}
+
+def mindmap_from_headings(report_content: str) -> Dict[str, Any]:
+    """
+    レポートの見出し（# / ## / ###）からマインドマップを作る（LLMを呼ばない）。
+    軽いプロファイルのクエリでは、LLMで作る代わりにこちらを使う。
+    """
+    root: Dict[str, Any] = {"name": "English Learning Report", "children": []}
+    # 見出しのレベルごとに、直近の親ノード
+    parents = {1: root}
+    title_found = False
+    for line in report_content.split('\n'):
+        level = len(line) - len(line.lstrip('#'))
+        name = line[level:].strip()
+        if not 1 <= level <= 3 or not name or line[level:level + 1] != ' ':
+            continue
+        if level == 1:
+            # 最初のタイトルだけを根にする
+            if not title_found:
+                root["name"], title_found = name, True
+            continue
+        node = {"name": name, "children": []}
+        parent = parents.get(level - 1, root)
+        parent["children"].append(node)
+        parents[level] = node
+        # 下位の見出しが上位を飛ばして現れても、直近の上位にぶら下げる
+        for deeper in range(level + 1, 4):
+            parents.pop(deeper, None)
+    return root
+
 
 class MindmapGeneratorModule:
     """マインドマップ生成モジュール"""
+
+    # マインドマップは構成が分かれば十分なので、長いレポートでもプロンプトはこの長さまでに抑える
+    MAX_PROMPT_TOKENS = 4000
     
     def __init__(self):
         self.llm_client = LLMClient()
-        self.prompt_template = """あなたは英語教育の専門家で、レポート内容を構造化してマインドマップを作成するのが得意です。
-以下のレポート内容を分析し、階層構造を持つマインドマップデータをJSON形式で生成してください。
-
-マインドマップの構造は以下の形式に従ってください：
-- メインノード（レポートのタイトル）
-- サブノード（主要な章やセクション）
-- さらに細かいノード（詳細な内容）
-
-出力は有効なJSON形式で、以下の構造にしてください：
-{
-  "name": "メインノード名",
-  "children": [
-    {
-      "name": "サブノード名",
-      "children": [
-        {"name": "詳細ノード名", "children": []},
-        {"name": "詳細ノード名2", "children": []}
-      ]
-    }
-  ]
-}
-
-レポート内容：
-{report_content}
-"""
+        self.prompt_template = get_template('mindmap')
     
     def generate_mindmap(self, report_content: str) -> Dict[str, Any]:
         """
@@ -45,38 +78,32 @@ class MindmapGeneratorModule:
         """
         try:
             # LLMでマインドマップデータを生成
-            prompt = self.prompt_template.format(report_content=report_content[:2000])  # 長すぎる場合は切り詰める
-            response = self.llm_client.generate_structured_output(prompt, output_format="json")
-            
-            # JSON文字列をパース
-            mindmap_data = json.loads(response)
-            
-            # 基本的な構造チェック
-            if self._validate_mindmap_structure(mindmap_data):
-                return mindmap_data
-            else:
-                return self._create_default_mindmap(report_content)
+            prompt = self.build_prompt(report_content)
+            return self.llm_client.generate_json(prompt, schema=MINDMAP_SCHEMA, max_tokens=3000,
+                                                 temperature=0.5, stage="mindmap")
             
         except Exception as e:
-            print(f"Error generating mindmap: {e}")
+            logger.warning(f"Error generating mindmap: {e}")
             # エラー時はデフォルトのマインドマップ構造を返す
+            run_context.mark_fallback('mindmap', str(e))
             return self._create_default_mindmap(report_content)
     
-    def _validate_mindmap_structure(self, mindmap_data: Dict[str, Any]) -> bool:
-        """マインドマップ構造の妥当性をチェック"""
+    def build_prompt(self, report_content: str) -> RenderedPrompt:
+        """LLMに送るプロンプトを組み立てる"""
+        # 長いレポートは段落ごとに均等に切り詰める（見出しは残る）
+        return self.llm_client.render(self.prompt_template, stage="mindmap", max_tokens=3000,
+                                      max_prompt_tokens=self.MAX_PROMPT_TOKENS,
+                                      trimmable=('report_content',), report_content=report_content)
+
+    def parse_response(self, response: str, report_content: str) -> Dict[str, Any]:
+        """LLMの応答からマインドマップデータを取り出す（不正な応答ならデフォルト構造）"""
         try:
-            if not isinstance(mindmap_data, dict):
-                return False
-            
-            if 'name' not in mindmap_data:
-                return False
-            
-            if 'children' in mindmap_data and not isinstance(mindmap_data['children'], list):
-                return False
-            
-            return True
-        except:
-            return False
+            # コードフェンスや途中で切れたJSONは修復してからスキーマで検証
+            return parse_json(response, MINDMAP_SCHEMA)
+        except StructuredOutputError as e:
+            logger.warning(f"Error parsing mindmap JSON: {e}")
+            run_context.mark_fallback('mindmap', str(e))
+            return self._create_default_mindmap(report_content)
     
     def _create_default_mindmap(self, report_content: str) -> Dict[str, Any]:
         """デフォルトのマインドマップ構造を作成"""
@@ -1,5 +1,12 @@
 import json
+from typing import Optional
 from .llm_client import LLMClient
+from .prompt_templates import RenderedPrompt, get_template
+from .citations import resolve_citations
+from . import run_context
+import logging
+
+logger = logging.getLogger(__name__)
 
 class OutlineCreator:
     """
@@ -9,62 +16,7 @@ class OutlineCreator:
         """
         プロンプトを初期化する。
         """
-        self.prompt_template = """あなたは、最新の英語教育ニュースや研究を常にフォローしている英語教育の専門家です。収集された情報源をもとに、下記のクエリーに対する解説レポートとして適切なアウトラインと簡潔なタイトルを作成してください。結論パートは絶対に作成しないでください。
-
-アウトラインは以下のMarkdownフォーマットに従って作成し、次のルールを厳守すること。
-1. クエリーに対して、英語教育的な観点からの解説・分析を目的とした構成にする。
-2. "# Title" をレポートのタイトルに用いる。
-3. "## Title" を章のタイトルとして用いる。
-   - 各章 ("## Title") に対して、必ず2～3個以上の節 ("### Title") を生成すること
-   - 章の数はクエリーに応じて5～10個の間で作成すること。
-4. "### Title" を節のタイトルとして用いる。
-   - 各節には、収集された情報源をできるだけ多く含めるようにし、必ず最低3～5個以上の異なる引用番号を使用すること
-   - 節同士で内容が類似しそうな場合、節を統合し、他の論点の節を追加すること
-5. 引用情報の記載方法
-   - 引用番号は節の次の行に記載すること。`### Title [3][4]` のように同じ行に記載してはならない
-6. Markdownフォーマットに関するルール
-   - "## 結論"という結論パートは絶対に作成してはいけない
-   - 出力には "# Title", "## Title"、"### Title" などのMarkdown形式のタイトル以外のテキストを一切含めないこと
-7. 各行はタイトル、セクション、サブセクション、引用番号のいずれかでそれ以外の情報を記載してはならない
-
-【出力例】
-    # レポートタイトル
-    ## セクション1
-    ### サブセクション1
-    [4][67]
-    ### サブセクション2
-    [30][28][1][27][102]
-    ## セクション2
-    ### サブセクション1
-    [14][25][9][96]
-    ### サブセクション2
-    [2][24][51]
-    ### サブセクション3
-    [29][11][4][56]
-    ...
-
-    【不適切な出力例】
-    # レポートタイトル: xxx    // 「レポートタイトル: 」という修飾はNG
-    ## セクション1
-    ### サブセクション1 [4][67]    // 引用はサブセクションの行にはつけない
-    [4][67]
-    このサブセクションでは...    // 説明文など要求していない不要な行は削除
-    ### サブセクション2 [30][28][1][27][102]    // 同上
-    [30][28][1][27][102]
-    ## セクション2
-    [2][24][29][11][4]    // セクション自体に引用がついている
-    ### サブセクション1
-    ### サブセクション: yyy    // 「サブセクション: 」という修飾はNG
-    [2][24][51]
-    ### サブセクション3
-    [29][11][4][156]     // （引用が例えば110までしかない場合）156は存在しない引用
-
-【情報源】
-{search_results_text}
-
-【クエリー】
-{refined_query}
-"""
+        self.prompt_template = get_template('outline')
         self.llm_client = LLMClient()
 
     def _format_search_results(self, search_results: dict[str, str]) -> str:
@@ -85,32 +37,52 @@ class OutlineCreator:
         Returns:
             Markdown形式のアウトライン
         """
-        print(f"Creating outline for query: {refined_query}")
+        logger.info("Creating outline", extra={'refined_query': refined_query, 'source_count': len(search_results)})
 
         try:
-            search_results_text = self._format_search_results(search_results)
-            full_prompt = self.prompt_template.format(
-                search_results_text=search_results_text,
-                refined_query=refined_query
-            )
+            full_prompt = self.build_prompt(refined_query, search_results)
             
             outline = self.llm_client.generate_structured_output(
                 full_prompt, 
-                output_format="markdown"
+                output_format="markdown",
+                stage="outline"
             )
-            
-            # レスポンスの妥当性をチェック
-            if self.llm_client.validate_response(outline):
-                print(f"Created outline:\n{outline}")
-                return outline.strip()
-            else:
-                # フォールバック: 仮実装
-                print(f"LLM response validation failed, using fallback")
-                return self._get_fallback_outline()
+            return self.parse_response(outline, search_results)
                 
         except Exception as e:
-            print(f"Error in outline creation: {e}")
+            logger.warning(f"Error in outline creation: {e}")
             # エラー時のフォールバック
+            run_context.mark_fallback('outline', str(e))
+            return self._get_fallback_outline()
+    
+    def build_prompt(self, refined_query: str, search_results: dict[str, str]) -> RenderedPrompt:
+        """LLMに送るプロンプトを組み立てる"""
+        search_results_text = self._format_search_results(search_results)
+        return self.llm_client.render(
+            self.prompt_template,
+            stage="outline",
+            max_tokens=3000,
+            trimmable=('search_results_text',),
+            search_results_text=search_results_text,
+            refined_query=refined_query
+        )
+
+    def parse_response(self, outline: str, search_results: Optional[dict[str, str]] = None) -> str:
+        """
+        LLMの応答からアウトラインを取り出す（不正な応答ならフォールバック）。
+        検索結果を渡すと、存在しない情報源への引用番号を取り除く（再生成はしない）。
+        """
+        # レスポンスの妥当性をチェック
+        if self.llm_client.validate_response(outline):
+            if search_results is not None:
+                outline = resolve_citations(outline, len(search_results))['text']
+            logger.info("Created outline", extra={'outline_lines': outline.strip().count('\n') + 1})
+            logger.debug("Outline", extra={'outline': outline})
+            return outline.strip()
+        else:
+            # フォールバック: 仮実装
+            logger.warning("LLM response validation failed, using fallback outline")
+            run_context.mark_fallback('outline', "invalid LLM response")
             return self._get_fallback_outline()
     
     def _get_fallback_outline(self) -> str:
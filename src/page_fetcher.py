@@ -0,0 +1,222 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+from concurrent.futures import wait
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Union
+import logging
+
+import requests
+
+from . import run_context
+from .host_scheduler import HostScheduler, get_scheduler
+from .settings import get_section
+
+logger = logging.getLogger(__name__)
+
+# 検索結果の文字列の中のURL行（ExternalApiClient._format_hit の書式）
+URL_LINE = re.compile(r"^URL: (?P<url>\S+)[ \t]*$", re.MULTILINE)
+
+# 本文を取り出さない要素
+_NON_CONTENT_TAGS = ('script', 'style', 'noscript', 'nav', 'header', 'footer', 'aside', 'form', 'svg')
+
+
+def extract_main_text(html: Union[str, bytes], max_chars: int, encoding: Optional[str] = None) -> str:
+    """
+    HTMLから本文らしいテキストを取り出す（main / article があればその中だけ）。
+    空白をまとめ、max_charsで切り詰める。バイト列の場合、encodingがなければmetaタグから判定する。
+    """
+    # BeautifulSoupは読み込みが重いので、ページを取得したときに初めて読み込む
+    from bs4 import BeautifulSoup
+    if isinstance(html, bytes):
+        soup = BeautifulSoup(html, 'html.parser', from_encoding=encoding)
+    else:
+        soup = BeautifulSoup(html, 'html.parser')
+    for tag in soup(_NON_CONTENT_TAGS):
+        tag.decompose()
+    root = soup.find('main') or soup.find('article') or soup.body or soup
+    text = re.sub(r"\s+", " ", root.get_text(" ")).strip()
+    if len(text) > max_chars:
+        text = text[:max_chars].rstrip() + "…"
+    return text
+
+
+class PageCache:
+    """
+    取得したページの本文をディスクに保存するキャッシュ（URLごとに1ファイル）。
+    ETag / Last-Modified を一緒に保存し、次回は条件付きGETで再検証する。
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, url: str) -> str:
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode('utf-8')).hexdigest() + ".json")
+
+    def get(self, url: str) -> Optional[Dict[str, Any]]:
+        """キャッシュ済みのエントリ（url, text, etag, last_modified, fetched_at）を返す"""
+        try:
+            with open(self._path(url), encoding='utf-8') as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        return entry if entry.get('url') == url else None
+
+    def put(self, url: str, text: str, etag: Optional[str], last_modified: Optional[str]) -> None:
+        """エントリを保存する（一時ファイルに書いてから置き換えるので、読み込み中の他スレッドは壊れたファイルを見ない）"""
+        entry = {'url': url, 'text': text, 'etag': etag, 'last_modified': last_modified, 'fetched_at': time.time()}
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, self._path(url))
+
+    def touch(self, url: str, entry: Dict[str, Any]) -> None:
+        """304で再検証できたエントリの取得時刻を更新する"""
+        self.put(url, entry['text'], entry.get('etag'), entry.get('last_modified'))
+
+
+class _Page(NamedTuple):
+    """取得したページ（HostSchedulerがstatus_codeとheadersでブロックを判定する）"""
+    status_code: int
+    headers: Any
+    body: bytes
+
+
+class PageFetcher:
+    """
+    検索結果の上位ページを並列に取得して本文を取り出すクラス。
+    リクエストはHostSchedulerを通し（ホストごとの同時接続数・間隔・robots.txt）、取得した本文はディスクにキャッシュする。
+    設定は settings.yaml の page_fetch セクション。
+    """
+
+    def __init__(self, scheduler: Optional[HostScheduler] = None, cache_dir: Optional[str] = None):
+        settings = get_section('page_fetch')
+        self.top_n = int(settings.get('top_n', 5))
+        self.max_chars = int(settings.get('max_chars', 3000))
+        self.max_bytes = int(settings.get('max_bytes', 2_000_000))
+        self.timeout = float(settings.get('timeout', 10))
+        # この秒数以内に取得したページは再検証せずにキャッシュを使う
+        self.fresh_seconds = float(settings.get('fresh_seconds', 3600))
+        self.cache = PageCache(cache_dir or settings.get('cache_dir', 'data/cache/pages'))
+        self.scheduler = scheduler or get_scheduler()
+
+    def _timeout(self) -> float:
+        deadline = run_context.current_deadline()
+        if deadline is None:
+            return self.timeout
+        deadline.check("page fetch")
+        return max(0.1, deadline.timeout(cap=self.timeout))
+
+    def _is_fresh(self, cached: Optional[Dict[str, Any]]) -> bool:
+        return cached is not None and time.time() - cached.get('fetched_at', 0) < self.fresh_seconds
+
+    def _request(self, url: str, cached: Optional[Dict[str, Any]]) -> Callable[[requests.Session], _Page]:
+        """スケジューラーのワーカーで実行する取得処理（キャッシュがあれば条件付きGET）"""
+        headers = {}
+        if cached is not None:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        def get_page(session: requests.Session) -> _Page:
+            response = session.get(url, headers=headers, timeout=self._timeout(), stream=True)
+            try:
+                body = b""
+                if response.status_code == 200 and 'html' in response.headers.get('Content-Type', 'text/html'):
+                    body = response.raw.read(self.max_bytes, decode_content=True)
+                return _Page(response.status_code, response.headers, body)
+            finally:
+                response.close()
+
+        return get_page
+
+    def _finish(self, url: str, cached: Optional[Dict[str, Any]], page: _Page) -> Optional[str]:
+        """取得結果から本文を取り出してキャッシュする（304ならキャッシュの本文）"""
+        if page.status_code == 304 and cached is not None:
+            self.cache.touch(url, cached)
+            return cached['text']
+        if page.status_code != 200 or not page.body:
+            logger.info(f"Page fetch for {url} returned {page.status_code}")
+            return cached['text'] if cached is not None else None
+        # charsetがヘッダーになければ、metaタグから判定させる（日本語のページで文字化けしないように）
+        charset = re.search(r"charset=([\w-]+)", page.headers.get('Content-Type', ''))
+        text = extract_main_text(page.body, self.max_chars, charset.group(1) if charset else None)
+        self.cache.put(url, text, page.headers.get('ETag'), page.headers.get('Last-Modified'))
+        return text
+
+    def fetch(self, url: str) -> Optional[str]:
+        """
+        ページの本文を返す。キャッシュがあれば条件付きGETで再検証し、304ならキャッシュを使う。
+        取得できなかった場合はキャッシュの本文（なければNone）を返す。
+        """
+        return self.fetch_many([url]).get(url)
+
+    def fetch_many(self, urls: List[str]) -> Dict[str, str]:
+        """
+        複数のページを並列に取得する。時間予算があれば、期限までに取得できなかったページは諦める。
+
+        Returns:
+            URLと本文の辞書（取得できなかったページは含まない）
+        """
+        pages: Dict[str, str] = {}
+        futures = {}
+        for url in urls:
+            cached = self.cache.get(url)
+            if self._is_fresh(cached):
+                pages[url] = cached['text']
+            else:
+                futures[self.scheduler.submit(url, self._request(url, cached))] = (url, cached)
+        if not futures:
+            return pages
+
+        deadline = run_context.current_deadline()
+        done, not_done = wait(futures, timeout=deadline.remaining() if deadline is not None else None)
+        for future in not_done:
+            self.scheduler.cancel(future)
+        if not_done:
+            run_context.mark_truncated(None, f"{len(not_done)}/{len(futures)} page fetches cancelled by deadline")
+
+        for future in done:
+            url, cached = futures[future]
+            try:
+                text = self._finish(url, cached, future.result())
+            except Exception as e:
+                logger.warning(f"Page fetch failed for {url}: {e}")
+                text = cached['text'] if cached is not None else None
+            if text:
+                pages[url] = text
+        return pages
+
+    def select_urls(self, search_results: Dict[str, str]) -> List[str]:
+        """各情報源の上位の結果から順に、重複なくtop_n件のURLを選ぶ（情報源ごとに1件ずつ交互に）"""
+        per_source = [URL_LINE.findall(text) for text in search_results.values()]
+        selected: Dict[str, None] = {}
+        rank = 0
+        while len(selected) < self.top_n and any(rank < len(urls) for urls in per_source):
+            for urls in per_source:
+                if rank < len(urls) and len(selected) < self.top_n:
+                    selected.setdefault(urls[rank], None)
+            rank += 1
+        return list(selected)
+
+    def enrich(self, search_results: Dict[str, str]) -> Dict[str, str]:
+        """
+        検索結果の上位ページの本文を取得し、各結果のURL行の下に "Content: ..." として差し込む。
+
+        Returns:
+            本文を差し込んだ検索結果（取得できなかったページの結果はそのまま）
+        """
+        pages = self.fetch_many(self.select_urls(search_results))
+        if not pages:
+            return search_results
+
+        def insert_content(match: re.Match) -> str:
+            text = pages.get(match.group('url'))
+            return f"{match.group(0)}\nContent: {text}" if text else match.group(0)
+
+        logger.info("Fetched source pages", extra={'page_count': len(pages)})
+        return {key: URL_LINE.sub(insert_content, text) for key, text in search_results.items()}
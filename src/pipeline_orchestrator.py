@@ -1,66 +1,319 @@
-from . import query_refiner
-from . import query_expander
-from . import external_api_client
-from . import outline_creater
-from . import report_writer
-from . import mindmap_generator
+from . import metrics
+from . import report_cache
+from . import run_context
+from .bootstrap import bootstrap
+from .cache_backend import get_cache
+from .deadline import Deadline
+from .profiling import RunProfiler
+from .prompt_templates import template_versions
+from .settings import get_section
 import asyncio
+import importlib
+import os
 import logging
-from typing import Dict, Any, List
+from contextlib import contextmanager
+from functools import cached_property
+from typing import Dict, Any, Iterator, List, Optional
 import time
 
-# ログ設定
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# openai・requests・bs4を読み込むステージのモジュール。起動を速くするため、初めて使うときに読み込む
+_STAGE_MODULES = ('query_refiner', 'query_expander', 'external_api_client', 'page_fetcher', 'outline_creater',
+                  'report_writer', 'mindmap_generator')
+
+
+def _stage_module(name: str) -> Any:
+    return importlib.import_module(f".{name}", __package__)
+
+
+def __getattr__(name: str) -> Any:
+    """ステージのモジュールを属性として参照されたときに読み込む（pipeline_orchestrator.query_refiner など）"""
+    if name in _STAGE_MODULES:
+        return _stage_module(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class RegenerationError(RuntimeError):
+    """作り直しのLLM呼び出しが失敗した（元のパートは残したまま呼び出し側に知らせる）"""
+
+
 class PipelineOrchestrator:
     """
     Lawsyの設計を参考にした、より洗練されたパイプライン全体のフローを制御するクラス。
     STORMベースの処理フローを実装し、英語教育に特化した検索戦略を採用。
     """
+
+    # 時間予算モードで各ステージに配分する比率（残りのステージの比率で残り時間を按分する）
+    STAGE_BUDGET_SHARES = {
+        'refine': 0.08,
+        'education_search': 0.12,
+        'general_search': 0.08,
+        'expand': 0.08,
+        'detailed_search': 0.20,
+        'enrich': 0.06,
+        'outline': 0.14,
+        'write': 0.25,
+        'mindmap': 0.05,
+    }
+    # 検索トピック1件あたりに見込む検索時間（秒）
+    SECONDS_PER_TOPIC_SEARCH = 2.0
+    MAX_TOPICS = 10
+    # 教育ドメイン検索の対象（プロファイルの education_domains の数だけ先頭から使う）
+    EDUCATION_DOMAINS = (
+        "jst.go.jp",  # 科学技術振興機構
+        "mext.go.jp",  # 文部科学省
+        "nier.go.jp",  # 国立教育政策研究所
+        "bunka.go.jp",  # 文化庁
+        "jasso.go.jp",  # 日本学生支援機構
+    )
+
+    # 結果とイベントに含めるルーティングの項目
+    ROUTING_FIELDS = ('query_type', 'profile', 'source', 'confidence', 'search_mode')
+    # 検索の所要時間として数えるステージ
+    SEARCH_STAGES = ('education_search', 'general_search', 'detailed_search')
+    # regenerate で作り直せるステージ（section は本文の1つの章）と、作り直すと古くなる下流のステージ
+    STAGE_DEPENDENTS = {
+        'lead': ('conclusion', 'mindmap'),
+        'body': ('conclusion', 'mindmap'),
+        'section': ('conclusion', 'mindmap'),
+        'related_topics': ('mindmap',),
+        'conclusion': ('mindmap',),
+        'mindmap': (),
+    }
+
     def __init__(self):
-        """各モジュールの初期化"""
-        self.refiner = query_refiner.QueryRefiner()
-        self.expander = query_expander.QueryExpander()
-        self.api_client = external_api_client.ExternalApiClient()
-        self.outline_creator = outline_creater.OutlineCreator()
-        self.writer = report_writer.ReportWriter()
-        self.mindmap_generator = mindmap_generator.MindmapGeneratorModule()
-        print("PipelineOrchestrator initialized with Lawsy-inspired design.")
-
-    def run(self, initial_query: str) -> dict:
+        """
+        各モジュールの初期化。
+        ステージのモジュールは最初に使うときに生成する（キャッシュに当たったクエリではLLMクライアントも作らない）。
+        """
+        bootstrap()
+        shared_reports = get_cache('report')
+        self.report_cache = report_cache.ReportCache(
+            path=os.getenv('REPORT_CACHE_PATH', 'data/cache/report_cache.jsonl'),
+            # プロセス内のバックエンドでは索引と同じレポートを二重に持つだけなので、共有できるときだけ使う
+            shared=shared_reports if shared_reports.shared else None,
+            # 永続化ファイルのレポートも共有キャッシュと同じ期間（settings.yaml の cache.namespaces.report.ttl）で期限切れにする
+            ttl=shared_reports.ttl,
+            **get_section('report_cache')
+        )
+        logger.info("PipelineOrchestrator initialized with Lawsy-inspired design.")
+        logger.info(f"Prompt template versions: {template_versions()}")
+
+    @cached_property
+    def refiner(self):
+        return _stage_module('query_refiner').QueryRefiner()
+
+    @cached_property
+    def expander(self):
+        return _stage_module('query_expander').QueryExpander()
+
+    @cached_property
+    def api_client(self):
+        return _stage_module('external_api_client').ExternalApiClient()
+
+    @cached_property
+    def page_fetcher(self):
+        return _stage_module('page_fetcher').PageFetcher()
+
+    @cached_property
+    def outline_creator(self):
+        return _stage_module('outline_creater').OutlineCreator()
+
+    @cached_property
+    def writer(self):
+        return _stage_module('report_writer').ReportWriter()
+
+    @cached_property
+    def mindmap_generator(self):
+        return _stage_module('mindmap_generator').MindmapGeneratorModule()
+
+    def run(self, initial_query: str, use_cache: bool = True,
+            event_callback: Optional[run_context.EventCallback] = None,
+            deadline: Optional[float] = None, background: bool = False,
+            query_type: Optional[str] = None, search_mode: Optional[str] = None,
+            profiling: bool = False) -> dict:
         """
         Lawsyの設計を参考にしたパイプラインを実行する。
 
         Args:
             initial_query: ユーザーからの最初のクエリ
+            use_cache: 類似クエリのキャッシュ済みレポートがあれば再利用するか
+            event_callback: ステージの開始・終了やレポートのトークンを受け取るコールバック
+            deadline: 時間予算（秒）。指定すると各ステージに予算を配分し、超過した処理は打ち切る
+            background: 低優先度で実行するか（LLM呼び出しはライブの実行に枠を譲る。起動時のウォームアップ用）
+            query_type: クエリの種類（UIのクエリタイプ）。省略するか「自動判定」ならクエリから判定する。
+                種類ごとのプロファイルで検索の広がりとステージが決まる
+            search_mode: 検索モード（自動 / 教育特化 / 一般検索 / 詳細検索）。省略するか「自動」ならプロファイルどおりに検索する
+            profiling: 実行のプロファイル（cProfile とステージごとの待ち時間・処理時間の内訳）を取り、
+                settings.yaml の profiling.output_dir に report_<run_id>.prof / .profile.txt として書き出すか
 
         Returns:
-            最終的に生成されたレポートとマインドマップを含む辞書
+            最終的に生成されたレポートとマインドマップを含む辞書（profiling なら 'profiling' に書き出したファイルと内訳）
         """
-        print(f"--- Running Lawsy-inspired pipeline for query: {initial_query} ---")
+        context = run_context.RunContext(
+            event_callback=event_callback,
+            deadline=Deadline(deadline) if deadline is not None else None,
+            use_cache=use_cache,
+            background=background,
+            profiler=RunProfiler() if profiling else None
+        )
+        in_flight = metrics.gauge('pipelines_in_flight', "Pipelines currently running", ('priority',))
+        priority = 'background' if background else 'live'
+        in_flight.inc(priority=priority)
+        try:
+            with run_context.run_scope(context):
+                result = self._run_profiled(context, initial_query, use_cache, query_type, search_mode)
+        finally:
+            in_flight.dec(priority=priority)
+
+        outcome = 'cache_hit' if result['cache']['hit'] else 'error' if 'error' in result else 'generated'
+        metrics.counter('pipeline_runs_total', "Finished pipeline runs by outcome", ('outcome',)).inc(outcome=outcome)
+        metrics.histogram('pipeline_duration_seconds', "End-to-end pipeline latency",
+                          ('outcome',)).observe(result['processing_time'], outcome=outcome)
+        return result
+
+    def _run_profiled(self, context: run_context.RunContext, initial_query: str, use_cache: bool,
+                      query_type: Optional[str], search_mode: Optional[str]) -> dict:
+        """ステージを実行し、プロファイルを取る実行なら書き出す"""
+        context.emit('pipeline', status='start', query=initial_query)
+        if context.profiler is None:
+            result = self._run_stages(initial_query, use_cache, query_type, search_mode)
+        else:
+            context.profiler.start()
+            try:
+                result = self._run_stages(initial_query, use_cache, query_type, search_mode)
+            finally:
+                context.profiler.stop()
+            # キャッシュに登録した辞書は変えず、プロファイルは返す結果にだけ付ける
+            result = {**result, 'profiling': context.profiler.write(f"report_{context.run_id}")}
+        context.emit('pipeline', status='end', processing_time=result['processing_time'],
+                     cache_hit=result['cache']['hit'])
+        return result
+
+    @contextmanager
+    def _stage(self, name: str) -> Iterator[None]:
+        """ステージの開始・終了をイベントとして通知し、時間予算があればステージの締め切りを設定する"""
+        context = run_context.current_run()
+        if context is not None:
+            context.stage = name
+            context.stage_deadline = self._stage_deadline(context, name)
+        run_context.emit('stage', stage=name, status='start')
+        profiler = context.profiler if context is not None else None
+        cpu_start = time.process_time() if profiler is not None else 0.0
+        stage_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - stage_start
+            run_context.emit('stage', stage=name, status='end', elapsed=elapsed)
+            metrics.histogram('pipeline_stage_duration_seconds', "Pipeline stage latency",
+                              ('stage',)).observe(elapsed, stage=name)
+            if profiler is not None:
+                profiler.record_stage(name, elapsed, time.process_time() - cpu_start)
+            if context is not None:
+                context.record_stage_time(name, elapsed)
+                context.stage = None
+                context.stage_deadline = None
+
+    def _stage_deadline(self, context: run_context.RunContext, name: str) -> Optional[Deadline]:
+        """残り時間を、このステージ以降のステージの配分比率で按分する"""
+        if context.deadline is None or name not in self.STAGE_BUDGET_SHARES:
+            return None
+        stages = list(self.STAGE_BUDGET_SHARES)
+        remaining_shares = sum(self.STAGE_BUDGET_SHARES[s] for s in stages[stages.index(name):])
+        return context.deadline.slice(self.STAGE_BUDGET_SHARES[name] / remaining_shares)
+
+    def _plan_topic_count(self, max_topics: int = MAX_TOPICS) -> int:
+        """詳細検索に見込める時間から、生成する検索トピック数を決める（プロファイルの上限 max_topics まで）"""
+        context = run_context.current_run()
+        if context is None or context.deadline is None:
+            return max_topics
+        stages = list(self.STAGE_BUDGET_SHARES)
+        remaining_shares = sum(self.STAGE_BUDGET_SHARES[s] for s in stages[stages.index('detailed_search'):])
+        search_seconds = context.deadline.remaining() * self.STAGE_BUDGET_SHARES['detailed_search'] / remaining_shares
+        per_topic = self.SECONDS_PER_TOPIC_SEARCH / max(1, self.api_client.max_concurrency)
+        topic_count = max(1, min(max_topics, int(search_seconds / per_topic)))
+        if topic_count < max_topics:
+            context.mark_truncated('expand', f"topic count reduced to {topic_count} for the time budget")
+        return topic_count
+
+    def _run_stages(self, initial_query: str, use_cache: bool, query_type: Optional[str] = None,
+                    search_mode: Optional[str] = None) -> dict:
+        """各ステージを順に実行する"""
+        logger.info("Running pipeline", extra={'query': initial_query})
         start_time = time.time()
 
         try:
+            # 0. クエリの種類を判定し、検索モードと合わせて検索の広がりとステージを決める（ローカルの分類器で数十マイクロ秒）
+            # 分類器は文法ルールの正規表現を読み込み時にコンパイルするので、最初のクエリで読み込む
+            query_classifier = _stage_module('query_classifier')
+            routing = query_classifier.route(initial_query, query_type, search_mode)
+            plan = routing['plan']
+            run_context.emit('routing', **{key: routing[key] for key in self.ROUTING_FIELDS})
+            logger.info("Routed query", extra={key: routing[key] for key in self.ROUTING_FIELDS})
+            # 同じか広い計画で作ったレポートだけを再利用する（一般検索モードのレポートを詳細検索に返さない）
+            def covers_plan(cached: Dict[str, Any]) -> bool:
+                return query_classifier.plan_covers(cached.get('plan'), plan)
+
+            # 0.5 類似クエリのキャッシュ確認（洗練前）
+            if use_cache:
+                cached = self.report_cache.lookup(initial_query, accept=covers_plan)
+                if cached:
+                    return self._get_cached_result(cached, initial_query, start_time)
+
             # 1. クエリ洗練（Web検索用に変換）
-            refined_query = self.refiner.refine(initial_query)
-            print(f"Step 1: Refined query for web search: {refined_query}")
+            with self._stage('refine'):
+                refined_query = self.refiner.refine(initial_query)
+            logger.info("Step 1: Refined query for web search", extra={'refined_query': refined_query})
+
+            # 洗練済みクエリでもキャッシュを確認
+            if use_cache:
+                cached = self.report_cache.lookup(refined_query, accept=covers_plan)
+                if cached:
+                    return self._get_cached_result(cached, initial_query, start_time)
+
+            # 検索APIのキーがなければ2〜5の検索を省く（executed は実際に実行した計画で、キャッシュの再利用の判定に使う）
+            executed, skipped_stages = dict(plan), []
+            if not self._web_search_available():
+                skipped_stages = [stage for stage, planned in (('education_search', plan['education_domains'] > 0),
+                                                               ('general_search', plan['general_search']),
+                                                               ('detailed_search', plan['max_topics'] > 0)) if planned]
+                executed.update(education_domains=0, general_search=False, max_topics=0)
+                if skipped_stages:
+                    logger.warning("Skipping web search stages: no search API key is configured",
+                                   extra={'skipped_stages': skipped_stages})
 
             # 2. ドメイン特化検索（英語教育関連サイト）
-            education_search_results = self._search_education_domains(refined_query)
-            print(f"Step 2: Education domain search completed")
+            education_search_results = {}
+            if executed['education_domains'] > 0:
+                with self._stage('education_search'):
+                    education_search_results = self._search_education_domains(
+                        refined_query, self.EDUCATION_DOMAINS[:executed['education_domains']])
+                logger.info("Step 2: Education domain search completed",
+                            extra={'result_count': len(education_search_results)})
 
             # 3. 一般的なWeb検索
-            general_search_results = self._search_general_web(refined_query)
-            print(f"Step 3: General web search completed")
+            general_search_results = {}
+            if executed['general_search']:
+                with self._stage('general_search'):
+                    general_search_results = self._search_general_web(refined_query)
+                logger.info("Step 3: General web search completed",
+                            extra={'result_count': len(general_search_results)})
 
             # 4. クエリ展開（複数のリサーチトピックに分解）
-            search_topics = self.expander.expand(refined_query)
-            print(f"Step 4: Expanded to search topics: {len(search_topics)} topics")
+            search_topics, detailed_search_results = [], {}
+            if executed['max_topics'] > 0:
+                with self._stage('expand'):
+                    search_topics = self.expander.expand(
+                        refined_query, max_topics=self._plan_topic_count(min(self.MAX_TOPICS, executed['max_topics'])))
+                logger.info("Step 4: Expanded to search topics", extra={'topic_count': len(search_topics)})
 
-            # 5. 各トピックに対する詳細検索
-            detailed_search_results = self._search_detailed_topics(search_topics)
-            print(f"Step 5: Detailed topic search completed")
+                # 5. 各トピックに対する詳細検索
+                with self._stage('detailed_search'):
+                    detailed_search_results = self._search_detailed_topics(search_topics)
+                logger.info("Step 5: Detailed topic search completed",
+                            extra={'result_count': len(detailed_search_results)})
 
             # 6. 情報の統合とアウトライン生成
             combined_results = self._combine_search_results(
@@ -68,22 +321,42 @@ class PipelineOrchestrator:
                 general_search_results, 
                 detailed_search_results
             )
-            outline = self.outline_creator.create(refined_query, combined_results)
-            print(f"Step 6: Created comprehensive outline")
+
+            # 5.5 上位の検索結果のページ本文を取得（settings.yamlの page_fetch.enabled が有効な場合）
+            combined_results = self._enrich_sources(combined_results)
+
+            with self._stage('outline'):
+                outline = self.outline_creator.create(refined_query, combined_results)
+            logger.info("Step 6: Created comprehensive outline")
 
             # 7. レポート執筆（リード文、本文、関連事項、結論）
-            final_report = self.writer.write(outline, combined_results, initial_query, refined_query)
-            print("Step 7: Report written with all sections")
+            with self._stage('write'):
+                sections = self.writer.write_sections(outline, combined_results, initial_query, refined_query)
+                final_report = self.writer.assemble_sections(sections, combined_results)
+            logger.info("Step 7: Report written with all sections")
 
-            # 8. マインドマップ生成
-            mindmap_data = self.mindmap_generator.generate_mindmap(final_report)
-            print("Step 8: Mindmap generated")
+            # 8. マインドマップ生成（軽いプロファイルではLLMを呼ばず、レポートの見出しから作る）
+            if plan['mindmap']:
+                with self._stage('mindmap'):
+                    mindmap_data = self.mindmap_generator.generate_mindmap(final_report)
+            else:
+                mindmap_data = _stage_module('mindmap_generator').mindmap_from_headings(final_report)
+            logger.info("Step 8: Mindmap generated")
 
             # 9. 処理時間の計算
             processing_time = time.time() - start_time
-            print(f"--- Pipeline finished in {processing_time:.2f} seconds ---")
+            logger.info("Pipeline finished", extra={'processing_time': round(processing_time, 2)})
+
+            # 検索モードごとの比較用に、送った検索の数と検索にかかった時間
+            stage_timings = run_context.current_run().stage_timings
+            education_count = min(executed['education_domains'], len(self.EDUCATION_DOMAINS))
+            search_count = education_count + (1 if executed['general_search'] else 0) + len(search_topics)
+            search_time = sum(stage_timings.get(stage, 0.0) for stage in self.SEARCH_STAGES)
+            logger.info("Search plan finished", extra={'search_mode': routing['search_mode'],
+                                                       'search_count': search_count,
+                                                       'search_time': round(search_time, 2)})
             
-            return {
+            result = {
                 'report': final_report,
                 'mindmap': mindmap_data,
                 'query': initial_query,
@@ -93,37 +366,162 @@ class PipelineOrchestrator:
                     'education_results': len(education_search_results),
                     'general_results': len(general_search_results),
                     'detailed_results': len(detailed_search_results),
-                    'total_topics': len(search_topics)
-                }
+                    'total_topics': len(search_topics),
+                    'search_mode': routing['search_mode'],
+                    'search_count': search_count,
+                    'search_time': search_time,
+                    'truncated_stages': list(run_context.current_run().truncated_stages),
+                    'skipped_stages': skipped_stages
+                },
+                # LLMが失敗して既定の文面で済ませたステージ
+                'fallback_stages': list(run_context.current_run().fallback_stages),
+                'routing': {key: routing[key] for key in self.ROUTING_FIELDS},
+                # キャッシュしたレポートを別の計画の実行に使えるかの判定用（省いた検索は含めない）
+                'plan': executed,
+                # 1つのパートだけを作り直すときに再利用する中間成果物（regenerate を参照）
+                'artifacts': {
+                    'outline': outline,
+                    'sources': combined_results,
+                    'sections': sections,
+                    'stale': [],
+                },
+                'cache': {'hit': False},
+                'stage_timings': dict(run_context.current_run().stage_timings),
+                'llm_metrics': {stage: dict(m) for stage, m in run_context.current_run().llm_metrics.items()}
             }
+            self._log_stage_metrics(result)
+            # 時間予算で打ち切ったレポート、検索を省いたレポート、フォールバックの文面を含むレポートは
+            # 品質が落ちるのでキャッシュしない
+            if not result['search_stats']['truncated_stages'] and not skipped_stages and not result['fallback_stages']:
+                self.report_cache.store(result)
+            return result
             
         except Exception as e:
             logger.error(f"Pipeline execution error: {e}")
-            return self._get_fallback_result(initial_query, str(e))
-
-    def _search_education_domains(self, refined_query: str) -> Dict[str, str]:
-        """英語教育関連ドメインに特化した検索"""
-        education_domains = [
-            "jst.go.jp",  # 科学技術振興機構
-            "mext.go.jp",  # 文部科学省
-            "nier.go.jp",  # 国立教育政策研究所
-            "bunka.go.jp",  # 文化庁
-            "jasso.go.jp",  # 日本学生支援機構
-        ]
-        
-        results = {}
-        for domain in education_domains:
-            try:
-                domain_query = f"{refined_query} site:{domain}"
-                result = self.api_client._search_basic_web(domain_query)
-                results[f"education_{domain}"] = result
-            except Exception as e:
-                logger.warning(f"Education domain search failed for {domain}: {e}")
-        
-        return results
+            return self._get_fallback_result(initial_query, str(e), search_mode)
+
+    def regenerate(self, result: Dict[str, Any], stage: str, section: Optional[str] = None,
+                   instruction: str = "",
+                   event_callback: Optional[run_context.EventCallback] = None) -> Dict[str, Any]:
+        """
+        保存済みのレポートの1つのステージ（または本文の1つの章）だけを作り直す。
+        クエリの洗練・検索・アウトラインは result['artifacts'] に保存したものを再利用するので、LLMの呼び出しは1回で済む。
+        下流のステージ（結論やマインドマップ）は作り直さず、artifacts['stale'] に古くなったものとして記録する。
+        古くなったステージも、あとから同じように作り直せる。
+
+        Args:
+            result: run（または regenerate）の戻り値
+            stage: STAGE_DEPENDENTS のいずれか（'section' は本文の1つの章）
+            section: stage が 'section' のときの章の見出し
+            instruction: 追加の指示（「具体例を増やして」など）
+            event_callback: ステージの開始・終了やトークンを受け取るコールバック
+
+        Returns:
+            作り直した部分を差し替えた新しい結果の辞書（元の result は変更しない）
+
+        Raises:
+            ValueError: stage が不正な場合や、result に中間成果物が保存されていない場合
+            RegenerationError: 生成に失敗した場合（既定の文面で保存済みのパートを上書きしない）
+        """
+        if stage not in self.STAGE_DEPENDENTS:
+            raise ValueError(f"Unknown stage '{stage}' (available: {', '.join(self.STAGE_DEPENDENTS)})")
+        artifacts = result.get('artifacts') or {}
+        if not artifacts.get('sections'):
+            raise ValueError("The report has no stored artifacts to regenerate from")
+
+        # 作り直しは毎回新しく生成する（LLMの応答キャッシュから前回と同じ文章を返さない）
+        context = run_context.RunContext(event_callback=event_callback, use_cache=False)
+        start_time = time.time()
+        with run_context.run_scope(context):
+            context.emit('pipeline', status='start', query=result['query'], regenerate=stage)
+            sections = artifacts['sections']
+            mindmap_data = result['mindmap']
+            with self._stage(stage):
+                if stage == 'mindmap':
+                    mindmap_data = self.mindmap_generator.generate_mindmap(result['report'])
+                else:
+                    sections = self.writer.regenerate(stage, sections, artifacts['outline'], artifacts['sources'],
+                                                      result['query'], result['refined_query'],
+                                                      section=section, instruction=instruction)
+            if context.fallback_stages:
+                context.emit('pipeline', status='error', regenerate=stage)
+                raise RegenerationError(f"Could not regenerate '{stage}': the LLM call failed")
+            report = (self.writer.assemble_sections(sections, artifacts['sources'])
+                      if sections is not artifacts['sections'] else result['report'])
+            stale = (set(artifacts.get('stale', ())) - {stage}) | set(self.STAGE_DEPENDENTS[stage])
+            regenerated = dict(result)
+            # processing_time は元のレポートの生成時間のまま残し、作り直しの時間は regenerated に入れる
+            regenerated.update({
+                'report': report,
+                'mindmap': mindmap_data,
+                'artifacts': {**artifacts, 'sections': sections,
+                              'stale': [name for name in self.STAGE_DEPENDENTS if name in stale]},
+                # 作り直せたステージは既定の文面ではなくなった（1つの章だけでは本文全体の既定の文面は消えない）
+                'fallback_stages': [name for name in result.get('fallback_stages', ()) if name != stage],
+                'regenerated': {'stage': stage, 'section': section, 'processing_time': time.time() - start_time},
+                'cache': {'hit': False},
+                'stage_timings': dict(context.stage_timings),
+                'llm_metrics': {name: dict(m) for name, m in context.llm_metrics.items()},
+            })
+            context.emit('pipeline', status='end', processing_time=regenerated['regenerated']['processing_time'],
+                         cache_hit=False)
+        logger.info("Regenerated report stage", extra={'regenerated_stage': stage, 'section': section,
+                                                       'stale': regenerated['artifacts']['stale']})
+        self._log_stage_metrics(regenerated)
+        return regenerated
+
+    def _log_stage_metrics(self, result: Dict[str, Any]) -> None:
+        """ルーティング調整用に、ステージごとの所要時間とトークン数をログに出す"""
+        for stage, elapsed in result['stage_timings'].items():
+            logger.info(f"Stage {stage}: {elapsed:.2f}s")
+        for stage, metrics in result['llm_metrics'].items():
+            logger.info(
+                f"LLM stage {stage} ({metrics['model']}): {metrics['calls']} calls, "
+                f"{metrics['latency']:.2f}s, tokens {metrics['prompt_tokens']}+{metrics['completion_tokens']} "
+                f"(cached {metrics.get('cached_tokens', 0)})"
+            )
+
+    def _get_cached_result(self, cached: Dict[str, Any], initial_query: str, start_time: float) -> Dict[str, Any]:
+        """キャッシュヒット時の結果を組み立てる"""
+        result = dict(cached['result'])
+        result['query'] = initial_query
+        result['processing_time'] = time.time() - start_time
+        context = run_context.current_run()
+        result['stage_timings'] = dict(context.stage_timings) if context else {}
+        result['llm_metrics'] = {stage: dict(m) for stage, m in context.llm_metrics.items()} if context else {}
+        result['cache'] = {
+            'hit': True,
+            'similarity': cached['similarity'],
+            'matched_query': cached['matched_query'],
+        }
+        logger.info("Served cached report", extra={'similarity': round(cached['similarity'], 2),
+                                                   'matched_query': cached['matched_query']})
+        return result
+
+    def _search_education_domains(self, refined_query: str,
+                                  education_domains: tuple = EDUCATION_DOMAINS) -> Dict[str, str]:
+        """英語教育関連ドメインに特化した検索（検索APIがなければ何もしない。_web_search_available を参照）"""
+        if not self._web_search_available():
+            return {}
+        queries = {f"education_{domain}": f"{refined_query} site:{domain}" for domain in education_domains}
+        try:
+            return self.api_client.run_searches(queries, self.api_client._search_topic,
+                                                cache_as=self.api_client.search_provider())
+        except Exception as e:
+            logger.warning(f"Education domain search failed: {e}")
+            return {}
+
+    def _web_search_available(self) -> bool:
+        """
+        Web検索には検索API（Google Custom Search・SerpAPI）が要る。
+        APIキーのないフォールバックは google.com/search を取得するが、robots.txt で拒否されるので必ず失敗する。
+        """
+        return self.api_client.search_provider() != 'basic_web'
 
     def _search_general_web(self, refined_query: str) -> Dict[str, str]:
-        """一般的なWeb検索"""
+        """一般的なWeb検索（検索APIがなければ何もしない）"""
+        if not self._web_search_available():
+            return {}
         try:
             return self.api_client.search([refined_query])
         except Exception as e:
@@ -131,7 +529,9 @@ class PipelineOrchestrator:
             return {"general_search": f"Search error: {str(e)}"}
 
     def _search_detailed_topics(self, search_topics: List[str]) -> Dict[str, str]:
-        """各トピックに対する詳細検索"""
+        """各トピックに対する詳細検索（検索APIがなければ何もしない）"""
+        if not self._web_search_available():
+            return {}
         try:
             return self.api_client.search(search_topics)
         except Exception as e:
@@ -141,21 +541,37 @@ class PipelineOrchestrator:
     def _combine_search_results(self, education_results: Dict[str, str], 
                                general_results: Dict[str, str], 
                                detailed_results: Dict[str, str]) -> Dict[str, str]:
-        """検索結果を統合"""
+        """検索結果を統合（失敗や結果なしの定型文は情報源としてアウトラインや本文に渡さない）"""
+        has_results = _stage_module('external_api_client').has_results
         combined = {}
         
-        # 教育ドメイン検索結果を優先
-        combined.update(education_results)
-        
-        # 一般的な検索結果を追加
-        combined.update(general_results)
-        
-        # 詳細検索結果を追加
-        combined.update(detailed_results)
+        # 教育ドメイン検索結果を優先、一般的な検索結果、詳細検索結果の順に追加
+        for results in (education_results, general_results, detailed_results):
+            combined.update((key, text) for key, text in results.items() if has_results(text))
         
         return combined
 
-    def _get_fallback_result(self, initial_query: str, error_message: str) -> Dict[str, Any]:
+    def _enrich_sources(self, search_results: Dict[str, str]) -> Dict[str, str]:
+        """上位の検索結果のページ本文を取得して検索結果に差し込む（無効ならそのまま返す）"""
+        if not get_section('page_fetch').get('enabled', False):
+            return search_results
+        with self._stage('enrich'):
+            try:
+                return self.page_fetcher.enrich(search_results)
+            except Exception as e:
+                logger.warning(f"Page enrichment failed: {e}")
+                return search_results
+
+    def search_sources(self, refined_query: str, search_topics: List[str]) -> Dict[str, str]:
+        """教育ドメイン・一般・詳細の検索をまとめて実行し、統合した結果を返す（バッチモード用）"""
+        return self._enrich_sources(self._combine_search_results(
+            self._search_education_domains(refined_query),
+            self._search_general_web(refined_query),
+            self._search_detailed_topics(search_topics)
+        ))
+
+    def _get_fallback_result(self, initial_query: str, error_message: str,
+                             search_mode: Optional[str] = None) -> Dict[str, Any]:
         """エラー時のフォールバック結果"""
         return {
             'report': f"# エラーが発生しました\n\nクエリ: {initial_query}\n\nエラー: {error_message}\n\n申し訳ございませんが、しばらく時間をおいてから再度お試しください。",
@@ -173,6 +589,18 @@ class PipelineOrchestrator:
                 'education_results': 0,
                 'general_results': 0,
                 'detailed_results': 0,
-                'total_topics': 0
-            }
+                'total_topics': 0,
+                'search_mode': search_mode or _stage_module('query_classifier').AUTO_SEARCH_MODE,
+                'search_count': 0,
+                'search_time': 0.0,
+                'truncated_stages': [],
+                'skipped_stages': []
+            },
+            'routing': {},
+            'fallback_stages': [],
+            'artifacts': {},
+            'cache': {'hit': False},
+            'stage_timings': {},
+            'llm_metrics': {},
+            'error': error_message
         }
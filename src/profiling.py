@@ -0,0 +1,107 @@
+import cProfile
+import io
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+import logging
+
+from .settings import get_section
+
+logger = logging.getLogger(__name__)
+
+
+class RunProfiler:
+    """
+    1回のパイプライン実行のプロファイル。
+    実行したスレッドの cProfile と、ステージごとの実時間・CPU時間を記録する。
+    CPU時間はプロセス全体（検索やページ取得のワーカースレッドを含む）なので、実時間との差がそのステージの待ち時間になる。
+    待ち時間の内訳（検索の間隔調整のスリープ・レート制限・LLMの応答待ちなど）は run_context.record_wait で記録する。
+    ワーカースレッドの待ちは並行して起きるので、内訳の合計は実時間を超えることがある。
+    """
+
+    def __init__(self):
+        self.profiler = cProfile.Profile()
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.waits: Dict[str, Dict[str, float]] = {}
+        self.wall = 0.0
+        self.cpu = 0.0
+        self._started: Optional[tuple] = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        self._started = (time.perf_counter(), time.process_time())
+        self.profiler.enable()
+
+    def stop(self) -> None:
+        self.profiler.disable()
+        if self._started is not None:
+            wall_start, cpu_start = self._started
+            self.wall = time.perf_counter() - wall_start
+            self.cpu = time.process_time() - cpu_start
+
+    def record_stage(self, stage: str, wall: float, cpu: float) -> None:
+        """ステージ1回分の実時間とCPU時間を足し込む"""
+        with self._lock:
+            timings = self.stages.setdefault(stage, {'wall': 0.0, 'cpu': 0.0})
+            timings['wall'] += wall
+            timings['cpu'] += cpu
+
+    def record_wait(self, stage: str, kind: str, seconds: float) -> None:
+        """ステージ中の待ち時間を種類ごとに足し込む"""
+        with self._lock:
+            waits = self.waits.setdefault(stage, {})
+            waits[kind] = waits.get(kind, 0.0) + seconds
+
+    def breakdown(self) -> Dict[str, Dict[str, Any]]:
+        """
+        ステージごとの内訳。
+
+        Returns:
+            {ステージ名: {'wall', 'cpu', 'wait'（実時間からCPU時間を引いた秒数）, 'waits'（待ちの種類ごとの秒数）}}
+            最後の 'total' は実行全体（ステージの外の処理も含む）
+        """
+        with self._lock:
+            rows = {stage: {**timings, 'wait': max(0.0, timings['wall'] - timings['cpu']),
+                            'waits': dict(self.waits.get(stage, {}))}
+                    for stage, timings in self.stages.items()}
+            total_waits: Dict[str, float] = {}
+            for waits in self.waits.values():
+                for kind, seconds in waits.items():
+                    total_waits[kind] = total_waits.get(kind, 0.0) + seconds
+        rows['total'] = {'wall': self.wall, 'cpu': self.cpu, 'wait': max(0.0, self.wall - self.cpu),
+                         'waits': total_waits}
+        return rows
+
+    def summary(self, top: int = 30) -> str:
+        """ステージごとの待ち時間と処理時間の表と、累積時間の上位の関数"""
+        import pstats
+
+        lines = [f"{'stage':<18}{'wall(s)':>10}{'cpu(s)':>10}{'wait(s)':>10}{'wait%':>8}  waits"]
+        for stage, row in self.breakdown().items():
+            share = row['wait'] / row['wall'] * 100 if row['wall'] else 0.0
+            waits = ", ".join(f"{kind} {seconds:.2f}s" for kind, seconds in sorted(row['waits'].items()))
+            lines.append(f"{stage:<18}{row['wall']:>10.2f}{row['cpu']:>10.2f}{row['wait']:>10.2f}{share:>7.0f}%  {waits}")
+        stream = io.StringIO()
+        pstats.Stats(self.profiler, stream=stream).sort_stats('cumulative').print_stats(top)
+        return "\n".join(lines) + "\n\n" + stream.getvalue()
+
+    def write(self, name: str, output_dir: Optional[str] = None) -> Dict[str, Any]:
+        """
+        プロファイルを output_dir（省略時は settings.yaml の profiling.output_dir）に書き出す。
+        name.prof は pstats / snakeviz で開ける cProfile の結果、name.profile.txt はステージの内訳と上位の関数。
+
+        Returns:
+            {'profile_path', 'summary_path', 'stages'（breakdown の戻り値）}
+        """
+        settings = get_section('profiling')
+        output_dir = output_dir or settings.get('output_dir', 'data/output')
+        os.makedirs(output_dir, exist_ok=True)
+        profile_path = os.path.join(output_dir, f"{name}.prof")
+        summary_path = os.path.join(output_dir, f"{name}.profile.txt")
+        self.profiler.dump_stats(profile_path)
+        with open(summary_path, 'w', encoding='utf-8') as f:
+            f.write(self.summary(int(settings.get('top_functions', 30))))
+        logger.info("Profile written", extra={'profile_path': profile_path, 'wall': round(self.wall, 2),
+                                              'cpu': round(self.cpu, 2)})
+        return {'profile_path': profile_path, 'summary_path': summary_path, 'stages': self.breakdown()}
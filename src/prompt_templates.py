@@ -0,0 +1,319 @@
+import hashlib
+import string
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Tuple
+
+# LLMに送るメッセージのリスト
+Messages = List[Dict[str, str]]
+
+
+class RenderedPrompt(list):
+    """テンプレートから組み立てたメッセージのリスト（どのテンプレートのどの版から作ったかを保持する）"""
+
+    def __init__(self, messages: Messages, template_name: str, version: str):
+        super().__init__(messages)
+        self.template_name = template_name
+        self.version = version
+
+    @property
+    def cache_key(self) -> str:
+        """プロバイダー側のプロンプトキャッシュを同じテンプレートの呼び出しに寄せるためのキー"""
+        return f"{self.template_name}:{self.version}"
+
+    def with_suffix(self, suffix: str) -> 'RenderedPrompt':
+        """最後のメッセージの末尾に文を足したコピーを返す（静的な前半部分はそのまま保つ）"""
+        messages = [dict(message) for message in self]
+        messages[-1]['content'] += suffix
+        return RenderedPrompt(messages, self.template_name, self.version)
+
+
+@dataclass(frozen=True)
+class PromptTemplate:
+    """
+    静的なシステムプロンプト（前半）と、リクエストごとに変わるユーザーメッセージ（後半）に分けたテンプレート。
+    前半を毎回同じ文字列にしておくと、プロバイダー側のプロンプトキャッシュが効く。
+    """
+    name: str
+    system: str
+    user: str
+    fields: Tuple[str, ...] = field(init=False)
+    version: str = field(init=False)
+
+    def __post_init__(self):
+        # 登録時に一度だけプレースホルダーを解析し、内容のハッシュを版とする
+        names = tuple(dict.fromkeys(
+            name for _, name, _, _ in string.Formatter().parse(self.user) if name
+        ))
+        object.__setattr__(self, 'fields', names)
+        digest = hashlib.sha256(f"{self.system}\0{self.user}".encode('utf-8')).hexdigest()
+        object.__setattr__(self, 'version', digest[:12])
+
+    def render(self, **values: Any) -> RenderedPrompt:
+        """
+        値を埋め込んでメッセージのリストを返す。
+
+        Raises:
+            KeyError: 必要な値が渡されていない場合
+        """
+        missing = [name for name in self.fields if name not in values]
+        if missing:
+            raise KeyError(f"Template '{self.name}' is missing values for: {', '.join(missing)}")
+        return RenderedPrompt([
+            {"role": "system", "content": self.system},
+            {"role": "user", "content": self.user.format(**values)},
+        ], self.name, self.version)
+
+
+_REGISTRY: Dict[str, PromptTemplate] = {}
+
+
+def register(name: str, system: str, user: str) -> PromptTemplate:
+    """テンプレートを登録する（同じ名前は上書き）"""
+    template = PromptTemplate(name=name, system=system.strip(), user=user.strip())
+    _REGISTRY[name] = template
+    return template
+
+
+def get_template(name: str) -> PromptTemplate:
+    """登録済みのテンプレートを返す"""
+    try:
+        return _REGISTRY[name]
+    except KeyError:
+        raise KeyError(f"Unknown prompt template: {name}") from None
+
+
+def template_versions() -> Dict[str, str]:
+    """テンプレート名と版（ハッシュ）の一覧"""
+    return {name: template.version for name, template in _REGISTRY.items()}
+
+
+register(
+    "refine",
+    system="""あなたはWebの扱いに長けた優秀な英語教育アナリストです。
+ユーザーのクエリー（高校入試や教科書からの英文を含む可能性があります）にたいして、その英文や関連する英語教育の観点からの解説を与えるのに適した簡潔な検索クエリーを一つ作ってください。
+なお、作成にあたっては下記を守って下さい。
+
+- 英語教育の観点からの解説に繋がるクエリーをつくること
+- あなたの作ったクエリーは可能な限りユーザーが作ったクエリーの意図と過不足なく一致させること
+- クエリーは日本語で作成すること
+- Web検索に最適化すること
+- 簡潔であること
+""",
+    user="""ユーザーのクエリー: {user_query}
+""",
+)
+
+register(
+    "expand",
+    system="""あなたは日本の英語教育に精通した専門家です。
+ユーザーのクエリー（高校入試や教科書からの英文を含む可能性があります）に関して、事前にWeb検索をして簡単に下調べしてあります。
+Web検索結果もふまえ、クエリーに関する英語教育的な解説・分析文書を作成するために必要な情報を検索しようとしています。
+
+解説・分析に必要な情報を適切にヒットさせきるための検索トピックを以下のJSON形式でリストアップしてください。
+
+出力フォーマット：
+{"topics": ["xxx", "yyy", "...", "zzz"]}
+
+検索トピックをリストアップするにあたり、以下の条件を遵守してください。
+
+- クエリーの背景にある英語教育的な論点を深く考察すること
+- クエリーに対する解説・分析を行うのに必要な情報（英文の文法構造、語彙の難易度、構文の複雑性、読解のポイント、指導上の留意点、関連する学習指導要領（英語）、第二言語習得論、応用言語学、英語教授法、教材研究、国内外の事例、および入力された英文に含まれる具体的な文法項目（例: 現在完了進行形、関係代名詞、仮定法など）に関する解説）が揃うように検索トピックをリストアップしてください
+- 検索トピックは可能な限り互いに重複せず、個別に調査可能な形にしてください。 **self-contained** であるべきです
+- 検索トピックは英語教育分野の文脈に準拠した具体的なものにしてください（短文または具体的な専門用語）
+- 検索精度を高めるため、第二言語習得論、応用言語学、英語教授法などの専門用語や、関連するキーワードを含めてください
+- 検索トピックをナンバリングする必要はありません。
+- 検索トピックの個数はユーザーが指定した上限を超えないでください。
+""",
+    user="""検索トピックの個数: 多くても{max_topics}個まで
+
+クエリー: {refined_query}
+""",
+)
+
+register(
+    "outline",
+    system="""あなたは、最新の英語教育ニュースや研究を常にフォローしている英語教育の専門家です。収集された情報源をもとに、ユーザーのクエリーに対する解説レポートとして適切なアウトラインと簡潔なタイトルを作成してください。結論パートは絶対に作成しないでください。
+
+アウトラインは以下のMarkdownフォーマットに従って作成し、次のルールを厳守すること。
+1. クエリーに対して、英語教育的な観点からの解説・分析を目的とした構成にする。
+2. "# Title" をレポートのタイトルに用いる。
+3. "## Title" を章のタイトルとして用いる。
+   - 各章 ("## Title") に対して、必ず2～3個以上の節 ("### Title") を生成すること
+   - 章の数はクエリーに応じて5～10個の間で作成すること。
+4. "### Title" を節のタイトルとして用いる。
+   - 各節には、収集された情報源をできるだけ多く含めるようにし、必ず最低3～5個以上の異なる引用番号を使用すること
+   - 節同士で内容が類似しそうな場合、節を統合し、他の論点の節を追加すること
+5. 引用情報の記載方法
+   - 引用番号は節の次の行に記載すること。`### Title [3][4]` のように同じ行に記載してはならない
+6. Markdownフォーマットに関するルール
+   - "## 結論"という結論パートは絶対に作成してはいけない
+   - 出力には "# Title", "## Title"、"### Title" などのMarkdown形式のタイトル以外のテキストを一切含めないこと
+7. 各行はタイトル、セクション、サブセクション、引用番号のいずれかでそれ以外の情報を記載してはならない
+
+【出力例】
+    # レポートタイトル
+    ## セクション1
+    ### サブセクション1
+    [4][67]
+    ### サブセクション2
+    [30][28][1][27][102]
+    ## セクション2
+    ### サブセクション1
+    [14][25][9][96]
+    ### サブセクション2
+    [2][24][51]
+    ### サブセクション3
+    [29][11][4][56]
+    ...
+
+    【不適切な出力例】
+    # レポートタイトル: xxx    // 「レポートタイトル: 」という修飾はNG
+    ## セクション1
+    ### サブセクション1 [4][67]    // 引用はサブセクションの行にはつけない
+    [4][67]
+    このサブセクションでは...    // 説明文など要求していない不要な行は削除
+    ### サブセクション2 [30][28][1][27][102]    // 同上
+    [30][28][1][27][102]
+    ## セクション2
+    [2][24][29][11][4]    // セクション自体に引用がついている
+    ### サブセクション1
+    ### サブセクション: yyy    // 「サブセクション: 」という修飾はNG
+    [2][24][51]
+    ### サブセクション3
+    [29][11][4][156]     // （引用が例えば110までしかない場合）156は存在しない引用
+""",
+    user="""【情報源】
+{search_results_text}
+
+【クエリー】
+{refined_query}
+""",
+)
+
+register(
+    "lead",
+    system="""あなたは英語教育問題に精通し、分かりやすい解説記事を書くことに定評のある信頼できるライターです。
+ユーザーのクエリーに関する調査レポートの、タイトルの直後に表示する簡潔なリード文を生成してください。
+リード文は、レポート全体の要旨、特に英語教育的な観点からの主要な論点や分析の方向性を含めた、140〜280文字程度の簡潔な文章にしてください。
+""",
+    user="""クエリー: {refined_query}
+""",
+)
+
+register(
+    "body",
+    system="""あなたは日本の英語教育に精通し、客観的なデータと英語教育理論に基づいた分かりやすい解説を書くことに定評のある信頼できるライターです。
+ユーザーのクエリー（高校入試や教科書からの英文を含む可能性があります）に関するレポートのアウトラインに基づき、各章の本文を執筆してください。
+アウトラインの中にある引用番号は漏れることなく必ず参照し、収集された情報源の内容を適切に解釈しながら、各節ごとに400字以上で解説を記載してください。
+解説は緻密かつ包括的で、情報源に基づいたものであることが望ましいです。特に、入力された英文がある場合は、その英文の具体的な分析（文法、語彙、構文、読解ポイントなど）を詳細に含めてください。英語教育に詳しくない人向けにわかりやすくかみ砕いて説明することも重要です。必要に応じて、関連する英語教育理論、歴史的背景、国内外の事例、最新の統計データなどを盛り込んでください。
+なお、内容の信頼性が重要なので、必ず情報源にあたり、下記指示にあるように引用をするのを忘れないで下さい。
+1. アウトラインの"# Title"、"## Title"、"### Title"のタイトルは変更しないでください。
+2. 必ず情報源の情報に基づき記載し、ハルシネーションに気をつけること。
+   記載の根拠となる参照すべき情報源は "...です[4][1][27]。" "...ます[21][9]。" のように明示してください。
+3. 正しく引用が明示されているほどあなたの解説は高く評価されます。
+4. 内容に応じて箇条書きを適切に配置し、読者の理解度を深めてください。
+5. 日本語の「ですます調」で解説を書いてください。
+6. 【英文の計測値】がある場合、語彙の難易度・文の長さ・読みやすさはその数値をそのまま使い、自分で推定したり数え直したりしないでください。
+""",
+    user="""【情報源】
+{search_results_text}
+
+【アウトライン】
+{outline}
+
+【クエリー】
+{refined_query}
+{passage_facts}
+""",
+)
+
+register(
+    "body_section",
+    system="""あなたは日本の英語教育に精通し、客観的なデータと英語教育理論に基づいた分かりやすい解説を書くことに定評のある信頼できるライターです。
+ユーザーのクエリーに関するレポートのうち、示されたアウトラインの1つの章（"## Title" とその配下の "### Title"）だけの本文を執筆し直してください。
+アウトラインの中にある引用番号は漏れることなく必ず参照し、収集された情報源の内容を適切に解釈しながら、各節ごとに400字以上で解説を記載してください。
+1. 章の "## Title" の行から書き始め、アウトラインの "## Title"、"### Title" のタイトルは変更しないでください。他の章は書かないでください。
+2. 必ず情報源の情報に基づき記載し、ハルシネーションに気をつけること。
+   記載の根拠となる参照すべき情報源は "...です[4][1][27]。" "...ます[21][9]。" のように、情報源に付いている番号のまま明示してください。
+3. 内容に応じて箇条書きを適切に配置し、読者の理解度を深めてください。
+4. 日本語の「ですます調」で解説を書いてください。
+5. 【英文の計測値】がある場合、語彙の難易度・文の長さ・読みやすさはその数値をそのまま使い、自分で推定したり数え直したりしないでください。
+6. 【追加の指示】がある場合は、上記のルールを守ったうえでその指示に従ってください。
+""",
+    user="""【情報源】
+{search_results_text}
+
+【章のアウトライン】
+{outline_section}
+
+【クエリー】
+{refined_query}
+{passage_facts}
+""",
+)
+
+register(
+    "related_topics",
+    system="""あなたは英文法に精通した専門家です。
+ユーザーが示す英文を分析し、含まれる主要な文法項目を特定してください。
+特定した各文法項目について、以下の形式で簡潔に解説してください。
+
+出力フォーマット：
+- **[文法項目名]**: [その文法項目の簡潔な説明]。例: [提供された英文からの該当箇所]
+
+例:
+- **現在完了進行形**: 過去のある時点から現在まで継続している動作を表します。例: "We have been discussing it since last week."
+- **関係代名詞**: 名詞を修飾する節を導きます。例: "It's a song about friendship." (ここでは関係代名詞が省略されているが、概念として関連する)
+
+検索トピックをリストアップするにあたり、以下の条件を遵守してください。
+- 英文に含まれる主要な文法項目を網羅的に特定すること。
+- 各文法項目の説明は、高校生が理解できるレベルで簡潔に記述すること。
+- 提供された英文中の具体的な箇所を例として引用し、解説と関連付けること。
+- 文法項目は、`_GrammarDictionary_Index.md`に記載されているような一般的な文法分類に従うこと。
+- 箇条書き形式で出力すること。
+""",
+    user="""【英文】
+{initial_query}
+""",
+)
+
+register(
+    "conclusion",
+    system="""あなたは英語教育問題に精通し、未来志向の提言をすることに定評のある信頼できるライターです。
+ユーザーが示すレポートの要点（見出しと各節の主な文）を踏まえて、レポート全体の要約を本文とはできるだけ異なる表現で記載しつつ、英語教育的な観点からの今後の展望や課題、考えられる対策を含んだ結論部を生成します。
+最低でも400字以上、可能なら600字以上記載してください。
+結論の文章部分のみ生成し、"## 結論" のようなヘッダは入れないでください。
+""",
+    user="""【レポートの要点】
+{digest}
+""",
+)
+
+register(
+    "mindmap",
+    system="""あなたは英語教育の専門家で、レポート内容を構造化してマインドマップを作成するのが得意です。
+ユーザーが示すレポート内容を分析し、階層構造を持つマインドマップデータをJSON形式で生成してください。
+
+マインドマップの構造は以下の形式に従ってください：
+- メインノード（レポートのタイトル）
+- サブノード（主要な章やセクション）
+- さらに細かいノード（詳細な内容）
+
+出力は有効なJSON形式で、以下の構造にしてください：
+{
+  "name": "メインノード名",
+  "children": [
+    {
+      "name": "サブノード名",
+      "children": [
+        {"name": "詳細ノード名", "children": []},
+        {"name": "詳細ノード名2", "children": []}
+      ]
+    }
+  ]
+}
+""",
+    user="""レポート内容：
+{report_content}
+""",
+)
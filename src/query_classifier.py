@@ -0,0 +1,198 @@
+import math
+import threading
+import unicodedata
+from collections import Counter
+from typing import Any, Dict, NamedTuple, Optional
+import logging
+
+from .grammar_analyzer import english_sentences
+from .settings import get_section
+
+logger = logging.getLogger(__name__)
+
+# UIで「自動判定」を選んだときの値（分類器で判定する）
+AUTO = "自動判定"
+# 検索モードの「自動」（クエリの種類のプロファイルどおりに検索する）
+AUTO_SEARCH_MODE = "自動"
+
+# プロファイルの既定値（settings.yaml の query_profiles で上書きする）。full は従来どおりの全ステージ
+_DEFAULT_PROFILE = {
+    'education_domains': 5,
+    'general_search': True,
+    'max_topics': 10,
+    'mindmap': True,
+}
+
+
+class Classification(NamedTuple):
+    """クエリの種類の判定結果"""
+    query_type: str
+    confidence: float
+    scores: Dict[str, float]
+
+
+class QueryClassifier:
+    """
+    キーワードと文字n-gramを特徴量とする多項ナイーブベイズで、クエリの種類（UIのクエリタイプ）を判定する。
+    学習データは settings.yaml の query_classifier.types にある例文とキーワードで、起動時に数ミリ秒で学習する。
+    判定はクエリの特徴量（数十個）の対数確率を足すだけなので、1件あたり数十マイクロ秒で終わる。
+    """
+
+    def __init__(self, settings: Optional[Dict[str, Any]] = None):
+        settings = settings if settings is not None else get_section('query_classifier')
+        self.types: Dict[str, Dict[str, Any]] = dict(settings.get('types') or {})
+        self.default_type = settings.get('default_type', 'その他')
+        self.min_confidence = float(settings.get('min_confidence', 0.5))
+        # どのキーワードも含まないクエリは特徴量が少なく確率が偏りやすいので、より高い確信度を求める
+        self.min_confidence_without_keywords = float(settings.get('min_confidence_without_keywords', 0.9))
+        low, high = settings.get('ngram_range', [2, 3])
+        self.ngram_range = (int(low), int(high))
+        self.keyword_weight = float(settings.get('keyword_weight', 3))
+        self.alpha = float(settings.get('alpha', 1.0))
+        self.keywords = sorted({keyword.lower() for config in self.types.values()
+                                for keyword in config.get('keywords') or []}, key=len, reverse=True)
+        self._log_priors: Dict[str, float] = {}
+        self._log_likelihoods: Dict[str, Dict[str, float]] = {}
+        self._log_unseen: Dict[str, float] = {}
+        self._train()
+
+    def _features(self, text: str) -> Counter:
+        """文字n-gram・キーワード・英文の有無と長さの特徴量"""
+        text = unicodedata.normalize('NFKC', text).lower()
+        features: Counter = Counter()
+        for chunk in text.split():
+            for n in range(self.ngram_range[0], self.ngram_range[1] + 1):
+                for i in range(len(chunk) - n + 1):
+                    features[chunk[i:i + n]] += 1
+        for keyword in self.keywords:
+            if keyword in text:
+                features[f"kw:{keyword}"] += 1
+        sentences = english_sentences(text)
+        if sentences:
+            features['signal:english'] += 1
+            if sum(len(sentence.split()) for sentence in sentences) > 40:
+                features['signal:passage'] += 1
+        return features
+
+    def _train(self) -> None:
+        counts: Dict[str, Counter] = {}
+        documents: Dict[str, float] = {}
+        for query_type, config in self.types.items():
+            class_counts = Counter()
+            examples = list(config.get('examples') or [])
+            for example in examples:
+                class_counts.update(self._features(example))
+            for keyword in config.get('keywords') or []:
+                class_counts[f"kw:{keyword.lower()}"] += self.keyword_weight
+            counts[query_type] = class_counts
+            documents[query_type] = max(1, len(examples))
+
+        vocabulary = set().union(*counts.values()) if counts else set()
+        total_documents = sum(documents.values())
+        for query_type, class_counts in counts.items():
+            denominator = sum(class_counts.values()) + self.alpha * len(vocabulary)
+            self._log_priors[query_type] = math.log(documents[query_type] / total_documents)
+            self._log_likelihoods[query_type] = {
+                feature: math.log((count + self.alpha) / denominator) for feature, count in class_counts.items()
+            }
+            self._log_unseen[query_type] = math.log(self.alpha / denominator)
+        self._vocabulary = vocabulary
+
+    def classify(self, query: str) -> Classification:
+        """
+        クエリの種類を判定する。確信度（事後確率）が min_confidence 未満なら既定の種類を返す。
+        既定の種類は全ステージを実行するプロファイルに割り当てるので、迷ったクエリは軽いプロファイルに回さない。
+        """
+        if not self._log_priors:
+            return Classification(self.default_type, 0.0, {})
+        features = [(feature, count) for feature, count in self._features(query).items()
+                    if feature in self._vocabulary]
+        log_scores = {}
+        for query_type, prior in self._log_priors.items():
+            likelihoods = self._log_likelihoods[query_type]
+            unseen = self._log_unseen[query_type]
+            log_scores[query_type] = prior + sum(count * likelihoods.get(feature, unseen)
+                                                 for feature, count in features)
+        best = max(log_scores.values())
+        weights = {query_type: math.exp(score - best) for query_type, score in log_scores.items()}
+        total = sum(weights.values())
+        scores = {query_type: weight / total for query_type, weight in weights.items()}
+        query_type = max(scores, key=scores.get)
+        has_keyword = any(feature.startswith('kw:') for feature, _ in features)
+        threshold = self.min_confidence if has_keyword else self.min_confidence_without_keywords
+        if not features or scores[query_type] < threshold:
+            return Classification(self.default_type, scores.get(self.default_type, 0.0), scores)
+        return Classification(query_type, scores[query_type], scores)
+
+    def profile_name(self, query_type: str) -> str:
+        """クエリの種類に割り当てたパイプラインのプロファイル名"""
+        config = self.types.get(query_type) or self.types.get(self.default_type) or {}
+        return config.get('profile', 'full')
+
+
+def get_profile(name: str) -> Dict[str, Any]:
+    """パイプラインのプロファイル（settings.yaml の query_profiles。未定義の項目は全ステージ実行の既定値）"""
+    profiles = get_section('query_profiles')
+    if name not in profiles:
+        logger.warning(f"Unknown query profile '{name}', running the full pipeline")
+    return {**_DEFAULT_PROFILE, **(profiles.get(name) or {})}
+
+
+def plan_covers(built: Optional[Dict[str, Any]], requested: Dict[str, Any]) -> bool:
+    """
+    built の計画で作ったレポートが requested の計画の代わりになるか（検索もマインドマップも同じか多い）。
+    計画の記録がないレポートは代わりにしない。
+    """
+    if not built:
+        return False
+    return all(built.get(key, 0) >= value for key, value in requested.items())
+
+
+def route(query: str, query_type: Optional[str] = None, search_mode: Optional[str] = None) -> Dict[str, Any]:
+    """
+    クエリの種類とプロファイルを決める。UIやAPIで種類が明示されていれば分類器より優先する。
+    検索モード（settings.yaml の search_modes）を指定すると、プロファイルの検索の設定をモードのものに置き換える。
+
+    Returns:
+        {'query_type', 'confidence', 'source'（user / classifier）, 'profile'（プロファイル名）,
+         'search_mode', 'plan'（プロファイルに検索モードを重ねた実行計画）}
+    """
+    classifier = get_classifier()
+    if query_type and query_type != AUTO and query_type in classifier.types:
+        routing = {'query_type': query_type, 'confidence': 1.0, 'source': 'user'}
+    else:
+        classification = classifier.classify(query)
+        routing = {'query_type': classification.query_type, 'confidence': round(classification.confidence, 3),
+                   'source': 'classifier'}
+    routing['profile'] = classifier.profile_name(routing['query_type'])
+    plan = get_profile(routing['profile'])
+
+    modes = get_section('search_modes')
+    if search_mode and search_mode != AUTO_SEARCH_MODE and search_mode not in modes:
+        logger.warning(f"Unknown search mode '{search_mode}', using the query profile")
+        search_mode = None
+    if search_mode and search_mode != AUTO_SEARCH_MODE:
+        plan.update(modes[search_mode] or {})
+    routing['search_mode'] = search_mode or AUTO_SEARCH_MODE
+    routing['plan'] = plan
+    return routing
+
+
+_classifier: Optional[QueryClassifier] = None
+_classifier_lock = threading.Lock()
+
+
+def get_classifier() -> QueryClassifier:
+    """プロセスで共有する分類器を返す（初回に settings.yaml の例文で学習する）"""
+    global _classifier
+    with _classifier_lock:
+        if _classifier is None:
+            _classifier = QueryClassifier()
+        return _classifier
+
+
+def reset_classifier() -> None:
+    """共有の分類器を破棄する（テスト用・設定の変更後）"""
+    global _classifier
+    with _classifier_lock:
+        _classifier = None
@@ -1,5 +1,20 @@
 from .llm_client import LLMClient
+from .prompt_templates import RenderedPrompt, get_template
+from .structured_output import StructuredOutputError, parse_json
+from . import run_context
 import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 検索トピックの出力形式
+TOPICS_SCHEMA = {
+    "type": "object",
+    "required": ["topics"],
+    "properties": {
+        "topics": {"type": "array", "items": {"type": "string", "minLength": 1}},
+    },
+}
 
 class QueryExpander:
     """
@@ -9,65 +24,69 @@ class QueryExpander:
         """
         プロンプトを初期化する。
         """
-        self.prompt_template = """あなたは日本の英語教育に精通した専門家です。
-下記のクエリー（高校入試や教科書からの英文を含む可能性があります）に関して、事前にWeb検索をして簡単に下調べしてあります。
-Web検索結果もふまえ、クエリーに関する英語教育的な解説・分析文書を作成するために必要な情報を検索しようとしています。
-
-解説・分析に必要な情報を適切にヒットさせきるための検索トピックを以下の形式でリストアップしてください。
-
-出力フォーマット：
-- xxx
-- yyy
-- ...
-- zzz
-
-検索トピックをリストアップするにあたり、以下の条件を遵守してください。
-
-- クエリーの背景にある英語教育的な論点を深く考察すること
-- クエリーに対する解説・分析を行うのに必要な情報（英文の文法構造、語彙の難易度、構文の複雑性、読解のポイント、指導上の留意点、関連する学習指導要領（英語）、第二言語習得論、応用言語学、英語教授法、教材研究、国内外の事例、および入力された英文に含まれる具体的な文法項目（例: 現在完了進行形、関係代名詞、仮定法など）に関する解説）が揃うように検索トピックをリストアップしてください
-- 検索トピックは可能な限り互いに重複せず、個別に調査可能な形にしてください。 **self-contained** であるべきです
-- 検索トピックは英語教育分野の文脈に準拠した具体的なものにしてください（短文または具体的な専門用語）
-- 検索精度を高めるため、第二言語習得論、応用言語学、英語教授法などの専門用語や、関連するキーワードを含めてください
-- 検索トピックをナンバリングする必要はありません。
-- 検索トピックの個数は多くても10個までにしてください。
-
-クエリー: {refined_query}
-"""
+        self.prompt_template = get_template('expand')
         self.llm_client = LLMClient()
 
-    def expand(self, refined_query: str) -> list[str]:
+    def expand(self, refined_query: str, max_topics: int = 10) -> list[str]:
         """
         洗練されたクエリを受け取り、プロンプトに基づいて検索トピックのリストを生成する。
 
         Args:
             refined_query: 洗練された検索クエリ
+            max_topics: 生成する検索トピックの上限数
 
         Returns:
             検索トピックのリスト
         """
         try:
-            full_prompt = self.prompt_template.format(refined_query=refined_query)
-            response_text = self.llm_client.generate_text(full_prompt, max_tokens=1000, temperature=0.4)
-            
-            # レスポンスの妥当性をチェック
-            if self.llm_client.validate_response(response_text):
-                # レスポンスから検索トピックを抽出
-                search_topics = self._extract_topics(response_text)
-                print(f"Expanding query for: {refined_query}")
-                print(f"Expanded to topics: {search_topics}")
-                return search_topics
-            else:
-                # フォールバック: 仮実装
-                print(f"LLM response validation failed, using fallback for: {refined_query}")
-                return self._get_fallback_topics(refined_query)
+            full_prompt = self.build_prompt(refined_query, max_topics)
+            try:
+                data = self.llm_client.generate_json(full_prompt, schema=TOPICS_SCHEMA, max_tokens=1000,
+                                                     temperature=0.4, stage="expand")
+                search_topics = [topic.strip() for topic in data['topics'] if topic.strip()][:max_topics]
+                if search_topics:
+                    logger.info("Expanded query", extra={'topic_count': len(search_topics), 'topics': search_topics})
+                    return search_topics
+                run_context.mark_fallback('expand', "no topics in the LLM response")
+                return self._get_fallback_topics(refined_query)[:max_topics]
+            except StructuredOutputError as e:
+                # JSONにならなかった応答は箇条書きとして読む
+                return self.parse_response(refined_query, e.text, max_topics)
                 
         except Exception as e:
-            print(f"Error in query expansion: {e}")
+            logger.warning(f"Error in query expansion: {e}")
             # エラー時のフォールバック
-            return self._get_fallback_topics(refined_query)
+            run_context.mark_fallback('expand', str(e))
+            return self._get_fallback_topics(refined_query)[:max_topics]
     
+    def build_prompt(self, refined_query: str, max_topics: int = 10) -> RenderedPrompt:
+        """LLMに送るプロンプトを組み立てる"""
+        return self.prompt_template.render(refined_query=refined_query, max_topics=max_topics)
+
+    def parse_response(self, refined_query: str, response_text: str, max_topics: int = 10) -> list[str]:
+        """LLMの応答から検索トピックのリストを取り出す（不正な応答ならフォールバック）"""
+        # レスポンスの妥当性をチェック
+        if self.llm_client.validate_response(response_text):
+            # レスポンスから検索トピックを抽出（JSONで読めなければ箇条書きとして読む）
+            search_topics = self._extract_topics(response_text)[:max_topics]
+            logger.info("Expanded query", extra={'topic_count': len(search_topics), 'topics': search_topics})
+            return search_topics
+        else:
+            # フォールバック: 仮実装
+            logger.warning("LLM response validation failed, using fallback", extra={'refined_query': refined_query})
+            run_context.mark_fallback('expand', "invalid LLM response")
+            return self._get_fallback_topics(refined_query)[:max_topics]
+
     def _extract_topics(self, response_text: str) -> list[str]:
         """レスポンステキストから検索トピックを抽出する"""
+        try:
+            data = parse_json(response_text, TOPICS_SCHEMA)
+            topics = [topic.strip() for topic in data['topics'] if topic.strip()]
+            if topics:
+                return topics
+        except StructuredOutputError:
+            pass
+
         topics = []
         lines = response_text.strip().split('\n')
         
@@ -79,7 +98,10 @@ Web検索結果もふまえ、クエリーに関する英語教育的な解説
                 if topic:
                     topics.append(topic)
         
-        return topics if topics else self._get_fallback_topics("")
+        if not topics:
+            run_context.mark_fallback('expand', "no topics in the LLM response")
+            return self._get_fallback_topics("")
+        return topics
     
     def _get_fallback_topics(self, refined_query: str) -> list[str]:
         """フォールバック用の検索トピックを返す"""
@@ -1,4 +1,9 @@
 from .llm_client import LLMClient
+from .prompt_templates import RenderedPrompt, get_template
+from . import run_context
+import logging
+
+logger = logging.getLogger(__name__)
 
 class QueryRefiner:
     """
@@ -8,18 +13,7 @@ class QueryRefiner:
         """
         プロンプトを初期化する。
         """
-        self.prompt_template = """あなたはWebの扱いに長けた優秀な英語教育アナリストです。
-下記のユーザーのクエリー（高校入試や教科書からの英文を含む可能性があります）にたいして、その英文や関連する英語教育の観点からの解説を与えるのに適した簡潔な検索クエリーを一つ作ってください。
-なお、作成にあたっては下記を守って下さい。
-
-- 英語教育の観点からの解説に繋がるクエリーをつくること
-- あなたの作ったクエリーは可能な限りユーザーが作ったクエリーの意図と過不足なく一致させること
-- クエリーは日本語で作成すること
-- Web検索に最適化すること
-- 簡潔であること
-
-ユーザーのクエリー: {user_query}
-"""
+        self.prompt_template = get_template('refine')
         self.llm_client = LLMClient()
 
     def refine(self, user_query: str) -> str:
@@ -33,20 +27,32 @@ class QueryRefiner:
             洗練された検索クエリ
         """
         try:
-            full_prompt = self.prompt_template.format(user_query=user_query)
-            refined_query = self.llm_client.generate_text(full_prompt, max_tokens=500, temperature=0.3)
-            
-            # レスポンスの妥当性をチェック
-            if self.llm_client.validate_response(refined_query):
-                print(f"Refining query for: {user_query}")
-                print(f"Refined query: {refined_query}")
-                return refined_query.strip()
-            else:
-                # フォールバック: 仮実装
-                print(f"LLM response validation failed, using fallback for: {user_query}")
-                return f'「{user_query}」に関する英語教育の観点からの解説'
+            full_prompt = self.build_prompt(user_query)
+            refined_query = self.llm_client.generate_text(full_prompt, max_tokens=500, temperature=0.3, stage="refine")
+            return self.parse_response(user_query, refined_query)
                 
         except Exception as e:
-            print(f"Error in query refinement: {e}")
+            logger.warning(f"Error in query refinement: {e}")
             # エラー時のフォールバック
-            return f'「{user_query}」に関する英語教育の観点からの解説'
+            run_context.mark_fallback('refine', str(e))
+            return self._get_fallback_query(user_query)
+
+    def build_prompt(self, user_query: str) -> RenderedPrompt:
+        """LLMに送るプロンプトを組み立てる"""
+        return self.prompt_template.render(user_query=user_query)
+
+    def parse_response(self, user_query: str, refined_query: str) -> str:
+        """LLMの応答から洗練済みクエリを取り出す（不正な応答ならフォールバック）"""
+        # レスポンスの妥当性をチェック
+        if self.llm_client.validate_response(refined_query):
+            logger.info("Refined query", extra={'user_query': user_query, 'refined_query': refined_query.strip()})
+            return refined_query.strip()
+        else:
+            # フォールバック: 仮実装
+            logger.warning("LLM response validation failed, using fallback", extra={'user_query': user_query})
+            run_context.mark_fallback('refine', "invalid LLM response")
+            return self._get_fallback_query(user_query)
+
+    def _get_fallback_query(self, user_query: str) -> str:
+        """フォールバック用の検索クエリを返す"""
+        return f'「{user_query}」に関する英語教育の観点からの解説'
@@ -0,0 +1,295 @@
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional, TypeVar
+import logging
+
+import openai
+
+from . import metrics
+from . import run_context
+from .deadline import Deadline, DeadlineExceeded
+from .settings import get_section
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# RPM/TPMを数える時間窓（秒）
+WINDOW_SECONDS = 60.0
+
+
+class Permit:
+    """1回のリクエストに割り当てた枠。実際のトークン数が分かったらsettleで見積もりを置き換える"""
+
+    def __init__(self, governor: 'RateGovernor', entry: list):
+        self._governor = governor
+        self._entry = entry
+
+    def settle(self, tokens: int) -> None:
+        """実際に消費したトークン数を記録する"""
+        if tokens > 0:
+            self._governor._settle(self._entry, tokens)
+
+
+class RateGovernor:
+    """
+    1つのモデルへのLLM呼び出しを統制するプロセス共通のガバナー。
+    直近60秒のリクエスト数（RPM）とトークン数（TPM）を設定した上限内に収め、
+    同時実行数は429を受けると半減、成功が続くと少しずつ増やす（AIMD）。
+    429や一時的なエラーはretry-afterを守りつつ、ジッター付きの指数バックオフで再試行する。
+    バックグラウンドの呼び出し（起動時のウォームアップなど）は枠の一部しか使わず、ライブの呼び出しが待っていれば譲る。
+    """
+
+    def __init__(self, name: str, rpm: int = 500, tpm: int = 300000, max_concurrency: int = 8,
+                 min_concurrency: int = 1, max_retries: int = 5, base_delay: float = 0.5,
+                 max_delay: float = 30.0, background_share: float = 0.25):
+        """
+        Args:
+            name: ログ用の名前（モデル名）
+            rpm: 1分あたりのリクエスト数の上限
+            tpm: 1分あたりのトークン数の上限
+            max_concurrency: 同時実行数の上限（AIMDで増やす上限）
+            min_concurrency: 同時実行数の下限（AIMDで減らす下限）
+            max_retries: 再試行の最大回数
+            base_delay: バックオフの基準秒数
+            max_delay: バックオフの最大秒数
+            background_share: バックグラウンドの呼び出しが使える同時実行数・RPM・TPMの割合
+        """
+        self.name = name
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.background_share = background_share
+
+        # AIMDで調整する同時実行数（小数で持ち、切り捨てた値を実際の上限にする）
+        self.concurrency_limit = float(max_concurrency)
+        self.in_flight = 0
+        # 直近の時間窓のリクエスト: [開始時刻, トークン数, 窓内にあるか]
+        self._window: deque = deque()
+        self._window_tokens = 0
+        # retry-afterで指定された時刻まで全リクエストを止める
+        self._blocked_until = 0.0
+        # 枠の空きを待っているライブの呼び出しの数（バックグラウンドの呼び出しはこれが0のときだけ始める）
+        self._live_waiting = 0
+        self._condition = threading.Condition()
+
+        self.stats_counters = {'requests': 0, 'rate_limited': 0, 'retries': 0, 'wait_seconds': 0.0}
+
+    def _prune(self, now: float) -> None:
+        while self._window and now - self._window[0][0] >= WINDOW_SECONDS:
+            entry = self._window.popleft()
+            entry[2] = False
+            self._window_tokens -= entry[1]
+
+    def _settle(self, entry: list, tokens: int) -> None:
+        with self._condition:
+            if entry[2]:
+                self._window_tokens += tokens - entry[1]
+            entry[1] = tokens
+            self._condition.notify_all()
+
+    def _wait_time(self, now: float, tokens: int, background: bool = False) -> float:
+        """今リクエストを始められなければ、待つべき秒数を返す（始められるなら0）"""
+        share = self.background_share if background else 1.0
+        if now < self._blocked_until:
+            return self._blocked_until - now
+        if background and self._live_waiting:
+            return 1.0
+        if self.in_flight >= max(1, int(self.concurrency_limit * share)):
+            # 同時実行数の空きはnotifyで起こされるので、念のための上限だけ返す
+            return 1.0
+        if len(self._window) >= max(1, int(self.rpm * share)):
+            return self._window[0][0] + WINDOW_SECONDS - now
+        if self._window and self._window_tokens + tokens > self.tpm * share:
+            # 1件で上限を超える見積もりでも、窓が空なら通す
+            return self._window[0][0] + WINDOW_SECONDS - now
+        return 0.0
+
+    @contextmanager
+    def request(self, estimated_tokens: int = 0, deadline: Optional[Deadline] = None,
+                background: bool = False) -> Iterator[Permit]:
+        """
+        RPM/TPMと同時実行数に空きができるまで待ってから枠を確保する。
+        backgroundならbackground_shareの枠内で、待っているライブの呼び出しがないときだけ始める。
+
+        Raises:
+            DeadlineExceeded: 空きを待つ間に締め切りを過ぎる場合
+        """
+        started = time.monotonic()
+        with self._condition:
+            waiting = False
+            try:
+                while True:
+                    now = time.time()
+                    self._prune(now)
+                    wait = self._wait_time(now, estimated_tokens, background)
+                    if wait <= 0:
+                        break
+                    if deadline is not None:
+                        if deadline.expired():
+                            raise DeadlineExceeded(f"Deadline exceeded waiting for {self.name} rate limit")
+                        wait = min(wait, deadline.remaining())
+                    if not background and not waiting:
+                        waiting = True
+                        self._live_waiting += 1
+                    self._condition.wait(timeout=wait)
+            finally:
+                if waiting:
+                    self._live_waiting -= 1
+
+            entry = [time.time(), estimated_tokens, True]
+            self._window.append(entry)
+            self._window_tokens += estimated_tokens
+            self.in_flight += 1
+            self.stats_counters['requests'] += 1
+            waited = time.monotonic() - started
+            self.stats_counters['wait_seconds'] += waited
+        run_context.record_wait('rate_limit', waited)
+
+        try:
+            yield Permit(self, entry)
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                self._condition.notify_all()
+
+    def call(self, fn: Callable[[Permit], T], estimated_tokens: int = 0,
+             deadline: Optional[Deadline] = None, background: bool = False) -> T:
+        """
+        枠を確保してfnを実行する。429や一時的なエラーならバックオフして再試行する。
+
+        Args:
+            fn: Permitを受け取りAPIを呼び出す関数
+            estimated_tokens: 見積もりトークン数（プロンプト＋最大出力）
+            deadline: 締め切り（再試行の待ち時間が締め切りを越えるなら諦める）
+            background: ライブの呼び出しに枠を譲る低優先度の呼び出しか
+
+        Returns:
+            fnの戻り値
+        """
+        attempt = 0
+        while True:
+            try:
+                with self.request(estimated_tokens, deadline, background) as permit:
+                    try:
+                        result = fn(permit)
+                    except DeadlineExceeded:
+                        raise
+                    except Exception as e:
+                        # 枠の待ちで締め切りを過ぎたものや時間予算の打ち切りは、プロバイダーの失敗に数えない
+                        metrics.counter('llm_provider_errors_total', "Failed provider calls, including retried ones",
+                                        ('model', 'error')).inc(model=self.name, error=type(e).__name__)
+                        raise
+            except Exception as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None or attempt >= self.max_retries:
+                    raise
+                if deadline is not None and deadline.remaining() <= delay:
+                    logger.warning(f"Not retrying {self.name} call: backoff {delay:.1f}s exceeds the deadline")
+                    raise
+                attempt += 1
+                with self._condition:
+                    self.stats_counters['retries'] += 1
+                logger.warning(f"Retrying {self.name} call in {delay:.2f}s "
+                               f"(attempt {attempt}/{self.max_retries}): {e}")
+                time.sleep(delay)
+                run_context.record_wait('retry_backoff', delay)
+                continue
+
+            self._on_success()
+            return result
+
+    def _retry_delay(self, error: Exception, attempt: int) -> Optional[float]:
+        """再試行までの秒数を返す（再試行しないエラーならNone）"""
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        if isinstance(error, openai.RateLimitError):
+            retry_after = _retry_after(error)
+            self._on_rate_limited(retry_after)
+            return max(retry_after, backoff) if retry_after is not None else backoff
+        if isinstance(error, (openai.APIConnectionError, openai.InternalServerError)):
+            # APITimeoutErrorはAPIConnectionErrorの派生だが、時間予算で打ち切った呼び出しなので再試行しない
+            if isinstance(error, openai.APITimeoutError):
+                return None
+            return backoff
+        return None
+
+    def _on_rate_limited(self, retry_after: Optional[float]) -> None:
+        """429を受けたら同時実行数を半減し、retry-afterの間は全リクエストを止める"""
+        with self._condition:
+            self.stats_counters['rate_limited'] += 1
+            self.concurrency_limit = max(float(self.min_concurrency), self.concurrency_limit / 2)
+            if retry_after is not None:
+                self._blocked_until = max(self._blocked_until, time.time() + retry_after)
+            logger.warning(f"Rate limited on {self.name}: concurrency limit now {int(self.concurrency_limit)}"
+                           + (f", pausing {retry_after:.1f}s" if retry_after is not None else ""))
+
+    def _on_success(self) -> None:
+        """成功するたびに同時実行数を少しずつ戻す（上限までおよそlimit回の成功で1増える）"""
+        with self._condition:
+            if self.concurrency_limit < self.max_concurrency:
+                self.concurrency_limit = min(float(self.max_concurrency),
+                                             self.concurrency_limit + 1.0 / self.concurrency_limit)
+                self._condition.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        """ガバナーの状態と累計のカウンター"""
+        with self._condition:
+            self._prune(time.time())
+            return {
+                'concurrency_limit': int(self.concurrency_limit),
+                'in_flight': self.in_flight,
+                'window_requests': len(self._window),
+                'window_tokens': self._window_tokens,
+                **self.stats_counters,
+            }
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """429応答のヘッダーから待ち秒数を取り出す"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    for name, scale in (('retry-after-ms', 0.001), ('retry-after', 1.0)):
+        value = headers.get(name)
+        if value is None:
+            continue
+        try:
+            return max(0.0, float(value) * scale)
+        except ValueError:
+            # HTTP日付形式のretry-afterは扱わない（OpenAIは秒数で返す）
+            continue
+    return None
+
+
+_governors: Dict[str, RateGovernor] = {}
+_governors_lock = threading.Lock()
+
+
+def get_governor(model: str) -> RateGovernor:
+    """
+    モデルごとのガバナーを返す（プロセス内で共有、初回に settings.yaml の llm.rate_limits から生成）。
+    """
+    with _governors_lock:
+        governor = _governors.get(model)
+        if governor is None:
+            settings = get_section('llm').get('rate_limits') or {}
+            limits = dict(settings.get('default') or {})
+            limits.update((settings.get('models') or {}).get(model) or {})
+            limits.update(settings.get('retry') or {})
+            governor = RateGovernor(model, **limits)
+            _governors[model] = governor
+        return governor
+
+
+def reset_governors() -> None:
+    """ガバナーを破棄する（設定の再読み込みやテスト用）"""
+    with _governors_lock:
+        _governors.clear()
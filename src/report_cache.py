@@ -0,0 +1,440 @@
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+import zlib
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set
+import logging
+
+try:
+    import fcntl
+except ImportError:  # Windowsではファイルロックなし（永続化ファイルを共有しない前提）
+    fcntl = None
+
+from .cache_backend import NamespacedCache, make_key
+
+logger = logging.getLogger(__name__)
+
+# MinHash用の大きな素数（メルセンヌ素数 2^61-1）
+_MERSENNE_PRIME = (1 << 61) - 1
+
+# 依頼表現の末尾（「〜を教えて」「〜を説明してください」など）は意味を持たないので除去する
+_REQUEST_SUFFIX_PATTERN = re.compile(
+    r'(について|に関して)?(を)?(教えて|説明して|解説して|まとめて|知りたい)(ください|下さい|ほしい|欲しい)?$'
+)
+# 記号・空白の除去
+_PUNCT_PATTERN = re.compile(r'[\W_]+', re.UNICODE)
+# 助詞などのひらがなは類似度判定のノイズになるので落とす
+_HIRAGANA_PATTERN = re.compile(r'[ぁ-ゟ]+')
+
+
+class ReportCache:
+    """
+    クエリの近似重複に対してレポートを再利用するキャッシュ。
+    クエリを正規化した文字n-gramからMinHash署名を作成し、LSH（バンド分割）で候補を絞り込んだ上で
+    n-gram集合のJaccard係数が閾値以上のものをヒットとして返す。
+    共有キャッシュを渡すと、正規化したクエリが一致するレポートは他のレプリカが生成したものも返す。
+    永続化ファイルを使うときは、メモリにはクエリの署名と計画だけを持ち、レポート本体はヒットしたときにファイルから読む。
+    """
+
+    # 永続化ファイルの行数が保持しているレポート数のこの倍を超えたら、期限切れ・削除済みの行を除いて書き直す
+    COMPACT_RATIO = 2
+    # 小さなファイルは書き直さない（この行数までは追記だけ）
+    COMPACT_MIN_LINES = 100
+
+    def __init__(self,
+                 threshold: Optional[float] = None,
+                 ngram_size: int = 2,
+                 num_perm: int = 128,
+                 bands: int = 32,
+                 max_entries: int = 1000,
+                 path: Optional[str] = None,
+                 shared: Optional[NamespacedCache] = None,
+                 ttl: Optional[float] = None,
+                 background_load: bool = False):
+        """
+        Args:
+            threshold: ヒットとみなすJaccard類似度の閾値（0.0-1.0）
+            ngram_size: 文字n-gramのn
+            num_perm: MinHash署名の長さ
+            bands: LSHのバンド数（num_permを割り切れること）
+            max_entries: 保持する最大レポート数（超えたら古いものから削除）
+            path: 永続化先のJSONLファイル（Noneならメモリのみ）
+            shared: レプリカ間で共有するキャッシュ（正規化したクエリをキーにレポートを保存する）
+            ttl: レポートを再利用する秒数（Noneなら期限なし。期限切れのレポートは索引とファイルから除く）
+            background_load: 永続化ファイルからの索引の再構築を別スレッドで行う（読み込み中のレポートはまだヒットしない）
+        """
+        if num_perm % bands != 0:
+            raise ValueError("num_perm must be divisible by bands")
+
+        self.threshold = threshold if threshold is not None else float(os.getenv('REPORT_CACHE_THRESHOLD', '0.8'))
+        self.ngram_size = ngram_size
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.max_entries = max_entries
+        self.path = path
+        self.shared = shared
+        self.ttl = ttl
+
+        # ハッシュ関数 h_i(x) = (a_i * x + b_i) mod p の係数（再起動しても同じ署名になるよう固定シード）
+        self._coefficients = [
+            (zlib.crc32(f"a{i}".encode()) | 1, zlib.crc32(f"b{i}".encode()))
+            for i in range(num_perm)
+        ]
+
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._buckets: List[Dict[tuple, Set[str]]] = [dict() for _ in range(bands)]
+        self._lock = threading.Lock()
+        # 永続化ファイルの行数（追記のたびに増え、書き直すと保持しているレポート数に戻る）
+        self._file_lines = 0
+        # 索引の再構築が終わるまではファイルを書き直さない
+        self._loaded = threading.Event()
+
+        # 統計情報
+        self._lookups = 0
+        self._hits = 0
+        self._lookup_time_total = 0.0
+        self._similarity_histogram = [0] * 10
+
+        if not self.path:
+            self._loaded.set()
+        elif background_load:
+            threading.Thread(target=self._load, name='report-cache-load', daemon=True).start()
+        else:
+            self._load()
+
+    def normalize(self, text: str) -> str:
+        """類似度計算用にクエリを正規化する"""
+        normalized = unicodedata.normalize('NFKC', text or '').lower().strip()
+        normalized = _PUNCT_PATTERN.sub('', normalized)
+        normalized = _REQUEST_SUFFIX_PATTERN.sub('', normalized)
+        content = _HIRAGANA_PATTERN.sub('', normalized)
+        # ひらがなだけのクエリは内容語が残らないので、そのまま使う
+        return content if len(content) >= self.ngram_size else normalized
+
+    def _shingles(self, text: str) -> Set[str]:
+        """正規化済みテキストから文字n-gram集合を作る"""
+        normalized = self.normalize(text)
+        if len(normalized) < self.ngram_size:
+            return {normalized} if normalized else set()
+        return {normalized[i:i + self.ngram_size] for i in range(len(normalized) - self.ngram_size + 1)}
+
+    def _signature(self, shingles: Set[str]) -> List[int]:
+        """n-gram集合のMinHash署名を計算する"""
+        hashed = [zlib.crc32(s.encode('utf-8')) for s in shingles]
+        return [
+            min((a * h + b) % _MERSENNE_PRIME for h in hashed)
+            for a, b in self._coefficients
+        ]
+
+    def _band_keys(self, signature: List[int]) -> List[tuple]:
+        return [tuple(signature[i * self.rows:(i + 1) * self.rows]) for i in range(self.bands)]
+
+    @staticmethod
+    def _jaccard(a: Set[str], b: Set[str]) -> float:
+        if not a or not b:
+            return 0.0
+        return len(a & b) / len(a | b)
+
+    def lookup(self, query: str,
+               accept: Optional[Callable[[Dict[str, Any]], bool]] = None) -> Optional[Dict[str, Any]]:
+        """
+        クエリに近いキャッシュ済みレポートを検索する。
+
+        Args:
+            query: 初期クエリまたは洗練済みクエリ
+            accept: キャッシュ済みの結果を受け取り、使えるレポートならTrueを返す関数（検索の計画の比較など）。
+                索引のエントリについては本体を読まずに済むよう {'plan': ...} だけを渡す
+
+        Returns:
+            ヒットした場合は {'result', 'similarity', 'matched_query'} を含む辞書、なければNone
+        """
+        start = time.perf_counter()
+        shingles = self._shingles(query)
+        best_id, best_similarity, best_key = None, 0.0, None
+
+        if shingles:
+            signature = self._signature(shingles)
+            with self._lock:
+                candidates: Set[str] = set()
+                for band, key in enumerate(self._band_keys(signature)):
+                    candidates.update(self._buckets[band].get(key, ()))
+
+                for key_id in candidates:
+                    entry_id, _, _ = key_id.partition('#')
+                    entry = self._entries.get(entry_id)
+                    if entry is None or self._expired(entry['created_at']):
+                        continue
+                    if accept is not None and not accept({'plan': entry['plan']}):
+                        continue
+                    for key_text, key_shingles in entry['keys']:
+                        similarity = self._jaccard(shingles, key_shingles)
+                        if similarity > best_similarity:
+                            best_id, best_similarity, best_key = entry_id, similarity, key_text
+
+        shared_record = None
+        if (best_id is None or best_similarity < self.threshold) and self.shared is not None:
+            shared_record = self.shared.get(self._shared_key(query))
+            if shared_record is not None and (self._expired(self._created_at(shared_record))
+                                              or (accept is not None and not accept(shared_record['result']))):
+                shared_record = None
+
+        result = None
+        if shared_record is not None:
+            # 他のレプリカが生成したレポート。以後の近似重複にも当たるよう索引に加える
+            with self._lock:
+                self._insert(shared_record, offset=None)
+            result, best_similarity = shared_record['result'], 1.0
+            best_key = next((key for key in shared_record['keys']
+                             if self.normalize(key) == self.normalize(query)), query)
+        elif best_id is not None and best_similarity >= self.threshold:
+            result = self._fetch(best_id)
+
+        with self._lock:
+            self._lookups += 1
+            self._lookup_time_total += time.perf_counter() - start
+            self._similarity_histogram[min(int(best_similarity * 10), 9)] += 1
+            if result is None:
+                return None
+            self._hits += 1
+
+        logger.info(f"Report cache hit (similarity={best_similarity:.2f}) for query: {query}")
+        return {
+            'result': result,
+            'similarity': best_similarity,
+            'matched_query': best_key,
+        }
+
+    def store(self, result: Dict[str, Any], keys: Optional[List[str]] = None) -> None:
+        """
+        パイプラインの結果をキャッシュに登録する。
+
+        Args:
+            result: PipelineOrchestrator.runの戻り値
+            keys: 索引に使うクエリ（省略時は初期クエリと洗練済みクエリ）
+        """
+        if keys is None:
+            keys = [result.get('query', ''), result.get('refined_query', '')]
+        record = {'id': f"{time.time_ns():x}", 'keys': [k for k in dict.fromkeys(keys) if k], 'result': result,
+                  'created_at': time.time()}
+        if not record['keys']:
+            return
+
+        with self._lock:
+            offset = self._append(record) if self.path else None
+            self._insert(record, offset)
+            if (self.path and self._loaded.is_set()
+                    and self._file_lines > max(self.COMPACT_MIN_LINES, self.COMPACT_RATIO * len(self._entries))):
+                self._compact()
+        if self.shared is not None:
+            for key in record['keys']:
+                self.shared.set(self._shared_key(key), record)
+
+    def _shared_key(self, query: str) -> str:
+        return make_key(self.normalize(query))
+
+    def _expired(self, created_at: float) -> bool:
+        return self.ttl is not None and time.time() - created_at > self.ttl
+
+    @staticmethod
+    def _created_at(record: Dict[str, Any]) -> float:
+        # created_at のない古い行は、生成時刻（ナノ秒）から作ったIDで代用する
+        return record.get('created_at') or int(record['id'], 16) / 1e9
+
+    def _insert(self, record: Dict[str, Any], offset: Optional[int]) -> None:
+        """
+        索引に1件追加する（ロック取得済みで呼ぶこと）。
+        レポート本体はメモリのみのときだけ持ち、ファイルに書いたものは行の位置（offset）、共有キャッシュのものはキーだけを持つ。
+        """
+        created_at = self._created_at(record)
+        if self._expired(created_at):
+            return
+        entry_id = record['id']
+        keys = []
+        for n, key_text in enumerate(record['keys']):
+            shingles = self._shingles(key_text)
+            if not shingles:
+                continue
+            keys.append((key_text, shingles))
+            for band, band_key in enumerate(self._band_keys(self._signature(shingles))):
+                self._buckets[band].setdefault(band_key, set()).add(f"{entry_id}#{n}")
+        entry = {'keys': keys, 'plan': record['result'].get('plan'), 'created_at': created_at, 'offset': offset}
+        if not self.path and self.shared is None:
+            entry['result'] = record['result']
+        self._entries.pop(entry_id, None)
+        self._entries[entry_id] = entry
+
+        # 古いものから順に並んでいるので、先頭から上限超過分と期限切れを削除する
+        while self._entries:
+            oldest_id = next(iter(self._entries))
+            if len(self._entries) <= self.max_entries and not self._expired(self._entries[oldest_id]['created_at']):
+                break
+            self._evict(oldest_id)
+
+    def _evict(self, entry_id: str) -> None:
+        """最も古いエントリを索引から取り除く（ロック取得済みで呼ぶこと）"""
+        entry = self._entries.pop(entry_id)
+        for n, (_, shingles) in enumerate(entry['keys']):
+            for band, band_key in enumerate(self._band_keys(self._signature(shingles))):
+                bucket = self._buckets[band].get(band_key)
+                if bucket is not None:
+                    bucket.discard(f"{entry_id}#{n}")
+                    if not bucket:
+                        del self._buckets[band][band_key]
+
+    def _fetch(self, entry_id: str) -> Optional[Dict[str, Any]]:
+        """索引のエントリのレポート本体を取り出す（ファイルが書き換わって見つからなければ索引から除いてNone）"""
+        with self._lock:
+            entry = self._entries.get(entry_id)
+            if entry is None:
+                return None
+            if 'result' in entry:
+                return entry['result']
+            offset, keys = entry['offset'], [key_text for key_text, _ in entry['keys']]
+
+        record = None
+        if offset is not None:
+            record = self._read_line(offset)
+        elif self.shared is not None:
+            record = next(filter(None, (self.shared.get(self._shared_key(key)) for key in keys)), None)
+        if record is not None and record.get('id') == entry_id:
+            return record['result']
+
+        with self._lock:
+            if entry_id in self._entries:
+                self._evict(entry_id)
+        return None
+
+    def _read_line(self, offset: int) -> Optional[Dict[str, Any]]:
+        """永続化ファイルの offset から1行読む"""
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(offset)
+                return json.loads(f.readline())
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to read report cache entry: {e}")
+            return None
+
+    @contextmanager
+    def _file_lock(self) -> Iterator[None]:
+        """
+        永続化ファイルを他のプロセスと排他する（JOB_EXECUTOR=process や、./data を共有するレプリカが同じファイルに書く）。
+        追記と書き直しはこのロックの中で行う。
+        """
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(f"{self.path}.lock", 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _append(self, record: Dict[str, Any]) -> Optional[int]:
+        """永続化ファイルに1件追記し、書いた行の位置を返す"""
+        try:
+            with self._file_lock(), open(self.path, 'ab') as f:
+                offset = f.tell()
+                f.write((json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8'))
+            self._file_lines += 1
+            return offset
+        except OSError as e:
+            logger.warning(f"Failed to persist report cache entry: {e}")
+            return None
+
+    def _compact(self) -> None:
+        """
+        期限切れ・重複を除いた直近 max_entries 件の行だけで永続化ファイルを書き直す（ロック取得済みで呼ぶこと）。
+        他のプロセスが追記した行も残すよう、ファイルロックの中で今のファイルを読み直してから書き直す。
+        """
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with self._file_lock():
+                records: Dict[str, bytes] = {}
+                total = 0
+                with open(self.path, 'rb') as source:
+                    for line in source:
+                        if not line.strip():
+                            continue
+                        total += 1
+                        try:
+                            record = json.loads(line)
+                            entry_id, created_at = record['id'], self._created_at(record)
+                        except (ValueError, KeyError, TypeError, AttributeError):
+                            continue
+                        if not self._expired(created_at):
+                            # 同じIDは後の行を残す（並び順も後の行の位置にする）
+                            records.pop(entry_id, None)
+                            records[entry_id] = line
+                kept = list(records.items())[-self.max_entries:]
+                offsets: Dict[str, int] = {}
+                with open(temp_path, 'wb') as f:
+                    for entry_id, line in kept:
+                        offsets[entry_id] = f.tell()
+                        f.write(line)
+                os.replace(temp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Failed to compact report cache: {e}")
+            return
+        # ファイルから落ちた行（他のプロセスの書き直しで上限を超えたものなど）は索引からも除く
+        for entry_id, entry in list(self._entries.items()):
+            if entry['offset'] is None:
+                continue
+            if entry_id in offsets:
+                entry['offset'] = offsets[entry_id]
+            else:
+                self._evict(entry_id)
+        logger.info("Report cache compacted", extra={'dropped_lines': total - len(offsets), 'entries': len(offsets)})
+        self._file_lines = len(offsets)
+
+    def _load(self) -> None:
+        """永続化ファイルから索引を再構築する"""
+        try:
+            if not os.path.exists(self.path):
+                return
+            try:
+                with open(self.path, 'rb') as f:
+                    offset = 0
+                    for line in f:
+                        line_offset, offset = offset, offset + len(line)
+                        if not line.strip():
+                            continue
+                        try:
+                            record = json.loads(line)
+                            with self._lock:
+                                self._file_lines += 1
+                                self._insert(record, line_offset)
+                        except (ValueError, KeyError, AttributeError) as e:
+                            logger.warning(f"Skipping broken report cache line: {e}")
+                logger.info(f"Report cache loaded with {len(self._entries)} entries")
+            except OSError as e:
+                logger.warning(f"Failed to load report cache: {e}")
+                return
+            with self._lock:
+                if self._file_lines > len(self._entries):
+                    self._compact()
+        finally:
+            self._loaded.set()
+
+    def stats(self) -> Dict[str, Any]:
+        """ヒット率や類似度分布などの統計情報を返す"""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'lookups': self._lookups,
+                'hits': self._hits,
+                'hit_rate': self._hits / self._lookups if self._lookups else 0.0,
+                'avg_lookup_ms': (self._lookup_time_total / self._lookups * 1000) if self._lookups else 0.0,
+                'similarity_histogram': {
+                    f"{i / 10:.1f}-{(i + 1) / 10:.1f}": count
+                    for i, count in enumerate(self._similarity_histogram)
+                },
+            }
+
+    def __len__(self) -> int:
+        return len(self._entries)
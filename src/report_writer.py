@@ -1,79 +1,77 @@
 from .llm_client import LLMClient
+from .prompt_templates import RenderedPrompt, get_template
+from .citations import CITATION_SCANNER, add_references, extract_citations, section_citations
+from . import grammar_analyzer, run_context, text_analyzer
+from typing import Dict, Iterable, List, Optional, Tuple
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# 文末（。！？!?）までの1文
+_SENTENCE = re.compile(r"[^。！？!?]+[。！？!?]?")
+# 箇条書き・番号付きリストの行頭
+_LIST_MARKER = re.compile(r"^(?:[-*+]|\d+[.)])\s+")
+# 章の見出し（## Title）の行
+_CHAPTER_HEADING = re.compile(r"^##[ \t]+(.+?)[ \t]*$", re.MULTILINE)
+
+
+def split_chapters(text: str) -> List[Tuple[str, str]]:
+    """
+    アウトラインや本文を ## の章ごとに (見出し, 見出し行からの章の本文) に分ける。
+    最初の章より前の部分は見出しを空文字とする。各部分をつなげると元のテキストに戻る。
+    """
+    matches = list(_CHAPTER_HEADING.finditer(text))
+    if not matches:
+        return [("", text)]
+    chapters = [("", text[:matches[0].start()])] if matches[0].start() > 0 else []
+    for match, following in zip(matches, matches[1:] + [None]):
+        chapters.append((match.group(1), text[match.start():following.start() if following else len(text)]))
+    return chapters
+
 
 class ReportWriter:
     """
     アウトラインと検索結果を元に、完全なレポートを執筆するクラス。
     リード文、本文、関連事項、結論を個別に生成して結合する。
     """
+    # 結論に渡す要点: 各節から取り出す文の数と、1文の最大文字数
+    DIGEST_SENTENCES_PER_SECTION = 2
+    DIGEST_SENTENCE_CHARS = 120
+
     def __init__(self):
-        self.lead_prompt = """あなたは英語教育問題に精通し、分かりやすい解説記事を書くことに定評のある信頼できるライターです。
-下記のクエリーに関する調査レポートの、タイトルの直後に表示する簡潔なリード文を生成してください。
-リード文は、レポート全体の要旨、特に英語教育的な観点からの主要な論点や分析の方向性を含めた、140〜280文字程度の簡潔な文章にしてください。
-
-クエリー: {refined_query}
-"""
-
-        self.section_prompt = """あなたは日本の英語教育に精通し、客観的なデータと英語教育理論に基づいた分かりやすい解説を書くことに定評のある信頼できるライターです。
-下記のクエリー（高校入試や教科書からの英文を含む可能性があります）に関するレポートのアウトラインに基づき、各章の本文を執筆してください。
-アウトラインの中にある引用番号は漏れることなく必ず参照し、収集された情報源の内容を適切に解釈しながら、各節ごとに400字以上で解説を記載してください。
-解説は緻密かつ包括的で、情報源に基づいたものであることが望ましいです。特に、入力された英文がある場合は、その英文の具体的な分析（文法、語彙、構文、読解ポイントなど）を詳細に含めてください。英語教育に詳しくない人向けにわかりやすくかみ砕いて説明することも重要です。必要に応じて、関連する英語教育理論、歴史的背景、国内外の事例、最新の統計データなどを盛り込んでください。
-なお、内容の信頼性が重要なので、必ず情報源にあたり、下記指示にあるように引用をするのを忘れないで下さい。
-1. アウトラインの"# Title"、"## Title"、"### Title"のタイトルは変更しないでください。
-2. 必ず情報源の情報に基づき記載し、ハルシネーションに気をつけること。
-   記載の根拠となる参照すべき情報源は "...です[4][1][27]。" "...ます[21][9]。" のように明示してください。
-3. 正しく引用が明示されているほどあなたの解説は高く評価されます。
-4. 内容に応じて箇条書きを適切に配置し、読者の理解度を深めてください。
-5. 日本語の「ですます調」で解説を書いてください。
-
-【情報源】
-{search_results_text}
-
-【アウトライン】
-{outline}
-
-【クエリー】
-{refined_query}
-"""
-
-        self.related_topics_prompt = """あなたは英文法に精通した専門家です。
-下記の英文を分析し、含まれる主要な文法項目を特定してください。
-特定した各文法項目について、以下の形式で簡潔に解説してください。
-
-出力フォーマット：
-- **[文法項目名]**: [その文法項目の簡潔な説明]。例: [提供された英文からの該当箇所]
-
-例:
-- **現在完了進行形**: 過去のある時点から現在まで継続している動作を表します。例: "We have been discussing it since last week."
-- **関係代名詞**: 名詞を修飾する節を導きます。例: "It's a song about friendship." (ここでは関係代名詞が省略されているが、概念として関連する)
-
-検索トピックをリストアップするにあたり、以下の条件を遵守してください。
-- 英文に含まれる主要な文法項目を網羅的に特定すること。
-- 各文法項目の説明は、高校生が理解できるレベルで簡潔に記述すること。
-- 提供された英文中の具体的な箇所を例として引用し、解説と関連付けること。
-- 文法項目は、`_GrammarDictionary_Index.md`に記載されているような一般的な文法分類に従うこと。
-- 箇条書き形式で出力すること。
-
-【英文】
-{initial_query}
-"""
-
-        self.conclusion_prompt = """あなたは英語教育問題に精通し、未来志向の提言をすることに定評のある信頼できるライターです。
-レポートのドラフトを踏まえて、レポート全体の要約を本文とはできるだけ異なる表現で記載しつつ、英語教育的な観点からの今後の展望や課題、考えられる対策を含んだ結論部を生成します。
-最低でも400字以上、可能なら600字以上記載してください。
-結論の文章部分のみ生成し、"## 結論" のようなヘッダは入れないでください。
-
-【レポートドラフト】
-{draft}
-"""
+        # プロンプトは prompt_templates に登録したものを使う（静的な前半部分がキャッシュされる）
+        self.lead_prompt = get_template('lead')
+        self.section_prompt = get_template('body')
+        self.body_section_prompt = get_template('body_section')
+        self.related_topics_prompt = get_template('related_topics')
+        self.conclusion_prompt = get_template('conclusion')
         self.llm_client = LLMClient()
 
-    def _format_search_results(self, search_results: dict[str, str]) -> str:
-        """検索結果の辞書を番号付きリストの文字列にフォーマットする"""
+    def _format_search_results(self, search_results: dict[str, str], numbers: Optional[Iterable[int]] = None) -> str:
+        """
+        検索結果の辞書を番号付きリストの文字列にフォーマットする。
+        numbers を渡すとその番号の情報源だけを並べる（番号は全件の中の番号のままなので、引用番号は変わらない）。
+        """
+        selected = set(numbers) if numbers is not None else None
         formatted_text = ""
         for i, (topic, result) in enumerate(search_results.items()):
-            formatted_text += f"[{i+1}] Topic: {topic}\nResult: {result}\n\n"
+            if selected is None or i + 1 in selected:
+                formatted_text += f"[{i+1}] Topic: {topic}\nResult: {result}\n\n"
         return formatted_text.strip()
 
+    def cited_sources_text(self, outline: str, search_results: dict[str, str]) -> str:
+        """アウトラインで引用された情報源だけをフォーマットする（引用が1つもなければ全件）"""
+        return self._sources_text(extract_citations(outline), search_results)
+
+    def _sources_text(self, numbers: Iterable[int], search_results: dict[str, str]) -> str:
+        cited = [number for number in numbers if 1 <= number <= len(search_results)]
+        if not cited:
+            return self._format_search_results(search_results)
+        logger.info("Sending cited sources only", extra={'cited_sources': len(cited),
+                                                         'source_count': len(search_results)})
+        return self._format_search_results(search_results, cited)
+
     def write(self, outline: str, search_results: dict[str, str], initial_query: str, refined_query: str) -> str:
         """
         アウトラインと検索結果を元に、完全なレポートを生成する。
@@ -87,102 +85,327 @@ class ReportWriter:
         Returns:
             完全なMarkdownレポート
         """
-        print("Writing final report...")
-        
+        sections = self.write_sections(outline, search_results, initial_query, refined_query)
+        return self.assemble_sections(sections, search_results)
+
+    def write_sections(self, outline: str, search_results: dict[str, str], initial_query: str,
+                       refined_query: str) -> Dict[str, str]:
+        """
+        レポートの各パートを生成する（引数は write と同じ）。
+        パートを保存しておくと、regenerate で1つのパートだけを作り直せる。
+
+        Returns:
+            {'title', 'lead', 'body', 'related_topics', 'conclusion'}（引用番号は情報源の元の番号のまま）
+        """
+        logger.info("Writing final report")
+
         try:
-            search_results_text = self._format_search_results(search_results)
+            # 本文にはアウトラインで引用された情報源だけを渡す
+            search_results_text = self.cited_sources_text(outline, search_results)
             title = outline.split('\n')[0]
 
             # 1. リード文生成
             lead_text = self._generate_lead(refined_query)
-            print("  - Lead section written.")
+            logger.debug("Lead section written")
 
-            # 2. 本文生成
-            body_text = self._generate_body(outline, search_results_text, refined_query)
-            print("  - Body sections written.")
+            # 2. 本文生成（クエリの英文の語彙レベルや読みやすさは、ローカルで計測した値を渡す）
+            passage_facts = text_analyzer.format_facts(text_analyzer.analyze_query(initial_query))
+            body_text = self._generate_body(outline, search_results_text, refined_query, passage_facts)
+            logger.debug("Body sections written")
 
             # 3. 関連文法事項の生成
             related_topics_text = self._generate_related_topics(initial_query)
-            print("  - Related topics section written.")
-
-            # 4. 結論生成
-            draft = f"{title}\n\n{lead_text}\n\n{body_text}"
-            conclusion_text = self._generate_conclusion(draft)
-            print("  - Conclusion section written.")
-
-            # 5. 全てのパートを結合
-            final_report = (
-                f"{title}\n\n"
-                f"{lead_text}\n\n"
-                f"{body_text}\n\n"
-                f"## 関連文法事項\n{related_topics_text}\n\n"
-                f"## 結論\n{conclusion_text}"
-            )
-            print("Final report assembled.")
+            logger.debug("Related topics section written")
+
+            # 4. 結論生成（ドラフト全文ではなく、見出しと各節の主な文の要点を渡す）
+            digest = self.build_digest(title, lead_text, body_text)
+            conclusion_text = self._generate_conclusion(digest)
+            logger.debug("Conclusion section written")
+
+            return {'title': title, 'lead': lead_text, 'body': body_text,
+                    'related_topics': related_topics_text, 'conclusion': conclusion_text}
 
-            return final_report
-            
         except Exception as e:
-            print(f"Error in report writing: {e}")
+            logger.warning(f"Error in report writing: {e}")
             # エラー時のフォールバック
-            return self._get_fallback_report(outline, refined_query)
+            run_context.mark_fallback('write', str(e))
+            return self._get_fallback_sections(outline, refined_query)
+
+    def assemble_sections(self, sections: Dict[str, str], sources: Optional[dict[str, str]] = None) -> str:
+        """write_sections のパートを結合してレポートにする"""
+        final_report = self.assemble_report(sections['title'], sections['lead'], sections['body'],
+                                            sections['related_topics'], sections['conclusion'], sources=sources)
+        logger.info("Final report assembled", extra={'report_chars': len(final_report)})
+        return final_report
+
+    def regenerate(self, stage: str, sections: Dict[str, str], outline: str, search_results: dict[str, str],
+                   initial_query: str, refined_query: str, section: Optional[str] = None,
+                   instruction: str = "") -> Dict[str, str]:
+        """
+        保存済みのパートのうち1つだけを生成し直す（LLMの呼び出しは1回）。
+
+        Args:
+            stage: 'lead' / 'body' / 'section'（本文の1つの章） / 'related_topics' / 'conclusion'
+            sections: write_sections の戻り値
+            section: stage が 'section' のときの章の見出し（"## " を除いた文字列）
+            instruction: 追加の指示（「具体例を増やして」など。関連文法事項には使わない）
+
+        Returns:
+            作り直したパートに置き換えた sections のコピー
+
+        Raises:
+            ValueError: stage や章の見出しが不正な場合
+        """
+        sections = dict(sections)
+        if stage == 'lead':
+            sections['lead'] = self._generate_lead(refined_query, instruction)
+        elif stage == 'body':
+            sections['body'] = self._generate_body(
+                outline, self.cited_sources_text(outline, search_results), refined_query,
+                text_analyzer.format_facts(text_analyzer.analyze_query(initial_query)), instruction)
+        elif stage == 'section':
+            sections['body'] = self._regenerate_chapter(sections['body'], section, outline, search_results,
+                                                        initial_query, refined_query, instruction)
+        elif stage == 'related_topics':
+            sections['related_topics'] = self._generate_related_topics(initial_query)
+        elif stage == 'conclusion':
+            digest = self.build_digest(sections['title'], sections['lead'], sections['body'])
+            sections['conclusion'] = self._generate_conclusion(digest, instruction)
+        else:
+            raise ValueError(f"Unknown report section '{stage}'")
+        logger.info("Regenerated report section", extra={'section_stage': stage, 'section': section})
+        return sections
+
+    def _regenerate_chapter(self, body_text: str, heading: Optional[str], outline: str,
+                            search_results: dict[str, str], initial_query: str, refined_query: str,
+                            instruction: str = "") -> str:
+        """
+        本文のうち見出しが heading の章だけを生成し直し、本文の他の章はそのまま残す。
+        情報源はアウトラインのその章で引用されたもの（アウトラインになければ今の章の本文で引用されたもの）だけを渡す。
+        """
+        chapters = split_chapters(body_text)
+        headings = [name for name, _ in chapters if name]
+        heading = (heading or "").strip().lstrip('#').strip()
+        if heading not in headings:
+            raise ValueError(f"Unknown section '{heading}' (available: {', '.join(headings)})")
+        current = next(text for name, text in chapters if name == heading)
+        outline_section = next((text for name, text in split_chapters(outline) if name == heading),
+                               f"## {heading}")
+        cited = section_citations(outline).get(heading) or extract_citations(current)
+        passage_facts = text_analyzer.format_facts(text_analyzer.analyze_query(initial_query))
+        try:
+            prompt = self.build_body_section_prompt(outline_section.strip(), self._sources_text(cited, search_results),
+                                                    refined_query, passage_facts)
+            chapter_text = self.llm_client.generate_text(
+                self._with_instruction(prompt, instruction),
+                max_tokens=1500,
+                temperature=0.5,
+                stage="body",
+                stream=True
+            )
+            chapter_text = self.parse_section(chapter_text, "")
+        except Exception as e:
+            logger.warning(f"Error generating body section: {e}")
+            chapter_text = ""
+        if not chapter_text:
+            # 作り直せなければ今の章を残し、失敗を記録する
+            run_context.mark_fallback('section', f"could not regenerate section '{heading}'")
+            return body_text
+        if not chapter_text.startswith('## '):
+            chapter_text = f"## {heading}\n{chapter_text}"
+        # 章の後ろの空行は元のまま保つ
+        trailing = current[len(current.rstrip()):]
+        return "".join(chapter_text + trailing if name == heading else text for name, text in chapters)
     
-    def _generate_lead(self, refined_query: str) -> str:
+    def _generate_lead(self, refined_query: str, instruction: str = "") -> str:
         """リード文を生成する"""
         try:
             lead_text = self.llm_client.generate_text(
-                self.lead_prompt.format(refined_query=refined_query),
+                self._with_instruction(self.build_lead_prompt(refined_query), instruction),
                 max_tokens=300,
-                temperature=0.7
+                temperature=0.7,
+                stage="lead",
+                stream=True
             )
-            return lead_text.strip() if self.llm_client.validate_response(lead_text) else self._get_fallback_lead(refined_query)
+            return self.parse_section(lead_text, self._get_fallback_lead(refined_query))
         except Exception as e:
-            print(f"Error generating lead: {e}")
+            logger.warning(f"Error generating lead: {e}")
+            run_context.mark_fallback('lead', str(e))
             return self._get_fallback_lead(refined_query)
     
-    def _generate_body(self, outline: str, search_results_text: str, refined_query: str) -> str:
+    def _generate_body(self, outline: str, search_results_text: str, refined_query: str,
+                       passage_facts: str = "", instruction: str = "") -> str:
         """本文を生成する"""
         try:
             body_text = self.llm_client.generate_text(
-                self.section_prompt.format(
-                    search_results_text=search_results_text,
-                    outline=outline,
-                    refined_query=refined_query
-                ),
+                self._with_instruction(
+                    self.build_body_prompt(outline, search_results_text, refined_query, passage_facts), instruction),
                 max_tokens=3000,
-                temperature=0.5
+                temperature=0.5,
+                stage="body",
+                stream=True
             )
-            return body_text.strip() if self.llm_client.validate_response(body_text) else self._get_fallback_body(outline)
+            return self.parse_section(body_text, self._get_fallback_body(outline))
         except Exception as e:
-            print(f"Error generating body: {e}")
+            logger.warning(f"Error generating body: {e}")
+            run_context.mark_fallback('body', str(e))
             return self._get_fallback_body(outline)
     
     def _generate_related_topics(self, initial_query: str) -> str:
-        """関連文法事項を生成する"""
+        """
+        関連文法事項を生成する。
+        英文の文法項目はまずパターン表（grammar_analyzer）で判定し、LLMには判定できなかった英文だけを送る。
+        クエリに英文がなければ、従来どおりクエリ全体をLLMに渡す。
+        """
+        analysis = grammar_analyzer.analyze(initial_query)
+        local_text = grammar_analyzer.format_items(analysis['matches'])
+        if local_text:
+            logger.info("Related topics classified locally",
+                        extra={'sentences': len(analysis['sentences']),
+                               'unclassified': len(analysis['unclassified'])})
+            # ストリーミング表示のUIにも、LLMの応答と同じように節の本文を届ける
+            run_context.emit('token', stage="related_topics", text=local_text + "\n")
+            if not analysis['unclassified']:
+                return local_text
+            remote_query = "\n".join(analysis['unclassified'])
+        else:
+            remote_query = initial_query
+
+        fallback = local_text or self._get_fallback_related_topics()
         try:
             related_topics_text = self.llm_client.generate_text(
-                self.related_topics_prompt.format(initial_query=initial_query),
+                self.build_related_topics_prompt(remote_query),
                 max_tokens=500,
-                temperature=0.6
+                temperature=0.6,
+                stage="related_topics",
+                stream=True
             )
-            return related_topics_text.strip() if self.llm_client.validate_response(related_topics_text) else self._get_fallback_related_topics()
         except Exception as e:
-            print(f"Error generating related topics: {e}")
-            return self._get_fallback_related_topics()
+            logger.warning(f"Error generating related topics: {e}")
+            run_context.mark_fallback('related_topics', str(e))
+            return fallback
+        remote_text = self.parse_section(related_topics_text, "")
+        if not remote_text:
+            return fallback
+        return f"{local_text}\n{remote_text}" if local_text else remote_text
     
-    def _generate_conclusion(self, draft: str) -> str:
+    def _generate_conclusion(self, digest: str, instruction: str = "") -> str:
         """結論を生成する"""
         try:
             conclusion_text = self.llm_client.generate_text(
-                self.conclusion_prompt.format(draft=draft),
+                self._with_instruction(self.build_conclusion_prompt(digest), instruction),
                 max_tokens=800,
-                temperature=0.6
+                temperature=0.6,
+                stage="conclusion",
+                stream=True
             )
-            return conclusion_text.strip() if self.llm_client.validate_response(conclusion_text) else self._get_fallback_conclusion()
+            return self.parse_section(conclusion_text, self._get_fallback_conclusion())
         except Exception as e:
-            print(f"Error generating conclusion: {e}")
+            logger.warning(f"Error generating conclusion: {e}")
+            run_context.mark_fallback('conclusion', str(e))
             return self._get_fallback_conclusion()
     
+    def build_lead_prompt(self, refined_query: str) -> RenderedPrompt:
+        """リード文生成のプロンプトを組み立てる"""
+        return self.lead_prompt.render(refined_query=refined_query)
+
+    def build_body_prompt(self, outline: str, search_results_text: str, refined_query: str,
+                          passage_facts: str = "") -> RenderedPrompt:
+        """本文生成のプロンプトを組み立てる（passage_facts は text_analyzer.format_facts の計測値）"""
+        return self.llm_client.render(
+            self.section_prompt,
+            stage="body",
+            max_tokens=3000,
+            trimmable=('search_results_text',),
+            search_results_text=search_results_text,
+            outline=outline,
+            refined_query=refined_query,
+            passage_facts=f"\n【英文の計測値】\n{passage_facts}" if passage_facts else ""
+        )
+
+    def build_body_section_prompt(self, outline_section: str, search_results_text: str, refined_query: str,
+                                  passage_facts: str = "") -> RenderedPrompt:
+        """本文の1つの章を生成し直すプロンプトを組み立てる"""
+        return self.llm_client.render(
+            self.body_section_prompt,
+            stage="body",
+            max_tokens=1500,
+            trimmable=('search_results_text',),
+            search_results_text=search_results_text,
+            outline_section=outline_section,
+            refined_query=refined_query,
+            passage_facts=f"\n【英文の計測値】\n{passage_facts}" if passage_facts else ""
+        )
+
+    @staticmethod
+    def _with_instruction(prompt: RenderedPrompt, instruction: str) -> RenderedPrompt:
+        """再生成時の追加の指示をユーザーメッセージの末尾に足す（システムプロンプトは変えない）"""
+        instruction = (instruction or "").strip()
+        return prompt.with_suffix(f"\n\n【追加の指示】\n{instruction}") if instruction else prompt
+
+    def build_related_topics_prompt(self, initial_query: str) -> RenderedPrompt:
+        """関連文法事項生成のプロンプトを組み立てる"""
+        return self.related_topics_prompt.render(initial_query=initial_query)
+
+    def build_conclusion_prompt(self, digest: str) -> RenderedPrompt:
+        """結論生成のプロンプトを組み立てる"""
+        return self.llm_client.render(self.conclusion_prompt, stage="conclusion", max_tokens=800,
+                                      trimmable=('digest',), digest=digest)
+
+    def build_digest(self, title: str, lead_text: str, body_text: str) -> str:
+        """
+        結論生成に渡すレポートの要点を組み立てる。
+        タイトル・リード文・本文の見出しに、各節の段落（箇条書きの項目）の最初の文を
+        DIGEST_SENTENCES_PER_SECTION 件まで添える。引用番号は結論に要らないので除く。
+        """
+        lines = [title, "", lead_text, ""]
+        taken = 0
+        for line in body_text.split('\n'):
+            stripped = line.strip()
+            if not stripped:
+                continue
+            if stripped.startswith('#'):
+                lines.append(stripped)
+                taken = 0
+                continue
+            if taken >= self.DIGEST_SENTENCES_PER_SECTION:
+                continue
+            text = _LIST_MARKER.sub('', CITATION_SCANNER.sub('', stripped)).strip()
+            sentence = _SENTENCE.match(text)
+            if sentence is None:
+                continue
+            sentence = sentence.group(0).strip()
+            if len(sentence) > self.DIGEST_SENTENCE_CHARS:
+                sentence = sentence[:self.DIGEST_SENTENCE_CHARS] + "…"
+            lines.append(f"- {sentence}")
+            taken += 1
+        return "\n".join(lines).strip()
+
+    def parse_section(self, text: str, fallback: str) -> str:
+        """LLMの応答を節の本文として取り出す（不正な応答ならフォールバック）"""
+        if self.llm_client.validate_response(text):
+            return text.strip()
+        run_context.mark_fallback(None, "invalid LLM response")
+        return fallback
+
+    def assemble_report(self, title: str, lead_text: str, body_text: str,
+                        related_topics_text: str, conclusion_text: str,
+                        sources: Optional[dict[str, str]] = None) -> str:
+        """
+        各パートを結合して完全なレポートにする。
+        情報源を渡すと、引用番号を検証して初出順に振り直し、引用された情報源の参考文献リストを付ける。
+        """
+        report = (
+            f"{title}\n\n"
+            f"{lead_text}\n\n"
+            f"{body_text}\n\n"
+            f"## 関連文法事項\n{related_topics_text}\n\n"
+            f"## 結論\n{conclusion_text}"
+        )
+        if sources is None:
+            return report
+        return add_references(report, sources)['text']
+    
     def _get_fallback_lead(self, refined_query: str) -> str:
         """フォールバック用のリード文"""
         return f"この記事では、「{refined_query}」について、英語教育の観点から深く掘り下げ、その指導法や理論的背景を解説します。"
@@ -199,18 +422,12 @@ class ReportWriter:
         """フォールバック用の結論"""
         return "本レポートでは...を明らかにし、今後の英語教育における課題と展望を示しました。"
     
-    def _get_fallback_report(self, outline: str, refined_query: str) -> str:
-        """フォールバック用の完全なレポート"""
-        title = outline.split('\n')[0]
-        lead_text = self._get_fallback_lead(refined_query)
-        body_text = self._get_fallback_body(outline)
-        related_topics_text = self._get_fallback_related_topics()
-        conclusion_text = self._get_fallback_conclusion()
-        
-        return (
-            f"{title}\n\n"
-            f"{lead_text}\n\n"
-            f"{body_text}\n\n"
-            f"## 関連文法事項\n{related_topics_text}\n\n"
-            f"## 結論\n{conclusion_text}"
-        )
+    def _get_fallback_sections(self, outline: str, refined_query: str) -> Dict[str, str]:
+        """フォールバック用のレポートの各パート"""
+        return {
+            'title': outline.split('\n')[0],
+            'lead': self._get_fallback_lead(refined_query),
+            'body': self._get_fallback_body(outline),
+            'related_topics': self._get_fallback_related_topics(),
+            'conclusion': self._get_fallback_conclusion(),
+        }
@@ -0,0 +1,163 @@
+import contextvars
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterator, List, Optional
+import logging
+
+from .deadline import Deadline
+
+logger = logging.getLogger(__name__)
+
+EventCallback = Callable[[Dict[str, Any]], None]
+
+
+@dataclass
+class RunContext:
+    """
+    1回のパイプライン実行に紐づく状態。
+    各ステージやLLMClientは引数で受け渡す代わりに current_run() から参照する。
+    """
+    run_id: str = field(default_factory=lambda: uuid.uuid4().hex[:12])
+    event_callback: Optional[EventCallback] = None
+    started_at: float = field(default_factory=time.time)
+    # 実行中のステージ名
+    stage: Optional[str] = None
+    # 実行全体の締め切りと、現在のステージに割り当てられた締め切り
+    deadline: Optional[Deadline] = None
+    stage_deadline: Optional[Deadline] = None
+    # Falseなら検索・LLM・レポートのキャッシュを読まない（結果は書き込んで更新する）
+    use_cache: bool = True
+    # ウォームアップなどの低優先度の実行（LLM呼び出しはライブの実行に枠を譲る）
+    background: bool = False
+    # 時間予算のために打ち切ったステージ名（発生順・重複なし）
+    truncated_stages: List[str] = field(default_factory=list)
+    # LLMの失敗や不正な応答のために既定の文面（フォールバック）で済ませたステージ名（発生順・重複なし）
+    fallback_stages: List[str] = field(default_factory=list)
+    # ステージごとの所要時間（秒）とLLM呼び出しの集計
+    stage_timings: Dict[str, float] = field(default_factory=dict)
+    llm_metrics: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    # プロファイルを取る実行のときだけ profiling.RunProfiler（Noneなら待ち時間の内訳は記録しない）
+    profiler: Optional[Any] = None
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def emit(self, event_type: str, **payload: Any) -> None:
+        """進捗イベントをコールバックへ通知する（コールバック側の例外はパイプラインに波及させない）"""
+        if self.event_callback is None:
+            return
+        event = {'type': event_type, 'run_id': self.run_id, 'time': time.time(), **payload}
+        try:
+            self.event_callback(event)
+        except Exception as e:
+            logger.warning(f"Event callback failed: {e}")
+
+    def record_stage_time(self, stage: str, elapsed: float) -> None:
+        """ステージの所要時間を記録する"""
+        with self._lock:
+            self.stage_timings[stage] = self.stage_timings.get(stage, 0.0) + elapsed
+
+    def record_llm_call(self, stage: str, model: str, latency: float,
+                        prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0) -> None:
+        """LLM呼び出し1回分のレイテンシとトークン数（うちキャッシュ済みの入力トークン数）をステージ単位で集計する"""
+        with self._lock:
+            metrics = self._stage_llm_metrics(stage, model)
+            metrics['model'] = model
+            metrics['calls'] += 1
+            metrics['latency'] += latency
+            metrics['prompt_tokens'] += prompt_tokens
+            metrics['completion_tokens'] += completion_tokens
+            metrics['cached_tokens'] += cached_tokens
+        if self.profiler is not None:
+            self.profiler.record_wait(self.stage or stage, 'llm', latency)
+
+    def record_prompt_trim(self, stage: str, model: str, trimmed_tokens: int) -> None:
+        """コンテキストウィンドウに収めるためにプロンプトから削ったトークン数を記録する"""
+        with self._lock:
+            self._stage_llm_metrics(stage, model)['trimmed_tokens'] += trimmed_tokens
+
+    def _stage_llm_metrics(self, stage: str, model: str) -> Dict[str, Any]:
+        return self.llm_metrics.setdefault(stage, {
+            'model': model, 'calls': 0, 'latency': 0.0, 'prompt_tokens': 0, 'completion_tokens': 0,
+            'cached_tokens': 0, 'trimmed_tokens': 0
+        })
+
+    def active_deadline(self) -> Optional[Deadline]:
+        """ステージの締め切りがあればそれを、なければ実行全体の締め切りを返す"""
+        return self.stage_deadline or self.deadline
+
+    def mark_truncated(self, stage: str, reason: str) -> None:
+        """時間予算のためにステージを打ち切ったことを記録する"""
+        if stage not in self.truncated_stages:
+            self.truncated_stages.append(stage)
+        logger.info(f"Stage '{stage}' truncated: {reason}")
+        self.emit('truncated', stage=stage, reason=reason)
+
+    def mark_fallback(self, stage: str, reason: str) -> None:
+        """ステージがフォールバックの文面を使ったことを記録する"""
+        if stage not in self.fallback_stages:
+            self.fallback_stages.append(stage)
+        logger.info(f"Stage '{stage}' used its fallback: {reason}")
+        self.emit('fallback', stage=stage, reason=reason)
+
+
+_current_run: contextvars.ContextVar[Optional[RunContext]] = contextvars.ContextVar('current_run', default=None)
+
+
+def current_run() -> Optional[RunContext]:
+    """実行中のパイプラインのコンテキストを返す（パイプライン外ではNone）"""
+    return _current_run.get()
+
+
+@contextmanager
+def run_scope(context: RunContext) -> Iterator[RunContext]:
+    """withブロックの間、contextを現在の実行コンテキストにする"""
+    token = _current_run.set(context)
+    try:
+        yield context
+    finally:
+        _current_run.reset(token)
+
+
+def current_deadline() -> Optional[Deadline]:
+    """現在のステージに適用される締め切り（パイプライン外や予算なしの場合はNone）"""
+    context = current_run()
+    return context.active_deadline() if context is not None else None
+
+
+def cache_reads_enabled() -> bool:
+    """実行中のパイプラインがキャッシュを読んでよいか（パイプライン外では常にTrue）"""
+    context = current_run()
+    return context is None or context.use_cache
+
+
+def mark_truncated(stage: Optional[str], reason: str) -> None:
+    """現在の実行コンテキストにステージの打ち切りを記録する（stage省略時は実行中のステージ）"""
+    context = current_run()
+    if context is not None:
+        context.mark_truncated(stage or context.stage or "unknown", reason)
+
+
+def mark_fallback(stage: Optional[str], reason: str) -> None:
+    """現在の実行コンテキストにフォールバックの使用を記録する（stage省略時は実行中のステージ）"""
+    context = current_run()
+    if context is not None:
+        context.mark_fallback(stage or context.stage or "unknown", reason)
+
+
+def record_wait(kind: str, seconds: float) -> None:
+    """
+    スリープやレート制限などの待ち時間を、実行中のステージのプロファイルに記録する。
+    プロファイルを取っていない実行やパイプラインの外では何もしない。
+    """
+    context = current_run()
+    if context is not None and context.profiler is not None:
+        context.profiler.record_wait(context.stage or "-", kind, seconds)
+
+
+def emit(event_type: str, **payload: Any) -> None:
+    """現在の実行コンテキストにイベントを通知する（コンテキストがなければ何もしない）"""
+    context = current_run()
+    if context is not None:
+        context.emit(event_type, **payload)
@@ -0,0 +1,53 @@
+import os
+import threading
+from typing import Any, Dict, Optional
+import logging
+
+import yaml
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SETTINGS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config', 'settings.yaml')
+
+_settings: Optional[Dict[str, Any]] = None
+_settings_lock = threading.Lock()
+
+
+def load_settings(path: Optional[str] = None, reload: bool = False) -> Dict[str, Any]:
+    """
+    config/settings.yaml を読み込んで返す（2回目以降はキャッシュを返す）。
+
+    Args:
+        path: 設定ファイルのパス（省略時は環境変数SETTINGS_PATH、なければconfig/settings.yaml）
+        reload: キャッシュを無視して読み直すか
+
+    Returns:
+        設定の辞書（ファイルがない・空の場合は空の辞書）
+    """
+    global _settings
+    with _settings_lock:
+        if _settings is not None and not reload and path is None:
+            return _settings
+
+        settings_path = path or os.getenv('SETTINGS_PATH', DEFAULT_SETTINGS_PATH)
+        try:
+            with open(settings_path, encoding='utf-8') as f:
+                loaded = yaml.safe_load(f) or {}
+        except FileNotFoundError:
+            logger.warning(f"Settings file not found: {settings_path}")
+            loaded = {}
+
+        if not isinstance(loaded, dict):
+            raise ValueError(f"Settings file must contain a mapping: {settings_path}")
+
+        if path is None:
+            _settings = loaded
+        return loaded
+
+
+def get_section(name: str) -> Dict[str, Any]:
+    """設定の1セクションを返す（存在しなければ空の辞書）"""
+    section = load_settings().get(name) or {}
+    if not isinstance(section, dict):
+        raise ValueError(f"Settings section '{name}' must be a mapping")
+    return section
@@ -0,0 +1,188 @@
+import atexit
+import copy
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, Optional
+import logging
+
+from .run_context import current_run
+from .settings import get_section
+
+# LogRecordが標準で持つ属性（これ以外の属性は extra= で渡された構造化フィールドとして出力する）
+_STANDARD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'run_id', 'stage'}
+
+DEFAULT_MAX_PAYLOAD_CHARS = 2000
+DEFAULT_QUEUE_SIZE = 10000
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s [%(run_id)s/%(stage)s] %(message)s"
+
+_exception_formatter = logging.Formatter()
+_listener: Optional[QueueListener] = None
+_listener_lock = threading.Lock()
+
+
+def cap_payload(value: Any, max_chars: int) -> Any:
+    """長い文字列を max_chars で切り詰める（切り詰めた文字数を末尾に付ける）"""
+    if isinstance(value, str) and len(value) > max_chars:
+        return f"{value[:max_chars]}…(+{len(value) - max_chars} chars)"
+    return value
+
+
+def _extra_fields(record: logging.LogRecord) -> Dict[str, Any]:
+    """extra= で渡された構造化フィールド"""
+    return {key: value for key, value in vars(record).items() if key not in _STANDARD_ATTRS}
+
+
+class RunContextFilter(logging.Filter):
+    """
+    ログを出したスレッドの実行コンテキストから run_id と stage を付け、メッセージと構造化フィールドを切り詰める。
+    QueueHandlerに付けて、ログを出したスレッドで実行する（コンテキストはスレッドごとに異なるため）。
+    """
+
+    def __init__(self, max_payload_chars: int = DEFAULT_MAX_PAYLOAD_CHARS):
+        super().__init__()
+        self.max_payload_chars = max_payload_chars
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        context = current_run()
+        record.run_id = context.run_id if context is not None else "-"
+        record.stage = (context.stage or "-") if context is not None else "-"
+        record.msg = cap_payload(record.getMessage(), self.max_payload_chars)
+        record.args = None
+        for key, value in _extra_fields(record).items():
+            setattr(record, key, cap_payload(value, self.max_payload_chars))
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    INFO以下のログをロガーごとの割合で間引く（WARNING以上は常に残す）。
+    割合はロガー名の前方一致で最長のものを使う（'src.external_api_client': 0.1 など）。
+    """
+
+    def __init__(self, rates: Optional[Dict[str, float]] = None):
+        super().__init__()
+        self.rates = {name: float(rate) for name, rate in (rates or {}).items()}
+
+    def rate_for(self, name: str) -> float:
+        matches = [prefix for prefix in self.rates if name == prefix or name.startswith(prefix + ".")]
+        return self.rates[max(matches, key=len)] if matches else 1.0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rate_for(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """キューが満杯のときは待たずにログを捨てるQueueHandler（捨てた件数を数える）"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # トレースバックは文字列にしてから渡す（フレームへの参照を出力スレッドに持ち込まない）
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if record.exc_info:
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class TextFormatter(logging.Formatter):
+    """人が読む形式（構造化フィールドは key=value で末尾に付ける）"""
+
+    def __init__(self):
+        super().__init__(TEXT_FORMAT)
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        fields = _extra_fields(record)
+        if not fields:
+            return text
+        head, sep, tail = text.partition("\n")
+        return head + " " + " ".join(f"{key}={value}" for key, value in fields.items()) + sep + tail
+
+
+class JsonFormatter(logging.Formatter):
+    """1行1件のJSONでログを出力する（run_id・stageと extra= で渡したフィールドを含む）"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            'level': record.levelname,
+            'logger': record.name,
+            'run_id': getattr(record, 'run_id', "-"),
+            'stage': getattr(record, 'stage', "-"),
+            'message': record.getMessage(),
+        }
+        entry.update(_extra_fields(record))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc_info'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def configure_logging(force: bool = False) -> Optional[QueueListener]:
+    """
+    ルートロガーに非同期のQueueHandlerを設定する。
+    ログを出したスレッドではキューに積むだけで、出力は別スレッドのQueueListenerが行う。
+    設定は settings.yaml の logging セクション（環境変数 LOG_LEVEL / LOG_FORMAT が優先）。
+
+    Args:
+        force: ルートロガーに既にハンドラーがあっても設定し直すか（ないときだけ設定するのが既定）
+
+    Returns:
+        起動したQueueListener（既にハンドラーがあり設定しなかった場合はNone）
+    """
+    global _listener
+    settings = get_section('logging')
+    root = logging.getLogger()
+    with _listener_lock:
+        if root.handlers and not force:
+            return None
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+
+        output = logging.StreamHandler(sys.stderr)
+        log_format = os.getenv('LOG_FORMAT', settings.get('format', 'json'))
+        output.setFormatter(JsonFormatter() if log_format == 'json' else TextFormatter())
+
+        handler = NonBlockingQueueHandler(queue.Queue(int(settings.get('queue_size', DEFAULT_QUEUE_SIZE))))
+        handler.addFilter(SamplingFilter(settings.get('sample_rates')))
+        handler.addFilter(RunContextFilter(int(settings.get('max_payload_chars', DEFAULT_MAX_PAYLOAD_CHARS))))
+        root.addHandler(handler)
+        root.setLevel(os.getenv('LOG_LEVEL', settings.get('level', 'INFO')).upper())
+
+        _listener = QueueListener(handler.queue, output, respect_handler_level=True)
+        _listener.start()
+        atexit.register(stop_logging)
+        return _listener
+
+
+def stop_logging() -> None:
+    """キューに残ったログを出力してからQueueListenerを止める"""
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
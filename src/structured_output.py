@@ -0,0 +1,280 @@
+import json
+import re
+from typing import Any, Dict, List, Optional
+
+
+class StructuredOutputError(ValueError):
+    """LLMの応答から構造化データを取り出せなかったときに送出される例外（元のテキストを保持する）"""
+
+    def __init__(self, message: str, text: str = "", errors: Optional[List[str]] = None):
+        super().__init__(message)
+        self.text = text
+        self.errors = errors or []
+
+
+_FENCE_PATTERN = re.compile(r"```[A-Za-z0-9_-]*\s*\n?(.*?)(?:```|$)", re.DOTALL)
+
+
+def strip_code_fences(text: str) -> str:
+    """```json ... ``` のようなコードフェンスを取り除く（閉じていないフェンスにも対応）"""
+    match = _FENCE_PATTERN.search(text)
+    return match.group(1) if match else text
+
+
+class _Level:
+    """走査中の1階層（オブジェクトまたは配列）の状態"""
+    __slots__ = ('closer', 'member_start', 'phase', 'value_start', 'scalar')
+
+    def __init__(self, closer: str, member_start: int):
+        self.closer = closer
+        # 現在のメンバー（要素）の開始位置。途中で切れた場合はここまで巻き戻す
+        self.member_start = member_start
+        # オブジェクトは key → colon → value、配列は常に value
+        self.phase = 'key' if closer == '}' else 'value'
+        self.value_start: Optional[int] = None
+        self.scalar = False
+
+    def next_member(self, member_start: int) -> None:
+        self.member_start = member_start
+        self.phase = 'key' if self.closer == '}' else 'value'
+        self.value_start = None
+        self.scalar = False
+
+
+class IncrementalJSONParser:
+    """
+    ストリーミングで届くJSONを少しずつ受け取り、途中の時点でも閉じ括弧を補って解釈できるパーサー。
+    走査の状態を保持するので、チャンクを受け取るたびに全体を読み直すことはない。
+    先頭のコードフェンスや説明文、トップレベルの値の後ろに続く文章は無視する。
+    """
+
+    def __init__(self):
+        self._raw: List[str] = []
+        self._out: List[str] = []
+        self._stack: List[_Level] = []
+        self._started = False
+        self._in_string = False
+        self._escape = False
+        self._key_string = False
+        self.complete = False
+
+    @property
+    def text(self) -> str:
+        """これまでに受け取った生のテキスト"""
+        return "".join(self._raw)
+
+    def feed(self, chunk: str) -> None:
+        """チャンクを追加する"""
+        self._raw.append(chunk)
+        for ch in chunk:
+            if self.complete:
+                return
+            self._consume(ch)
+
+    def _consume(self, ch: str) -> None:
+        out = self._out
+        if not self._started:
+            if ch not in '{[':
+                return
+            self._started = True
+
+        level = self._stack[-1] if self._stack else None
+
+        if self._in_string:
+            out.append(ch)
+            if self._escape:
+                self._escape = False
+            elif ch == '\\':
+                self._escape = True
+            elif ch == '"':
+                self._in_string = False
+                if self._key_string:
+                    level.phase = 'colon'
+            return
+
+        if ch == '"':
+            self._in_string = True
+            self._key_string = level is not None and level.closer == '}' and level.phase == 'key'
+            if level is not None and not self._key_string and level.value_start is None:
+                level.value_start = len(out)
+            out.append(ch)
+        elif ch in '{[':
+            if level is not None and level.value_start is None:
+                level.value_start = len(out)
+            out.append(ch)
+            self._stack.append(_Level('}' if ch == '{' else ']', len(out)))
+        elif ch in '}]':
+            if level is None:
+                return
+            self._strip_trailing_comma()
+            out.append(level.closer)
+            self._stack.pop()
+            if not self._stack:
+                self.complete = True
+        elif ch == ':':
+            out.append(ch)
+            if level is not None and level.closer == '}':
+                level.phase = 'value'
+        elif ch == ',':
+            out.append(ch)
+            if level is not None:
+                level.next_member(len(out))
+        elif ch.isspace():
+            out.append(ch)
+        else:
+            # 数値・true/false/null
+            if level is not None and level.value_start is None:
+                level.value_start = len(out)
+                level.scalar = True
+            out.append(ch)
+
+    def _strip_trailing_comma(self) -> None:
+        """閉じ括弧の直前の余分なカンマを取り除く（[1, 2,] のような出力への対策）"""
+        out = self._out
+        index = len(out) - 1
+        while index >= 0 and out[index].isspace():
+            index -= 1
+        if index >= 0 and out[index] == ',':
+            del out[index:]
+
+    def snapshot(self) -> str:
+        """現時点までの入力を、閉じ括弧などを補った有効なJSON文字列にして返す"""
+        if not self._started:
+            raise StructuredOutputError("No JSON object or array found in output", self.text)
+        out = list(self._out)
+        if self.complete:
+            return "".join(out)
+
+        level = self._stack[-1]
+        cut = False
+        if self._in_string:
+            if self._key_string:
+                cut = True
+            else:
+                if self._escape:
+                    out.pop()
+                out.append('"')
+        elif level.closer == '}' and level.phase != 'value':
+            cut = True
+        elif level.value_start is None:
+            cut = True
+        elif level.scalar:
+            # 途中で切れた true/数値などは解釈できなければ捨てる
+            try:
+                json.loads("".join(out[level.value_start:]))
+            except ValueError:
+                cut = True
+
+        stack = list(self._stack)
+        if cut:
+            del out[level.member_start:]
+            # 中身が空になった入れ子のオブジェクト・配列は、親のメンバーごと取り除く
+            while len(stack) > 1 and "".join(out[stack[-1].member_start - 1:]).strip() in ('{', '['):
+                stack.pop()
+                del out[stack[-1].member_start:]
+        text = "".join(out).rstrip()
+        if text.endswith(','):
+            text = text[:-1]
+        return text + "".join(lvl.closer for lvl in reversed(stack))
+
+    def partial(self) -> Any:
+        """現時点までの入力を解釈した値を返す（まだ何も解釈できなければNone）"""
+        try:
+            return json.loads(self.snapshot())
+        except ValueError:
+            return None
+
+
+def repair_json(text: str) -> str:
+    """
+    壊れたJSON文字列を修復する。
+    コードフェンスや前後の文章を取り除き、末尾のカンマを消して、途中で切れた文字列・括弧を閉じる。
+    """
+    parser = IncrementalJSONParser()
+    parser.feed(strip_code_fences(text))
+    return parser.snapshot()
+
+
+def validate(data: Any, schema: Dict[str, Any]) -> List[str]:
+    """
+    JSON Schemaのサブセット（type, properties, required, items, minItems, maxItems, minLength,
+    $ref: "#/definitions/..."）でデータを検証し、エラーの一覧を返す（妥当なら空リスト）。
+    """
+    errors: List[str] = []
+    _validate(data, schema, schema, "$", errors)
+    return errors
+
+
+_TYPES = {
+    'object': dict,
+    'array': list,
+    'string': str,
+    'boolean': bool,
+    'null': type(None),
+}
+
+
+def _matches_type(value: Any, type_name: str) -> bool:
+    if type_name == 'integer':
+        return isinstance(value, int) and not isinstance(value, bool)
+    if type_name == 'number':
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    return isinstance(value, _TYPES[type_name])
+
+
+def _validate(value: Any, schema: Dict[str, Any], root: Dict[str, Any], path: str, errors: List[str]) -> None:
+    if '$ref' in schema:
+        ref = schema['$ref']
+        if not ref.startswith('#/definitions/'):
+            raise ValueError(f"Unsupported $ref: {ref}")
+        schema = root['definitions'][ref[len('#/definitions/'):]]
+
+    expected = schema.get('type')
+    if expected is not None:
+        types = expected if isinstance(expected, list) else [expected]
+        if not any(_matches_type(value, t) for t in types):
+            errors.append(f"{path}: expected {'/'.join(types)}, got {type(value).__name__}")
+            return
+
+    if isinstance(value, dict):
+        for name in schema.get('required', []):
+            if name not in value:
+                errors.append(f"{path}: missing required property '{name}'")
+        for name, sub_schema in schema.get('properties', {}).items():
+            if name in value:
+                _validate(value[name], sub_schema, root, f"{path}.{name}", errors)
+    elif isinstance(value, list):
+        if 'minItems' in schema and len(value) < schema['minItems']:
+            errors.append(f"{path}: expected at least {schema['minItems']} items")
+        if 'maxItems' in schema and len(value) > schema['maxItems']:
+            errors.append(f"{path}: expected at most {schema['maxItems']} items")
+        if 'items' in schema:
+            for index, item in enumerate(value):
+                _validate(item, schema['items'], root, f"{path}[{index}]", errors)
+    elif isinstance(value, str):
+        if 'minLength' in schema and len(value) < schema['minLength']:
+            errors.append(f"{path}: expected at least {schema['minLength']} characters")
+
+
+def parse_json(text: str, schema: Optional[Dict[str, Any]] = None) -> Any:
+    """
+    LLMの応答をJSONとして解釈する。そのまま読めなければ修復してから読み、schemaがあれば検証する。
+
+    Raises:
+        StructuredOutputError: 解釈できない、またはスキーマに合わない場合
+    """
+    if text is None:
+        raise StructuredOutputError("Empty output", "")
+    try:
+        data = json.loads(text)
+    except ValueError:
+        try:
+            data = json.loads(repair_json(text))
+        except ValueError as e:
+            raise StructuredOutputError(f"Could not parse JSON output: {e}", text) from e
+
+    if schema is not None:
+        errors = validate(data, schema)
+        if errors:
+            raise StructuredOutputError(f"Output does not match schema: {errors[0]}", text, errors)
+    return data
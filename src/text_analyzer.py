@@ -0,0 +1,318 @@
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+import logging
+
+from .grammar_analyzer import english_sentences
+from .settings import get_section
+
+logger = logging.getLogger(__name__)
+
+LEVELS = ('A1', 'A2', 'B1', 'B2', 'C1', 'C2')
+
+# 索引ファイルの形式: ヘッダー（マジック8バイト＋件数）に続き、見出し語の昇順に固定長のレコードを並べる。
+# レコードは見出し語（UTF-8、NULで埋める）とレベル番号（LEVELSの添字）1バイト
+_MAGIC = b'CEFRIDX1'
+_HEADER = struct.Struct('<8sI')
+_WORD_BYTES = 31
+_RECORD_BYTES = _WORD_BYTES + 1
+
+_WORD = re.compile(r"[A-Za-z]+(?:[-'][A-Za-z]+)*")
+_SENTENCE_END = re.compile(r"(?<=[.?!])\s+")
+_VOWEL_GROUP = re.compile(r"[aeiouy]+")
+_CONTRACTIONS = {"won't": "will", "can't": "can", "shan't": "shall"}
+_IRREGULAR = {
+    'was': 'be', 'were': 'be', 'is': 'be', 'are': 'be', 'am': 'be', 'been': 'be', 'being': 'be',
+    'has': 'have', 'had': 'have', 'did': 'do', 'does': 'do', 'done': 'do', 'went': 'go', 'gone': 'go',
+    'saw': 'see', 'seen': 'see', 'took': 'take', 'taken': 'take', 'made': 'make', 'came': 'come',
+    'got': 'get', 'gotten': 'get', 'gave': 'give', 'given': 'give', 'knew': 'know', 'known': 'know',
+    'thought': 'think', 'told': 'tell', 'said': 'say', 'found': 'find', 'felt': 'feel', 'left': 'leave',
+    'kept': 'keep', 'brought': 'bring', 'bought': 'buy', 'caught': 'catch', 'taught': 'teach',
+    'wrote': 'write', 'written': 'write', 'spoke': 'speak', 'spoken': 'speak', 'ate': 'eat', 'eaten': 'eat',
+    'drank': 'drink', 'ran': 'run', 'began': 'begin', 'begun': 'begin', 'sat': 'sit', 'stood': 'stand',
+    'met': 'meet', 'heard': 'hear', 'held': 'hold', 'paid': 'pay', 'sent': 'send', 'spent': 'spend',
+    'built': 'build', 'lost': 'lose', 'meant': 'mean', 'slept': 'sleep', 'chose': 'choose',
+    'chosen': 'choose', 'broke': 'break', 'broken': 'break', 'fell': 'fall', 'fallen': 'fall',
+    'forgot': 'forget', 'forgotten': 'forget', 'grew': 'grow', 'grown': 'grow', 'drove': 'drive',
+    'driven': 'drive', 'flew': 'fly', 'flown': 'fly', 'understood': 'understand', 'became': 'become',
+    'children': 'child', 'men': 'man', 'women': 'woman', 'people': 'person', 'feet': 'foot',
+    'teeth': 'tooth', 'mice': 'mouse', 'better': 'good', 'best': 'good', 'worse': 'bad', 'worst': 'bad',
+    'him': 'he', 'her': 'she', 'them': 'they', 'us': 'we', 'me': 'i',
+}
+
+
+def build_index(seed_path: Optional[str] = None, index_path: Optional[str] = None) -> int:
+    """
+    語彙レベル表（lemma<TAB>レベルのTSV）から索引ファイルを作り、収めた見出し語の数を返す。
+    別のプロセスが読んでいても壊れないよう、一時ファイルに書いてから置き換える。
+    """
+    settings = get_section('text_analysis')
+    seed_path = seed_path or settings.get('seed_path', 'data/vocab/cefr_seed.tsv')
+    index_path = index_path or settings.get('index_path', 'data/cache/cefr_index.bin')
+
+    levels: Dict[bytes, int] = {}
+    with open(seed_path, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            lemma, _, level = line.partition('\t')
+            word = lemma.strip().lower().encode('utf-8')
+            level = level.strip().upper()
+            if level not in LEVELS or not word or len(word) > _WORD_BYTES:
+                logger.warning(f"Skipping invalid vocabulary entry at {seed_path}:{line_number}")
+                continue
+            # 同じ語が複数のレベルにあれば低い方を使う
+            levels[word] = min(levels.get(word, len(LEVELS)), LEVELS.index(level))
+
+    os.makedirs(os.path.dirname(index_path) or '.', exist_ok=True)
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, len(levels)))
+        for word in sorted(levels):
+            f.write(word.ljust(_WORD_BYTES, b'\0') + bytes([levels[word]]))
+    os.replace(tmp_path, index_path)
+    logger.info("Vocabulary index built", extra={'entries': len(levels), 'path': index_path})
+    return len(levels)
+
+
+class VocabularyIndex:
+    """
+    索引ファイルをメモリマップして、見出し語のCEFRレベルを二分探索で引く。
+    ファイルはOSのページキャッシュで全プロセスに共有され、読み込みの時間もメモリの複製もいらない。
+    """
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count = _HEADER.unpack_from(self._mmap, 0)
+        if magic != _MAGIC or len(self._mmap) != _HEADER.size + self._count * _RECORD_BYTES:
+            self._mmap.close()
+            raise ValueError(f"Not a vocabulary index: {path}")
+
+    def __len__(self) -> int:
+        return self._count
+
+    def close(self) -> None:
+        self._mmap.close()
+
+    def _word_at(self, i: int) -> bytes:
+        offset = _HEADER.size + i * _RECORD_BYTES
+        return self._mmap[offset:offset + _WORD_BYTES].rstrip(b'\0')
+
+    def get(self, lemma: str) -> Optional[str]:
+        """見出し語のレベル（リストになければNone）"""
+        word = lemma.lower().encode('utf-8')
+        low, high = 0, self._count
+        while low < high:
+            mid = (low + high) // 2
+            if self._word_at(mid) < word:
+                low = mid + 1
+            else:
+                high = mid
+        if low < self._count and self._word_at(low) == word:
+            return LEVELS[self._mmap[_HEADER.size + low * _RECORD_BYTES + _WORD_BYTES]]
+        return None
+
+    def level(self, word: str) -> Optional[str]:
+        """活用形・派生形も見出し語に戻して引いたレベル（リストになければNone）"""
+        for candidate in lemma_candidates(word):
+            level = self.get(candidate)
+            if level is not None:
+                return level
+        return None
+
+
+def lemma_candidates(word: str) -> Iterator[str]:
+    """語の見出し語の候補を、確からしい順に返す（辞書を引いて最初に見つかったものを使う）"""
+    word = word.lower()
+    word = _CONTRACTIONS.get(word, word)
+    if "'" in word:
+        word = word[:-3] if word.endswith("n't") else word.split("'")[0]
+    yield word
+    if word in _IRREGULAR:
+        yield _IRREGULAR[word]
+    for suffix, replacements in (('ies', ('y',)), ('ied', ('y',)), ('ier', ('y',)), ('iest', ('y',)),
+                                 ('ily', ('y',)), ('es', ('', 'e')), ('s', ('',)), ('ed', ('', 'e')),
+                                 ('ing', ('', 'e')), ('er', ('', 'e')), ('est', ('', 'e')), ('ly', ('', 'le'))):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 2:
+            stem = word[:-len(suffix)]
+            for replacement in replacements:
+                yield stem + replacement
+            # stopped → stop, running → run, bigger → big
+            if len(stem) >= 3 and stem[-1] == stem[-2] and stem[-1] not in 'aeiosl':
+                yield stem[:-1]
+
+
+def count_syllables(word: str) -> int:
+    """音節数の概算（母音字のまとまりの数から、語末の黙字のeを除く）"""
+    word = word.lower().replace("'", "")
+    count = len(_VOWEL_GROUP.findall(word))
+    if word.endswith('e') and not word.endswith(('le', 'ee', 'ye')) and count > 1:
+        count -= 1
+    return max(1, count)
+
+
+def split_sentences(passage: str) -> List[str]:
+    """英文を文に分ける"""
+    return [sentence.strip() for sentence in _SENTENCE_END.split(passage) if sentence.strip()]
+
+
+def analyze_passage(passage: str, index: Optional[VocabularyIndex] = None,
+                    coverage: float = 0.95, max_unlisted: int = 10) -> Dict[str, Any]:
+    """
+    英文の語彙レベルの分布・リスト外の語・文の長さ・読みやすさを計測する。
+
+    Args:
+        passage: 英文
+        index: 語彙の索引（省略時はプロセスで共有する索引）
+        coverage: 語彙の目安とする、語のカバー率
+        max_unlisted: 返すリスト外の語の最大数
+
+    Returns:
+        計測結果の辞書（語彙レベルの割合はリスト外の語も含めた全語に対する比率）
+    """
+    started = time.perf_counter()
+    if index is None:
+        index = get_vocabulary()
+    sentences = split_sentences(passage)
+    counts = dict.fromkeys(LEVELS + ('unlisted',), 0)
+    unlisted: Dict[str, None] = {}
+    words = syllables = proper_nouns = 0
+    sentence_lengths = []
+    types = set()
+
+    for sentence in sentences:
+        tokens = [match.group(0) for match in _WORD.finditer(sentence)]
+        sentence_lengths.append(len(tokens))
+        for position, token in enumerate(tokens):
+            words += 1
+            syllables += sum(count_syllables(part) for part in token.split('-'))
+            types.add(token.lower())
+            level = index.level(token)
+            if level is None and '-' in token:
+                # 複合語は最も難しい構成語のレベルとする
+                parts = [index.level(part) for part in token.split('-')]
+                level = None if None in parts else max(parts, key=LEVELS.index)
+            if level is None and position > 0 and token[0].isupper():
+                # 文中の大文字で始まる語は固有名詞とみなし、語彙の分布に入れない
+                proper_nouns += 1
+                continue
+            if level is None:
+                counts['unlisted'] += 1
+                unlisted.setdefault(token.lower())
+            else:
+                counts[level] += 1
+
+    rated = sum(counts.values())
+    estimated_level = None
+    if rated:
+        covered = 0
+        for level in LEVELS:
+            covered += counts[level]
+            if covered / rated >= coverage:
+                estimated_level = level
+                break
+        else:
+            estimated_level = 'C2+'
+
+    words_per_sentence = words / len(sentences) if sentences else 0.0
+    syllables_per_word = syllables / words if words else 0.0
+    return {
+        'words': words,
+        'sentences': len(sentences),
+        'avg_sentence_length': round(words_per_sentence, 1),
+        'max_sentence_length': max(sentence_lengths, default=0),
+        'level_distribution': {level: round(count / rated, 3) if rated else 0.0 for level, count in counts.items()},
+        'estimated_level': estimated_level,
+        'coverage': coverage,
+        'unlisted_words': list(unlisted)[:max_unlisted],
+        'proper_nouns': proper_nouns,
+        'type_token_ratio': round(len(types) / words, 3) if words else 0.0,
+        'flesch_reading_ease': round(206.835 - 1.015 * words_per_sentence - 84.6 * syllables_per_word, 1) if words else None,
+        'flesch_kincaid_grade': round(0.39 * words_per_sentence + 11.8 * syllables_per_word - 15.59, 1) if words else None,
+        'elapsed_ms': round((time.perf_counter() - started) * 1000, 2),
+    }
+
+
+def analyze_query(query: str) -> Optional[Dict[str, Any]]:
+    """
+    クエリに含まれる英文を計測する（text_analysis が無効か、英文が短すぎればNone）。
+    索引が使えない場合もNoneを返し、レポート生成は計測なしで続ける。
+    """
+    settings = get_section('text_analysis')
+    if not settings.get('enabled', True):
+        return None
+    passage = " ".join(english_sentences(query))
+    if len(passage.split()) < int(settings.get('min_words', 8)):
+        return None
+    try:
+        return analyze_passage(passage, coverage=float(settings.get('coverage', 0.95)),
+                               max_unlisted=int(settings.get('max_unlisted', 10)))
+    except Exception as e:
+        logger.warning(f"Passage analysis failed: {e}")
+        return None
+
+
+def format_facts(analysis: Optional[Dict[str, Any]], approximate: Optional[bool] = None) -> str:
+    """
+    計測結果を、プロンプトに埋め込む短い箇条書きにする（計測結果がなければ空文字列）。
+    approximate（省略時は text_analysis.levels_approximate）なら、語彙レベルを概算と明記し、断定しないよう指示する。
+    """
+    if not analysis:
+        return ""
+    if approximate is None:
+        approximate = bool(get_section('text_analysis').get('levels_approximate', True))
+    label = "（概算）" if approximate else ""
+    distribution = " / ".join(
+        f"{'リスト外' if level == 'unlisted' else level} {ratio:.0%}"
+        for level, ratio in analysis['level_distribution'].items()
+    )
+    lines = [
+        f"- 語数: {analysis['words']}語・{analysis['sentences']}文"
+        f"（1文平均{analysis['avg_sentence_length']}語、最長{analysis['max_sentence_length']}語）",
+        f"- 語彙レベル（CEFR）の分布{label}: {distribution}",
+        f"- 語彙の目安{label}: {analysis['estimated_level']}（語の{analysis['coverage']:.0%}をカバーするレベル）",
+        f"- 読みやすさ: Flesch Reading Ease {analysis['flesch_reading_ease']}"
+        f" / Flesch-Kincaid Grade {analysis['flesch_kincaid_grade']}",
+    ]
+    if analysis['unlisted_words']:
+        lines.append(f"- 語彙表にない語: {', '.join(analysis['unlisted_words'])}")
+    if approximate:
+        lines.append("- 注意: 語彙レベルは出典のある公式の語彙表ではなく、小さな初期リストによる概算です。"
+                     "レベルは「目安」「〜程度」として述べ、断定しないでください")
+    return "\n".join(lines)
+
+
+_vocabulary: Optional[VocabularyIndex] = None
+_vocabulary_lock = threading.Lock()
+
+
+def get_vocabulary() -> VocabularyIndex:
+    """
+    プロセスで共有する語彙の索引を返す。
+    索引ファイルがないか語彙レベル表より古ければ、先に作り直す（初期データなら数十ミリ秒）。
+    """
+    global _vocabulary
+    with _vocabulary_lock:
+        if _vocabulary is None:
+            settings = get_section('text_analysis')
+            seed_path = settings.get('seed_path', 'data/vocab/cefr_seed.tsv')
+            index_path = settings.get('index_path', 'data/cache/cefr_index.bin')
+            if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(seed_path):
+                build_index(seed_path, index_path)
+            _vocabulary = VocabularyIndex(index_path)
+        return _vocabulary
+
+
+def reset_vocabulary() -> None:
+    """共有の索引を閉じる（テスト用・語彙レベル表の差し替え後）"""
+    global _vocabulary
+    with _vocabulary_lock:
+        if _vocabulary is not None:
+            _vocabulary.close()
+        _vocabulary = None
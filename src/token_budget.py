@@ -0,0 +1,203 @@
+import math
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+import logging
+
+from .settings import get_section
+
+logger = logging.getLogger(__name__)
+
+try:
+    import tiktoken
+except ImportError:  # tiktokenがなければ文字種ごとの概算で数える
+    tiktoken = None
+
+# モデルごとのコンテキストウィンドウ（トークン数、前方一致で最長のものを使う）
+CONTEXT_WINDOWS = {
+    'gpt-4.1': 1047576,
+    'gpt-4o': 128000,
+    'gpt-4-turbo': 128000,
+    'gpt-4-1106': 128000,
+    'gpt-4-0125': 128000,
+    'gpt-4-32k': 32768,
+    'gpt-4': 8192,
+    'gpt-3.5-turbo': 16385,
+    'o1': 200000,
+    'o3': 200000,
+    'o4': 200000,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+
+# メッセージごとにかかる書式分のトークン数と、見積もり誤差に備えた余裕
+MESSAGE_OVERHEAD_TOKENS = 4
+SAFETY_MARGIN_TOKENS = 256
+# 出力枠をこれ以上削らなければ収まらない場合は送信しない
+MIN_COMPLETION_TOKENS = 256
+
+TRUNCATION_MARK = "…"
+
+
+class ContextWindowExceeded(ValueError):
+    """プロンプトがモデルのコンテキストウィンドウに収まらないときに送出される例外"""
+
+
+@lru_cache(maxsize=None)
+def _encoding(model: str):
+    """モデルのトークナイザーを返す（tiktokenがない、またはエンコーディングを取得できなければNone）"""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        try:
+            return tiktoken.get_encoding("o200k_base" if model.startswith(('gpt-4o', 'gpt-4.1', 'o')) else "cl100k_base")
+        except Exception:
+            return None
+    except Exception as e:
+        logger.warning(f"Could not load tokenizer for {model}, using estimates: {e}")
+        return None
+
+
+def count_tokens(text: str, model: str = "") -> int:
+    """
+    テキストのトークン数を数える。
+    tiktokenがあれば正確に数え、なければASCIIは4文字で1トークン、日本語などは1文字1トークンで概算する
+    （どちらのトークナイザーでも多めに見積もる側になる）。
+    """
+    if not text:
+        return 0
+    encoding = _encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return math.ceil(ascii_chars / 4) + (len(text) - ascii_chars)
+
+
+def count_message_tokens(messages: Iterable[Dict[str, str]], model: str = "") -> int:
+    """メッセージのリストのトークン数を数える"""
+    return sum(count_tokens(message['content'], model) + MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+
+def context_window(model: str) -> int:
+    """モデルのコンテキストウィンドウを返す（settings.yamlの llm.context_windows が優先）"""
+    overrides = get_section('llm').get('context_windows') or {}
+    table = {**CONTEXT_WINDOWS, **overrides}
+    matches = [prefix for prefix in table if model.startswith(prefix)]
+    if not matches:
+        return DEFAULT_CONTEXT_WINDOW
+    return int(table[max(matches, key=len)])
+
+
+def prompt_budget(model: str, completion_tokens: int) -> int:
+    """出力枠と余裕を差し引いた、プロンプトに使えるトークン数"""
+    return context_window(model) - completion_tokens - SAFETY_MARGIN_TOKENS
+
+
+def truncate_tokens(text: str, max_tokens: int, model: str = "") -> str:
+    """テキストを先頭からmax_tokensに収まる長さで切り詰める（切り詰めた場合は末尾に印を付ける）"""
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text, model) <= max_tokens:
+        return text
+    # 文字数を二分探索して、収まる最長の先頭部分を探す
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if count_tokens(text[:mid], model) + 1 <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low].rstrip() + TRUNCATION_MARK
+
+
+def trim_blocks(text: str, max_tokens: int, model: str = "", separator: str = "\n\n") -> str:
+    """
+    空行で区切られたブロック（検索結果の1件、レポートの1段落など）を均等に切り詰めてmax_tokensに収める。
+    短いブロックはそのまま残し、長いブロックほど多く削るので、各ブロックの先頭（見出しや出典）は残る。
+    """
+    if count_tokens(text, model) <= max_tokens:
+        return text
+    blocks = text.split(separator)
+    separator_tokens = count_tokens(separator, model)
+    available = max_tokens - separator_tokens * (len(blocks) - 1)
+    if available <= 0:
+        return truncate_tokens(text, max_tokens, model)
+
+    sizes = [count_tokens(block, model) for block in blocks]
+    # 水位（1ブロックあたりの上限）を、短いブロックから順に埋めて決める
+    cap = available // len(blocks)
+    remaining_budget = available
+    remaining_blocks = len(blocks)
+    for size in sorted(sizes):
+        share = remaining_budget // remaining_blocks
+        if size > share:
+            cap = share
+            break
+        remaining_budget -= size
+        remaining_blocks -= 1
+    else:
+        cap = max(sizes)
+
+    trimmed = [block if size <= cap else truncate_tokens(block, cap, model) for block, size in zip(blocks, sizes)]
+    return separator.join(block for block in trimmed if block)
+
+
+def fit_values(build: Any, values: Dict[str, str], trimmable: Sequence[str], model: str,
+               completion_tokens: int, max_prompt_tokens: Optional[int] = None) -> Dict[str, Any]:
+    """
+    build(**values) で組み立てたメッセージが予算に収まるよう、trimmableに挙げた値を切り詰める。
+
+    Args:
+        build: 値を受け取りメッセージのリストを返す関数（PromptTemplate.renderなど）
+        values: テンプレートに埋め込む値
+        trimmable: 切り詰めてよい値の名前（先に挙げたものから削る）
+        model: 送信先のモデル
+        completion_tokens: 出力に確保するトークン数
+        max_prompt_tokens: コンテキストウィンドウとは別に設けるプロンプトの上限
+
+    Returns:
+        {'values': 調整後の値, 'prompt_tokens': 調整後のトークン数, 'trimmed_tokens': 削ったトークン数}
+    """
+    budget = prompt_budget(model, completion_tokens)
+    if max_prompt_tokens is not None:
+        budget = min(budget, max_prompt_tokens)
+
+    values = dict(values)
+    total = count_message_tokens(build(**values), model)
+    original = total
+    for name in trimmable:
+        # 切り詰めの印などで少しはみ出すことがあるので、数回まで詰め直す
+        for _ in range(3):
+            if total <= budget:
+                break
+            current = count_tokens(values[name], model)
+            target = max(0, current - (total - budget))
+            values[name] = trim_blocks(values[name], target, model)
+            total = count_message_tokens(build(**values), model)
+
+    if total != original:
+        logger.info(f"Trimmed prompt from {original} to {total} tokens (budget {budget}, model {model})")
+    return {'values': values, 'prompt_tokens': total, 'trimmed_tokens': original - total}
+
+
+def preflight(messages: List[Dict[str, str]], model: str, completion_tokens: int) -> Dict[str, int]:
+    """
+    送信前にプロンプトがコンテキストウィンドウに収まるかを確認する。
+    出力枠を削れば収まる場合は削った出力枠を返し、それでも収まらなければ例外を送出する。
+
+    Returns:
+        {'prompt_tokens': プロンプトのトークン数, 'max_tokens': 使用する出力枠}
+
+    Raises:
+        ContextWindowExceeded: 出力枠をMIN_COMPLETION_TOKENSまで削っても収まらない場合
+    """
+    prompt_tokens = count_message_tokens(messages, model)
+    available = context_window(model) - prompt_tokens - SAFETY_MARGIN_TOKENS
+    if available >= completion_tokens:
+        return {'prompt_tokens': prompt_tokens, 'max_tokens': completion_tokens}
+    if available >= MIN_COMPLETION_TOKENS:
+        logger.warning(f"Reducing max_tokens from {completion_tokens} to {available} to fit {model}'s context window")
+        return {'prompt_tokens': prompt_tokens, 'max_tokens': available}
+    raise ContextWindowExceeded(
+        f"Prompt of {prompt_tokens} tokens does not fit {model}'s context window ({context_window(model)})"
+    )
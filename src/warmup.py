@@ -0,0 +1,138 @@
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+import logging
+
+from .cache_backend import get_cache, make_key
+from .settings import get_section
+
+logger = logging.getLogger(__name__)
+
+
+def sample_queries(kind: str = 'general') -> List[str]:
+    """settings.yaml の sample_queries（UIのサンプルクエリで、ウォームアップの対象にもなる）"""
+    return list(get_section('sample_queries').get(kind) or [])
+
+
+class Warmup:
+    """
+    起動時に、サンプルクエリと最近よく使われたクエリのレポートをバックグラウンドで生成してレポートキャッシュに入れる。
+    デプロイ直後の最初のクリックからキャッシュ済みのレポートを返すため。
+    ライブのリクエストとは競合させない: 実行中のリクエストがあれば空くまで待ち、
+    LLM呼び出しは低優先度（RateGovernorのバックグラウンド枠）で送る。
+    設定は settings.yaml の warmup セクション。
+    """
+
+    def __init__(self, orchestrator_factory: Callable[[], Any],
+                 is_busy: Callable[[], bool] = lambda: False,
+                 recent_queries: Optional[Callable[[float, int], List[str]]] = None,
+                 settings: Optional[Dict[str, Any]] = None):
+        """
+        Args:
+            orchestrator_factory: ライブのリクエストと共有するオーケストレーターを返す関数
+            is_busy: ライブのリクエストを処理中ならTrueを返す関数
+            recent_queries: (since, limit) を受け取り、since以降によく使われたクエリを多い順に返す関数
+            settings: warmup セクションの設定（省略時は settings.yaml から読む）
+        """
+        settings = settings if settings is not None else get_section('warmup')
+        self.orchestrator_factory = orchestrator_factory
+        self.is_busy = is_busy
+        self.recent_queries = recent_queries
+        self.enabled = bool(settings.get('enabled', True))
+        # 起動直後の初期化（モジュールの読み込みなど）と重ならないよう、少し待ってから始める
+        self.start_delay = float(settings.get('start_delay', 5))
+        self.max_concurrency = int(settings.get('max_concurrency', 1))
+        self.sample_kinds = list(settings.get('sample_kinds', ['general', 'education']))
+        self.recent_limit = int(settings.get('recent_queries', 5))
+        self.recent_window = float(settings.get('recent_window_days', 7)) * 86400
+        self.idle_poll = float(settings.get('idle_poll', 2.0))
+        # 同じクエリを複数のレプリカが同時に生成しないよう、共有キャッシュに担当を書いておく秒数
+        self.claim_ttl = float(settings.get('claim_ttl', 1800))
+
+        self.claims = get_cache('warmup')
+        self.replica = f"{socket.gethostname()}:{os.getpid()}"
+        self.results = {'warmed': 0, 'cached': 0, 'failed': 0, 'skipped': 0}
+        self._results_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def queries(self) -> List[str]:
+        """ウォームアップするクエリ（サンプルクエリ、最近よく使われたクエリの順・重複なし）"""
+        queries: Dict[str, None] = {}
+        for kind in self.sample_kinds:
+            queries.update(dict.fromkeys(sample_queries(kind)))
+        if self.recent_queries is not None and self.recent_limit > 0:
+            try:
+                queries.update(dict.fromkeys(self.recent_queries(time.time() - self.recent_window,
+                                                                 self.recent_limit)))
+            except Exception as e:
+                logger.warning(f"Could not load recent queries for warm-up: {e}")
+        return [query for query in queries if query]
+
+    def start(self) -> Optional[threading.Thread]:
+        """バックグラウンドのスレッドでウォームアップを始める（無効ならNone）"""
+        if not self.enabled:
+            return None
+        if not os.getenv('OPENAI_API_KEY'):
+            logger.info("Skipping warm-up: OPENAI_API_KEY is not set")
+            return None
+        self._thread = threading.Thread(target=self.run, name="warmup", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self) -> None:
+        """ウォームアップを止める（生成中のクエリは最後まで実行される）"""
+        self._stop.set()
+
+    def run(self) -> Dict[str, int]:
+        """全クエリをウォームアップして、結果の件数を返す"""
+        if self._stop.wait(self.start_delay):
+            return self.results
+        queries = self.queries()
+        logger.info("Starting warm-up", extra={'query_count': len(queries)})
+        with ThreadPoolExecutor(max_workers=max(1, self.max_concurrency), thread_name_prefix="warmup") as executor:
+            list(executor.map(self._warm, queries))
+        logger.info("Warm-up finished", extra=dict(self.results))
+        return self.results
+
+    def _count(self, outcome: str) -> None:
+        with self._results_lock:
+            self.results[outcome] += 1
+
+    def _wait_until_idle(self) -> bool:
+        """ライブのリクエストがなくなるまで待つ（止められたらFalse）"""
+        while not self._stop.is_set():
+            try:
+                if not self.is_busy():
+                    return True
+            except Exception as e:
+                logger.warning(f"Warm-up busy check failed: {e}")
+            self._stop.wait(self.idle_poll)
+        return False
+
+    def _warm(self, query: str) -> None:
+        if not self._wait_until_idle():
+            self._count('skipped')
+            return
+        claim = make_key(query)
+        if not self.claims.add(claim, self.replica, ttl=self.claim_ttl):
+            # 他のレプリカが生成中か、最近生成した
+            self._count('skipped')
+            return
+
+        try:
+            # キャッシュに当たればすぐ返り、なければ生成してキャッシュに入れる
+            result = self.orchestrator_factory().run(query, background=True)
+        except Exception as e:
+            result = {'error': str(e)}
+        if result.get('error'):
+            logger.warning(f"Warm-up failed for query: {query}", extra={'error': result['error']})
+            self.claims.delete(claim)
+            self._count('failed')
+        elif result.get('cache', {}).get('hit'):
+            self._count('cached')
+        else:
+            self._count('warmed')
@@ -0,0 +1,113 @@
+import json
+import threading
+import pytest
+from src.batch_runner import BatchPipeline, LocalBatchEndpoint, STAGES
+from src.pipeline_orchestrator import PipelineOrchestrator
+
+
+def _fake_responder(body):
+    """プロンプトの内容からステージを推定して決め打ちの応答を返す"""
+    prompt = "\n".join(message['content'] for message in body['messages'])
+    if "JSON" in prompt and "マインドマップ" in prompt:
+        return json.dumps({"name": "比較級", "children": [{"name": "用法", "children": []}]}, ensure_ascii=False)
+    if "アウトライン" in prompt or "Markdown形式" in prompt:
+        return "# 比較級の解説\n## 1. 形\n## 2. 用法"
+    if "トピック" in prompt:
+        return "- 比較級 作り方\n- 比較級 指導法"
+    return "生成されたテキスト"
+
+
+@pytest.fixture
+def orchestrator(tmp_path, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+    monkeypatch.setenv("REPORT_CACHE_PATH", str(tmp_path / "cache.jsonl"))
+    orchestrator = PipelineOrchestrator()
+    # 検索はネットワークを使わない
+    monkeypatch.setattr(orchestrator, "search_sources",
+                        lambda refined_query, topics: {t: f"result for {t}" for t in topics})
+    return orchestrator
+
+
+class TestBatchPipeline:
+    """BatchPipelineのテストクラス"""
+
+    def test_round_writes_batch_requests(self, tmp_path, orchestrator):
+        """リクエストファイルがバッチAPIの形式で書き出されることのテスト"""
+        pipeline = BatchPipeline(str(tmp_path / "batch"), orchestrator=orchestrator)
+        query_ids = pipeline.add_queries(["比較級", "仮定法"])
+        path = pipeline.prepare_round()
+
+        with open(path, encoding='utf-8') as f:
+            requests = [json.loads(line) for line in f]
+        assert [r['custom_id'] for r in requests] == [f"{qid}:refine:refine" for qid in query_ids]
+        assert requests[0]['url'] == "/v1/chat/completions"
+        assert [m['role'] for m in requests[0]['body']['messages']] == ["system", "user"]
+        assert "model" in requests[0]['body']
+        assert requests[0]['body']['prompt_cache_key'].startswith("refine:")
+
+    def test_runs_to_completion(self, tmp_path, orchestrator):
+        """ラウンドを繰り返して全クエリのレポートが完成することのテスト"""
+        work_dir = tmp_path / "batch"
+        pipeline = BatchPipeline(str(work_dir), orchestrator=orchestrator)
+        query_ids = pipeline.add_queries(["比較級"])
+        results = pipeline.run(LocalBatchEndpoint(_fake_responder), poll_interval=0)
+
+        # doneを除く各ステージで1ラウンドずつ
+        assert pipeline.state['round'] == len(STAGES) - 1
+        result = results[query_ids[0]]
+        assert result['report'].startswith("# 比較級の解説")
+        assert result['mindmap']['name'] == "比較級"
+        assert result['search_stats']['total_topics'] == 2
+        assert (work_dir / "reports" / f"{query_ids[0]}.md").exists()
+
+    def test_resume_from_state(self, tmp_path, orchestrator):
+        """作業ディレクトリの状態から途中のラウンドを再開できることのテスト"""
+        work_dir = str(tmp_path / "batch")
+        first = BatchPipeline(work_dir, orchestrator=orchestrator)
+        first.add_queries(["比較級"])
+        first.run(LocalBatchEndpoint(_fake_responder), poll_interval=0, max_rounds=2)
+
+        resumed = BatchPipeline(work_dir, orchestrator=orchestrator)
+        entry = next(iter(resumed.state['queries'].values()))
+        assert entry['stage'] == "outline"
+        resumed.run(LocalBatchEndpoint(_fake_responder), poll_interval=0)
+        assert resumed.is_complete()
+
+    def test_failed_requests_use_fallback(self, tmp_path, orchestrator):
+        """失敗したリクエストは各ステージのフォールバックで続行することのテスト"""
+        def failing_responder(body):
+            raise RuntimeError("rate limited")
+
+        pipeline = BatchPipeline(str(tmp_path / "batch"), orchestrator=orchestrator)
+        query_ids = pipeline.add_queries(["比較級"])
+        results = pipeline.run(LocalBatchEndpoint(failing_responder), poll_interval=0)
+
+        result = results[query_ids[0]]
+        assert "比較級" in result['refined_query']
+        assert result['mindmap']['children']
+
+    def test_searches_run_in_parallel(self, tmp_path, orchestrator, monkeypatch):
+        """クエリごとの検索を同時実行数の上限までまとめて並列に実行することのテスト"""
+        lock = threading.Lock()
+        state = {'running': 0, 'peak': 0}
+        barrier = threading.Barrier(2, timeout=5)
+
+        def search_sources(refined_query, topics):
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            # 2件が同時に実行されていなければ待ち切れずに失敗する
+            barrier.wait()
+            with lock:
+                state['running'] -= 1
+            return {t: f"result for {t}" for t in topics}
+
+        monkeypatch.setenv("BATCH_SEARCH_WORKERS", "2")
+        monkeypatch.setattr(orchestrator, "search_sources", search_sources)
+        pipeline = BatchPipeline(str(tmp_path / "batch"), orchestrator=orchestrator)
+        pipeline.add_queries(["比較級", "仮定法", "受動態", "関係代名詞"])
+        pipeline.run(LocalBatchEndpoint(_fake_responder), poll_interval=0, max_rounds=2)
+
+        assert state['peak'] == 2
+        assert all(entry['stage'] == "outline" and entry['artifacts']['search_results']
+                   for entry in pipeline.state['queries'].values())
@@ -0,0 +1,24 @@
+import subprocess
+import sys
+
+
+class TestLazyImports:
+    """起動時の読み込みのテストクラス"""
+
+    def _imported_modules(self, code):
+        result = subprocess.run([sys.executable, "-c", code + "; import sys; print(' '.join(sys.modules))"],
+                                capture_output=True, text=True, check=True)
+        return set(result.stdout.split())
+
+    def test_orchestrator_import_is_light(self):
+        """オーケストレーターの読み込みでopenai・requests・bs4と文法ルールの分類器を読み込まないことのテスト"""
+        modules = self._imported_modules("import main, src.pipeline_orchestrator")
+        assert not modules & {"openai", "requests", "bs4", "src.llm_client", "dotenv",
+                              "src.query_classifier", "src.grammar_analyzer"}
+
+    def test_stage_modules_load_on_first_use(self):
+        """ステージのモジュールはモジュール属性として参照したときに読み込まれることのテスト"""
+        modules = self._imported_modules(
+            "from src import pipeline_orchestrator; pipeline_orchestrator.query_refiner.QueryRefiner"
+        )
+        assert {"src.query_refiner", "src.llm_client", "openai"} <= modules
@@ -0,0 +1,169 @@
+import threading
+import time
+import pytest
+from src import run_context
+from src.cache_backend import (CacheBackend, MemoryBackend, NamespacedCache, RedisBackend, SQLiteBackend,
+                               make_key, reset_cache)
+from src.report_cache import ReportCache
+
+
+@pytest.fixture(params=['memory', 'sqlite', 'redis'])
+def backend(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryBackend()
+    if request.param == 'sqlite':
+        return SQLiteBackend(str(tmp_path / "cache.sqlite3"))
+    # Redis互換のインメモリサーバー（fakeredis）に対してテストする
+    fakeredis = pytest.importorskip("fakeredis")
+    return RedisBackend(client=fakeredis.FakeRedis(), prefix="test")
+
+
+class _BrokenBackend(CacheBackend):
+    def get(self, namespace, key):
+        raise ConnectionError("cache is down")
+
+    def set(self, namespace, key, value, ttl=None):
+        raise ConnectionError("cache is down")
+
+
+class TestCacheBackend:
+    """キャッシュのバックエンドのテストクラス（3種類のバックエンドで同じテストを実行する）"""
+
+    def test_round_trip_and_namespaces(self, backend):
+        """値をJSONで保存して取り出し、名前空間ごとに分かれていることのテスト"""
+        search = NamespacedCache(backend, 'search')
+        llm = NamespacedCache(backend, 'llm')
+        search.set("k", {'results': ["比較級"]})
+        assert search.get("k") == {'results': ["比較級"]}
+        assert llm.get("k") is None
+        search.delete("k")
+        assert search.get("k") is None
+
+    def test_namespace_ttl(self, backend):
+        """名前空間のTTLを過ぎたエントリは返さないことのテスト"""
+        cache = NamespacedCache(backend, 'search', ttl=0.05)
+        cache.set("short", "a")
+        cache.set("long", "b", ttl=60)
+        time.sleep(0.1)
+        assert cache.get("short") is None
+        assert cache.get("long") == "b"
+
+    def test_stats(self, backend):
+        """名前空間ごとに件数・バイト数・ヒット率を数えることのテスト"""
+        cache = NamespacedCache(backend, 'report', ttl=60)
+        cache.set("a", "x" * 10)
+        cache.set("b", "y")
+        cache.get("a")
+        cache.get("missing")
+        NamespacedCache(backend, 'llm').set("c", "z")
+
+        stats = cache.stats()
+        assert stats['entries'] == 2
+        assert stats['bytes'] == len('"xxxxxxxxxx"') + len('"y"')
+        assert (stats['hits'], stats['misses'], stats['writes']) == (1, 1, 2)
+        assert stats['hit_rate'] == pytest.approx(0.5)
+
+        cache.clear()
+        assert cache.stats()['entries'] == 0
+        assert NamespacedCache(backend, 'llm').stats()['entries'] == 1
+
+    def test_add_only_when_absent(self, backend):
+        """キーがないときだけ保存でき、同時に確保しても1つだけが成功することのテスト"""
+        cache = NamespacedCache(backend, 'warmup')
+        assert cache.add("claim", "replica-a", ttl=0.05)
+        assert not cache.add("claim", "replica-b", ttl=60)
+        assert cache.get("claim") == "replica-a"
+        time.sleep(0.1)
+        assert cache.add("claim", "replica-b", ttl=60)
+
+        won = []
+        threads = [threading.Thread(target=lambda i=i: won.append(cache.add("race", i))) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert won.count(True) == 1
+
+    def test_run_without_cache_skips_reads(self, backend):
+        """キャッシュを使わない実行では読まずに書き込むことのテスト"""
+        cache = NamespacedCache(backend, 'llm')
+        cache.set("k", "old")
+        with run_context.run_scope(run_context.RunContext(use_cache=False)):
+            assert cache.get_or_set("k", lambda: "new") == "new"
+        assert cache.get("k") == "new"
+
+
+class _CountingBackend(MemoryBackend):
+    def __init__(self):
+        super().__init__()
+        self.incr_calls = 0
+
+    def incr(self, namespace, counter, amount=1):
+        self.incr_calls += 1
+        super().incr(namespace, counter, amount)
+
+
+class TestSharedCache:
+    """キャッシュの共有と障害時の振る舞いのテスト"""
+
+    def test_counters_are_batched(self):
+        """ヒット・ミスの件数はまとめてバックエンドに書き、statsの前に書き出すことのテスト"""
+        backend = _CountingBackend()
+        cache = NamespacedCache(backend, 'search')
+        cache.set("k", "v")
+        for _ in range(50):
+            cache.get("k")
+            cache.get("missing")
+        assert backend.incr_calls == 0
+
+        stats = cache.stats()
+        assert (stats['hits'], stats['misses'], stats['writes']) == (50, 50, 1)
+        assert backend.incr_calls == 3
+
+    def test_backend_failure_is_a_miss(self):
+        """バックエンドの障害はキャッシュなしとして扱うことのテスト"""
+        cache = NamespacedCache(_BrokenBackend(), 'search')
+        cache.set("k", "v")
+        assert cache.get("k") is None
+        assert cache.get_or_set("k", lambda: "computed") == "computed"
+
+    def test_make_key_is_stable(self):
+        """キーの材料が同じなら同じキーになることのテスト"""
+        messages = [{'role': 'user', 'content': "比較級"}]
+        assert make_key('text', 'gpt-4o', messages, 100) == make_key('text', 'gpt-4o', messages, 100)
+        assert make_key('text', 'gpt-4o', messages, 100) != make_key('text', 'gpt-4o', messages, 200)
+
+    def test_report_shared_across_replicas(self, tmp_path):
+        """あるレプリカが保存したレポートを、別のレプリカが正規化したクエリで取り出せることのテスト"""
+        path = str(tmp_path / "shared.sqlite3")
+        replica_a = ReportCache(shared=NamespacedCache(SQLiteBackend(path), 'report'))
+        replica_b = ReportCache(shared=NamespacedCache(SQLiteBackend(path), 'report'))
+        replica_a.store({'query': "比較級と最上級の使い方を教えて", 'refined_query': "比較級 最上級 用法",
+                         'report': "report body"})
+
+        hit = replica_b.lookup("比較級・最上級の使い方を説明して")
+        assert hit['result']['report'] == "report body"
+        assert hit['matched_query'] == "比較級と最上級の使い方を教えて"
+        # 取り出したレポートは索引にも加わり、近似重複にも当たる
+        assert len(replica_b) == 1
+
+    def test_search_results_are_cached(self):
+        """キャッシュにある検索は送らず、失敗した検索はキャッシュしないことのテスト"""
+        from src.external_api_client import ExternalApiClient
+        reset_cache(MemoryBackend())
+        try:
+            client = ExternalApiClient()
+            client.request_interval = 0
+            calls = []
+
+            def search(query):
+                calls.append(query)
+                return f"result {query}" if query != "broken" else f"Search error for '{query}': timeout"
+
+            queries = {'a': 'qa', 'b': 'broken'}
+            client.run_searches(queries, search, cache_as='test')
+            results = client.run_searches(queries, search, cache_as='test')
+            assert results == {'a': 'result qa', 'b': "Search error for 'broken': timeout"}
+            assert calls == ['qa', 'broken', 'broken']
+        finally:
+            reset_cache()
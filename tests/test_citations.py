@@ -0,0 +1,47 @@
+from src.citations import add_references, extract_citations, resolve_citations, section_citations
+
+
+class TestCitations:
+    """引用番号の検証と参考文献リストのテストクラス"""
+
+    def test_extract_citations(self):
+        """引用番号を出現順に重複なく取り出すことのテスト"""
+        text = "比較級は形容詞に-erを付ける[2][5]。詳しくは[5, 1]を参照。[リンク](https://example.com) [3](https://x)"
+        assert extract_citations(text) == [2, 5, 1]
+
+    def test_outline_drops_out_of_range(self):
+        """範囲外の番号を削除し、空になった引用行は行ごと削除することのテスト"""
+        outline = "# 比較級\n## 形\n[1][3][156]\n## 用法\n[156]\n### 比較の対象\n[2][2]"
+        resolved = resolve_citations(outline, source_count=3)
+        assert resolved['text'] == "# 比較級\n## 形\n[1][3]\n## 用法\n### 比較の対象\n[2]"
+        assert resolved['dropped'] == [156]
+        assert resolved['mapping'] == {1: 1, 3: 3, 2: 2}
+
+    def test_section_citations(self):
+        """アウトラインの節ごとの引用番号（### の分は親の ## にも含める）のテスト"""
+        outline = "# 比較級\n## 形\n### -er\n[4][1]\n### more\n[2][4]\n## 用法\n[3]"
+        assert section_citations(outline) == {'形': [4, 1, 2], '-er': [4, 1], 'more': [2, 4], '用法': [3]}
+
+    def test_renumber_in_order_of_first_citation(self):
+        """初出順に番号を振り直すことのテスト"""
+        resolved = resolve_citations("A[4]。B[2][4]。C[0]", source_count=4, renumber=True)
+        assert resolved['text'] == "A[1]。B[2][1]。C"
+        assert resolved['mapping'] == {4: 1, 2: 2}
+        assert resolved['dropped'] == [0]
+
+    def test_reference_list_has_only_cited_sources(self):
+        """参考文献リストには実際に引用された情報源だけが並ぶことのテスト"""
+        sources = {"比較級 作り方": "...", "比較級 指導法": "...", "最上級": "..."}
+        report = add_references("# 比較級\n\n本文[3]と[1][9]。", sources)['text']
+        assert report.endswith("## 参考文献\n[1] 最上級\n[2] 比較級 作り方")
+        assert "本文[1]と[2]。" in report
+
+    def test_no_references_without_citations(self):
+        """引用がなければ参考文献リストを付けないことのテスト"""
+        assert add_references("# 比較級\n\n本文", {"a": "b"})['text'] == "# 比較級\n\n本文"
+
+    def test_reference_list_includes_source_url(self):
+        """情報源にURL行があれば参考文献リストに載せることのテスト"""
+        sources = {"比較級": "Title: 比較級の作り方\nURL: https://www.mext.go.jp/a\nSnippet: ..."}
+        report = add_references("本文[1]", sources)['text']
+        assert report.endswith("[1] 比較級 https://www.mext.go.jp/a")
@@ -0,0 +1,82 @@
+import time
+import pytest
+from src.deadline import Deadline, DeadlineExceeded
+from src.external_api_client import ExternalApiClient
+from src import run_context
+
+
+class TestDeadline:
+    """Deadlineのテストクラス"""
+
+    def test_remaining_and_expired(self):
+        """残り時間と期限切れ判定のテスト"""
+        deadline = Deadline(0.05)
+        assert 0 < deadline.remaining() <= 0.05
+        assert not deadline.expired()
+        time.sleep(0.06)
+        assert deadline.expired()
+        assert deadline.remaining() == 0
+        with pytest.raises(DeadlineExceeded):
+            deadline.check("test")
+
+    def test_slice_never_exceeds_parent(self):
+        """子の締め切りが親を超えないことのテスト"""
+        parent = Deadline(10)
+        child = parent.slice(0.5)
+        assert child.remaining() <= 5.0
+        assert child.expires_at <= parent.expires_at
+        assert parent.slice(2.0).expires_at <= parent.expires_at
+
+    def test_timeout_cap(self):
+        """タイムアウトが上限で切り詰められることのテスト"""
+        assert Deadline(100).timeout(cap=10) == 10
+        assert Deadline(1).timeout(cap=10) <= 1
+
+
+class TestSearchDeadline:
+    """時間予算付きの並列検索のテスト"""
+
+    def setup_method(self):
+        """各テストメソッドの前に実行されるセットアップ"""
+        self.client = ExternalApiClient()
+        self.client.request_interval = 0
+
+    def test_searches_without_deadline(self):
+        """締め切りなしでは全件の結果が順序通りに返ることのテスト"""
+        results = self.client.run_searches({'a': 'qa', 'b': 'qb'}, lambda q: f"result {q}")
+        assert list(results.items()) == [('a', 'result qa'), ('b', 'result qb')]
+
+    def test_slow_searches_are_cancelled(self):
+        """締め切りを過ぎた検索が打ち切られ記録されることのテスト"""
+        def search(query):
+            if query == 'slow':
+                time.sleep(0.5)
+            return f"result {query}"
+
+        context = run_context.RunContext(deadline=Deadline(0.1), stage='detailed_search')
+        start = time.monotonic()
+        with run_context.run_scope(context):
+            results = self.client.run_searches({'fast': 'fast', 'slow': 'slow'}, search)
+
+        assert time.monotonic() - start < 0.4
+        assert results == {'fast': 'result fast'}
+        assert context.truncated_stages == ['detailed_search']
+
+    def test_expired_deadline_skips_search(self):
+        """期限切れなら検索自体を行わないことのテスト"""
+        calls = []
+        context = run_context.RunContext(deadline=Deadline(0), stage='general_search')
+        with run_context.run_scope(context):
+            results = self.client.run_searches({'a': 'qa'}, calls.append)
+
+        assert results == {}
+        assert calls == []
+        assert context.truncated_stages == ['general_search']
+
+    @pytest.mark.parametrize("method", ['_search_google_custom', '_search_serpapi', '_search_basic_web'])
+    def test_deadline_is_not_a_search_error(self, method):
+        """各検索方法が時間切れを検索エラーの文字列にせず、呼び出し側に伝えることのテスト"""
+        context = run_context.RunContext(deadline=Deadline(0), stage='detailed_search')
+        with run_context.run_scope(context):
+            with pytest.raises(DeadlineExceeded):
+                getattr(self.client, method)("比較級")
@@ -0,0 +1,120 @@
+import pytest
+from src import run_context
+from src.grammar_analyzer import analyze, english_sentences, find_grammar_items, format_items
+
+
+def names(sentence):
+    return [match.rule.name for match in find_grammar_items(sentence)]
+
+
+class FakeLLMClient:
+    """送られたプロンプトを記録し、決まった応答を返すLLMクライアント"""
+
+    def __init__(self, response="- **倒置**: 語順を入れ替えて強調します。例: \"Never have I seen it.\""):
+        self.prompts = []
+        self.response = response
+
+    def generate_text(self, prompt, **kwargs):
+        self.prompts.append(prompt)
+        return self.response
+
+    def validate_response(self, text):
+        return bool(text and text.strip())
+
+
+class TestGrammarAnalyzer:
+    """文法項目のパターン表のテストクラス"""
+
+    @pytest.mark.parametrize("sentence, expected", [
+        ("We have been discussing it since last week.", ["現在完了進行形"]),
+        ("She will have finished her homework by noon.", ["未来完了形"]),
+        ("He was praised by the teacher.", ["受動態"]),
+        ("Mount Fuji is the highest mountain in Japan.", ["最上級"]),
+        ("This is the house where he was born.", ["関係副詞", "受動態"]),
+        ("I don't know what he wants.", ["間接疑問文"]),
+        ("My mother made me clean my room.", ["使役動詞"]),
+        ("I enjoy playing tennis, don't you?", ["動名詞", "付加疑問文"]),
+        ("It is important for us to study English every day.", ["形式主語構文"]),
+    ])
+    def test_detects_items(self, sentence, expected):
+        """代表的な文法項目を判定することのテスト"""
+        assert names(sentence) == expected
+
+    @pytest.mark.parametrize("sentence, wrong", [
+        ("The apple is red.", "受動態"),
+        ("She went to Tokyo.", "不定詞"),
+        ("What is the difference between will and be going to?", "未来表現"),
+        ("What is the difference between will and be going to?", "進行形"),
+        ("I went there in spring.", "動名詞"),
+        ("It is close to home.", "形式主語構文"),
+        ("Tea rather than coffee, please.", "比較級"),
+        ("They made it easy.", "使役動詞"),
+    ])
+    def test_no_false_positives(self, sentence, wrong):
+        """形だけ似た語（動詞でない -ed 語・固有名詞・語の言及など）を文法項目と取らないことのテスト"""
+        assert wrong not in names(sentence)
+
+    def test_ambiguous_rules_go_to_llm(self):
+        """紛らわしい規則に一致した英文は、ローカルの項目に挙げずLLMに任せることのテスト"""
+        analysis = analyze("My hobby is reading books. He was praised by the teacher.")
+        assert analysis['unclassified'] == ["My hobby is reading books."]
+        assert [match.rule.name for match in analysis['matches']] == ["受動態"]
+
+    def test_specific_rule_wins_within_family(self):
+        """同じ系統ではより具体的な項目だけを挙げることのテスト"""
+        found = names("They had been waiting for an hour when the bus came.")
+        assert "過去完了進行形" in found
+        assert "過去完了形" not in found and "進行形" not in found
+
+    def test_english_sentences_in_japanese_query(self):
+        """日本語の混じったクエリから英文だけを取り出すことのテスト"""
+        query = "次の英文を解説して: I think that she’s running in the park. よろしく"
+        assert english_sentences(query) == ["I think that she's running in the park."]
+        assert english_sentences("英語の比較級と最上級の使い方を教えて") == []
+
+    def test_format_items(self):
+        """プロンプトと同じ形式で、該当箇所を太字にした例を付けることのテスト"""
+        analysis = analyze("The book which I bought is more interesting than that one. The cat sat quietly.")
+        assert analysis['unclassified'] == ["The cat sat quietly."]
+        assert format_items(analysis['matches']).splitlines() == [
+            "- **関係代名詞**: 名詞を後ろから説明する節を導きます。"
+            "例: \"The book **which I** bought is more interesting than that one.\"",
+            "- **比較級**: 2つのものを比べて「より〜」を表します。"
+            "例: \"The book which I bought is **more interesting than** that one.\"",
+        ]
+
+
+class TestRelatedTopics:
+    """ReportWriterの関連文法事項の生成のテストクラス"""
+
+    @pytest.fixture
+    def writer(self, monkeypatch):
+        monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+        from src.report_writer import ReportWriter
+        writer = ReportWriter()
+        writer.llm_client = FakeLLMClient()
+        return writer
+
+    def test_classified_locally_without_llm(self, writer):
+        """全ての英文を判定できればLLMを呼ばず、ストリーミングにも本文を流すことのテスト"""
+        events = []
+        with run_context.run_scope(run_context.RunContext(event_callback=events.append)):
+            text = writer._generate_related_topics("He was praised by the teacher.")
+        assert text.startswith("- **受動態**")
+        assert writer.llm_client.prompts == []
+        assert events[0]['type'] == 'token' and events[0]['stage'] == 'related_topics'
+
+    def test_only_unclassified_sentences_go_to_llm(self, writer):
+        """判定できなかった英文だけをLLMに送り、結果を結合することのテスト"""
+        text = writer._generate_related_topics("He was praised by the teacher. Never did I see him again.")
+        assert len(writer.llm_client.prompts) == 1
+        prompt = writer.llm_client.prompts[0][-1]["content"]
+        assert "Never did I see him again." in prompt and "praised" not in prompt
+        assert text.splitlines()[0].startswith("- **受動態**")
+        assert text.splitlines()[1].startswith("- **倒置**")
+
+    def test_query_without_english_uses_llm(self, writer):
+        """英文のないクエリは従来どおりLLMに渡すことのテスト"""
+        text = writer._generate_related_topics("英語の比較級と最上級の使い方を教えて")
+        assert len(writer.llm_client.prompts) == 1
+        assert text.startswith("- **倒置**")
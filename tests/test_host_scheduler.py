@@ -0,0 +1,148 @@
+import threading
+import time
+from types import SimpleNamespace
+import pytest
+from src.host_scheduler import DisallowedByRobots, HostScheduler, _retry_after
+
+
+class FakeSession:
+    """robots.txtと決めた順の応答を返し、リクエストの順番と同時接続数を記録するセッション"""
+
+    def __init__(self, robots="", responses=None, delay=0.0):
+        self.robots = robots
+        self.responses = responses or []
+        self.delay = delay
+        self.requests = []
+        self.in_flight = 0
+        self.peak = 0
+        self.closed = 0
+        self._lock = threading.Lock()
+
+    def close(self):
+        self.closed += 1
+
+    def get(self, url, timeout=None, **kwargs):
+        if url.endswith("/robots.txt"):
+            return SimpleNamespace(status_code=200, text=self.robots, headers={})
+        with self._lock:
+            self.requests.append((url, time.monotonic()))
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+            response = self.responses.pop(0) if self.responses else SimpleNamespace(status_code=200, headers={})
+        time.sleep(self.delay)
+        with self._lock:
+            self.in_flight -= 1
+        return response
+
+
+def make_scheduler(session, **kwargs):
+    options = {'per_host_interval': 0, 'respect_robots': False, 'session_factory': lambda host: session}
+    options.update(kwargs)
+    return HostScheduler(**options)
+
+
+class TestHostScheduler:
+    """HostSchedulerのテストクラス"""
+
+    def test_round_robin_across_hosts(self):
+        """1つのホストに大量のリクエストがあっても、他のホストのリクエストが交互に取り出されることのテスト"""
+        session = FakeSession(delay=0.01)
+        scheduler = make_scheduler(session, max_workers=1, per_host_concurrency=1)
+        futures = [scheduler.submit(f"https://a.example/{i}", lambda s, i=i: s.get(f"https://a.example/{i}"))
+                   for i in range(6)]
+        futures.append(scheduler.submit("https://b.example/0", lambda s: s.get("https://b.example/0")))
+        for future in futures:
+            future.result(timeout=5)
+        order = [url for url, _ in session.requests]
+        assert order.index("https://b.example/0") <= 2
+
+    def test_per_host_concurrency_and_interval(self):
+        """同じホストへの同時接続数とリクエスト開始の間隔を守ることのテスト"""
+        session = FakeSession(delay=0.03)
+        scheduler = make_scheduler(session, per_host_concurrency=2)
+        for future in [scheduler.submit(f"https://a.example/{i}", lambda s, i=i: s.get(f"https://a.example/{i}"))
+                       for i in range(6)]:
+            future.result(timeout=5)
+        assert session.peak <= 2
+
+        session = FakeSession()
+        scheduler = make_scheduler(session, per_host_interval=0.05)
+        for i in range(3):
+            scheduler.get(f"https://a.example/{i}")
+        starts = [started for _, started in session.requests]
+        assert all(b - a >= 0.045 for a, b in zip(starts, starts[1:]))
+
+    def test_robots_disallow(self):
+        """robots.txtで禁止されたURLは取得せずに DisallowedByRobots を返すことのテスト"""
+        session = FakeSession(robots="User-agent: *\nDisallow: /search\n")
+        scheduler = make_scheduler(session, respect_robots=True)
+        with pytest.raises(DisallowedByRobots):
+            scheduler.get("https://www.google.com/search?q=x")
+        assert scheduler.get("https://www.google.com/about").status_code == 200
+        assert [url for url, _ in session.requests] == ["https://www.google.com/about"]
+        assert scheduler.stats()['disallowed'] == 1
+
+    def test_crawl_delay_widens_interval(self):
+        """robots.txtのCrawl-delayがリクエスト間隔より長ければそちらに従うことのテスト"""
+        session = FakeSession(robots="User-agent: *\nCrawl-delay: 5\n")
+        scheduler = make_scheduler(session, respect_robots=True)
+        scheduler.get("https://a.example/")
+        assert scheduler._hosts["a.example"].interval == 5.0
+
+    def test_backoff_and_requeue_on_429(self):
+        """429を受けたらretry-afterの間ホストを止め、積み直して成功することのテスト"""
+        throttled = SimpleNamespace(status_code=429, headers={'Retry-After': '0.1'})
+        session = FakeSession(responses=[throttled])
+        scheduler = make_scheduler(session, base_delay=0.01, max_delay=0.02)
+        assert scheduler.get("https://a.example/").status_code == 200
+        (_, first), (_, second) = session.requests
+        assert second - first >= 0.09
+        stats = scheduler.stats()
+        assert stats['blocked'] == 1 and stats['retries'] == 1
+        assert scheduler._hosts["a.example"].strikes == 0
+
+    def test_gives_up_after_max_retries(self):
+        """積み直しが上限に達したら429/503の応答をそのまま返すことのテスト"""
+        throttled = SimpleNamespace(status_code=503, headers={})
+        session = FakeSession(responses=[throttled] * 3)
+        scheduler = make_scheduler(session, max_retries=1, base_delay=0.01, max_delay=0.01)
+        assert scheduler.get("https://a.example/").status_code == 503
+        assert len(session.requests) == 2
+
+    def test_wait_is_bounded_by_timeout(self):
+        """キューで待つ間にタイムアウトしたら、リクエストを取り消して送らないことのテスト"""
+        session = FakeSession()
+        scheduler = make_scheduler(session, per_host_interval=5.0)
+        assert scheduler.get("https://a.example/first", timeout=1).status_code == 200
+        started = time.monotonic()
+        with pytest.raises(TimeoutError):
+            scheduler.get("https://a.example/second", timeout=0.1)
+        assert time.monotonic() - started < 1
+        assert scheduler.stats()['queued'] == 0
+        assert [url for url, _ in session.requests] == ["https://a.example/first"]
+
+    def test_cancelled_request_is_not_requeued(self):
+        """ブロックされて積み直すリクエストも、取り消したら送り直さないことのテスト"""
+        throttled = SimpleNamespace(status_code=429, headers={'Retry-After': '0.2'})
+        session = FakeSession(responses=[throttled])
+        scheduler = make_scheduler(session, base_delay=0.01, max_delay=0.02)
+        with pytest.raises(TimeoutError):
+            scheduler.get("https://a.example/", timeout=0.1)
+        time.sleep(0.3)
+        assert len(session.requests) == 1
+
+    def test_idle_hosts_are_evicted(self):
+        """しばらく使われなかったホストは接続プールごと破棄することのテスト"""
+        session = FakeSession()
+        scheduler = make_scheduler(session, idle_ttl=0.05)
+        scheduler.get("https://a.example/")
+        time.sleep(0.1)
+        scheduler.get("https://b.example/")
+        assert list(scheduler._hosts) == ["b.example"]
+        assert session.closed == 1 and scheduler.stats()['evicted'] == 1
+
+    def test_retry_after_formats(self):
+        """Retry-Afterの秒数とHTTP日付を解釈することのテスト"""
+        assert _retry_after({'Retry-After': '7'}) == 7.0
+        assert _retry_after({'Retry-After': 'Mon, 01 Jan 2024 00:00:00 GMT'}) == 0.0
+        assert _retry_after({}) is None
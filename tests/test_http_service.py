@@ -0,0 +1,217 @@
+import asyncio
+import json
+import threading
+from aiohttp.test_utils import TestClient, TestServer
+from src.http_service import ReportService
+
+
+class FakeOrchestrator:
+    """イベントを流して即座に結果を返すオーケストレーター"""
+
+    def __init__(self, release=None):
+        self.release = release
+
+    def run(self, query, use_cache=True, event_callback=None):
+        event_callback({'type': 'pipeline', 'status': 'start'})
+        event_callback({'type': 'stage', 'stage': 'refine', 'status': 'end'})
+        event_callback({'type': 'token', 'stage': 'body', 'text': 'Hello'})
+        if self.release is not None:
+            self.release.wait(5)
+        event_callback({'type': 'pipeline', 'status': 'end'})
+        return {'report': f"# {query}", 'mindmap': {}, 'query': query}
+
+    def regenerate(self, result, stage, section=None, instruction=""):
+        if stage != 'conclusion':
+            raise ValueError(f"Unknown stage '{stage}'")
+        return {**result, 'report': result['report'] + f"\n## 結論\n{instruction}"}
+
+
+def _parse_sse(body):
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.split("\n") if not line.startswith(":"))
+        events.append((lines['event'], json.loads(lines['data'])))
+    return events
+
+
+def _run(coro_factory, service):
+    async def runner():
+        client = TestClient(TestServer(service.create_app()))
+        await client.start_server()
+        try:
+            await coro_factory(client)
+        finally:
+            await client.close()
+    asyncio.run(runner())
+
+
+class TestReportService:
+    """ReportServiceのテストクラス"""
+
+    def test_submit_and_stream_events(self):
+        """ジョブ登録からSSEでの完了通知までのテスト"""
+        service = ReportService(orchestrator_factory=FakeOrchestrator)
+
+        async def scenario(client):
+            response = await client.post('/reports', json={'query': '比較級'})
+            assert response.status == 202
+            job_id = (await response.json())['job_id']
+
+            events_response = await client.get(f'/reports/{job_id}/events')
+            assert events_response.headers['Content-Type'] == 'text/event-stream'
+            events = _parse_sse(await events_response.text())
+
+            types = [event_type for event_type, _ in events]
+            assert types == ['pipeline', 'stage', 'token', 'pipeline', 'done']
+            assert events[-1][1]['result']['report'] == '# 比較級'
+
+            status = await (await client.get(f'/reports/{job_id}')).json()
+            assert status['status'] == 'done'
+
+        _run(scenario, service)
+
+    def test_invalid_request(self):
+        """不正なリクエストが400になることのテスト"""
+        service = ReportService(orchestrator_factory=FakeOrchestrator)
+
+        async def scenario(client):
+            assert (await client.post('/reports', json={'query': ''})).status == 400
+            assert (await client.post('/reports', data='not json')).status == 400
+            assert (await client.post('/reports', json={'query': '比較級', 'search_mode': 'fast'})).status == 400
+            assert (await client.get('/reports/unknown')).status == 404
+
+        _run(scenario, service)
+
+    def test_per_client_limit(self):
+        """クライアントごとの同時実行数制限のテスト"""
+        release = threading.Event()
+        service = ReportService(orchestrator_factory=lambda: FakeOrchestrator(release), per_client_limit=1,
+                                trusted_proxies=['127.0.0.1'])
+
+        async def scenario(client):
+            headers = {'X-Client-Id': 'lms'}
+            first = await client.post('/reports', json={'query': 'q1'}, headers=headers)
+            assert first.status == 202
+            second = await client.post('/reports', json={'query': 'q2'}, headers=headers)
+            assert second.status == 429
+            other = await client.post('/reports', json={'query': 'q3'}, headers={'X-Client-Id': 'other'})
+            assert other.status == 202
+
+            release.set()
+            job_id = (await first.json())['job_id']
+            await (await client.get(f'/reports/{job_id}/events')).text()
+            third = await client.post('/reports', json={'query': 'q4'}, headers=headers)
+            assert third.status == 202
+
+        _run(scenario, service)
+
+    def test_client_headers_need_trusted_proxy(self):
+        """信用する接続元でなければ X-Client-Id や X-Forwarded-For で制限を回避できないことのテスト"""
+        release = threading.Event()
+        service = ReportService(orchestrator_factory=lambda: FakeOrchestrator(release), per_client_limit=1,
+                                trusted_proxies=[])
+
+        async def scenario(client):
+            first = await client.post('/reports', json={'query': 'q1'}, headers={'X-Client-Id': 'a'})
+            assert first.status == 202
+            spoofed = await client.post('/reports', json={'query': 'q2'},
+                                        headers={'X-Client-Id': 'b', 'X-Forwarded-For': '203.0.113.9'})
+            assert spoofed.status == 429
+            release.set()
+
+        _run(scenario, service)
+
+    def test_forwarded_for_from_trusted_proxy(self):
+        """信用するプロキシからは X-Forwarded-For の末尾のアドレスをクライアントとして扱うことのテスト"""
+        release = threading.Event()
+        service = ReportService(orchestrator_factory=lambda: FakeOrchestrator(release), per_client_limit=1,
+                                trusted_proxies=['127.0.0.1'])
+
+        async def scenario(client):
+            first = await client.post('/reports', json={'query': 'q1'},
+                                      headers={'X-Forwarded-For': '198.51.100.1, 203.0.113.9'})
+            assert first.status == 202
+            same = await client.post('/reports', json={'query': 'q2'},
+                                     headers={'X-Forwarded-For': '198.51.100.2, 203.0.113.9'})
+            assert same.status == 429
+            other = await client.post('/reports', json={'query': 'q3'}, headers={'X-Forwarded-For': '203.0.113.10'})
+            assert other.status == 202
+            release.set()
+
+        _run(scenario, service)
+
+    def test_regenerate(self):
+        """完了したレポートの一部を作り直して、ジョブの結果を差し替えることのテスト"""
+        release = threading.Event()
+        service = ReportService(orchestrator_factory=lambda: FakeOrchestrator(release))
+
+        async def scenario(client):
+            job_id = (await (await client.post('/reports', json={'query': '比較級'})).json())['job_id']
+            assert (await client.post(f'/reports/{job_id}/regenerate', json={'stage': 'conclusion'})).status == 409
+
+            release.set()
+            await (await client.get(f'/reports/{job_id}/events')).text()
+            response = await client.post(f'/reports/{job_id}/regenerate',
+                                         json={'stage': 'conclusion', 'instruction': '短く'})
+            assert response.status == 200
+            assert (await response.json())['result']['report'] == "# 比較級\n## 結論\n短く"
+            status = await (await client.get(f'/reports/{job_id}')).json()
+            assert status['result']['report'].endswith("短く")
+
+            assert (await client.post(f'/reports/{job_id}/regenerate', json={'stage': 'outline'})).status == 400
+            assert (await client.post(f'/reports/{job_id}/regenerate', json={})).status == 400
+            assert (await client.post('/reports/unknown/regenerate', json={'stage': 'lead'})).status == 404
+
+        _run(scenario, service)
+
+    def test_regenerate_counts_against_client_limit(self):
+        """作り直しもクライアントの同時実行数に数え、同じジョブへの作り直しは順に行うことのテスト"""
+        started, release = threading.Event(), threading.Event()
+
+        class SlowRegenerate(FakeOrchestrator):
+            def regenerate(self, result, stage, section=None, instruction=""):
+                started.set()
+                release.wait(5)
+                return super().regenerate(result, stage, section, instruction)
+
+        service = ReportService(orchestrator_factory=SlowRegenerate, per_client_limit=2,
+                                trusted_proxies=['127.0.0.1'])
+
+        async def scenario(client):
+            headers = {'X-Client-Id': 'lms'}
+            job_id = (await (await client.post('/reports', json={'query': '比較級'}, headers=headers)).json())['job_id']
+            await (await client.get(f'/reports/{job_id}/events')).text()
+
+            url = f'/reports/{job_id}/regenerate'
+            first = asyncio.create_task(client.post(url, json={'stage': 'conclusion', 'instruction': 'A'},
+                                                    headers=headers))
+            await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+            assert service._active_by_client['lms'] == 1
+            second = asyncio.create_task(client.post(url, json={'stage': 'conclusion', 'instruction': 'B'},
+                                                     headers=headers))
+            while service._active_by_client['lms'] < 2:
+                await asyncio.sleep(0.01)
+            assert (await client.post(url, json={'stage': 'conclusion'}, headers=headers)).status == 429
+            assert (await client.post('/reports', json={'query': 'q'}, headers=headers)).status == 429
+
+            release.set()
+            assert (await first).status == 200
+            assert (await second).status == 200
+            # 2件目は1件目の結果を元に作り直している
+            status = await (await client.get(f'/reports/{job_id}')).json()
+            assert status['result']['report'] == "# 比較級\n## 結論\nA\n## 結論\nB"
+            assert 'lms' not in service._active_by_client
+
+        _run(scenario, service)
+
+    def test_metrics(self):
+        """GET /metrics で Prometheus のテキスト形式のメトリクスを返すことのテスト"""
+        service = ReportService(orchestrator_factory=FakeOrchestrator)
+
+        async def scenario(client):
+            response = await client.get('/metrics')
+            assert response.status == 200
+            assert response.headers['Content-Type'].startswith("text/plain")
+            assert "english_report_service_active_jobs 0.0" in await response.text()
+
+        _run(scenario, service)
@@ -0,0 +1,138 @@
+import threading
+import time
+import pytest
+from src.job_queue import JobQueue, JobStore, DONE, FAILED, QUEUED, RUNNING
+
+
+def _fake_runner(query, options, on_event=None):
+    if on_event:
+        on_event({'type': 'stage', 'stage': 'refine', 'status': 'end'})
+    if query == "boom":
+        raise RuntimeError("pipeline exploded")
+    return {'report': f"# {query}", 'mindmap': {}, 'query': query, 'options': options}
+
+
+class TestJobQueue:
+    """JobQueueのテストクラス"""
+
+    def setup_method(self):
+        """各テストメソッドの前に実行されるセットアップ"""
+        self.queue = None
+
+    def teardown_method(self):
+        if self.queue is not None:
+            self.queue.shutdown()
+
+    def test_submit_and_wait(self, tmp_path):
+        """ジョブの登録から完了までのテスト"""
+        self.queue = JobQueue(max_workers=2, executor_type="thread",
+                              db_path=str(tmp_path / "jobs.db"), runner=_fake_runner)
+        job_id = self.queue.submit("比較級", use_cache=False)
+        job = self.queue.wait(job_id, timeout=5)
+
+        assert job['status'] == DONE
+        assert job['result']['report'] == "# 比較級"
+        assert job['result']['options'] == {'use_cache': False}
+        assert job['finished_at'] >= job['started_at']
+        assert job['progress'] == {'stage': 'refine', 'status': 'end'}
+
+    def test_failed_job(self, tmp_path):
+        """失敗したジョブがエラー付きで記録されることのテスト"""
+        self.queue = JobQueue(max_workers=1, executor_type="thread",
+                              db_path=str(tmp_path / "jobs.db"), runner=_fake_runner)
+        job = self.queue.wait(self.queue.submit("boom"), timeout=5)
+
+        assert job['status'] == FAILED
+        assert "pipeline exploded" in job['error']
+
+    def test_concurrency_is_bounded(self, tmp_path):
+        """同時実行数がワーカー数を超えないことのテスト"""
+        lock = threading.Lock()
+        state = {'running': 0, 'peak': 0}
+
+        def slow_runner(query, options, on_event=None):
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            threading.Event().wait(0.05)
+            with lock:
+                state['running'] -= 1
+            return {'report': query}
+
+        self.queue = JobQueue(max_workers=2, executor_type="thread",
+                              db_path=str(tmp_path / "jobs.db"), runner=slow_runner)
+        job_ids = [self.queue.submit(f"q{i}") for i in range(6)]
+        for job_id in job_ids:
+            assert self.queue.wait(job_id, timeout=5)['status'] == DONE
+
+        assert state['peak'] <= 2
+        assert self.queue.queue_depth() == 0
+
+    def test_resume_unfinished_jobs(self, tmp_path):
+        """前回未完了のジョブが再投入されることのテスト"""
+        db_path = str(tmp_path / "jobs.db")
+        job_id = JobStore(db_path).create("受動態", {})
+
+        self.queue = JobQueue(max_workers=1, executor_type="thread", db_path=db_path, runner=_fake_runner)
+
+        assert self.queue.wait(job_id, timeout=5)['status'] == DONE
+
+    def test_only_expired_leases_are_reclaimed(self, tmp_path):
+        """心拍の途絶えた実行中のジョブだけを引き取り、他のプロセスが実行中のジョブには触れないことのテスト"""
+        db_path = str(tmp_path / "jobs.db")
+        store = JobStore(db_path)
+        alive = store.create("現在完了", {})
+        crashed = store.create("関係代名詞", {})
+        assert store.claim(alive, "other-replica")
+        assert store.claim(crashed, "crashed-replica")
+        store.update(crashed, heartbeat_at=time.time() - 120)
+
+        self.queue = JobQueue(max_workers=1, executor_type="thread", db_path=db_path,
+                              runner=_fake_runner, lease_seconds=60)
+
+        assert self.queue.wait(crashed, timeout=5)['status'] == DONE
+        job = store.get(alive)
+        assert (job['status'], job['owner']) == (RUNNING, "other-replica")
+
+    def test_reaper_reclaims_while_running(self, tmp_path):
+        """起動後に落ちた他のプロセスのジョブも、リースが切れたら引き取って実行することのテスト"""
+        db_path = str(tmp_path / "jobs.db")
+        self.queue = JobQueue(max_workers=1, executor_type="thread", db_path=db_path,
+                              runner=_fake_runner, lease_seconds=0.2)
+        store = JobStore(db_path)
+        job_id = store.create("不定詞", {})
+        assert store.claim(job_id, "crashed-replica")
+
+        assert self.queue.wait(job_id, timeout=5)['status'] == DONE
+
+    def test_error_result_is_failed(self, tmp_path):
+        """パイプラインがエラー付きの結果を返したら失敗として記録することのテスト"""
+        def error_runner(query, options, on_event=None):
+            return {'report': "# エラーが発生しました", 'error': "quota exceeded"}
+
+        self.queue = JobQueue(max_workers=1, executor_type="thread",
+                              db_path=str(tmp_path / "jobs.db"), runner=error_runner)
+        job = self.queue.wait(self.queue.submit("比較級"), timeout=5)
+        assert (job['status'], job['error']) == (FAILED, "quota exceeded")
+
+    def test_claim_is_atomic(self, tmp_path):
+        """待機中のジョブは1つの所有者だけが確保でき、所有権を失った側は完了を書けないことのテスト"""
+        store = JobStore(str(tmp_path / "jobs.db"))
+        job_id = store.create("q", {})
+
+        assert store.claim(job_id, "a")
+        assert not store.claim(job_id, "b")
+        assert store.heartbeat(job_id, "a")
+        assert not store.heartbeat(job_id, "b")
+        assert not store.finish(job_id, "b", status=DONE)
+        assert store.finish(job_id, "a", status=DONE)
+        assert store.get(job_id)['status'] == DONE
+
+    def test_store_rejects_unknown_fields(self, tmp_path):
+        """未知のカラムの更新が拒否されることのテスト"""
+        store = JobStore(str(tmp_path / "jobs.db"))
+        job_id = store.create("q", {})
+
+        with pytest.raises(ValueError):
+            store.update(job_id, nonexistent="x")
+        assert store.get(job_id)['status'] == QUEUED
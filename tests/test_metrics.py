@@ -0,0 +1,124 @@
+import socket
+import urllib.request
+import pytest
+from src import metrics
+from src.cache_backend import MemoryBackend, reset_cache
+from src.deadline import DeadlineExceeded
+from src.external_api_client import ExternalApiClient
+from src.pipeline_orchestrator import PipelineOrchestrator
+from src.rate_governor import RateGovernor
+
+
+@pytest.fixture(autouse=True)
+def registry():
+    metrics.reset_registry()
+    yield metrics.get_registry()
+    metrics.stop_server()
+    metrics.reset_registry()
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class TestRegistry:
+    """メトリクスの登録簿のテストクラス"""
+
+    def test_render_text_format(self):
+        """カウンター・ゲージ・ヒストグラムを Prometheus のテキスト形式で出力することのテスト"""
+        registry = metrics.Registry("app", buckets=(1.0, 5.0))
+        registry.counter('calls_total', "Calls", ('model',)).inc(2, model='gpt "4"')
+        registry.gauge('depth', "Depth").set_function(lambda: 3)
+        histogram = registry.histogram('latency_seconds', "Latency")
+        histogram.observe(0.5)
+        histogram.observe(2.0)
+        histogram.observe(10.0)
+
+        text = registry.render()
+        assert '# TYPE app_calls_total counter\n' in text
+        assert 'app_calls_total{model="gpt \\"4\\""} 2.0\n' in text
+        assert 'app_depth 3.0\n' in text
+        assert 'app_latency_seconds_bucket{le="1.0"} 1\n' in text
+        assert 'app_latency_seconds_bucket{le="5.0"} 2\n' in text
+        assert 'app_latency_seconds_bucket{le="+Inf"} 3\n' in text
+        assert 'app_latency_seconds_sum 12.5\n' in text
+        assert 'app_latency_seconds_count 3\n' in text
+
+    def test_get_or_create(self, registry):
+        """同じ名前なら同じメトリクスを返し、種類やラベルが違えばエラーにすることのテスト"""
+        counter = metrics.counter('things_total', "Things", ('kind',))
+        assert metrics.counter('things_total', "Things", ('kind',)) is counter
+        with pytest.raises(ValueError):
+            metrics.gauge('things_total', "Things", ('kind',))
+        with pytest.raises(ValueError):
+            counter.inc(kind='a', extra='b')
+
+
+class TestInstrumentation:
+    """各モジュールの計測のテストクラス"""
+
+    def test_stage_duration(self, tmp_path, monkeypatch):
+        """ステージの所要時間をヒストグラムに記録することのテスト"""
+        monkeypatch.setenv("REPORT_CACHE_PATH", str(tmp_path / "cache.jsonl"))
+        orchestrator = PipelineOrchestrator()
+        with orchestrator._stage('outline'):
+            pass
+        histogram = metrics.histogram('pipeline_stage_duration_seconds', "Pipeline stage latency", ('stage',))
+        assert histogram.count(stage='outline') == 1
+
+    def test_provider_errors(self):
+        """プロバイダーの失敗を再試行したものも含めて数えることのテスト"""
+        governor = RateGovernor("test-model")
+        with pytest.raises(KeyError):
+            governor.call(lambda permit: {}['missing'])
+        errors = metrics.counter('llm_provider_errors_total', "", ('model', 'error'))
+        assert errors.value(model='test-model', error='KeyError') == 1
+
+    def test_deadline_is_not_a_provider_error(self):
+        """枠の待ちや呼び出し中に締め切りを過ぎたものはプロバイダーの失敗に数えないことのテスト"""
+        governor = RateGovernor("deadline-model")
+
+        def expire(permit):
+            raise DeadlineExceeded("budget exhausted")
+
+        with pytest.raises(DeadlineExceeded):
+            governor.call(expire)
+        errors = metrics.counter('llm_provider_errors_total', "", ('model', 'error'))
+        assert errors.value(model='deadline-model', error='DeadlineExceeded') == 0
+
+    def test_search_results(self, monkeypatch):
+        """検索の成否とキャッシュの当たりを検索方法ごとに数えることのテスト"""
+        monkeypatch.setenv("SEARCH_REQUEST_INTERVAL", "0")
+        reset_cache(MemoryBackend())
+        try:
+            client = ExternalApiClient()
+            results = {"good": "Results for good", "bad": "Search error: boom"}
+            client.run_searches({key: key for key in results}, lambda query: results[query], cache_as="test_provider")
+            client.run_searches({"good": "good"}, lambda query: results[query], cache_as="test_provider")
+        finally:
+            reset_cache()
+
+        searches = metrics.counter('search_requests_total', "", ('provider', 'result'))
+        assert searches.value(provider='test_provider', result='ok') == 1
+        assert searches.value(provider='test_provider', result='error') == 1
+        assert searches.value(provider='test_provider', result='cache_hit') == 1
+
+
+class TestServer:
+    """メトリクスのHTTPサーバーのテストクラス"""
+
+    def test_serves_metrics(self):
+        """/metrics で登録簿の内容を返すことのテスト"""
+        metrics.counter('served_total', "Served").inc()
+        server = metrics.start_server(port=_free_port())
+        assert metrics.start_server() is server
+        with urllib.request.urlopen(f"http://127.0.0.1:{server.server_address[1]}/metrics", timeout=5) as response:
+            assert response.headers['Content-Type'] == metrics.CONTENT_TYPE
+            assert "english_report_served_total 1.0" in response.read().decode('utf-8')
+
+    def test_port_zero_disables(self, monkeypatch):
+        """ポートが 0 ならサーバーを起動しないことのテスト"""
+        monkeypatch.setenv("METRICS_PORT", "0")
+        assert metrics.start_server() is None
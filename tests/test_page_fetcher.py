@@ -0,0 +1,105 @@
+import io
+import threading
+import time
+from types import SimpleNamespace
+import pytest
+from src.host_scheduler import HostScheduler
+from src.page_fetcher import PageFetcher, extract_main_text
+
+PAGE = (
+    "<html><head><meta charset='utf-8'><script>var x = 1;</script></head>"
+    "<body><nav>メニュー</nav><main><h1>比較級</h1><p>形容詞に -er を付ける。</p></main>"
+    "<footer>著作権</footer></body></html>"
+).encode('utf-8')
+
+
+class _Raw(io.BytesIO):
+    def read(self, size=-1, decode_content=False):
+        return super().read(size)
+
+
+class FakeSession:
+    """URLごとの応答を返し、送られた条件付きGETのヘッダーと同時接続数を記録するセッション"""
+
+    def __init__(self, status=200, headers=None, delay=0.0):
+        self.status = status
+        self.headers = headers if headers is not None else {
+            'Content-Type': 'text/html', 'ETag': '"v1"', 'Last-Modified': 'Mon, 01 Jan 2024 00:00:00 GMT'
+        }
+        self.delay = delay
+        self.requests = []
+        self.in_flight = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def get(self, url, headers=None, timeout=None, stream=False):
+        with self._lock:
+            self.requests.append((url, dict(headers or {})))
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        time.sleep(self.delay)
+        with self._lock:
+            self.in_flight -= 1
+        return SimpleNamespace(status_code=self.status, headers=self.headers, raw=_Raw(PAGE),
+                               raise_for_status=lambda: None, close=lambda: None)
+
+
+@pytest.fixture
+def make_fetcher(tmp_path):
+    def make(session, per_host_concurrency=2):
+        scheduler = HostScheduler(per_host_concurrency=per_host_concurrency, per_host_interval=0,
+                                  respect_robots=False, session_factory=lambda host: session)
+        fetcher = PageFetcher(scheduler=scheduler, cache_dir=str(tmp_path / "pages"))
+        fetcher.fresh_seconds = 0
+        return fetcher
+    return make
+
+
+class TestPageFetcher:
+    """PageFetcherのテストクラス"""
+
+    def test_extract_main_text(self):
+        """main要素の本文だけを取り出し、長さを制限することのテスト"""
+        assert extract_main_text(PAGE, 1000) == "比較級 形容詞に -er を付ける。"
+        assert extract_main_text(PAGE, 3) == "比較級…"
+
+    def test_conditional_get_uses_cache_on_304(self, make_fetcher):
+        """2回目はETag / Last-Modifiedで再検証し、304ならキャッシュの本文を使うことのテスト"""
+        session = FakeSession()
+        fetcher = make_fetcher(session)
+        assert fetcher.fetch("https://www.mext.go.jp/a") == "比較級 形容詞に -er を付ける。"
+
+        session.status = 304
+        assert fetcher.fetch("https://www.mext.go.jp/a") == "比較級 形容詞に -er を付ける。"
+        assert session.requests[1][1] == {'If-None-Match': '"v1"',
+                                          'If-Modified-Since': 'Mon, 01 Jan 2024 00:00:00 GMT'}
+
+    def test_fresh_cache_skips_request(self, make_fetcher):
+        """取得して間もないページは再検証しないことのテスト"""
+        session = FakeSession()
+        fetcher = make_fetcher(session)
+        fetcher.fresh_seconds = 3600
+        fetcher.fetch("https://www.nier.go.jp/a")
+        fetcher.fetch("https://www.nier.go.jp/a")
+        assert len(session.requests) == 1
+
+    def test_per_host_limit(self, make_fetcher):
+        """同じホストへの同時接続数が上限を超えないことのテスト"""
+        session = FakeSession(delay=0.05)
+        fetcher = make_fetcher(session, per_host_concurrency=2)
+        pages = fetcher.fetch_many([f"https://www.mext.go.jp/{i}" for i in range(6)])
+        assert len(pages) == 6
+        assert session.peak <= 2
+
+    def test_enrich_inserts_content_under_url(self, make_fetcher):
+        """各結果のURL行の下に本文を差し込み、上位top_n件だけを取得することのテスト"""
+        fetcher = make_fetcher(FakeSession())
+        fetcher.top_n = 2
+        results = {
+            "比較級": "Title: A\nURL: https://a.example/1\nSnippet: a\n\nTitle: B\nURL: https://a.example/2\nSnippet: b",
+            "最上級": "Title: C\nURL: https://c.example/1\nSnippet: c",
+        }
+        enriched = fetcher.enrich(results)
+        assert "URL: https://a.example/1\nContent: 比較級" in enriched["比較級"]
+        assert "URL: https://a.example/2\nSnippet: b" in enriched["比較級"]
+        assert "URL: https://c.example/1\nContent: 比較級" in enriched["最上級"]
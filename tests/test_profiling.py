@@ -0,0 +1,67 @@
+import os
+import time
+from src import run_context
+from src.pipeline_orchestrator import PipelineOrchestrator
+from src.profiling import RunProfiler
+from src.query_classifier import route
+
+
+def busy(seconds):
+    end = time.process_time() + seconds
+    while time.process_time() < end:
+        pass
+
+
+class TestRunProfiler:
+    """実行のプロファイルのテストクラス"""
+
+    def test_stage_wait_and_work_breakdown(self, tmp_path, monkeypatch):
+        """ステージごとに待ち時間と処理時間を分け、プロファイルをファイルに書き出すことのテスト"""
+        monkeypatch.setenv("REPORT_CACHE_PATH", str(tmp_path / "cache.jsonl"))
+        orchestrator = PipelineOrchestrator()
+        profiler = RunProfiler()
+        with run_context.run_scope(run_context.RunContext(profiler=profiler)):
+            profiler.start()
+            with orchestrator._stage('general_search'):
+                time.sleep(0.1)
+                run_context.record_wait('search_throttle', 0.1)
+                busy(0.05)
+            profiler.stop()
+
+        stages = profiler.breakdown()
+        search = stages['general_search']
+        assert search['wall'] >= 0.15
+        assert search['cpu'] >= 0.04
+        assert 0.08 <= search['wait'] < search['wall']
+        assert search['waits'] == {'search_throttle': 0.1}
+        assert stages['total']['wall'] >= search['wall']
+
+        written = profiler.write("report_test", output_dir=str(tmp_path))
+        assert os.path.exists(written['profile_path'])
+        with open(written['summary_path'], encoding='utf-8') as f:
+            summary = f.read()
+        assert "general_search" in summary and "search_throttle" in summary and "cumulative" in summary
+
+    def test_run_with_profiling(self, tmp_path, monkeypatch):
+        """run(profiling=True) の結果の 'profiling' に書き出したファイルを返すことのテスト"""
+        monkeypatch.setenv("REPORT_CACHE_PATH", str(tmp_path / "cache.jsonl"))
+        write = RunProfiler.write
+        monkeypatch.setattr(RunProfiler, 'write', lambda self, name: write(self, name, output_dir=str(tmp_path)))
+        orchestrator = PipelineOrchestrator()
+        query = "英語の受動態の作り方を説明して"
+        plan = {key: 99 for key in route(query)['plan']}
+        orchestrator.report_cache.store({'query': query, 'refined_query': "", 'report': "# 受動態",
+                                         'mindmap': {}, 'plan': plan})
+
+        result = orchestrator.run(query, profiling=True)
+        assert result['cache']['hit']
+        assert os.path.exists(result['profiling']['profile_path'])
+        assert 'profiling' not in orchestrator.run(query)
+
+    def test_disabled_records_nothing(self):
+        """プロファイルを取らない実行では待ち時間を記録しないことのテスト"""
+        context = run_context.RunContext()
+        with run_context.run_scope(context):
+            run_context.record_wait('search_throttle', 1.0)
+        assert context.profiler is None
+        run_context.record_wait('search_throttle', 1.0)
@@ -0,0 +1,49 @@
+import pytest
+from src.prompt_templates import PromptTemplate, RenderedPrompt, get_template, template_versions
+
+
+class TestPromptTemplates:
+    """プロンプトテンプレートのテストクラス"""
+
+    def test_all_stages_registered(self):
+        """全ステージのテンプレートが登録されていることのテスト"""
+        assert set(template_versions()) >= {
+            'refine', 'expand', 'outline', 'lead', 'body', 'related_topics', 'conclusion', 'mindmap'
+        }
+
+    def test_static_prefix_is_stable(self):
+        """入力が変わってもシステムプロンプト（前半部分）が同じであることのテスト"""
+        template = get_template('body')
+        first = template.render(search_results_text="[1] A", outline="# X", refined_query="比較級",
+                                passage_facts="")
+        second = template.render(search_results_text="[1] B", outline="# Y", refined_query="仮定法",
+                                 passage_facts="- 語数: 12語・1文")
+        assert first[0] == second[0]
+        assert first[0]['role'] == "system"
+        assert "比較級" in first[1]['content']
+        assert first.cache_key == second.cache_key == f"body:{template.version}"
+
+    def test_values_with_braces(self):
+        """波括弧を含む値やJSON例を含むテンプレートでも組み立てられることのテスト"""
+        messages = get_template('mindmap').render(report_content='{"name": "x"}')
+        assert '"children"' in messages[0]['content']
+        assert messages[1]['content'].endswith('{"name": "x"}')
+
+    def test_missing_value(self):
+        with pytest.raises(KeyError):
+            get_template('expand').render(refined_query="比較級")
+
+    def test_version_changes_with_content(self):
+        """内容が変わると版（ハッシュ）が変わることのテスト"""
+        a = PromptTemplate(name="t", system="指示A", user="{q}")
+        b = PromptTemplate(name="t", system="指示B", user="{q}")
+        assert a.version != b.version
+        assert a.fields == ("q",)
+
+    def test_with_suffix_keeps_prefix(self):
+        messages = get_template('refine').render(user_query="比較級")
+        suffixed = messages.with_suffix("\n\nJSONで")
+        assert isinstance(suffixed, RenderedPrompt)
+        assert suffixed[0] == messages[0]
+        assert suffixed[1]['content'].endswith("JSONで")
+        assert not messages[1]['content'].endswith("JSONで")
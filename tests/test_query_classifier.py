@@ -0,0 +1,211 @@
+import pytest
+from src import query_classifier
+from src.pipeline_orchestrator import PipelineOrchestrator
+from src.query_classifier import AUTO, AUTO_SEARCH_MODE, QueryClassifier, route
+
+
+class Stub:
+    """呼び出しを記録するだけのステージ"""
+
+    def __init__(self, calls, **methods):
+        self.calls = calls
+        self.methods = methods
+        self.max_concurrency = 4
+        self._search_topic = None
+
+    def __getattr__(self, name):
+        method = self.methods[name]
+
+        def call(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            return method(*args, **kwargs)
+        return call
+
+
+@pytest.fixture
+def orchestrator(tmp_path, monkeypatch):
+    monkeypatch.setenv("REPORT_CACHE_PATH", str(tmp_path / "cache.jsonl"))
+    orchestrator = PipelineOrchestrator()
+    calls = []
+    orchestrator.refiner = Stub(calls, refine=lambda query: query)
+    orchestrator.api_client = Stub(
+        calls,
+        run_searches=lambda queries, search_fn, cache_as=None: {key: "education result" for key in queries},
+        search=lambda queries: {query: "web result" for query in queries},
+        search_provider=lambda: "serpapi",
+    )
+    orchestrator.expander = Stub(calls, expand=lambda query, max_topics: [f"topic {i}" for i in range(max_topics)])
+    orchestrator.outline_creator = Stub(calls, create=lambda query, results: "# タイトル\n## 1. 用法")
+    orchestrator.writer = Stub(
+        calls,
+        write_sections=lambda outline, results, query, refined: {'title': "# タイトル", 'body': "## 1. 用法\n本文"},
+        assemble_sections=lambda sections, sources: "# タイトル\n## 1. 用法\n本文",
+    )
+    orchestrator.mindmap_generator = Stub(calls, generate_mindmap=lambda report: {'name': "LLM", 'children': []})
+    orchestrator.calls = calls
+    return orchestrator
+
+
+def called(orchestrator, name):
+    return [call for call in orchestrator.calls if call[0] == name]
+
+
+class TestQueryClassifier:
+    """クエリの種類の判定のテストクラス"""
+
+    @pytest.mark.parametrize("query, expected", [
+        ("関係代名詞の使い方を教えて", "文法解説"),
+        ("英単語を効率よく覚えたい", "語彙学習"),
+        ("長文読解が苦手な生徒への指導", "読解指導"),
+        ("シャドーイングのやり方", "リスニング"),
+        ("英作文の採点基準", "ライティング"),
+        ("日本の英語教育政策の課題", "その他"),
+    ])
+    def test_classifies_settings_examples(self, query, expected):
+        """settings.yaml の例文で学習した分類器で判定することのテスト"""
+        assert query_classifier.get_classifier().classify(query).query_type == expected
+
+    def test_unsure_queries_use_default(self):
+        """確信度が低いクエリは既定の種類（全ステージ）にすることのテスト"""
+        classifier = QueryClassifier({
+            'default_type': "その他", 'min_confidence': 0.6,
+            'types': {'文法解説': {'profile': 'light', 'keywords': ["文法"], 'examples': ["文法の説明"]},
+                      'その他': {'profile': 'full', 'examples': ["教育の研究"]}},
+        })
+        assert classifier.classify("文法の説明をして").query_type == "文法解説"
+        assert classifier.classify("天気").query_type == "その他"
+        assert classifier.profile_name("その他") == "full"
+
+    def test_explicit_type_overrides_classifier(self):
+        """UIで指定した種類は分類器より優先することのテスト"""
+        routing = route("関係代名詞の使い方を教えて", "読解指導")
+        assert (routing['query_type'], routing['source'], routing['profile']) == ("読解指導", "user", "standard")
+        assert route("関係代名詞の使い方を教えて", AUTO)['source'] == "classifier"
+
+
+class TestRouting:
+    """オーケストレーターのプロファイル別の実行のテストクラス"""
+
+    def test_light_profile(self, orchestrator):
+        """軽いプロファイルでは検索を減らし、マインドマップを見出しから作ることのテスト"""
+        result = orchestrator.run("関係代名詞の使い方を教えて", use_cache=False)
+        assert result['routing']['profile'] == "light"
+        education_queries = called(orchestrator, 'run_searches')[0][1][0]
+        assert len(education_queries) == 1
+        assert called(orchestrator, 'expand')[0][2]['max_topics'] == 3
+        assert called(orchestrator, 'generate_mindmap') == []
+        assert result['mindmap'] == {'name': "タイトル", 'children': [{'name': "1. 用法", 'children': []}]}
+        assert result['search_stats']['total_topics'] == 3
+
+    def test_full_profile_for_explicit_type(self, orchestrator):
+        """種類を指定すれば、その種類のプロファイルで全ステージを実行することのテスト"""
+        result = orchestrator.run("関係代名詞の使い方を教えて", use_cache=False, query_type="その他")
+        assert result['routing'] == {'query_type': "その他", 'profile': "full", 'source': "user", 'confidence': 1.0,
+                                     'search_mode': AUTO_SEARCH_MODE}
+        assert len(called(orchestrator, 'run_searches')[0][1][0]) == 5
+        assert called(orchestrator, 'expand')[0][2]['max_topics'] == 10
+        assert result['mindmap']['name'] == "LLM"
+
+
+    def test_fallback_reports_are_not_cached(self, orchestrator):
+        """フォールバックの文面を含むレポートはキャッシュしないことのテスト"""
+        from src import run_context
+
+        def write_sections(outline, results, query, refined):
+            run_context.mark_fallback('lead', "insufficient_quota")
+            return {'title': "# タイトル", 'body': "## 1. 用法\n本文"}
+        orchestrator.writer.methods['write_sections'] = write_sections
+        result = orchestrator.run("日本の英語教育政策の課題")
+        assert result['fallback_stages'] == ['lead'] and 'error' not in result
+        assert orchestrator.run("日本の英語教育政策の課題")['cache']['hit'] is False
+
+
+class TestSearchModes:
+    """検索モードごとの実行計画のテストクラス"""
+
+    def test_general_only(self, orchestrator):
+        """一般検索モードでは一般検索だけを送ることのテスト"""
+        result = orchestrator.run("日本の英語教育政策の課題", use_cache=False, search_mode="一般検索")
+        assert called(orchestrator, 'run_searches') == [] and called(orchestrator, 'expand') == []
+        assert len(called(orchestrator, 'search')) == 1
+        stats = result['search_stats']
+        assert (stats['search_mode'], stats['search_count'], stats['total_topics']) == ("一般検索", 1, 0)
+        assert stats['search_time'] >= 0
+
+    def test_education_only(self, orchestrator):
+        """教育特化モードでは教育ドメインだけを検索することのテスト"""
+        result = orchestrator.run("日本の英語教育政策の課題", use_cache=False, search_mode="教育特化")
+        assert len(called(orchestrator, 'run_searches')[0][1][0]) == 5
+        assert called(orchestrator, 'search') == []
+        assert result['search_stats']['search_count'] == 5
+        assert result['search_stats']['general_results'] == 0
+
+    def test_education_search_uses_search_api(self, orchestrator):
+        """教育ドメインの site: 検索は設定された検索APIで送り、APIキーがなければステージを省くことのテスト"""
+        orchestrator.run("日本の英語教育政策の課題", use_cache=False, search_mode="教育特化")
+        assert called(orchestrator, 'run_searches')[0][2] == {'cache_as': "serpapi"}
+
+        orchestrator.calls.clear()
+        orchestrator.api_client.methods['search_provider'] = lambda: "basic_web"
+        result = orchestrator.run("日本の英語教育政策の課題", use_cache=False, search_mode="教育特化")
+        assert called(orchestrator, 'run_searches') == []
+        stats = result['search_stats']
+        assert (stats['skipped_stages'], stats['search_count']) == (['education_search'], 0)
+
+    def test_search_stages_need_search_api(self, orchestrator):
+        """APIキーがなければ一般・詳細検索も省き、実行した計画を記録して、そのレポートはキャッシュしないことのテスト"""
+        orchestrator.api_client.methods['search_provider'] = lambda: "basic_web"
+        query = "日本の英語教育政策の課題"
+        result = orchestrator.run(query, search_mode="詳細検索")
+        assert called(orchestrator, 'search') == [] and called(orchestrator, 'expand') == []
+        assert result['search_stats']['skipped_stages'] == ['education_search', 'general_search', 'detailed_search']
+        assert result['search_stats']['search_count'] == 0
+        assert (result['plan']['education_domains'], result['plan']['general_search'], result['plan']['max_topics']) \
+            == (0, False, 0)
+        assert called(orchestrator, 'create')[0][1][1] == {}
+
+        # 検索APIを設定したら、検索を省いたレポートは使わずに作り直す
+        orchestrator.api_client.methods['search_provider'] = lambda: "serpapi"
+        assert orchestrator.run(query, search_mode="教育特化")['cache']['hit'] is False
+
+    def test_placeholder_results_are_not_sources(self, orchestrator):
+        """検索の失敗や結果なしの定型文は、情報源としてアウトラインに渡さないことのテスト"""
+        orchestrator.api_client.methods['search'] = lambda queries: {
+            query: f"Search error for '{query}': boom" for query in queries}
+        orchestrator.run("日本の英語教育政策の課題", use_cache=False, search_mode="一般検索")
+        assert called(orchestrator, 'create')[0][1][1] == {}
+
+    def test_deep_overrides_light_profile(self, orchestrator):
+        """詳細検索モードは軽いプロファイルのクエリでも全トピックを検索し、それ以外はプロファイルに従うことのテスト"""
+        result = orchestrator.run("関係代名詞の使い方を教えて", use_cache=False, search_mode="詳細検索")
+        assert result['routing']['profile'] == "light"
+        assert called(orchestrator, 'expand')[0][2]['max_topics'] == 10
+        assert result['search_stats']['search_count'] == 5 + 1 + 10
+        # マインドマップはプロファイルどおり見出しから作る
+        assert called(orchestrator, 'generate_mindmap') == []
+
+    def test_cache_only_serves_covering_plans(self, orchestrator):
+        """検索モードを広げたら再生成し、同じか狭い計画の実行にだけキャッシュを返すことのテスト"""
+        query = "日本の英語教育政策の課題"
+        first = orchestrator.run(query, search_mode="一般検索")
+        assert first['cache']['hit'] is False
+        deep = orchestrator.run(query, search_mode="詳細検索")
+        assert deep['cache']['hit'] is False and deep['search_stats']['search_count'] == 5 + 1 + 10
+        # 詳細検索のレポートは一般検索・教育特化の代わりになる
+        assert orchestrator.run(query, search_mode="一般検索")['cache']['hit'] is True
+        assert orchestrator.run(query, search_mode="教育特化")['cache']['hit'] is True
+
+    def test_plan_covers(self):
+        """計画のすべての項目が同じか多いときだけ代わりにすることのテスト"""
+        general = {'education_domains': 0, 'general_search': True, 'max_topics': 0, 'mindmap': False}
+        education = {'education_domains': 5, 'general_search': False, 'max_topics': 0, 'mindmap': False}
+        assert query_classifier.plan_covers(general, general)
+        assert not query_classifier.plan_covers(general, education)
+        assert not query_classifier.plan_covers(education, general)
+        assert not query_classifier.plan_covers(None, general)
+
+    def test_unknown_mode_is_auto(self):
+        """未知の検索モードはプロファイルどおりの検索にすることのテスト"""
+        routing = route("関係代名詞の使い方を教えて", search_mode="fast")
+        assert routing['search_mode'] == AUTO_SEARCH_MODE
+        assert routing['plan']['max_topics'] == 3
@@ -0,0 +1,122 @@
+import threading
+import time
+from types import SimpleNamespace
+import openai
+import pytest
+from src import rate_governor
+from src.deadline import Deadline, DeadlineExceeded
+from src.rate_governor import RateGovernor
+
+
+def _rate_limit_error(headers=None):
+    response = SimpleNamespace(status_code=429, headers=headers or {}, request=None)
+    return openai.RateLimitError("Rate limit reached", response=response, body=None)
+
+
+class TestRateGovernor:
+    """RateGovernorのテストクラス"""
+
+    def test_retry_after_is_honoured(self):
+        """429のretry-afterだけ待ってから再試行し、同時実行数を半減することのテスト"""
+        governor = RateGovernor("test", max_concurrency=8, base_delay=0.001)
+        calls = []
+
+        def fn(permit):
+            calls.append(time.monotonic())
+            if len(calls) == 1:
+                raise _rate_limit_error({'retry-after-ms': '200'})
+            return "ok"
+
+        assert governor.call(fn) == "ok"
+        assert calls[1] - calls[0] >= 0.2
+        stats = governor.stats()
+        assert stats['rate_limited'] == 1
+        assert stats['retries'] == 1
+        # 半減したあと成功で少しだけ戻る
+        assert stats['concurrency_limit'] == 4
+
+    def test_additive_increase(self):
+        """成功が続くと同時実行数が上限まで戻ることのテスト"""
+        governor = RateGovernor("test", max_concurrency=4)
+        governor.concurrency_limit = 1.0
+        for _ in range(20):
+            governor.call(lambda permit: None)
+        assert governor.stats()['concurrency_limit'] == 4
+
+    def test_non_retryable_errors_are_raised(self):
+        """レート制限以外のエラーは再試行しないことのテスト"""
+        governor = RateGovernor("test")
+        calls = []
+
+        def fn(permit):
+            calls.append(1)
+            raise ValueError("bad prompt")
+
+        with pytest.raises(ValueError):
+            governor.call(fn)
+        assert len(calls) == 1
+
+    def test_gives_up_after_max_retries(self):
+        governor = RateGovernor("test", max_retries=2, base_delay=0.001)
+        calls = []
+
+        def fn(permit):
+            calls.append(1)
+            raise _rate_limit_error()
+
+        with pytest.raises(openai.RateLimitError):
+            governor.call(fn)
+        assert len(calls) == 3
+
+    def test_rpm_window(self, monkeypatch):
+        """RPMの上限に達したら時間窓が空くまで待つことのテスト"""
+        monkeypatch.setattr(rate_governor, "WINDOW_SECONDS", 0.3)
+        governor = RateGovernor("test", rpm=2)
+        started = time.monotonic()
+        for _ in range(3):
+            governor.call(lambda permit: None)
+        assert time.monotonic() - started >= 0.3
+
+    def test_tpm_settles_to_actual_usage(self):
+        """実際のトークン数で見積もりが置き換わることのテスト"""
+        governor = RateGovernor("test", tpm=1000)
+        governor.call(lambda permit: permit.settle(100), estimated_tokens=900)
+        assert governor.stats()['window_tokens'] == 100
+
+    def test_concurrency_limit(self):
+        """同時実行数が上限を超えないことのテスト"""
+        governor = RateGovernor("test", max_concurrency=2)
+        peak = []
+        lock = threading.Lock()
+
+        def fn(permit):
+            with lock:
+                peak.append(governor.in_flight)
+            time.sleep(0.05)
+
+        threads = [threading.Thread(target=governor.call, args=(fn,)) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert max(peak) <= 2
+
+    def test_deadline_while_blocked(self):
+        """retry-afterの待ちが締め切りを越えるなら打ち切ることのテスト"""
+        governor = RateGovernor("test")
+        governor._blocked_until = time.time() + 5
+        with pytest.raises(DeadlineExceeded):
+            governor.call(lambda permit: None, deadline=Deadline(0.1))
+
+    def test_background_share(self):
+        """バックグラウンドの呼び出しは同時実行数の一部しか使わず、待っているライブの呼び出しに譲ることのテスト"""
+        governor = RateGovernor("test", max_concurrency=4, background_share=0.25)
+        with governor.request(background=True):
+            # バックグラウンドの枠（4 * 0.25 = 1）は埋まっているが、ライブの呼び出しは通る
+            assert governor._wait_time(time.time(), 0, background=True) > 0
+            assert governor._wait_time(time.time(), 0) == 0
+
+        governor._live_waiting = 1
+        assert governor._wait_time(time.time(), 0, background=True) > 0
+        governor._live_waiting = 0
+        assert governor._wait_time(time.time(), 0, background=True) == 0
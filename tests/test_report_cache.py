@@ -0,0 +1,152 @@
+import time
+import pytest
+from src.report_cache import ReportCache
+
+
+def _result(query, refined_query, report="report body"):
+    return {'query': query, 'refined_query': refined_query, 'report': report, 'mindmap': {}}
+
+
+class TestReportCache:
+    """ReportCacheのテストクラス"""
+
+    def setup_method(self):
+        """各テストメソッドの前に実行されるセットアップ"""
+        self.cache = ReportCache(threshold=0.8)
+
+    def test_normalize_removes_request_phrasing(self):
+        """依頼表現・助詞・記号の正規化のテスト"""
+        assert self.cache.normalize("比較級と最上級の使い方を教えて") == \
+            self.cache.normalize("比較級・最上級の使い方を説明して")
+
+    def test_near_duplicate_hit(self):
+        """近似重複クエリがヒットすることのテスト"""
+        self.cache.store(_result("比較級と最上級の使い方を教えて", "英語 比較級 最上級 用法"))
+        hit = self.cache.lookup("比較級・最上級の使い方を説明して")
+
+        assert hit is not None
+        assert hit['similarity'] >= 0.8
+        assert hit['result']['report'] == "report body"
+
+    def test_different_topic_miss(self):
+        """別トピックのクエリがヒットしないことのテスト"""
+        self.cache.store(_result("現在完了形と過去形の違いを説明して", "現在完了形 過去形 違い"))
+
+        assert self.cache.lookup("現在完了進行形と過去形の違いを説明して") is None
+        assert self.cache.lookup("英語の受動態の作り方を説明して") is None
+
+    def test_refined_query_is_indexed(self):
+        """洗練済みクエリでもヒットすることのテスト"""
+        self.cache.store(_result("比較級について", "英語 比較級 最上級 用法 解説"))
+
+        assert self.cache.lookup("英語 比較級 最上級 用法 解説") is not None
+
+    def test_stats(self):
+        """ヒット率と類似度分布のテスト"""
+        self.cache.store(_result("英語の仮定法の使い方を教えて", "仮定法 用法"))
+        self.cache.lookup("英語の仮定法の使い方を説明して")
+        self.cache.lookup("関係代名詞")
+
+        stats = self.cache.stats()
+        assert stats['lookups'] == 2
+        assert stats['hits'] == 1
+        assert stats['hit_rate'] == pytest.approx(0.5)
+        assert sum(stats['similarity_histogram'].values()) == 2
+
+    def test_max_entries_eviction(self):
+        """上限を超えたら古いエントリから削除されることのテスト"""
+        cache = ReportCache(max_entries=2)
+        cache.store(_result("英語の前置詞の使い方", ""))
+        cache.store(_result("英語の受動態の作り方", ""))
+        cache.store(_result("英語の仮定法の使い方", ""))
+
+        assert len(cache) == 2
+        assert cache.lookup("英語の前置詞の使い方") is None
+        assert cache.lookup("英語の仮定法の使い方") is not None
+
+    def test_persistence(self, tmp_path):
+        """JSONLファイルから索引が再構築されることのテスト"""
+        path = str(tmp_path / "report_cache.jsonl")
+        ReportCache(path=path).store(_result("英語の受動態の作り方を説明して", "受動態 作り方"))
+
+        reloaded = ReportCache(path=path)
+        assert reloaded.lookup("英語の受動態の作り方を教えて") is not None
+
+    def test_ttl(self, tmp_path, monkeypatch):
+        """期限切れのレポートは返さず、読み込み時にファイルからも除くことのテスト"""
+        path = str(tmp_path / "report_cache.jsonl")
+        cache = ReportCache(path=path, ttl=60)
+        cache.store(_result("英語の受動態の作り方を説明して", "受動態 作り方"))
+        assert cache.lookup("英語の受動態の作り方を教えて") is not None
+
+        now = time.time()
+        monkeypatch.setattr(time, 'time', lambda: now + 120)
+        assert cache.lookup("英語の受動態の作り方を教えて") is None
+        reloaded = ReportCache(path=path, ttl=60)
+        assert len(reloaded) == 0
+        with open(path, encoding='utf-8') as f:
+            assert f.read() == ""
+
+    def test_compaction(self, tmp_path, monkeypatch):
+        """削除済みの行が溜まったら、保持しているレポートだけでファイルを書き直すことのテスト"""
+        monkeypatch.setattr(ReportCache, 'COMPACT_MIN_LINES', 4)
+        path = str(tmp_path / "report_cache.jsonl")
+        cache = ReportCache(path=path, max_entries=2)
+        for query in ["英語の前置詞の使い方", "英語の受動態の作り方", "英語の仮定法の使い方",
+                      "英語の比較級の使い方", "英語の関係代名詞の使い方"]:
+            cache.store(_result(query, ""))
+        with open(path, encoding='utf-8') as f:
+            assert len(f.readlines()) <= 4
+        reloaded = ReportCache(path=path)
+        assert len(reloaded) == 2
+        assert reloaded.lookup("英語の関係代名詞の使い方") is not None
+
+    def test_index_keeps_only_signature_and_plan(self, tmp_path):
+        """永続化ファイルを使うときは、索引にレポート本体を持たずヒット時にファイルから読むことのテスト"""
+        path = str(tmp_path / "report_cache.jsonl")
+        cache = ReportCache(path=path)
+        result = dict(_result("英語の受動態の作り方を説明して", "受動態 作り方"), plan={'max_topics': 2})
+        cache.store(result)
+        assert all('result' not in entry for entry in cache._entries.values())
+
+        plans = []
+        hit = cache.lookup("英語の受動態の作り方を教えて", accept=lambda cached: plans.append(cached) or True)
+        assert plans and all(cached == {'plan': {'max_topics': 2}} for cached in plans)
+        assert hit['result'] == result
+
+    def test_stale_offset_is_a_miss(self, tmp_path):
+        """他のプロセスがファイルを書き換えて行が見つからないときは、ミスにして索引から除くことのテスト"""
+        path = str(tmp_path / "report_cache.jsonl")
+        cache = ReportCache(path=path)
+        cache.store(_result("英語の受動態の作り方を説明して", "受動態 作り方"))
+        with open(path, 'w', encoding='utf-8'):
+            pass
+        assert cache.lookup("英語の受動態の作り方を教えて") is None
+        assert len(cache) == 0
+
+    def test_background_load(self, tmp_path):
+        """索引の再構築を別スレッドで行えることのテスト"""
+        path = str(tmp_path / "report_cache.jsonl")
+        ReportCache(path=path).store(_result("英語の受動態の作り方を説明して", "受動態 作り方"))
+
+        reloaded = ReportCache(path=path, background_load=True)
+        assert reloaded._loaded.wait(5)
+        assert reloaded.lookup("英語の受動態の作り方を教えて") is not None
+
+    def test_compaction_keeps_other_writers_lines(self, tmp_path, monkeypatch):
+        """書き直しは他のプロセスが追記した行を落とさないことのテスト"""
+        monkeypatch.setattr(ReportCache, 'COMPACT_MIN_LINES', 4)
+        monkeypatch.setattr(ReportCache, 'COMPACT_RATIO', 1)
+        path = str(tmp_path / "report_cache.jsonl")
+        writer_a = ReportCache(path=path, max_entries=3)
+        writer_b = ReportCache(path=path, max_entries=3)
+        for _ in range(4):
+            writer_a.store(_result("英語の前置詞の使い方", ""))
+        writer_b.store(_result("英語の受動態の作り方", ""))
+        # 5行目の追記で writer_a が書き直す
+        writer_a.store(_result("英語の前置詞の使い方", ""))
+
+        with open(path, encoding='utf-8') as f:
+            assert len(f.readlines()) <= 3
+        assert ReportCache(path=path).lookup("英語の受動態の作り方") is not None
+        assert list(tmp_path.glob("*.tmp")) == []
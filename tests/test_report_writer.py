@@ -0,0 +1,183 @@
+import pytest
+
+
+@pytest.fixture
+def writer(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+    from src.report_writer import ReportWriter
+    return ReportWriter()
+
+
+class TestReportWriter:
+    """ReportWriterのプロンプトの組み立てのテストクラス"""
+
+    def test_body_gets_only_cited_sources(self, writer):
+        """本文にはアウトラインで引用された情報源だけを、元の番号のまま渡すことのテスト"""
+        sources = {f"topic {i}": f"result {i}" for i in range(1, 6)}
+        text = writer.cited_sources_text("# 比較級\n## 形\n[4][2]\n## 用法\n[4][99]", sources)
+        assert text == "[2] Topic: topic 2\nResult: result 2\n\n[4] Topic: topic 4\nResult: result 4"
+        # 引用のないアウトライン（フォールバック）では全件を渡す
+        assert writer.cited_sources_text("# 比較級\n## 形", sources).count("Topic:") == 5
+
+    def test_conclusion_digest(self, writer):
+        """結論には見出しと各節の最初の文だけを、引用番号を除いて渡すことのテスト"""
+        body = ("## 1. 形\n比較級は-erを付けます[1]。長い語はmoreを使います[2]。\n"
+                "- **例外**: goodはbetterになります。\n- 三つ目の項目です。\n"
+                "## 2. 用法\n" + "とても長い説明" * 30 + "。\n")
+        digest = writer.build_digest("# 比較級", "リード文です。", body)
+        assert digest.splitlines() == [
+            "# 比較級", "", "リード文です。", "",
+            "## 1. 形", "- 比較級は-erを付けます。", "- **例外**: goodはbetterになります。",
+            "## 2. 用法", "- " + ("とても長い説明" * 30)[:writer.DIGEST_SENTENCE_CHARS] + "…",
+        ]
+        prompt = writer.build_conclusion_prompt(digest)
+        assert prompt[-1]['content'].endswith(digest)
+
+    def test_fallback_is_recorded(self, writer, monkeypatch):
+        """LLMが失敗して既定の文面を使ったステージを実行コンテキストに記録することのテスト"""
+        from src import run_context
+
+        def fail(prompt, **kwargs):
+            raise RuntimeError("insufficient_quota")
+        monkeypatch.setattr(writer.llm_client, 'generate_text', fail)
+        context = run_context.RunContext()
+        with run_context.run_scope(context):
+            sections = writer.write_sections("# 比較級\n## 1. 形", {}, "比較級", "比較級")
+        assert sections['lead'].startswith("この記事では")
+        assert context.fallback_stages == ['lead', 'body', 'related_topics', 'conclusion']
+
+
+BODY = ("## 1. 形\n比較級は-erを付けます[1]。\n\n"
+        "## 2. 用法\n### 比べる対象\nthanの後に比べる対象を置きます[2]。\n\n"
+        "## 3. 注意点\nmoreとの併用は誤りです[3]。")
+OUTLINE = "# 比較級\n## 1. 形\n[1]\n## 2. 用法\n### 比べる対象\n[2][3]\n## 3. 注意点\n[3]"
+SOURCES = {f"topic {i}": f"result {i}" for i in range(1, 4)}
+
+
+@pytest.fixture
+def llm_calls(writer, monkeypatch):
+    calls = []
+
+    def generate_text(prompt, **kwargs):
+        calls.append(prompt)
+        return "## 2. 用法\n### 比べる対象\n書き直した本文です[3]。"
+    monkeypatch.setattr(writer.llm_client, 'generate_text', generate_text)
+    return calls
+
+
+class TestRegenerate:
+    """保存済みのパートから1つだけを作り直すことのテストクラス"""
+
+    def test_split_chapters(self):
+        """章ごとに分けてつなげ直すと元に戻ることのテスト"""
+        from src.report_writer import split_chapters
+        chapters = split_chapters("前置き\n" + BODY)
+        assert [heading for heading, _ in chapters] == ["", "1. 形", "2. 用法", "3. 注意点"]
+        assert "".join(text for _, text in chapters) == "前置き\n" + BODY
+
+    def test_regenerate_one_chapter(self, writer, llm_calls):
+        """1つの章だけをその章の情報源と追加の指示で作り直し、他の章はそのまま残すことのテスト"""
+        sections = {'title': "# 比較級", 'lead': "リード", 'body': BODY, 'related_topics': "", 'conclusion': "結論"}
+        updated = writer.regenerate('section', sections, OUTLINE, SOURCES, "比較級", "比較級",
+                                    section="2. 用法", instruction="例を増やしてください")
+        assert len(llm_calls) == 1
+        user_message = llm_calls[0][-1]['content']
+        assert "[2] Topic: topic 2" in user_message and "[1] Topic" not in user_message
+        assert user_message.endswith("【追加の指示】\n例を増やしてください")
+        assert updated['body'] == BODY.replace("thanの後に比べる対象を置きます[2]。", "書き直した本文です[3]。")
+        assert sections['body'] == BODY
+
+        with pytest.raises(ValueError):
+            writer.regenerate('section', sections, OUTLINE, SOURCES, "比較級", "比較級", section="4. 例外")
+
+    def test_orchestrator_marks_dependents_stale(self, writer, llm_calls, tmp_path, monkeypatch):
+        """作り直したステージの下流を古いものとして記録し、上流は作り直さないことのテスト"""
+        monkeypatch.setenv("REPORT_CACHE_PATH", str(tmp_path / "cache.jsonl"))
+        from src.pipeline_orchestrator import PipelineOrchestrator
+        orchestrator = PipelineOrchestrator()
+        orchestrator.writer = writer
+        sections = {'title': "# 比較級", 'lead': "リード", 'body': BODY, 'related_topics': "- 比較級",
+                    'conclusion': "結論"}
+        result = {'query': "比較級", 'refined_query': "比較級", 'report': writer.assemble_sections(sections, SOURCES),
+                  'mindmap': {'name': "比較級", 'children': []}, 'processing_time': 30.0,
+                  'artifacts': {'outline': OUTLINE, 'sources': SOURCES, 'sections': sections, 'stale': []}}
+
+        updated = orchestrator.regenerate(result, 'section', section="2. 用法")
+        assert len(llm_calls) == 1
+        # 結合したレポートでは引用番号が初出順に振り直される（topic 2 はもう引用されない）
+        assert "書き直した本文です[2]。" in updated['report'] and updated['report'].endswith("[2] topic 3")
+        assert updated['artifacts']['stale'] == ['conclusion', 'mindmap']
+        assert updated['mindmap'] == result['mindmap'] and updated['processing_time'] == 30.0
+        assert updated['regenerated']['stage'] == 'section'
+        assert result['artifacts']['stale'] == []
+
+        monkeypatch.setattr(writer.llm_client, 'generate_text', lambda prompt, **kwargs: "新しい結論です。")
+        updated = orchestrator.regenerate(updated, 'conclusion')
+        assert updated['report'].split("## 結論\n")[1].startswith("新しい結論です。")
+        assert updated['artifacts']['stale'] == ['mindmap']
+
+        with pytest.raises(ValueError):
+            orchestrator.regenerate(updated, 'outline')
+        with pytest.raises(ValueError):
+            orchestrator.regenerate({**result, 'artifacts': {}}, 'lead')
+
+    def test_regenerate_skips_response_cache(self, writer, tmp_path, monkeypatch):
+        """追加の指示がなくても、作り直すたびにLLMを呼び出すことのテスト"""
+        from types import SimpleNamespace
+        from src.cache_backend import MemoryBackend, NamespacedCache
+        from src.pipeline_orchestrator import PipelineOrchestrator
+        monkeypatch.setenv("REPORT_CACHE_PATH", str(tmp_path / "cache.jsonl"))
+        calls = []
+
+        def create(**kwargs):
+            calls.append(kwargs)
+            message = SimpleNamespace(content=f"リード{len(calls)}")
+            return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+        writer.llm_client.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+        writer.llm_client.response_cache = NamespacedCache(MemoryBackend(), 'llm')
+        orchestrator = PipelineOrchestrator()
+        orchestrator.writer = writer
+        sections = {'title': "# 比較級", 'lead': "リード", 'body': BODY, 'related_topics': "", 'conclusion': "結論"}
+        result = {'query': "比較級", 'refined_query': "比較級", 'report': writer.assemble_sections(sections, SOURCES),
+                  'mindmap': {}, 'processing_time': 1.0,
+                  'artifacts': {'outline': OUTLINE, 'sources': SOURCES, 'sections': sections, 'stale': []}}
+
+        first = orchestrator.regenerate(result, 'lead')
+        second = orchestrator.regenerate(result, 'lead')
+        assert len(calls) == 2
+        assert first['artifacts']['sections']['lead'] != second['artifacts']['sections']['lead']
+
+    @pytest.mark.parametrize("stage, section", [('lead', None), ('section', "2. 用法"), ('mindmap', None)])
+    def test_failed_regeneration_keeps_stored_part(self, writer, tmp_path, monkeypatch, stage, section):
+        """作り直しのLLM呼び出しが失敗したら、既定の文面で上書きせずにエラーにすることのテスト"""
+        from src.pipeline_orchestrator import PipelineOrchestrator, RegenerationError
+        monkeypatch.setenv("REPORT_CACHE_PATH", str(tmp_path / "cache.jsonl"))
+
+        def fail(prompt, **kwargs):
+            raise RuntimeError("insufficient_quota")
+        monkeypatch.setattr(writer.llm_client, 'generate_text', fail)
+        monkeypatch.setattr(writer.llm_client, 'generate_json', fail)
+        orchestrator = PipelineOrchestrator()
+        orchestrator.writer = writer
+        orchestrator.mindmap_generator.llm_client = writer.llm_client
+        sections = {'title': "# 比較級", 'lead': "リード", 'body': BODY, 'related_topics': "", 'conclusion': "結論"}
+        result = {'query': "比較級", 'refined_query': "比較級", 'report': writer.assemble_sections(sections, SOURCES),
+                  'mindmap': {'name': "比較級", 'children': []}, 'processing_time': 1.0,
+                  'artifacts': {'outline': OUTLINE, 'sources': SOURCES, 'sections': sections, 'stale': []}}
+
+        with pytest.raises(RegenerationError):
+            orchestrator.regenerate(result, stage, section=section)
+        assert result['artifacts']['sections'] == sections and result['mindmap']['name'] == "比較級"
+
+    def test_successful_regeneration_clears_fallback(self, writer, llm_calls, tmp_path, monkeypatch):
+        """作り直せたステージは fallback_stages から外すことのテスト"""
+        from src.pipeline_orchestrator import PipelineOrchestrator
+        monkeypatch.setenv("REPORT_CACHE_PATH", str(tmp_path / "cache.jsonl"))
+        orchestrator = PipelineOrchestrator()
+        orchestrator.writer = writer
+        sections = {'title': "# 比較級", 'lead': "リード", 'body': BODY, 'related_topics': "", 'conclusion': "結論"}
+        result = {'query': "比較級", 'refined_query': "比較級", 'report': writer.assemble_sections(sections, SOURCES),
+                  'mindmap': {}, 'processing_time': 1.0, 'fallback_stages': ['body', 'conclusion'],
+                  'artifacts': {'outline': OUTLINE, 'sources': SOURCES, 'sections': sections, 'stale': []}}
+        updated = orchestrator.regenerate(result, 'conclusion')
+        assert updated['fallback_stages'] == ['body']
@@ -0,0 +1,53 @@
+import pytest
+from src import settings
+from src.llm_client import LLMClient
+
+
+class TestSettings:
+    """設定ファイル読み込みのテストクラス"""
+
+    def test_load_repository_settings(self):
+        """リポジトリの設定ファイルにLLMのルーティングが定義されていることのテスト"""
+        llm = settings.load_settings(path=settings.DEFAULT_SETTINGS_PATH)['llm']
+        assert 'default' in llm
+        assert 'refine' in llm['stages']
+
+    def test_missing_file_returns_empty(self, tmp_path):
+        """設定ファイルがなければ空の辞書になることのテスト"""
+        assert settings.load_settings(path=str(tmp_path / "missing.yaml")) == {}
+
+    def test_non_mapping_is_rejected(self, tmp_path):
+        """辞書でない設定ファイルがエラーになることのテスト"""
+        path = tmp_path / "settings.yaml"
+        path.write_text("- a\n- b\n", encoding='utf-8')
+        with pytest.raises(ValueError):
+            settings.load_settings(path=str(path))
+
+
+class TestModelRouting:
+    """LLMClientのステージ別ルーティングのテストクラス"""
+
+    def setup_method(self):
+        """各テストメソッドの前に実行されるセットアップ"""
+        self.client = object.__new__(LLMClient)
+        self.client.model = "big-model"
+        self.client.default_route = {'max_tokens': 2000, 'temperature': 0.7}
+        self.client.stage_routes = {
+            'refine': {'model': 'small-model', 'max_tokens': 400, 'temperature': 0.2},
+            'body': {'max_tokens': 3500},
+        }
+
+    def test_stage_route_wins(self):
+        """ステージ設定が呼び出し側の指定より優先されることのテスト"""
+        route = self.client.resolve_route('refine', max_tokens=500, temperature=0.3)
+        assert (route.model, route.max_tokens, route.temperature) == ('small-model', 400, 0.2)
+
+    def test_partial_stage_route(self):
+        """一部だけ設定したステージでは残りを呼び出し側の指定で補うことのテスト"""
+        route = self.client.resolve_route('body', max_tokens=3000, temperature=0.5)
+        assert (route.model, route.max_tokens, route.temperature) == ('big-model', 3500, 0.5)
+
+    def test_default_route(self):
+        """未設定のステージでは既定値を使うことのテスト"""
+        route = self.client.resolve_route(None)
+        assert (route.model, route.max_tokens, route.temperature) == ('big-model', 2000, 0.7)
@@ -0,0 +1,53 @@
+import json
+import queue
+import logging
+from src.run_context import RunContext, run_scope
+from src.structured_logging import JsonFormatter, NonBlockingQueueHandler, RunContextFilter, SamplingFilter
+
+
+def _record(message="hello", level=logging.INFO, name="src.test", **extra):
+    record = logging.LogRecord(name, level, __file__, 1, message, None, None)
+    for key, value in extra.items():
+        setattr(record, key, value)
+    return record
+
+
+class TestStructuredLogging:
+    """構造化ログのテストクラス"""
+
+    def test_run_context_fields(self):
+        """実行中のパイプラインのrun_idとステージがログに付くことのテスト"""
+        context = RunContext()
+        context.stage = "outline"
+        record = _record()
+        with run_scope(context):
+            RunContextFilter().filter(record)
+        entry = json.loads(JsonFormatter().format(record))
+        assert entry['run_id'] == context.run_id
+        assert entry['stage'] == "outline"
+        assert entry['message'] == "hello"
+
+    def test_payload_cap(self):
+        """長いメッセージと構造化フィールドを切り詰めることのテスト"""
+        record = _record("x" * 500, outline="y" * 500, topic_count=3)
+        RunContextFilter(max_payload_chars=100).filter(record)
+        entry = json.loads(JsonFormatter().format(record))
+        assert entry['message'].startswith("x" * 100) and entry['message'].endswith("(+400 chars)")
+        assert len(entry['outline']) < 150
+        assert entry['topic_count'] == 3
+
+    def test_sampling_keeps_warnings(self):
+        """INFO以下は割合で間引き、WARNING以上は常に残すことのテスト"""
+        sampling = SamplingFilter({'src.external_api_client': 0.0, 'src': 1.0})
+        assert not sampling.filter(_record(name="src.external_api_client"))
+        assert sampling.filter(_record(name="src.external_api_client", level=logging.WARNING))
+        assert sampling.filter(_record(name="src.llm_client"))
+        assert sampling.rate_for("src.external_api_clientx") == 1.0
+
+    def test_full_queue_drops_without_blocking(self):
+        """キューが満杯のときは待たずに捨てることのテスト"""
+        handler = NonBlockingQueueHandler(queue.Queue(maxsize=1))
+        handler.handle(_record("first"))
+        handler.handle(_record("second"))
+        assert handler.queue.qsize() == 1
+        assert handler.dropped == 1
@@ -0,0 +1,141 @@
+from types import SimpleNamespace
+import pytest
+from src.structured_output import (
+    IncrementalJSONParser, StructuredOutputError, parse_json, repair_json, strip_code_fences, validate
+)
+from src.mindmap_generator import MINDMAP_SCHEMA
+
+
+class TestRepair:
+    """JSON修復のテストクラス"""
+
+    def test_strip_code_fences(self):
+        """コードフェンスと後ろの文章が取り除かれることのテスト"""
+        text = 'はい、どうぞ。\n```json\n{"name": "A"}\n```\n以上です。'
+        assert strip_code_fences(text).strip() == '{"name": "A"}'
+        assert parse_json(text) == {"name": "A"}
+
+    def test_trailing_comma_and_prose(self):
+        """末尾のカンマや後続の文章があっても解釈できることのテスト"""
+        assert parse_json('{"topics": ["a", "b",],} Hope this helps!') == {"topics": ["a", "b"]}
+
+    @pytest.mark.parametrize("text,expected", [
+        ('{"name": "A", "children": [{"name": "B", "chi', {"name": "A", "children": [{"name": "B"}]}),
+        ('{"topics": ["比較級", "最上', {"topics": ["比較級", "最上"]}),
+        ('{"a": 1, "b": tru', {"a": 1}),
+        ('{"a": 1, "b":', {"a": 1}),
+        ('{"a": "x\\', {"a": "x"}),
+    ])
+    def test_close_truncated_output(self, text, expected):
+        """途中で切れた出力が閉じられることのテスト"""
+        assert parse_json(text) == expected
+
+    def test_no_json(self):
+        """JSONを含まない出力は元のテキスト付きで例外になることのテスト"""
+        with pytest.raises(StructuredOutputError) as excinfo:
+            repair_json("- topic 1\n- topic 2")
+        assert excinfo.value.text == "- topic 1\n- topic 2"
+
+
+class TestIncrementalJSONParser:
+    """IncrementalJSONParserのテストクラス"""
+
+    def test_partial_values_while_streaming(self):
+        """チャンクごとに途中の値を取り出せることのテスト"""
+        parser = IncrementalJSONParser()
+        chunks = ['```json\n{"na', 'me": "Root", "chil', 'dren": [{"name": "A"}, {"name": "B', '"}]}\n```']
+        partials = []
+        for chunk in chunks:
+            parser.feed(chunk)
+            partials.append(parser.partial())
+
+        assert partials[0] == {}
+        assert partials[1] == {"name": "Root"}
+        assert partials[2] == {"name": "Root", "children": [{"name": "A"}, {"name": "B"}]}
+        assert parser.complete
+        assert partials[3] == {"name": "Root", "children": [{"name": "A"}, {"name": "B"}]}
+
+
+class TestValidate:
+    """スキーマ検証のテストクラス"""
+
+    def test_valid_mindmap(self):
+        data = {"name": "Root", "children": [{"name": "A", "children": [{"name": "A1"}]}]}
+        assert validate(data, MINDMAP_SCHEMA) == []
+
+    def test_invalid_nested_node(self):
+        """ネストしたノードのエラーがパス付きで報告されることのテスト"""
+        data = {"name": "Root", "children": [{"children": []}, "B"]}
+        errors = validate(data, MINDMAP_SCHEMA)
+        assert "$.children[0]: missing required property 'name'" in errors
+        assert "$.children[1]: expected object, got str" in errors
+
+    def test_parse_json_with_schema(self):
+        with pytest.raises(StructuredOutputError):
+            parse_json('{"title": "x"}', MINDMAP_SCHEMA)
+
+
+def _chunk(text=None, usage=None):
+    choices = [SimpleNamespace(delta=SimpleNamespace(content=text))] if text is not None else []
+    return SimpleNamespace(choices=choices, usage=usage)
+
+
+class _FakeCompletions:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.requests = []
+
+    def create(self, **request):
+        self.requests.append(request)
+        return iter(self.chunks)
+
+
+class TestGenerateJson:
+    """LLMClient.generate_jsonのテストクラス"""
+
+    def _client(self, monkeypatch, chunks):
+        monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+        from src.llm_client import LLMClient
+        client = LLMClient()
+        completions = _FakeCompletions(chunks)
+        client.client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+        return client, completions
+
+    def test_json_mode_and_fenced_output(self, monkeypatch):
+        """JSONモードを指定し、コードフェンス付きの応答を解釈することのテスト"""
+        chunks = [_chunk('```json\n{"topics": '), _chunk('["a", "b"]}\n```'),
+                  _chunk(usage=SimpleNamespace(prompt_tokens=10, completion_tokens=5))]
+        client, completions = self._client(monkeypatch, chunks)
+        data = client.generate_json("トピックを挙げて", stage="expand")
+
+        assert data == {"topics": ["a", "b"]}
+        request = completions.requests[0]
+        assert request['response_format'] == {"type": "json_object"}
+        assert request['stream'] is True
+        assert "JSON" in request['messages'][0]['content']
+
+    def test_truncated_output_is_recovered(self, monkeypatch):
+        """max_tokensで切れた応答も受信済みの部分を使うことのテスト"""
+        chunks = [_chunk('{"name": "Root", "children": [{"name": "A"}, {"na')]
+        client, _ = self._client(monkeypatch, chunks)
+        data = client.generate_json("マインドマップ", schema=MINDMAP_SCHEMA, stage="mindmap")
+        assert data == {"name": "Root", "children": [{"name": "A"}]}
+
+    def test_only_deterministic_calls_are_cached(self, monkeypatch):
+        """temperatureが0の呼び出しと設定したステージだけ応答をキャッシュすることのテスト"""
+        from src.cache_backend import MemoryBackend, NamespacedCache
+        chunks = [_chunk('{"topics": ["a"]}')]
+        client, completions = self._client(monkeypatch, chunks)
+        client.response_cache = NamespacedCache(MemoryBackend(), 'llm')
+
+        for _ in range(2):
+            client.generate_json("トピックを挙げて", stage="expand")
+        assert len(completions.requests) == 1
+
+        for _ in range(2):
+            client.generate_json("リード文", stage="lead")
+        assert len(completions.requests) == 3
+
+        for _ in range(2):
+            client.generate_json("まとめ", temperature=0)
+        assert len(completions.requests) == 4
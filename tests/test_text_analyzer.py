@@ -0,0 +1,104 @@
+import pytest
+from src.text_analyzer import (VocabularyIndex, analyze_passage, build_index, count_syllables, format_facts,
+                               get_vocabulary, reset_vocabulary)
+
+
+@pytest.fixture
+def index(tmp_path):
+    seed = tmp_path / "seed.tsv"
+    seed.write_text("# lemma\tlevel\nthe\tA1\ncat\tA1\nrun\tA1\nbe\tA1\nhappy\tA1\nstudy\tA2\n"
+                    "stop\tA2\nbig\tA1\nwith\tA1\nsustainable\tB2\nhappy\tB1\nbroken entry\n", encoding="utf-8")
+    path = str(tmp_path / "index.bin")
+    assert build_index(str(seed), path) == 10
+    index = VocabularyIndex(path)
+    yield index
+    index.close()
+
+
+class TestVocabularyIndex:
+    """語彙の索引のテストクラス"""
+
+    def test_lookup(self, index):
+        """見出し語を引き、重複した語は低いレベルを使うことのテスト"""
+        assert len(index) == 10
+        assert index.get("sustainable") == "B2"
+        assert index.get("happy") == "A1"
+        assert index.get("zebra") is None
+        assert index.get("a") is None
+
+    @pytest.mark.parametrize("word, level", [
+        ("cats", "A1"), ("studied", "A2"), ("studies", "A2"), ("running", "A1"), ("stopped", "A2"),
+        ("bigger", "A1"), ("was", "A1"), ("happily", "A1"), ("Cat's", "A1"),
+    ])
+    def test_inflected_forms(self, index, word, level):
+        """活用形・派生形を見出し語に戻して引くことのテスト"""
+        assert index.level(word) == level
+
+    def test_rejects_other_files(self, tmp_path):
+        """索引でないファイルは開かないことのテスト"""
+        path = tmp_path / "other.bin"
+        path.write_bytes(b"not an index at all")
+        with pytest.raises(ValueError):
+            VocabularyIndex(str(path))
+
+    def test_shared_index_is_rebuilt_from_seed(self, tmp_path, monkeypatch):
+        """共有の索引は、なければ語彙レベル表から作ることのテスト"""
+        seed = tmp_path / "seed.tsv"
+        seed.write_text("cat\tA1\n", encoding="utf-8")
+        monkeypatch.setattr("src.text_analyzer.get_section", lambda name: {
+            'seed_path': str(seed), 'index_path': str(tmp_path / "cache" / "index.bin")})
+        reset_vocabulary()
+        try:
+            assert get_vocabulary().get("cat") == "A1"
+        finally:
+            reset_vocabulary()
+
+
+class TestPassageAnalysis:
+    """英文の計測のテストクラス"""
+
+    def test_counts_and_levels(self, index):
+        """語数・文の長さ・レベルの分布・リスト外の語を数えることのテスト"""
+        analysis = analyze_passage("The cat is running with Ken. The cat studied sustainable zebras!", index=index)
+        assert (analysis['words'], analysis['sentences']) == (11, 2)
+        assert analysis['max_sentence_length'] == 6
+        # 文中の大文字の語（Ken）は固有名詞として分布に入れない
+        assert analysis['proper_nouns'] == 1
+        assert analysis['unlisted_words'] == ["zebras"]
+        distribution = analysis['level_distribution']
+        assert distribution['A1'] == pytest.approx(7 / 10, abs=1e-3)
+        assert distribution['unlisted'] == pytest.approx(1 / 10, abs=1e-3)
+        assert analysis['estimated_level'] == 'C2+'
+
+    def test_estimated_level(self, index):
+        """語のカバー率から語彙の目安のレベルを決めることのテスト"""
+        analysis = analyze_passage("The big cat is happy. The cat studies.", index=index, coverage=0.8)
+        assert analysis['estimated_level'] == 'A1'
+        assert analyze_passage("The big cat is happy. The cat studies.", index=index,
+                               coverage=1.0)['estimated_level'] == 'A2'
+
+    def test_syllables(self):
+        """音節数の概算のテスト"""
+        assert [count_syllables(word) for word in ("cat", "believe", "table", "rapidly", "the")] == [1, 2, 2, 3, 1]
+
+    def test_facts_in_body_prompt(self, index, monkeypatch):
+        """計測値を本文のプロンプトに埋め込むことのテスト"""
+        monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+        from src.report_writer import ReportWriter
+        facts = format_facts(analyze_passage("The big cat is happy. The cat studies.", index=index))
+        assert "語数: 8語・2文" in facts
+
+        writer = ReportWriter()
+        prompt = writer.build_body_prompt("# タイトル", "[1] Topic: t\nResult: r", "クエリ", facts)
+        assert "【英文の計測値】\n" + facts in prompt[-1]['content']
+        assert "【英文の計測値】" not in writer.build_body_prompt("# タイトル", "", "クエリ")[-1]['content']
+        assert format_facts(None) == ""
+
+    def test_approximate_levels_are_labelled(self, index):
+        """出典のない初期リストの語彙レベルは、概算と明記することのテスト"""
+        analysis = analyze_passage("The big cat is happy. The cat studies.", index=index)
+        approximate = format_facts(analysis)
+        assert "語彙レベル（CEFR）の分布（概算）" in approximate
+        assert "断定しないでください" in approximate
+        sourced = format_facts(analysis, approximate=False)
+        assert "概算" not in sourced
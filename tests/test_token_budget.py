@@ -0,0 +1,68 @@
+import pytest
+from src import token_budget
+from src.prompt_templates import get_template
+from src.token_budget import (
+    ContextWindowExceeded, context_window, count_tokens, fit_values, preflight, trim_blocks
+)
+
+
+@pytest.fixture(autouse=True)
+def heuristic_counting(monkeypatch):
+    """tiktokenの有無でテスト結果が変わらないよう概算で数える"""
+    monkeypatch.setattr(token_budget, "tiktoken", None)
+    token_budget._encoding.cache_clear()
+    yield
+    token_budget._encoding.cache_clear()
+
+
+class TestTokenBudget:
+    """トークン数の計測と事前確認のテストクラス"""
+
+    def test_count_heuristic(self):
+        """ASCIIは4文字で1トークン、日本語は1文字1トークンで数えることのテスト"""
+        assert count_tokens("") == 0
+        assert count_tokens("abcdefgh") == 2
+        assert count_tokens("比較級") == 3
+
+    def test_context_window_prefix(self):
+        """モデル名の前方一致で最長のものを使うことのテスト"""
+        assert context_window("gpt-4o-mini") == 128000
+        assert context_window("gpt-4-32k-0613") == 32768
+        assert context_window("gpt-4-0613") == 8192
+        assert context_window("unknown-model") == token_budget.DEFAULT_CONTEXT_WINDOW
+
+    def test_trim_blocks_is_fair(self):
+        """短いブロックは残し、長いブロックの先頭を残して切り詰めることのテスト"""
+        blocks = ["[1] short", "[2] " + "a" * 400, "[3] " + "b" * 400]
+        trimmed = trim_blocks("\n\n".join(blocks), 100).split("\n\n")
+        assert count_tokens("\n\n".join(trimmed)) <= 100
+        assert trimmed[0] == "[1] short"
+        assert trimmed[1].startswith("[2] a") and trimmed[1].endswith(token_budget.TRUNCATION_MARK)
+        assert trimmed[2].startswith("[3] b")
+        assert abs(count_tokens(trimmed[1]) - count_tokens(trimmed[2])) <= 1
+
+    def test_fit_values_trims_only_trimmable(self):
+        """予算を超える場合は指定した値だけを切り詰めることのテスト"""
+        template = get_template('body')
+        search_results_text = "\n\n".join(f"[{i}] " + "検索結果" * 500 for i in range(1, 6))
+        fitted = fit_values(template.render,
+                            {'search_results_text': search_results_text, 'outline': "# 比較級",
+                             'refined_query': "比較級", 'passage_facts': ""},
+                            ('search_results_text',), "gpt-4o-mini", 3000, max_prompt_tokens=4000)
+        assert fitted['prompt_tokens'] <= 4000
+        assert fitted['trimmed_tokens'] > 0
+        assert fitted['values']['outline'] == "# 比較級"
+        assert fitted['values']['search_results_text'].count("[") == 5
+
+    def test_preflight_reduces_completion(self):
+        """出力枠を削れば収まる場合は出力枠を減らすことのテスト"""
+        messages = [{'role': 'user', 'content': "あ" * 6000}]
+        checked = preflight(messages, "gpt-4", 2000)
+        assert checked['prompt_tokens'] == 6004
+        assert checked['max_tokens'] == 8192 - 6004 - token_budget.SAFETY_MARGIN_TOKENS
+
+    def test_preflight_raises_when_too_long(self):
+        """出力枠を削っても収まらなければ送信前に例外を送出することのテスト"""
+        messages = [{'role': 'user', 'content': "あ" * 8000}]
+        with pytest.raises(ContextWindowExceeded):
+            preflight(messages, "gpt-4", 2000)
@@ -0,0 +1,86 @@
+import threading
+import time
+import pytest
+from src.cache_backend import MemoryBackend, reset_cache
+from src.job_queue import JobStore, DONE
+from src.warmup import Warmup
+
+
+class FakeOrchestrator:
+    """呼ばれたクエリを記録し、2回目以降はキャッシュに当たったことにするオーケストレーター"""
+
+    def __init__(self):
+        self.runs = []
+        self.cached = set()
+
+    def run(self, query, background=False, **kwargs):
+        self.runs.append((query, background))
+        if query == "失敗するクエリ":
+            return {'report': "# エラーが発生しました", 'cache': {'hit': False}, 'error': "boom"}
+        hit = query in self.cached
+        self.cached.add(query)
+        return {'report': f"# {query}", 'cache': {'hit': hit}}
+
+
+def make_warmup(orchestrator, **kwargs):
+    settings = {'start_delay': 0, 'idle_poll': 0.01, 'sample_kinds': ['general'], 'recent_queries': 2}
+    return Warmup(lambda: orchestrator, settings=settings, **kwargs)
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache():
+    reset_cache(MemoryBackend())
+    yield
+    reset_cache()
+
+
+class TestWarmup:
+    """Warmupのテストクラス"""
+
+    def test_samples_and_recent_queries(self, tmp_path):
+        """サンプルクエリと最近よく使われたクエリを重複なく、低優先度で生成することのテスト"""
+        store = JobStore(str(tmp_path / "jobs.db"))
+        for query in ["関係代名詞", "関係代名詞", "英語の仮定法の使い方を教えて", "不定詞"]:
+            store.update(store.create(query, {}), status=DONE)
+        orchestrator = FakeOrchestrator()
+        warmup = make_warmup(orchestrator, recent_queries=store.frequent_queries)
+
+        queries = warmup.queries()
+        assert queries[0] == "英語の比較級と最上級の使い方を教えて"
+        # 回数が同じなら新しいものから上位2件
+        assert queries[5:] == ["関係代名詞", "不定詞"]
+        assert len(queries) == len(set(queries)) == 7
+
+        results = warmup.run()
+        assert results == {'warmed': 7, 'cached': 0, 'failed': 0, 'skipped': 0}
+        assert all(background for _, background in orchestrator.runs)
+
+    def test_waits_for_live_requests(self):
+        """ライブのリクエストがある間は始めないことのテスト"""
+        busy = threading.Event()
+        busy.set()
+        orchestrator = FakeOrchestrator()
+        warmup = make_warmup(orchestrator, is_busy=busy.is_set)
+        thread = threading.Thread(target=warmup.run)
+        thread.start()
+        time.sleep(0.1)
+        assert orchestrator.runs == []
+
+        busy.clear()
+        thread.join(timeout=5)
+        assert len(orchestrator.runs) == 5
+
+    def test_claimed_queries_are_skipped(self):
+        """他のレプリカが担当したクエリは生成しないことのテスト"""
+        orchestrator = FakeOrchestrator()
+        make_warmup(orchestrator).run()
+        results = make_warmup(orchestrator).run()
+        assert results['skipped'] == 5
+        assert len(orchestrator.runs) == 5
+
+    def test_failed_query_releases_claim(self):
+        """失敗したクエリは担当を外し、次のウォームアップで再挑戦することのテスト"""
+        orchestrator = FakeOrchestrator()
+        warmup = make_warmup(orchestrator, recent_queries=lambda since, limit: ["失敗するクエリ"])
+        assert warmup.run()['failed'] == 1
+        assert make_warmup(orchestrator, recent_queries=lambda since, limit: ["失敗するクエリ"]).run()['failed'] == 1